@@ -6,6 +6,9 @@ from sqlmodel import select
 
 from grpc_config.inventory_utils import get_mo_with_params_for_tmo_id_by_grpc
 from schemas.hier_schemas import Level, Obj
+from services.hierarchy.hierarchy_builder.utils import (
+    create_path_for_children_node_by_parent_node,
+)
 
 DEFAULT_KEY_OF_NULL_NODE = "Null"
 
@@ -208,6 +211,9 @@ class HierarchyBuilder:
                         parent_id=parent_node.id
                         if parent_node is not None
                         else None,
+                        path=create_path_for_children_node_by_parent_node(
+                            parent_node
+                        ),
                         level_id=level.id,
                     )
                     self.db_session.add(new_node)
@@ -260,6 +266,9 @@ class HierarchyBuilder:
                     parent_id=parent_node.id
                     if parent_node is not None
                     else None,
+                    path=create_path_for_children_node_by_parent_node(
+                        parent_node
+                    ),
                     level_id=level.id,
                 )
                 self.db_session.add(new_node)
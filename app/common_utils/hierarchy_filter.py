@@ -20,7 +20,11 @@ from grpc_config.protobuf.mo_info_pb2 import (
 )
 from grpc_config.search.client import SearchClient
 from models import FilterColumn
-from schemas.hier_schemas import Hierarchy, Level, Obj
+from schemas.hier_schemas import Level, Obj
+from services.hierarchy.metadata.cache import (
+    HierarchyMetadata,
+    hierarchy_metadata_cache,
+)
 
 
 async def check_if_node_match_condition_for_real_node(
@@ -147,30 +151,25 @@ class HierarchyFilter:
     def parent_node_id(self):
         return self._parent_node_id
 
+    async def get_hierarchy_metadata(self) -> HierarchyMetadata | None:
+        """Returns cached hierarchy and levels, so levels are not selected
+        for every step of search"""
+        return await hierarchy_metadata_cache.get(
+            self.hierarchy_id, self.session
+        )
+
     async def get_hierarchy(self):
-        if self._hierarchy is None:
-            stmt = select(Hierarchy).where(Hierarchy.id == self.hierarchy_id)
-            res = await self.session.execute(stmt)
-            self._hierarchy = res.scalars().first()
-            return self._hierarchy
-        if self._hierarchy.id != self.hierarchy_id:
-            stmt = select(Hierarchy).where(Hierarchy.id == self.hierarchy_id)
-            res = await self.session.execute(stmt)
-            self._hierarchy = res.scalars().first()
-            return self._hierarchy
+        if self._hierarchy is None or self._hierarchy.id != self.hierarchy_id:
+            metadata = await self.get_hierarchy_metadata()
+            self._hierarchy = metadata.hierarchy if metadata else None
+            self._levels_of_hierarchy = metadata.levels if metadata else []
         return self._hierarchy
 
     async def get_levels_of_hierarchy(self):
-        if self._levels_of_hierarchy is None:
-            stmt = select(Level).where(Level.hierarchy_id == self.hierarchy_id)
-            res = await self.session.execute(stmt)
-            self._levels_of_hierarchy = res.scalars().all()
-            return self._levels_of_hierarchy
-        if self._hierarchy.id != self.hierarchy_id:
-            stmt = select(Level).where(Level.hierarchy_id == self.hierarchy_id)
-            res = await self.session.execute(stmt)
-            self._levels_of_hierarchy = res.scalars().all()
-            return self._levels_of_hierarchy
+        if self._levels_of_hierarchy is None or (
+            self._hierarchy is None or self._hierarchy.id != self.hierarchy_id
+        ):
+            await self.get_hierarchy()
         return self._levels_of_hierarchy
 
     async def get_ids_of_levels_with_mo_link(self):
@@ -204,13 +203,10 @@ class HierarchyFilter:
 
     async def get_levels_with_current_tmo(self):
         """Returns levels for current hierarchy with particular tmo_id"""
-        levels_with_tmo = select(Level).where(
-            Level.object_type_id == self.tmo_id,
-            Level.hierarchy_id == self.hierarchy_id,
-        )
-        res = await self.session.execute(levels_with_tmo)
-        res = res.scalars().all()
-        return res
+        levels = await self.get_levels_of_hierarchy()
+        return [
+            level for level in levels if level.object_type_id == self.tmo_id
+        ]
 
     async def get_real_and_virtual_deepest_levels(self):
         """Returns dict with virtual and real Levels which has max Level.level and Level.object_type_id = self.tmo_id"""
@@ -232,9 +228,10 @@ class HierarchyFilter:
             obj.level_id for obj in virtual_nodes if not obj.object_id
         }
 
-        stmt = select(Level).where(Level.id.in_(virtual_levels_ids))
-        virtual_levels = await self.session.execute(stmt)
-        virtual_levels = virtual_levels.scalars().all()
+        levels = await self.get_levels_of_hierarchy()
+        virtual_levels = [
+            level for level in levels if level.id in virtual_levels_ids
+        ]
 
         for level in virtual_levels:
             mo_matched_condition_by_level = await get_mo_matched_condition(
@@ -436,12 +433,11 @@ class HierarchyFilter:
         """Returns mo_ids of node if node is match conditions, otherwise returns empty list"""
 
         # get node levels
-        stmt = select(Level).where(
-            Level.id.in_({node.level_id for node in path})
-        )
-        levels_cache = await self.session.execute(stmt)
+        metadata = await self.get_hierarchy_metadata()
         levels_cache = {
-            level.id: level for level in levels_cache.scalars().all()
+            node.level_id: metadata.levels_by_id[node.level_id]
+            for node in path
+            if node.level_id in metadata.levels_by_id
         }
 
         cache_parents = set()
@@ -534,9 +530,10 @@ class HierarchyFilter:
             children_nodes = children_nodes.scalars().all()
             return children_nodes
 
-        stmt = select(Level).where(Level.parent_id == self.parent_node.level_id)
-        first_child_levels = await self.session.execute(stmt)
-        first_child_levels = first_child_levels.scalars().all()
+        metadata = await self.get_hierarchy_metadata()
+        first_child_levels = metadata.get_child_levels(
+            [self.parent_node.level_id]
+        )
 
         # level caching
         if self.collect_data_cache:
@@ -636,9 +633,7 @@ class HierarchyFilter:
                     }
                 )
 
-            stmt = select(Level).where(Level.parent_id == level.id)
-            child_levels = await self.session.execute(stmt)
-            child_levels = child_levels.scalars().all()
+            child_levels = metadata.get_child_levels([level.id])
 
             result.extend(level_nodes)
 
@@ -988,13 +983,12 @@ class HierarchyFilter:
                     level.object_type_id
                 )
 
+        metadata = await self.get_hierarchy_metadata()
         order = []
         if level_pre_results:
             order.append(list(level_pre_results))
         for step in order:
-            stmt = select(Level).where(Level.parent_id.in_(step))
-            res = await self.session.execute(stmt)
-            res = res.scalars().all()
+            res = metadata.get_child_levels(step)
 
             if res:
                 [add_child_level_tmo_id_to_main_level(level) for level in res]
@@ -1020,9 +1014,12 @@ class HierarchyFilter:
 
         # virual levels which has one or more real children levels.
 
-        stmt = select(Level).where(Level.id.in_(level_node_dict))
-        virtual_levels = await self.session.execute(stmt)
-        virtual_levels = virtual_levels.scalars().all()
+        metadata = await self.get_hierarchy_metadata()
+        virtual_levels = [
+            metadata.levels_by_id[level_id]
+            for level_id in level_node_dict
+            if level_id in metadata.levels_by_id
+        ]
 
         self.level_cache.update({level.id: level for level in virtual_levels})
 
@@ -1,11 +1,12 @@
 """Node manipulator class"""
 
-from uuid import UUID
-
-from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from schemas.hier_schemas import Obj
+from services.node.common.ancestors import (
+    get_breadcrumbs_of_nodes,
+    get_short_chain_of_ancestors,
+)
 
 
 class NodeManipulator:
@@ -15,46 +16,17 @@ class NodeManipulator:
 
     async def get_short_chain_of_parent_nodes(self):
         """Looks for a path to the nearest parent with a different tmo
-        and returns ordered list of parent nodes for this node."""
-
-        async def recursive_find_parents(
-            parent_node_id: UUID, session: AsyncSession
-        ):
-            stm = select(Obj).where(Obj.id == parent_node_id)
-            parent = await session.execute(stm)
-            parent = parent.scalars().first()
-
-            if parent.object_id is not None:
-                return [parent]
-            else:
-                if parent.parent_id is not None:
-                    return [parent] + await recursive_find_parents(
-                        parent.parent_id, session
-                    )
-                else:
-                    return [parent]
-
-        if self.node.parent_id is None:
-            return []
-        else:
-            return await recursive_find_parents(
-                self.node.parent_id, self.session
-            )
+        and returns ordered list of parent nodes for this node.
+        Parent nodes are found by ids from path of current node in one query"""
+        return await get_short_chain_of_ancestors(self.node, self.session)
 
     async def get_full_chain_of_parent_nodes(self):
-        """Returns full breadcrumbs for current node"""
-
-        async def recursive_find_parent(node: Obj, session: AsyncSession):
-            if node is None:
-                return []
-            if node.parent_id is None:
-                return [node]
-            stmt = select(Obj).where(Obj.id == node.parent_id)
-            parent_node = await session.execute(stmt)
-            parent_node = parent_node.scalars().first()
-            return await recursive_find_parent(parent_node, session) + [node]
-
-        return await recursive_find_parent(self.node, self.session)
+        """Returns full breadcrumbs for current node.
+        Parent nodes are found by ids from path of current node in one query"""
+        if self.node is None:
+            return []
+        breadcrumbs = await get_breadcrumbs_of_nodes([self.node], self.session)
+        return breadcrumbs[self.node.id]
 
     async def delete_node(self):
         """Deletes current node and change child count for parent node.
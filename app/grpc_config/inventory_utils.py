@@ -8,9 +8,11 @@ from starlette.datastructures import QueryParams
 
 from grpc_config.protobuf import mo_info_pb2, mo_info_pb2_grpc
 from grpc_config.protobuf.mo_info_pb2_grpc import InformerStub
+from services.metrics.consumer import measure_inventory_grpc_time
 from settings import INVENTORY_GRPC_URL
 
 
+@measure_inventory_grpc_time
 async def get_mo_tprm_values_by_grpc(mo_id: int, tprm_ids: set[int]) -> dict:
     async with grpc.aio.insecure_channel(INVENTORY_GRPC_URL) as channel:
         stub = mo_info_pb2_grpc.InformerStub(channel)
@@ -30,6 +32,7 @@ async def get_mo_tprm_values_by_grpc(mo_id: int, tprm_ids: set[int]) -> dict:
         return result
 
 
+@measure_inventory_grpc_time
 async def get_mo_info_by_grpc(mo_id: int) -> dict:
     async with grpc.aio.insecure_channel(INVENTORY_GRPC_URL) as channel:
         stub = mo_info_pb2_grpc.InformerStub(channel)
@@ -65,6 +68,7 @@ async def get_mo_with_params_for_tmo_id_by_grpc(
             yield msg
 
 
+@measure_inventory_grpc_time
 async def check_if_tmo_has_lifecycle(tmo_ids: List[int]):
     if tmo_ids:
         async with grpc.aio.insecure_channel(INVENTORY_GRPC_URL) as channel:
@@ -75,6 +79,7 @@ async def check_if_tmo_has_lifecycle(tmo_ids: List[int]):
     return []
 
 
+@measure_inventory_grpc_time
 async def get_max_severity_for_mo_ids_with_particular_tmo(
     tmo_id: int, mo_ids: List[int]
 ):
@@ -97,6 +102,7 @@ async def get_max_severity_for_mo_ids_with_particular_tmo(
         return max(result)
 
 
+@measure_inventory_grpc_time
 async def get_mo_matched_condition(
     object_type_id: int = None,
     query_params: QueryParams = None,
@@ -163,6 +169,7 @@ async def get_mo_matched_condition(
             ]
 
 
+@measure_inventory_grpc_time
 async def get_children_mo_id_grouped_by_parent_node_id(
     request: mo_info_pb2.RequestListLevels,
 ):
@@ -184,6 +191,7 @@ async def get_children_mo_id_grouped_by_parent_node_id(
         }
 
 
+@measure_inventory_grpc_time
 async def get_tprms_data_by_tprms_ids(tprm_ids: Iterable[int]):
     """getter for GetTPRMData"""
     result = []
@@ -196,6 +204,7 @@ async def get_tprms_data_by_tprms_ids(tprm_ids: Iterable[int]):
     return result
 
 
+@measure_inventory_grpc_time
 async def get_tmo_data_by_tmo_ids(tmo_ids: List[int]):
     """getter for GetTMOInfoByTMOId"""
     res = dict()
@@ -261,6 +270,7 @@ async def get_all_mo_with_special_params_by_tmo_id(
         raise
 
 
+@measure_inventory_grpc_time
 async def get_mo_links_tprms(tmo_id: int) -> list[int]:
     async with grpc.aio.insecure_channel(INVENTORY_GRPC_URL) as channel:
         stub = InformerStub(channel)
@@ -281,6 +291,7 @@ async def get_mo_links_tprms(tmo_id: int) -> list[int]:
         return mo_links
 
 
+@measure_inventory_grpc_time
 def get_mo_links_values(mo_links: list[int]) -> dict[int, str]:
     with grpc.insecure_channel(INVENTORY_GRPC_URL) as channel:
         stub = InformerStub(channel)
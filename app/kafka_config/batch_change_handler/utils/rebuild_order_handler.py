@@ -1,21 +1,20 @@
-import time
-
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 from kafka_config.batch_change_handler.utils.utils import (
-    get_count_of_hierarchy_nodes,
     rebuild_all_hierarchies_from_order,
     rebuild_hierarchy_and_change_item_of_hierarchy_rebuild_order,
 )
 from schemas.hier_schemas import HierarchyRebuildOrder
+from services.hierarchy.hierarchy_builder.checkpoints import (
+    get_stalled_hierarchy_ids,
+)
 import settings
+from settings import HierarchyBuilderConfigs
 
 
 class HierarchyRebuildOrderChecker:
-    DEFAULT_SLEEP_TIME = 5
-
     @staticmethod
     async def get_hierarchy_rebuild_order_with_on_rebuild_true(
         session: AsyncSession,
@@ -30,8 +29,8 @@ class HierarchyRebuildOrderChecker:
 
     async def check_order_and_rebuild_hierarchy(self):
         """IF there are some hierarchies in rebuild order with status on_rebuild False - rebuilds this hierarchies.
-        If there are some hierarchies in rebuild order with status on_rebuild True - checks to see if they are stuck.
-        If they are stuck - rebuilds them too"""
+        If there are some hierarchies in rebuild order with status on_rebuild True - checks heartbeats of their builds.
+        If builds are stopped - continues them from their checkpoints"""
         engine = create_async_engine(
             settings.DATABASE_URL, echo=False, future=True, pool_pre_ping=True
         )
@@ -58,50 +57,19 @@ class HierarchyRebuildOrderChecker:
             print("Search for hierarchies with on rebuild End Start")
 
             if h_on_rebuild_true:
-                h_ids_on_rebuild_true = [
-                    item.hierarchy_id for item in h_on_rebuild_true
-                ]
-                count_hierarchies_nodes = await get_count_of_hierarchy_nodes(
-                    session=db_session, hierarchy_ids=h_ids_on_rebuild_true
-                )
-                time.sleep(self.DEFAULT_SLEEP_TIME)
-
-                h_on_rebuild_true = (
-                    await self.get_hierarchy_rebuild_order_with_on_rebuild_true(
-                        db_session
-                    )
+                # builds which have not sent heartbeat are stopped,
+                # they are continued from their checkpoints
+                stalled_hierarchy_ids = await get_stalled_hierarchy_ids(
+                    session=db_session,
+                    hierarchy_ids=[
+                        item.hierarchy_id for item in h_on_rebuild_true
+                    ],
+                    heartbeat_timeout=HierarchyBuilderConfigs().heartbeat_timeout,
                 )
-                h_ids_on_rebuild_true = [
-                    item.hierarchy_id for item in h_on_rebuild_true
-                ]
-                control_data = await get_count_of_hierarchy_nodes(
-                    session=db_session, hierarchy_ids=h_ids_on_rebuild_true
-                )
-
-                cache_hierarchy_rebuild_item_by_h_id = {
-                    h.hierarchy_id: h for h in h_on_rebuild_true
-                }
-
-                intersection_ids = set(count_hierarchies_nodes).intersection(
-                    control_data
-                )
-
-                if intersection_ids:
-                    # find hierarchies ids count nodes of which was not changed
-                    not_changed = {
-                        x
-                        for x in intersection_ids
-                        if control_data[x] == count_hierarchies_nodes[x]
-                    }
-                    if not_changed:
-                        for not_changed_hierarchy_id in not_changed:
-                            h_order_item = (
-                                cache_hierarchy_rebuild_item_by_h_id.get(
-                                    not_changed_hierarchy_id
-                                )
-                            )
-                            if h_order_item:
-                                await rebuild_hierarchy_and_change_item_of_hierarchy_rebuild_order(
-                                    session=db_session,
-                                    item_to_rebuild=h_order_item,
-                                )
+                for h_order_item in h_on_rebuild_true:
+                    if h_order_item.hierarchy_id in stalled_hierarchy_ids:
+                        await rebuild_hierarchy_and_change_item_of_hierarchy_rebuild_order(
+                            session=db_session,
+                            item_to_rebuild=h_order_item,
+                            resume=True,
+                        )
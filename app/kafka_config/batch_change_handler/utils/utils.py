@@ -2,10 +2,14 @@ from typing import Iterable, List, Union
 
 from sqlalchemy import func, select
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
-from common_utils.hierarchy_builder import HierarchyBuilder
 from schemas.hier_schemas import HierarchyRebuildOrder, Obj
+from services.hierarchy.hierarchy_builder.scheduler import (
+    HierarchyRebuildScheduler,
+    HierarchyRebuildTask,
+)
+from settings import HierarchyBuilderConfigs
 
 
 async def get_list_of_hierarchies_on_rebuild_stage(
@@ -30,6 +34,20 @@ async def get_item_from_hierarchy_rebuild_order(
     return item_to_rebuild
 
 
+async def get_items_from_hierarchy_rebuild_order(
+    session: AsyncSession,
+) -> List[HierarchyRebuildOrder]:
+    """Returns all items from hierarchy rebuild order with on_rebuild False"""
+    stmt = (
+        select(HierarchyRebuildOrder)
+        .where(HierarchyRebuildOrder.on_rebuild == False)  # noqa: E712
+        .order_by(HierarchyRebuildOrder.id)
+        .execution_options(populate_existing=True)
+    )
+    items_to_rebuild = await session.execute(stmt)
+    return list(items_to_rebuild.scalars().all())
+
+
 async def get_items_from_hierarchy_rebuild_order_by_hierarchy_ids(
     session: AsyncSession, hierarchy_ids: Iterable[int], on_rebuild_status: bool
 ) -> List[HierarchyRebuildOrder]:
@@ -44,10 +62,16 @@ async def get_items_from_hierarchy_rebuild_order_by_hierarchy_ids(
 
 
 async def rebuild_hierarchy_and_change_item_of_hierarchy_rebuild_order(
-    session: AsyncSession, item_to_rebuild: HierarchyRebuildOrder
-) -> None:
+    session: AsyncSession,
+    item_to_rebuild: HierarchyRebuildOrder,
+    resume: bool = False,
+) -> bool:
     """Changes status of HierarchyRebuildOrder instance, rebuilds hierarchy and delete instance
-    of HierarchyRebuildOrder from order"""
+    of HierarchyRebuildOrder from order. If resume is True, stopped build of hierarchy is continued
+    from its checkpoint. Returns True if hierarchy was rebuilt"""
+    # builder module imports kafka connection handler, which imports this module
+    from services.hierarchy.hierarchy_builder.builder import HierarchyBuilderV2
+
     print(f"Hierarchy to rebuild {item_to_rebuild}")
     if not item_to_rebuild.on_rebuild:
         item_to_rebuild.on_rebuild = True
@@ -57,14 +81,21 @@ async def rebuild_hierarchy_and_change_item_of_hierarchy_rebuild_order(
             await session.commit()
         except Exception:
             print(str(Exception))
-            return
-
-    keeper = HierarchyBuilder(
-        db_session=session, hierarchy_id=item_to_rebuild.hierarchy_id
+            return False
+
+    keeper = HierarchyBuilderV2(
+        db_session=session,
+        hierarchy_id=item_to_rebuild.hierarchy_id,
+        nodes_write_mode=HierarchyBuilderConfigs().get_nodes_write_mode(
+            hierarchy_id=item_to_rebuild.hierarchy_id
+        ),
+        resume=resume,
     )
 
+    is_rebuilt = False
     try:
         await keeper.build_hierarchy()
+        is_rebuilt = True
         print("Hierarchy successfully rebuilt")
     except IntegrityError as e:
         print(e)
@@ -79,25 +110,62 @@ async def rebuild_hierarchy_and_change_item_of_hierarchy_rebuild_order(
         pass
     finally:
         await session.commit()
+    return is_rebuilt
 
 
 async def rebuild_all_hierarchies_from_order(
     session: AsyncSession, item_to_rebuild: HierarchyRebuildOrder = None
 ) -> None:
-    """Rebuilds all hierarchies with attr on_rebuild = False - one hierarchy per iteration"""
-    if item_to_rebuild is None:
-        item_to_rebuild = await get_item_from_hierarchy_rebuild_order(session)
-
-    if item_to_rebuild:
-        await rebuild_hierarchy_and_change_item_of_hierarchy_rebuild_order(
-            session, item_to_rebuild
+    """Rebuilds all hierarchies with attr on_rebuild = False. Hierarchies are rebuilt concurrently
+    by HierarchyRebuildScheduler, every hierarchy in its own session"""
+    build_session_maker = async_sessionmaker(
+        session.bind, expire_on_commit=False
+    )
+    item_ids_by_hierarchy_id = dict()
+
+    async def rebuild_item(task: HierarchyRebuildTask):
+        async with build_session_maker() as build_session:
+            item = await build_session.get(
+                HierarchyRebuildOrder,
+                item_ids_by_hierarchy_id[task.hierarchy_id],
+            )
+            if item is None:
+                return
+            is_rebuilt = await rebuild_hierarchy_and_change_item_of_hierarchy_rebuild_order(
+                session=build_session, item_to_rebuild=item
+            )
+            if not is_rebuilt:
+                raise ValueError(
+                    f"Hierarchy {task.hierarchy_id} was not rebuilt from order"
+                )
+
+    items_to_rebuild = await get_items_from_hierarchy_rebuild_order(session)
+    if item_to_rebuild is not None:
+        items_to_rebuild.insert(0, item_to_rebuild)
+    passed_item_ids = set()
+    while items_to_rebuild:
+        # the other items of the same hierarchies are rebuilt by the next iteration
+        item_ids_by_hierarchy_id.clear()
+        for item in items_to_rebuild:
+            item_ids_by_hierarchy_id.setdefault(item.hierarchy_id, item.id)
+        passed_item_ids.update(item_ids_by_hierarchy_id.values())
+
+        # small hierarchies are rebuilt first
+        count_of_nodes = await get_count_of_hierarchy_nodes(
+            session=session, hierarchy_ids=list(item_ids_by_hierarchy_id)
+        )
+        await HierarchyRebuildScheduler().rebuild(
+            hierarchy_ids=list(item_ids_by_hierarchy_id),
+            build_function=rebuild_item,
+            priorities=count_of_nodes,
         )
-    else:
-        return
 
-    item_to_rebuild = await get_item_from_hierarchy_rebuild_order(session)
-    if item_to_rebuild:
-        await rebuild_all_hierarchies_from_order(session, item_to_rebuild)
+        # items which could not be taken into rebuild are not taken again
+        items_to_rebuild = [
+            item
+            for item in await get_items_from_hierarchy_rebuild_order(session)
+            if item.id not in passed_item_ids
+        ]
 
 
 async def get_count_of_hierarchy_nodes(
@@ -15,6 +15,9 @@ from services.hierarchy.hierarchy_builder.utils import (
     create_path_for_children_node_by_parent_node,
     get_node_key_data,
 )
+from services.node.common.update.child_count_updater import (
+    mark_nodes_to_update_child_count,
+)
 from services.updater.event_handlers.common.msg_utils import (
     rebuilding_nodes_based_on_their_data,
 )
@@ -59,44 +62,10 @@ async def delete_node_and_recalculate_child_count_for_parent(
             stmt = delete(Obj).where(Obj.id.in_(step_list))
             await session.execute(stmt)
 
-    if parent_ids_to_recalculate:
-        steps = math.ceil(
-            len(parent_ids_to_recalculate) / POSTGRES_ITEMS_LIMIT_IN_QUERY
-        )
-        list_of_node_id = list(parent_ids_to_recalculate)
-
-        for step in range(steps):
-            start = POSTGRES_ITEMS_LIMIT_IN_QUERY * step
-            end = start + POSTGRES_ITEMS_LIMIT_IN_QUERY
-
-            step_list = list_of_node_id[start:end]
-
-            subquery = (
-                select(Obj.parent_id, func.count(Obj.id).label("new_count"))
-                .where(Obj.parent_id.in_(step_list))
-                .group_by(Obj.parent_id)
-                .subquery()
-            )
-            aliased_table = aliased(subquery)
-
-            stmt = (
-                select(Obj)
-                .where(Obj.id.in_(step_list))
-                .outerjoin(aliased_table, Obj.id == aliased_table.c.parent_id)
-                .add_columns(aliased_table.c.new_count)
-            )
-
-            res = await session.execute(stmt)
-            res = res.all()
-
-            for item in res:
-                if item.new_count is None:
-                    item.Obj.child_count = 0
-                else:
-                    item.Obj.child_count = item.new_count
-                session.add(item.Obj)
-
-            await session.commit()
+    # child_count of parents is recalculated before commit
+    mark_nodes_to_update_child_count(
+        session=session, node_ids=parent_ids_to_recalculate
+    )
 
     stmt = delete(NodeData).where(
         NodeData.node_id.in_(list(nodes_ids_must_be_deleted))
@@ -12,6 +12,9 @@ from common_utils.hierarchy_builder import (
 )
 from kafka_config.connection_handler.handler import KafkaConnectionHandler
 from schemas.hier_schemas import Level, Obj
+from services.node.common.ancestors import (
+    get_short_chain_of_ancestors_with_levels,
+)
 
 
 async def get_parent_change_child_count_and_check(
@@ -134,26 +137,9 @@ async def recursive_find_parent_nodes_and_levels(
     node_obj: Obj, session: AsyncSession
 ):
     """Looks for a path to the nearest parent with a different object_type_id (tmo)
-    and returns ordered list of parent levels for this level."""
-    if node_obj.parent_id is None:
-        return []
-    node = aliased(Obj, name="node")
-    level = aliased(Level, name="level")
-    stm = (
-        select(node, level)
-        .join(level, node.level_id == level.id)
-        .where(node.id == node_obj.parent_id)
-    )
-    tuple_node_level = await session.execute(stm)
-    tuple_node_level = tuple_node_level.first()
-    if tuple_node_level["node"].object_id is not None:
-        return [tuple_node_level]
-    else:
-        return [
-            tuple_node_level
-        ] + await recursive_find_parent_nodes_and_levels(
-            tuple_node_level["node"], session
-        )
+    and returns ordered list of parent nodes with their levels.
+    Parent nodes are found by ids from path of node in one query"""
+    return await get_short_chain_of_ancestors_with_levels(node_obj, session)
 
 
 async def add_values_to_existing_note_instance(
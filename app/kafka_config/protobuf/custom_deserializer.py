@@ -1,8 +1,10 @@
+from collections.abc import Mapping
 from typing import Any, Union
 
 from google.protobuf import json_format
 from google.protobuf.internal.containers import RepeatedScalarFieldContainer
 from google.protobuf.internal.well_known_types import Struct, Timestamp
+from google.protobuf.message import Message
 
 from . import inventory_instances_pb2
 
@@ -31,7 +33,7 @@ PROTO_TYPES_SERIALIZERS = {
 }
 
 
-def __msg_f_serializer(value: Any):
+def _msg_f_serializer(value: Any):
     """Returns serialized proto msg field value into python type"""
     serializer = PROTO_TYPES_SERIALIZERS.get(type(value).__name__)
     if serializer:
@@ -55,7 +57,7 @@ def protobuf_kafka_msg_to_dict(
     if including_default_value_fields is False:
         message_as_dict["objects"] = [
             {
-                field.name: __msg_f_serializer(value)
+                field.name: _msg_f_serializer(value)
                 for field, value in item.ListFields()
             }
             for item in msg.objects
@@ -63,9 +65,58 @@ def protobuf_kafka_msg_to_dict(
     else:
         message_as_dict["objects"] = [
             {
-                field: __msg_f_serializer(getattr(item, field))
+                field: _msg_f_serializer(getattr(item, field))
                 for field in item.DESCRIPTOR.fields_by_name.keys()
             }
             for item in msg.objects
         ]
     return message_as_dict
+
+
+class ProtoObjectView(Mapping):
+    """Read-only view of protobuf object as of dict with default values of all fields.
+    Fields are converted into python types on the first access, so handlers
+    do not pay for fields they do not read."""
+
+    __slots__ = ("_item", "_fields", "_values")
+
+    def __init__(self, item: Message):
+        self._item = item
+        self._fields = item.DESCRIPTOR.fields_by_name
+        self._values = dict()
+
+    def __getitem__(self, key: str):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        if key not in self._fields:
+            raise KeyError(key)
+        value = _msg_f_serializer(getattr(self._item, key))
+        self._values[key] = value
+        return value
+
+    def __contains__(self, key) -> bool:
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict(self)})"
+
+
+def protobuf_kafka_msg_to_view(
+    msg: Union[
+        inventory_instances_pb2.ListMO,
+        inventory_instances_pb2.ListTMO,
+        inventory_instances_pb2.ListTPRM,
+        inventory_instances_pb2.ListPRM,
+    ],
+) -> dict:
+    """Returns message as of protobuf_kafka_msg_to_dict with default value fields,
+    objects of message are views of protobuf objects"""
+    return {"objects": [ProtoObjectView(item) for item in msg.objects]}
@@ -9,6 +9,7 @@ from kafka_producer.model_mediator import MODEL_EQ_MESSAGE
 from kafka_producer.producer import prepare_msg_for_kafka
 from services.kafka.process_manager.lisnter_handler import (
     process_manager_mediator_for_hierarchies,
+    process_manager_mediator_for_levels,
 )
 from services.obj_events.status import ObjEventStatus
 from services.session_utils.listeners.enum_models import SessionDataKeys
@@ -56,6 +57,8 @@ def receive_after_commit(session):
     ):
         data = session.info[key_for_session_data.value]
         del session.info[key_for_session_data.value]
+        if "Hierarchy" in data or "Level" in data:
+            process_manager_mediator_for_levels()
         for class_name, items_data in data.items():
             if class_name == "Hierarchy":
                 process_manager_mediator_for_hierarchies(
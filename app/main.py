@@ -1,3 +1,4 @@
+import asyncio
 import subprocess
 
 from fastapi import Depends
@@ -15,10 +16,18 @@ from kafka_producer.session_listener.listener import (
 )
 from routers import hierarchy_object_router, hierarchy_router, level_router
 from routers.hierarchy_object.router import router as hierarchy_object_routers
+from services.hierarchy.hierarchy_builder.process_pool import (
+    HierarchyBuilderProcessPool,
+)
 from services.kafka.process_manager.impl import (
     KafkaConsumerProcessManager,
     init_all_kafka_consumer_processes_with_admin_session,
 )
+from services.link_keys.cache import link_keys_cache
+from services.metrics.exposition import (
+    clear_metrics_of_previous_run,
+    create_metrics_app,
+)
 from services.security.data import listener  # noqa
 from services.security.routers.hierarchy import (
     router as security_permissions_router,
@@ -69,16 +78,23 @@ v1_app.include_router(hierarchy_object_routers)
 v1_app.include_router(security_permissions_router)
 
 app.mount("/v1", v1_app)
+# metrics of consumer processes for Prometheus
+app.mount("/metrics", create_metrics_app())
 
 
 @app.on_event("startup")
 async def on_startup():
     await database.init()
+    clear_metrics_of_previous_run()
 
     if KAFKA_TURN_ON:
         # Register common listeners for kafka
         listen(Session, "after_flush", receive_after_flush)
         listen(Session, "after_commit", receive_after_commit)
+        # consumers send ids of changed MOs and PRMs to cache of keys of nodes
+        app.state.link_keys_invalidations_task = asyncio.create_task(
+            link_keys_cache.apply_invalidations_periodically()
+        )
         await init_all_kafka_consumer_processes_with_admin_session()
 
 
@@ -87,6 +103,7 @@ def shutdown_event():
     # terminate all active children processes
     p_m = KafkaConsumerProcessManager()
     p_m.stop_all_processes()
+    HierarchyBuilderProcessPool().shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+"""Added index of obj path and filled paths of existing nodes
+
+Revision ID: 5c1e8a2d7b93
+Revises: 3b9d2f6c1e47
+Create Date: 2026-10-17 14:03:52.918274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e8a2d7b93'
+down_revision = '3b9d2f6c1e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # paths of nodes created without them are filled from parents,
+    # path of children is "<path of parent><id of parent>/"
+    op.execute(
+        """
+        WITH RECURSIVE tree AS (
+            SELECT id, NULL::varchar AS path
+            FROM obj
+            WHERE parent_id IS NULL
+            UNION ALL
+            SELECT obj.id, COALESCE(tree.path, '') || tree.id::text || '/'
+            FROM obj
+            JOIN tree ON obj.parent_id = tree.id
+        )
+        UPDATE obj
+        SET path = tree.path
+        FROM tree
+        WHERE obj.id = tree.id AND obj.path IS DISTINCT FROM tree.path
+        """
+    )
+    op.create_index('ix_obj_path', 'obj', ['path'], unique=False, postgresql_using='spgist')
+
+
+def downgrade() -> None:
+    op.drop_index('ix_obj_path', table_name='obj', postgresql_using='spgist')
@@ -0,0 +1,26 @@
+"""Added index of obj children by key
+
+Revision ID: 7d2e4b9a1c58
+Revises: 5c1e8a2d7b93
+Create Date: 2026-10-17 16:21:07.412853
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2e4b9a1c58'
+down_revision = '5c1e8a2d7b93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # children of parent are read by pages sorted by key
+    op.create_index('ix_obj_hierarchy_id_parent_id_key', 'obj', ['hierarchy_id', 'parent_id', 'key'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_obj_hierarchy_id_parent_id_key', table_name='obj')
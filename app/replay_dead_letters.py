@@ -0,0 +1,45 @@
+"""
+Applies dead letters of Kafka consumer again after the cause of their failure is fixed.
+Letters which fail again are kept in dead letters.
+"""
+
+import asyncio
+
+from sqlalchemy.event import listen
+from sqlalchemy.orm import Session
+
+from database import async_session_maker_with_admin_perm
+from services.kafka.consumer.dead_letters import (
+    get_dead_letters_sink,
+    replay_dead_letters,
+)
+from services.session_utils.listeners.processes.inner_listener import (
+    process_session_receive_after_commit,
+    process_session_receive_after_flush,
+)
+from services.updater.event_handlers.mediator.impl import (
+    UpdaterEventMediatorImpl,
+)
+from settings import KafkaConfigs
+
+
+async def main():
+    # changes of replayed letters are sent to Kafka as changes of consumer
+    listen(Session, "after_flush", process_session_receive_after_flush)
+    listen(Session, "after_commit", process_session_receive_after_commit)
+
+    dead_letters = get_dead_letters_sink(KafkaConfigs())
+    if dead_letters is None:
+        print("Dead letters are disabled")
+        return
+
+    applied, failed = await replay_dead_letters(
+        dead_letters=dead_letters,
+        msg_handler=UpdaterEventMediatorImpl(),
+        session_maker=async_session_maker_with_admin_perm,
+    )
+    print(f"Dead letters replayed: {applied} applied, {failed} failed")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
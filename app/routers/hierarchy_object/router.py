@@ -17,15 +17,15 @@ from grpc_config.inventory_utils import (
 from routers.hierarchy_object.utills.utils import (
     get_child_mo_ids_for_nodes_ids_consider_default_key,
     get_child_mo_ids_with_particular_object_type_for_nodes_ids,
-    get_first_depth_child_levels,
     get_node_or_raise_error,
     get_nodes_by_node_ids,
     get_object_type_ids_of_all_child_levels,
 )
-from routers.utility_checks import check_hierarchy_exist
+from routers.utility_checks import check_hierarchy_metadata_exist
 
 # from routers.utils import update_nodes_key_if_mo_link_or_prm_link
-from schemas.hier_schemas import Hierarchy, Level, Obj, ObjResponseNew
+from schemas.hier_schemas import Hierarchy, Obj, ObjResponseNew
+from services.node.common.ancestors import get_breadcrumbs_of_nodes
 
 router = APIRouter(prefix="/hierarchy_object", tags=["Node"])
 
@@ -173,6 +173,19 @@ async def get_children_mo_ids_of_particular_nodes(
     return res
 
 
+@router.get(
+    "/breadcrumbs", response_model=dict[uuid.UUID, list[ObjResponseNew]]
+)
+async def get_hierarchy_objects_breadcrumbs(
+    node_ids: List[uuid.UUID] = Query(),
+    session: AsyncSession = Depends(database.get_session),
+):
+    """Returns breadcrumbs of every node by its id, not existing nodes are skipped.
+    Ancestors of all nodes are loaded by one query"""
+    nodes = await get_nodes_by_node_ids(node_ids, session)
+    return await get_breadcrumbs_of_nodes(nodes, session)
+
+
 @router.get("/{object_id}/breadcrumbs", response_model=list[ObjResponseNew])
 async def get_hierarchy_object_breadcrumbs(
     object_id: uuid.UUID, session: AsyncSession = Depends(database.get_session)
@@ -196,23 +209,15 @@ async def get_mo_ids_of_first_real_children_nodes(
 ):
     node = await get_node_or_raise_error(node_id=object_id, session=session)
 
-    hierarchy_exist = await check_hierarchy_exist(node.hierarchy_id, session)
+    metadata = await check_hierarchy_metadata_exist(node.hierarchy_id, session)
+    hierarchy_exist = metadata.hierarchy
 
-    child_levels = await get_first_depth_child_levels(
-        parent_level_ids=[node.level_id], session=session
-    )
+    child_levels = metadata.get_child_levels([node.level_id])
 
     order = [dict(node_ids=[node.id], levels=child_levels)]
 
-    stmt = select(Level).where(Level.hierarchy_id == hierarchy_exist.id)
-    hierarchy_level_param_type_ids = await session.execute(stmt)
-    hierarchy_level_param_type_ids = (
-        hierarchy_level_param_type_ids.scalars().all()
-    )
-
     levels_param_type_ids_dict = {
-        level.id: level.param_type_id
-        for level in hierarchy_level_param_type_ids
+        level.id: level.param_type_id for level in metadata.levels
     }
 
     tprms_data = await get_tprms_data_by_tprms_ids(
@@ -285,9 +290,7 @@ async def get_mo_ids_of_first_real_children_nodes(
             node_ids = node_ids.scalars().all()
 
             parent_level_ids = [level.id for level in interation["levels"]]
-            stmt = select(Level).where(Level.parent_id.in_(parent_level_ids))
-            child_levels = await session.execute(stmt)
-            child_levels = child_levels.scalars().all()
+            child_levels = metadata.get_child_levels(parent_level_ids)
 
             if node_ids and child_levels:
                 step_count = 30000
@@ -1,13 +1,21 @@
+import base64
+import json
 import math
-from typing import List
+from typing import Any, List
 import uuid
 
 from fastapi import HTTPException
-from sqlalchemy import func, select
+from sqlalchemy import exists, func, or_, select, tuple_
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
 from common_utils.hierarchy_builder import DEFAULT_KEY_OF_NULL_NODE
 from schemas.hier_schemas import Level, Obj
+from services.hierarchy.hierarchy_builder.utils import (
+    get_sql_path_for_children_node,
+    path_startswith,
+)
+from services.hierarchy.metadata.cache import HierarchyMetadata
 
 
 async def get_node_or_raise_error(
@@ -151,42 +159,9 @@ async def get_child_mo_ids_with_particular_object_type_for_nodes_ids(
 
 async def get_child_mo_ids_for_nodes_ids(node_ids: List, session: AsyncSession):
     """Returns dict with node.id as key and list of children object_id as value"""
-    if not node_ids:
-        return {}
-    dict_result = {x: list() for x in node_ids}
-    dict_order = [{x: [x]} for x in node_ids]
-    for dict_in_order in dict_order:
-        main_node_id = list(dict_in_order.keys())[0]
-        node_ids_from_order = dict_in_order[main_node_id]
-
-        stmt = select(Obj.id).where(Obj.parent_id.in_(node_ids_from_order))
-        res = await session.execute(stmt)
-        res = res.scalars().all()
-        if res:
-            stmt = (
-                select(Obj.object_id)
-                .where(
-                    Obj.parent_id.in_(node_ids_from_order),
-                    Obj.object_id != None,  # noqa: E711
-                )
-                .distinct()
-            )
-
-            real_obj_ids = await session.execute(stmt)
-            real_obj_ids = real_obj_ids.scalars().all()
-            if real_obj_ids:
-                dict_result[main_node_id].extend(real_obj_ids)
-
-            max_count = 30000
-            slices = 1
-            if len(res) > max_count:
-                slices = math.ceil(len(res) / max_count)
-
-            for slice_iter in range(slices):
-                start = max_count * slice_iter
-                end = start + max_count
-                dict_order.append({main_node_id: res[start:end]})
-    return dict_result
+    return await get_child_mo_ids_for_nodes_ids_consider_default_key(
+        node_ids=node_ids, session=session
+    )
 
 
 async def get_child_mo_ids_for_nodes_ids_consider_default_key(
@@ -195,60 +170,41 @@ async def get_child_mo_ids_for_nodes_ids_consider_default_key(
     consider_nodes_with_default_key: bool = True,
 ):
     """Returns dict with node.id as key and list of children object_id as value. If consider_nodes_with_default_key is
-    False searches for nodes whose key is not equal to DEFAULT_KEY_OF_NULL_NODE"""
+    False searches for nodes whose key is not equal to DEFAULT_KEY_OF_NULL_NODE and not under such nodes.
+    Descendants of all nodes are found by prefixes of their paths in one query"""
     if not node_ids:
         return {}
     dict_result = {x: list() for x in node_ids}
-    dict_order = [{x: [x]} for x in node_ids]
-    for dict_in_order in dict_order:
-        main_node_id = list(dict_in_order.keys())[0]
-        node_ids_from_order = dict_in_order[main_node_id]
-
-        if consider_nodes_with_default_key:
-            stmt = select(Obj.id).where(Obj.parent_id.in_(node_ids_from_order))
-        else:
-            stmt = select(Obj.id).where(
-                Obj.parent_id.in_(node_ids_from_order),
-                Obj.key != DEFAULT_KEY_OF_NULL_NODE,
-            )
 
-        res = await session.execute(stmt)
-        res = res.scalars().all()
-        if res:
-            if consider_nodes_with_default_key:
-                stmt = (
-                    select(Obj.object_id)
-                    .where(
-                        Obj.parent_id.in_(node_ids_from_order),
-                        Obj.object_id != None,  # noqa: E711
-                    )
-                    .distinct()
-                )
-            else:
-                stmt = (
-                    select(Obj.object_id)
-                    .where(
-                        Obj.parent_id.in_(node_ids_from_order),
-                        Obj.key != DEFAULT_KEY_OF_NULL_NODE,
-                        Obj.object_id != None,  # noqa: E711
-                    )
-                    .distinct()
-                )
-
-            real_obj_ids = await session.execute(stmt)
-            real_obj_ids = real_obj_ids.scalars().all()
-            if real_obj_ids:
-                dict_result[main_node_id].extend(real_obj_ids)
-
-            max_count = 30000
-            slices = 1
-            if len(res) > max_count:
-                slices = math.ceil(len(res) / max_count)
+    parent_node = aliased(Obj, name="parent_node")
+    child_node = aliased(Obj, name="child_node")
+    children_path = get_sql_path_for_children_node(parent_node)
+    stmt = (
+        select(parent_node.id, child_node.object_id)
+        .join(child_node, path_startswith(children_path, child_node.path))
+        .where(
+            parent_node.id.in_(node_ids),
+            child_node.object_id != None,  # noqa: E711
+        )
+        .distinct()
+    )
+    if not consider_nodes_with_default_key:
+        default_node = aliased(Obj, name="default_node")
+        stmt = stmt.where(
+            child_node.key != DEFAULT_KEY_OF_NULL_NODE,
+            ~exists().where(
+                default_node.key == DEFAULT_KEY_OF_NULL_NODE,
+                path_startswith(children_path, default_node.path),
+                path_startswith(
+                    get_sql_path_for_children_node(default_node),
+                    child_node.path,
+                ),
+            ),
+        )
 
-            for slice_iter in range(slices):
-                start = max_count * slice_iter
-                end = start + max_count
-                dict_order.append({main_node_id: res[start:end]})
+    res = await session.execute(stmt)
+    for node_id, object_id in res.all():
+        dict_result[node_id].append(object_id)
     return dict_result
 
 
@@ -312,3 +268,85 @@ async def get_object_ids_of_real_nodes_with_existing_key(
         obj_ids = obj_ids.scalars().all()
         res.update(obj_ids)
     return res
+
+
+CHILDREN_SORT_COLUMNS = {"key": Obj.key, "child_count": Obj.child_count}
+
+
+def encode_children_cursor(node: Obj, sort_by: str) -> str:
+    """Returns cursor of page of children which starts after node"""
+    data = json.dumps([getattr(node, sort_by), str(node.id)])
+    return base64.urlsafe_b64encode(data.encode()).decode()
+
+
+def decode_children_cursor(cursor: str, sort_by: str) -> tuple[Any, uuid.UUID]:
+    """Returns value of sort column and id of the last node of previous page"""
+    try:
+        value, node_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        node_id = uuid.UUID(node_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=422, detail="Invalid cursor")
+    value_type = str if sort_by == "key" else int
+    if not isinstance(value, value_type) or isinstance(value, bool):
+        raise HTTPException(status_code=422, detail="Invalid cursor")
+    return value, node_id
+
+
+async def get_page_of_children_nodes(
+    metadata: HierarchyMetadata,
+    parent_id: uuid.UUID | None,
+    session: AsyncSession,
+    sort_by: str = "key",
+    descending: bool = False,
+    after: str | None = None,
+    limit: int = 100,
+    with_total: bool = False,
+) -> tuple[list[Obj], str | None, int | None]:
+    """Returns page of children of parent node sorted by sort_by and id, cursor of
+    the next page or None for the last page and count of all children if with_total.
+    Page starts after node of cursor, so it is read by index of (hierarchy_id,
+    parent_id, key) without offset. Children with default key are skipped if
+    hierarchy does not create empty nodes, children of levels with
+    show_without_children equal to False are skipped if they have no children"""
+    hierarchy = metadata.hierarchy
+    conditions = [Obj.hierarchy_id == hierarchy.id, Obj.parent_id == parent_id]
+    if not hierarchy.create_empty_nodes:
+        conditions.append(Obj.key != DEFAULT_KEY_OF_NULL_NODE)
+
+    level_ids_without_children = metadata.level_ids_shown_only_with_children
+    if level_ids_without_children:
+        conditions.append(
+            or_(
+                Obj.level_id.is_(None),
+                Obj.level_id.not_in(level_ids_without_children),
+                Obj.child_count > 0,
+            )
+        )
+
+    total = None
+    if with_total:
+        stmt = select(func.count()).select_from(Obj).where(*conditions)
+        total = (await session.execute(stmt)).scalar_one()
+
+    sort_column = CHILDREN_SORT_COLUMNS[sort_by]
+    stmt = select(Obj).where(*conditions)
+    if after is not None:
+        value, node_id = decode_children_cursor(after, sort_by)
+        position = tuple_(sort_column, Obj.id)
+        stmt = stmt.where(
+            position < tuple_(value, node_id)
+            if descending
+            else position > tuple_(value, node_id)
+        )
+    order_by = (sort_column, Obj.id)
+    if descending:
+        order_by = (column.desc() for column in order_by)
+    # one more node is read to know whether the next page exists
+    stmt = stmt.order_by(*order_by).limit(limit + 1)
+    nodes = (await session.execute(stmt)).scalars().all()
+
+    next_cursor = None
+    if len(nodes) > limit:
+        nodes = nodes[:limit]
+        next_cursor = encode_children_cursor(nodes[-1], sort_by)
+    return nodes, next_cursor, total
@@ -1,5 +1,7 @@
+from collections import defaultdict
 import http
 import time
+from typing import Literal
 import uuid
 
 from fastapi import (
@@ -8,6 +10,7 @@ from fastapi import (
     Depends,
     HTTPException,
     Query,
+    Response,
     WebSocket,
     status,
 )
@@ -15,8 +18,8 @@ from fastapi.requests import Request
 from fastapi.websockets import WebSocketDisconnect
 from google.protobuf import json_format
 import grpc
-from sqlalchemy import and_
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import and_, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.future import select
 
 from common_utils.hierarchy_builder import DEFAULT_KEY_OF_NULL_NODE
@@ -25,13 +28,20 @@ from common_utils.notifier import Notifier
 from database import database
 from grpc_config.protobuf import mo_info_pb2_grpc
 from grpc_config.protobuf.mo_info_pb2 import RequestTMOlifecycleByTMOidList
+from kafka_config.batch_change_handler.utils.utils import (
+    get_count_of_hierarchy_nodes,
+)
 from models import FilterColumn
 from routers.hierarchy_object.utills.utils import (
     get_count_of_children_nodes_with_not_default_key,
     get_node_or_raise_error,
+    get_page_of_children_nodes,
 )
 from routers.utility_checks import (
+    TREE_MAX_DEPTH,
+    TREE_MAX_NODES,
     check_hierarchy_exist,
+    check_hierarchy_metadata_exist,
     create_tree_from_parent_node,
 )
 from routers.utils import (
@@ -40,12 +50,26 @@ from routers.utils import (
     update_nodes_key_if_mo_link_or_prm_link_as_dict,
 )
 from schemas.enum_models import HierarchyStatus
-from schemas.hier_schemas import Hierarchy, Level, Obj, ObjResponseNew
+from schemas.hier_schemas import (
+    Hierarchy,
+    Level,
+    Obj,
+    ObjPage,
+    ObjResponseNew,
+)
 from services.hierarchy.hierarchy_builder.builder import (
     HierarchyBuilderV2,
     refresh_hierarchy_with_error_catch,
 )
-from settings import INV_HOST, INVENTORY_GRPC_PORT
+from services.hierarchy.hierarchy_builder.inventory_snapshot import (
+    InventorySnapshotCache,
+)
+from services.hierarchy.hierarchy_builder.scheduler import (
+    HierarchyRebuildScheduler,
+    HierarchyRebuildTask,
+    RebuildTaskStatus,
+)
+from settings import INV_HOST, INVENTORY_GRPC_PORT, HierarchyBuilderConfigs
 
 router = APIRouter()
 
@@ -109,35 +133,114 @@ async def refresh_all_hierarchies(
     for hierarchy in all_hierarchies:
         hierarchy.status = HierarchyStatus.IN_PROCESS.value
         session.add(hierarchy)
-        await session.commit()
+    await session.commit()
 
-        print("Hierarchy refresh begins")
-        try:
-            keeper = HierarchyBuilderV2(
-                db_session=session, hierarchy_id=hierarchy.id
-            )
-            await keeper.build_hierarchy()
-        except Exception as ex:
-            await session.rollback()
-            hierarchy.status = HierarchyStatus.ERROR.value
-            session.add(hierarchy)
-            await session.commit()
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=str(ex),
-            )
+    hierarchy_ids = [hierarchy.id for hierarchy in all_hierarchies]
+    # small hierarchies are rebuilt first
+    count_of_nodes = await get_count_of_hierarchy_nodes(
+        session=session, hierarchy_ids=hierarchy_ids
+    )
+    build_session_maker = async_sessionmaker(
+        session.bind, expire_on_commit=False
+    )
+    # MO of TMO used by several levels are read from Inventory once. Levels are
+    # registered per scheduled build and are released by the build or after
+    # the rebuild, if the build is failed or is not run
+    inventory_snapshot_cache = InventorySnapshotCache()
+    levels = await session.execute(
+        select(Level).where(Level.hierarchy_id.in_(hierarchy_ids))
+    )
+    levels_by_hierarchy_id = defaultdict(list)
+    for level in levels.scalars().all():
+        levels_by_hierarchy_id[level.hierarchy_id].append(level)
+    snapshot_readers = {
+        hierarchy_id: inventory_snapshot_cache.register_levels(
+            levels_by_hierarchy_id[hierarchy_id]
+        )
+        for hierarchy_id in hierarchy_ids
+    }
 
-        hierarchy.status = HierarchyStatus.COMPLETE.value
-        session.add(hierarchy)
-        await session.commit()
-        print("Hierarchy refresh finished")
-    # rebuild_order_item = HierarchyRebuildOrder(hierarchy_id=hierarchy_id)
-    # session.add(rebuild_order_item)
-    # await session.commit()
+    async def build_hierarchy(task: HierarchyRebuildTask):
+        async with build_session_maker() as build_session:
+            hierarchy = await build_session.get(Hierarchy, task.hierarchy_id)
+            print(f"Hierarchy {hierarchy.id} refresh begins")
+            try:
+                keeper = HierarchyBuilderV2(
+                    db_session=build_session,
+                    hierarchy_id=hierarchy.id,
+                    nodes_write_mode=HierarchyBuilderConfigs().get_nodes_write_mode(
+                        hierarchy_id=hierarchy.id
+                    ),
+                    on_level_built=task.on_level_built,
+                    inventory_snapshot_cache=inventory_snapshot_cache,
+                    inventory_snapshot_readers=snapshot_readers[hierarchy.id],
+                )
+                await keeper.build_hierarchy()
+            finally:
+                await inventory_snapshot_cache.release_levels(
+                    snapshot_readers[task.hierarchy_id]
+                )
+            print(f"Hierarchy {hierarchy.id} refresh finished")
+
+    try:
+        tasks = await HierarchyRebuildScheduler().rebuild(
+            hierarchy_ids=hierarchy_ids,
+            build_function=build_hierarchy,
+            priorities=count_of_nodes,
+        )
+    finally:
+        for readers in snapshot_readers.values():
+            await inventory_snapshot_cache.release_levels(readers)
+        await inventory_snapshot_cache.close()
+    print(f"Inventory snapshots: {inventory_snapshot_cache.stats}")
+
+    # hierarchy may be rebuilt by task scheduled before with other build function,
+    # so statuses are set by results of tasks instead of build function
+    failed_hierarchy_ids = [
+        task.hierarchy_id
+        for task in tasks
+        if task.status == RebuildTaskStatus.ERROR
+    ]
+    await session.execute(
+        update(Hierarchy)
+        .where(
+            Hierarchy.id.in_(hierarchy_ids),
+            Hierarchy.id.not_in(failed_hierarchy_ids),
+        )
+        .values(status=HierarchyStatus.COMPLETE.value)
+    )
+    if failed_hierarchy_ids:
+        await session.execute(
+            update(Hierarchy)
+            .where(Hierarchy.id.in_(failed_hierarchy_ids))
+            .values(status=HierarchyStatus.ERROR.value)
+        )
+    await session.commit()
+
+    errors = [
+        f"Hierarchy {task.hierarchy_id}: {task.error}"
+        for task in tasks
+        if task.status == RebuildTaskStatus.ERROR
+    ]
+    if errors:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="; ".join(errors),
+        )
 
     return {"details": "Completed"}
 
 
+@router.get(
+    "/refresh_all_hierarchies/queue",
+    status_code=http.HTTPStatus.OK,
+    tags=["Create/change hierarchy methods"],
+)
+async def get_hierarchies_rebuild_queue():
+    """Returns status, queue position and built levels of hierarchies being rebuilt"""
+    return HierarchyRebuildScheduler().get_tasks_state()
+
+
 @router.get(
     "/hierarchy/{hierarchy_id}/parent/{parent_id}",
     response_model=list[Obj],
@@ -149,7 +252,8 @@ async def get_hierarchy_objects(
     with_lifecycle: bool = False,
     session: AsyncSession = Depends(database.get_session),
 ):
-    hierarchy_exist = await check_hierarchy_exist(hierarchy_id, session)
+    metadata = await check_hierarchy_metadata_exist(hierarchy_id, session)
+    hierarchy_exist = metadata.hierarchy
 
     if parent_id.upper() in ("ROOT", "NONE", "NULL"):
         parent_id = None
@@ -162,13 +266,7 @@ async def get_hierarchy_objects(
                 detail="badly formed hexadecimal UUID string",
             )
     if with_lifecycle:
-        stmt = (
-            select(Level.object_type_id)
-            .where(Level.hierarchy_id == hierarchy_id)
-            .distinct()
-        )  # noqa
-        uniq_tmo_for_hierarchy = await session.execute(stmt)
-        response = uniq_tmo_for_hierarchy.scalars().all()
+        response = sorted(metadata.object_type_ids)
         if response:
             async with grpc.aio.insecure_channel(
                 f"{INV_HOST}:{INVENTORY_GRPC_PORT}"
@@ -259,18 +357,8 @@ async def get_hierarchy_objects(
         )
 
     # find levels with show_without_children is false
-    stmt = select(Level).where(
-        Level.hierarchy_id == hierarchy_id,
-        Level.show_without_children == False,  # noqa: E712
-    )
-    h_lev_show_without_children_false = await session.execute(stmt)
-    h_lev_show_without_children_false = (
-        h_lev_show_without_children_false.scalars().all()
-    )
-
-    if h_lev_show_without_children_false:
-        level_ids = {level.id for level in h_lev_show_without_children_false}
-
+    level_ids = metadata.level_ids_shown_only_with_children
+    if level_ids:
         response = [
             item
             for item in response
@@ -280,6 +368,66 @@ async def get_hierarchy_objects(
     return response
 
 
+@router.get(
+    "/hierarchy/{hierarchy_id}/parent/{parent_id}/page",
+    response_model=ObjPage,
+    tags=["Main"],
+)
+async def get_page_of_hierarchy_objects(
+    hierarchy_id: int,
+    parent_id: str,
+    sort_by: Literal["key", "child_count"] = "key",
+    descending: bool = False,
+    after: str | None = Query(default=None),
+    limit: int = Query(default=100, ge=1, le=1000),
+    with_total: bool = False,
+    session: AsyncSession = Depends(database.get_session),
+):
+    """Returns page of children nodes of parent_id sorted by sort_by. \n
+    To get the next page pass next_cursor of the current page as after,
+    next_cursor of the last page is null. Set with_total to get count of all children.
+    Keys of nodes of levels with mo_link or prm_link are resolved for the page only."""
+    metadata = await check_hierarchy_metadata_exist(hierarchy_id, session)
+    hierarchy_exist = metadata.hierarchy
+
+    if parent_id.upper() in ("ROOT", "NONE", "NULL"):
+        parent_id = None
+    else:
+        try:
+            parent_id = uuid.UUID(parent_id)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="badly formed hexadecimal UUID string",
+            )
+
+    nodes, next_cursor, total = await get_page_of_children_nodes(
+        metadata=metadata,
+        parent_id=parent_id,
+        session=session,
+        sort_by=sort_by,
+        descending=descending,
+        after=after,
+        limit=limit,
+        with_total=with_total,
+    )
+
+    # nodes are changed for response only
+    for node in nodes:
+        session.expunge(node)
+
+    if nodes and not hierarchy_exist.create_empty_nodes:
+        # recount children
+        children_count = await get_count_of_children_nodes_with_not_default_key(
+            p_ids=[item.id for item in nodes], session=session
+        )
+        for item in nodes:
+            item.child_count = children_count.get(item.id, 0)
+
+    nodes = await update_nodes_key_if_mo_link_or_prm_link(nodes, session)
+    return ObjPage(items=nodes, next_cursor=next_cursor, total=total)
+
+
 @router.post("/hierarchy/{hierarchy_id}/parent/{parent_id}/with_conditions")
 async def get_child_nodes_of_parent_id_with_filter_condition(
     hierarchy_id: int,
@@ -313,7 +461,8 @@ async def get_child_nodes_of_parent_id_with_filter_condition(
         "session": session,
     }
 
-    hierarchy_exist = await check_hierarchy_exist(hierarchy_id, session)
+    metadata = await check_hierarchy_metadata_exist(hierarchy_id, session)
+    hierarchy_exist = metadata.hierarchy
 
     # check parent_id
     if parent_id.upper() in ("ROOT", "NONE", "NULL"):
@@ -345,11 +494,7 @@ async def get_child_nodes_of_parent_id_with_filter_condition(
     # check tmo_id
     # IF tmo id than return filtered results
     if tmo_id:
-        stmt = select(Level).where(
-            Level.object_type_id == tmo_id, Level.hierarchy_id == hierarchy_id
-        )
-        levels_with_tmo = await session.execute(stmt)
-        levels_with_tmo = levels_with_tmo.scalars().all()
+        levels_with_tmo = metadata.get_levels_by_object_type_id(tmo_id)
 
         if not levels_with_tmo:
             raise HTTPException(
@@ -461,18 +606,9 @@ async def get_child_nodes_of_parent_id_with_filter_condition(
     #     res.append(node.__dict__)
 
     # find levels with show_without_children is false
-    stmt = select(Level).where(
-        Level.hierarchy_id == hierarchy_id,
-        Level.show_without_children == False,  # noqa: E712
+    level_ids_do_not_show_without_child = (
+        metadata.level_ids_shown_only_with_children
     )
-    h_lev_show_without_children_false = await session.execute(stmt)
-    h_lev_show_without_children_false = (
-        h_lev_show_without_children_false.scalars().all()
-    )
-
-    level_ids_do_not_show_without_child = {
-        level.id for level in h_lev_show_without_children_false
-    }
 
     for node in nodes:
         if (
@@ -498,21 +634,36 @@ async def get_child_nodes_of_parent_id_with_filter_condition(
     tags=["Main"],
 )
 async def get_hierarchy_child(
-    parent_id: uuid.UUID, session: AsyncSession = Depends(database.get_session)
+    parent_id: uuid.UUID,
+    response: Response,
+    max_depth: int | None = Query(default=TREE_MAX_DEPTH, ge=1),
+    max_nodes: int | None = Query(default=TREE_MAX_NODES, ge=1),
+    session: AsyncSession = Depends(database.get_session),
 ):
+    """Returns tree of descendants of node. Tree is cut by max_depth levels and
+    max_nodes nodes if they are passed, nodes with not returned children have
+    truncated equal to True. If node has more than max_nodes children, first
+    max_nodes of them are returned with header X-Truncated equal to true"""
     stmt = select(Obj).where(Obj.id == parent_id)
     parent_obj = await session.execute(stmt)
     parent_obj = parent_obj.scalars().first()
 
-    hierarchy_exist = await check_hierarchy_exist(
+    metadata = await check_hierarchy_metadata_exist(
         parent_obj.hierarchy_id, session
     )
+    hierarchy_exist = metadata.hierarchy
     result = list()
 
     if parent_obj is not None:
-        result = await create_tree_from_parent_node(
-            parent_obj, session, hierarchy_exist.create_empty_nodes
+        result, children_are_truncated = await create_tree_from_parent_node(
+            parent_obj,
+            session,
+            hierarchy_exist.create_empty_nodes,
+            max_depth=max_depth,
+            max_nodes=max_nodes,
         )
+        if children_are_truncated:
+            response.headers["X-Truncated"] = "true"
     return result
 
 
@@ -1,8 +1,9 @@
+from collections import defaultdict
 import http
 from uuid import UUID
 
 from fastapi import HTTPException
-from sqlalchemy import and_
+from sqlalchemy import and_, func
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
@@ -17,6 +18,16 @@ from schemas.hier_schemas import (
     Obj,
     ObjResponseNew,
 )
+from services.hierarchy.hierarchy_builder.utils import path_startswith
+from services.hierarchy.metadata.cache import (
+    HierarchyMetadata,
+    hierarchy_metadata_cache,
+)
+
+# limits of subtree returned by create_tree_from_parent_node,
+# whole subtree is returned by default
+TREE_MAX_DEPTH = None
+TREE_MAX_NODES = None
 
 
 # HIERARCHY
@@ -30,6 +41,19 @@ async def check_hierarchy_exist(hierarchy_id: int, session: AsyncSession):
     return hierarchy
 
 
+async def check_hierarchy_metadata_exist(
+    hierarchy_id: int, session: AsyncSession
+) -> HierarchyMetadata:
+    """Returns cached metadata of hierarchy for read endpoints"""
+    metadata = await hierarchy_metadata_cache.get(hierarchy_id, session)
+    if not metadata:
+        raise HTTPException(
+            status_code=http.HTTPStatus.NOT_FOUND,
+            detail="hierarchy_id with this number was not found",
+        )
+    return metadata
+
+
 async def check_hierarchy_exist_with_lock(
     hierarchy_id: int, session: AsyncSession
 ):
@@ -57,52 +81,148 @@ async def check_hierarchy_name_exist(
 
 
 async def create_tree_from_parent(parent_id: UUID, session: AsyncSession):
+    """Returns tree of descendants of parent node. Descendants are found
+    by prefix of their paths in one query and are grouped by parents in memory"""
+    parent_path = await session.execute(
+        select(Obj.path).where(Obj.id == parent_id)
+    )
+    parent_path = parent_path.first()
+    if parent_path is None:
+        return []
+    children_path = f"{parent_path.path or ''}{parent_id}/"
+
     objects = await session.execute(
-        select(Obj).where(Obj.parent_id == parent_id)
+        select(Obj).where(path_startswith(children_path))
     )
-    objects: list[Obj] = objects.scalars().all()
-    result = []
-    for o in objects:
-        child = await create_tree_from_parent(o.id, session)
-        if len(child) == 0:
-            child = None
-        result.append(ObjResponseNew(**o.dict(), child=child))
+    objects_by_parent_id = defaultdict(list)
+    for o in objects.scalars().all():
+        objects_by_parent_id[o.parent_id].append(o)
+
+    def create_tree(node_id: UUID) -> list[ObjResponseNew]:
+        result = []
+        for o in objects_by_parent_id.get(node_id, []):
+            child = create_tree(o.id)
+            if len(child) == 0:
+                child = None
+            result.append(ObjResponseNew(**o.dict(), child=child))
+        return result
+
+    return create_tree(parent_id)
 
-    return result
+
+def get_depth_of_path():
+    """Returns count of ancestors of node by count of separators in its path"""
+    return func.length(Obj.path) - func.length(func.replace(Obj.path, "/", ""))
+
+
+async def get_depth_to_load_subtree(
+    children_path: str,
+    session: AsyncSession,
+    max_depth: int | None = TREE_MAX_DEPTH,
+    max_nodes: int | None = TREE_MAX_NODES,
+) -> tuple[int | None, bool]:
+    """Returns the deepest depth of path of descendants that keeps subtree in
+    max_depth levels and max_nodes nodes, and whether deeper descendants exist.
+    Depth of children of node is always loaded"""
+    depth = get_depth_of_path()
+    stmt = (
+        select(depth.label("depth"), func.count().label("count"))
+        .where(path_startswith(children_path))
+        .group_by(depth)
+        .order_by(depth)
+    )
+    counts_by_depth = (await session.execute(stmt)).all()
+    if not counts_by_depth:
+        return None, False
+
+    children_depth = counts_by_depth[0].depth
+    depth_to_load = children_depth
+    count_of_nodes = 0
+    for item in counts_by_depth:
+        count_of_nodes += item.count
+        if item.depth != children_depth and (
+            (max_depth is not None and item.depth - children_depth >= max_depth)
+            or (max_nodes is not None and count_of_nodes > max_nodes)
+        ):
+            return depth_to_load, True
+        depth_to_load = item.depth
+    return depth_to_load, False
 
 
 async def create_tree_from_parent_node(
     parent_node: Obj,
     session: AsyncSession,
     consider_nodes_with_default_key: bool = True,
-):
-    objects = await session.execute(
-        select(Obj).where(Obj.parent_id == parent_node.id)
+    max_depth: int | None = TREE_MAX_DEPTH,
+    max_nodes: int | None = TREE_MAX_NODES,
+) -> tuple[list[ObjResponseNew], bool]:
+    """Returns tree of descendants of parent node and whether its children are
+    truncated. Descendants are loaded by prefix of their paths in one query and
+    are grouped by parents in memory.
+    Tree is cut by max_depth levels and max_nodes nodes, nodes of the last loaded
+    level which have children are returned with truncated equal to True. If parent
+    node has more than max_nodes children, first max_nodes of them are returned.
+    If consider_nodes_with_default_key is False, nodes with default key and their
+    descendants are skipped and are not counted in child_count of parents"""
+    children_path = f"{parent_node.path or ''}{parent_node.id}/"
+    depth_to_load, is_truncated = await get_depth_to_load_subtree(
+        children_path=children_path,
+        session=session,
+        max_depth=max_depth,
+        max_nodes=max_nodes,
     )
-    objects: list[Obj] = objects.scalars().all()
+    if depth_to_load is None:
+        return [], False
 
+    stmt = select(Obj).where(
+        path_startswith(children_path), get_depth_of_path() <= depth_to_load
+    )
+    # only children are loaded if they are more than max_nodes, one more child
+    # is loaded to know that they are truncated
+    children_are_loaded_by_limit = (
+        max_nodes is not None and depth_to_load == children_path.count("/")
+    )
+    if children_are_loaded_by_limit:
+        stmt = stmt.order_by(Obj.key, Obj.id).limit(max_nodes + 1)
+    objects: list[Obj] = (await session.execute(stmt)).scalars().all()
+    children_are_truncated = (
+        children_are_loaded_by_limit and len(objects) > max_nodes
+    )
+    if children_are_truncated:
+        objects = objects[:max_nodes]
     objects = await update_nodes_key_if_mo_link_or_prm_link(objects, session)
 
-    result = []
-    if not consider_nodes_with_default_key:
-        for o in objects:
-            if o.key == DEFAULT_KEY_OF_NULL_NODE:
-                parent_node.child_count -= 1
+    objects_by_parent_id = defaultdict(list)
+    for o in objects:
+        objects_by_parent_id[o.parent_id].append(o)
+
+    def create_tree(node_id: UUID) -> tuple[list[ObjResponseNew], int]:
+        """Returns children of node and count of skipped children"""
+        result = []
+        skipped = 0
+        for o in objects_by_parent_id.get(node_id, []):
+            if (
+                not consider_nodes_with_default_key
+                and o.key == DEFAULT_KEY_OF_NULL_NODE
+            ):
+                skipped += 1
                 continue
-            child = await create_tree_from_parent_node(
-                o, session, consider_nodes_with_default_key
+            child, skipped_of_child = create_tree(o.id)
+            result.append(
+                ObjResponseNew(
+                    **o.dict(exclude={"child_count"}),
+                    child_count=o.child_count - skipped_of_child,
+                    child=child or None,
+                    truncated=is_truncated
+                    and o.child_count > 0
+                    and o.path.count("/") == depth_to_load,
+                )
             )
-            if len(child) == 0:
-                child = None
-            result.append(ObjResponseNew(**o.dict(), child=child))
-    else:
-        for o in objects:
-            child = await create_tree_from_parent_node(o, session)
-            if len(child) == 0:
-                child = None
-            result.append(ObjResponseNew(**o.dict(), child=child))
+        return result, skipped
 
-    return result
+    result, skipped = create_tree(parent_node.id)
+    parent_node.child_count -= skipped
+    return result, children_are_truncated
 
 
 # LEVEL
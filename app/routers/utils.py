@@ -13,13 +13,13 @@ from common_utils.elastic_client import ElasticClient
 from common_utils.hierarchy_builder import DEFAULT_KEY_OF_NULL_NODE
 from common_utils.hierarchy_filter import HierarchyFilter
 from grpc_config.inventory_utils import (
-    get_mo_data_by_mo_ids,
-    get_mo_prm_data_by_prm_ids,
     get_tprms_data_by_tprms_ids,
 )
 from grpc_config.protobuf import mo_info_pb2_grpc
 from grpc_config.protobuf.mo_info_pb2 import RequestTMOlifecycleByTMOidList
 from schemas.hier_schemas import Hierarchy, Level, Obj
+from services.hierarchy.metadata.cache import hierarchy_metadata_cache
+from services.link_keys.cache import link_keys_cache
 from settings import INV_HOST, INVENTORY_GRPC_PORT
 
 
@@ -132,54 +132,27 @@ async def update_nodes_key_if_mo_link_or_prm_link(
                     list_to_update_key.append(item)
 
         if node_change_key_to_mo_name or node_change_key_to_prm_value:
-            async with grpc.aio.insecure_channel(
-                f"{INV_HOST}:{INVENTORY_GRPC_PORT}"
-            ) as channel:
-                if node_change_key_to_mo_name:
-                    # get mo data
-                    node_keys = [
-                        int(node.key) for node in node_change_key_to_mo_name
-                    ]
-                    mo_link_data_gen = get_mo_data_by_mo_ids(
-                        channel, mo_ids=node_keys
-                    )
-                    mo_link_data_dict = dict()
-                    async for msg in mo_link_data_gen:
-                        for mo_data in msg.list_of_mo:
-                            mo_link_data_dict[str(mo_data.id)] = {
-                                "name": mo_data.name,
-                                "id": mo_data.id,
-                                "tmo_id": mo_data.tmo_id,
-                            }
-
-                    for res_item in node_change_key_to_mo_name:
-                        value_exists = mo_link_data_dict.get(res_item.key, None)
-                        if value_exists is not None:
-                            res_item.key = value_exists["name"]
-                            res_item.object_id = value_exists["id"]
-                            res_item.object_type_id = value_exists["tmo_id"]
-
-                if node_change_key_to_prm_value:
-                    # get prm data
-                    node_keys = [
-                        int(node.key) for node in node_change_key_to_prm_value
-                    ]
-                    prm_link_data_gen = get_mo_prm_data_by_prm_ids(
-                        channel, prm_ids=node_keys
-                    )
-                    prm_link_data_dict = dict()
-                    async for msg in prm_link_data_gen:
-                        for prm_data in msg.list_of_prm:
-                            prm_link_data_dict[str(prm_data.id)] = (
-                                prm_data.value
-                            )
-
-                    for res_item in node_change_key_to_prm_value:
-                        value_exists = prm_link_data_dict.get(
-                            res_item.key, None
-                        )
-                        if value_exists is not None:
-                            res_item.key = value_exists
+            (
+                mo_link_data_dict,
+                prm_link_data_dict,
+            ) = await link_keys_cache.get_mo_data_and_prm_values(
+                mo_ids=[int(node.key) for node in node_change_key_to_mo_name],
+                prm_ids=[
+                    int(node.key) for node in node_change_key_to_prm_value
+                ],
+            )
+
+            for res_item in node_change_key_to_mo_name:
+                value_exists = mo_link_data_dict.get(int(res_item.key), None)
+                if value_exists is not None:
+                    res_item.key = value_exists["name"]
+                    res_item.object_id = value_exists["id"]
+                    res_item.object_type_id = value_exists["tmo_id"]
+
+            for res_item in node_change_key_to_prm_value:
+                value_exists = prm_link_data_dict.get(int(res_item.key), None)
+                if value_exists is not None:
+                    res_item.key = value_exists
 
     return nodes
 
@@ -240,57 +213,31 @@ async def update_nodes_key_if_mo_link_or_prm_link_as_dict(
                     list_to_update_key.append(item)
 
         if node_change_key_to_mo_name or node_change_key_to_prm_value:
-            async with grpc.aio.insecure_channel(
-                f"{INV_HOST}:{INVENTORY_GRPC_PORT}"
-            ) as channel:
-                if node_change_key_to_mo_name:
-                    # get mo data
-                    node_keys = [
-                        int(node["key"]) for node in node_change_key_to_mo_name
-                    ]
-                    mo_link_data_gen = get_mo_data_by_mo_ids(
-                        channel, mo_ids=node_keys
-                    )
-                    mo_link_data_dict = dict()
-                    async for msg in mo_link_data_gen:
-                        for mo_data in msg.list_of_mo:
-                            mo_link_data_dict[str(mo_data.id)] = {
-                                "name": mo_data.name,
-                                "id": mo_data.id,
-                                "tmo_id": mo_data.tmo_id,
-                            }
-
-                    for res_item in node_change_key_to_mo_name:
-                        value_exists = mo_link_data_dict.get(
-                            res_item["key"], None
-                        )
-                        if value_exists is not None:
-                            res_item["key"] = value_exists["name"]
-                            res_item["object_id"] = value_exists["id"]
-                            res_item["object_type_id"] = value_exists["tmo_id"]
-
-                if node_change_key_to_prm_value:
-                    # get prm data
-                    node_keys = [
-                        int(node["key"])
-                        for node in node_change_key_to_prm_value
-                    ]
-                    prm_link_data_gen = get_mo_prm_data_by_prm_ids(
-                        channel, prm_ids=node_keys
-                    )
-                    prm_link_data_dict = dict()
-                    async for msg in prm_link_data_gen:
-                        for prm_data in msg.list_of_prm:
-                            prm_link_data_dict[str(prm_data.id)] = (
-                                prm_data.value
-                            )
-
-                    for res_item in node_change_key_to_prm_value:
-                        value_exists = prm_link_data_dict.get(
-                            res_item["key"], None
-                        )
-                        if value_exists is not None:
-                            res_item["key"] = value_exists
+            (
+                mo_link_data_dict,
+                prm_link_data_dict,
+            ) = await link_keys_cache.get_mo_data_and_prm_values(
+                mo_ids=[
+                    int(node["key"]) for node in node_change_key_to_mo_name
+                ],
+                prm_ids=[
+                    int(node["key"]) for node in node_change_key_to_prm_value
+                ],
+            )
+
+            for res_item in node_change_key_to_mo_name:
+                value_exists = mo_link_data_dict.get(int(res_item["key"]), None)
+                if value_exists is not None:
+                    res_item["key"] = value_exists["name"]
+                    res_item["object_id"] = value_exists["id"]
+                    res_item["object_type_id"] = value_exists["tmo_id"]
+
+            for res_item in node_change_key_to_prm_value:
+                value_exists = prm_link_data_dict.get(
+                    int(res_item["key"]), None
+                )
+                if value_exists is not None:
+                    res_item["key"] = value_exists
 
     return nodes
 
@@ -355,9 +302,8 @@ async def get_total_results(
     )
     print(f"select objects took: {time.time() - st}")
     st = time.time()
-    stmt = select(Level).where(Level.hierarchy_id == hierarchy_exist.id)
-    h_levels = await session.execute(stmt)
-    h_levels = h_levels.scalars().all()
+    metadata = await hierarchy_metadata_cache.get(hierarchy_exist.id, session)
+    h_levels = metadata.levels if metadata else []
     print(f"select levels took: {time.time() - st}")
     levels_param_type_ids_dict = {
         level.id: level.param_type_id for level in h_levels
@@ -506,9 +452,8 @@ async def get_nodes_and_real_children_for_elastic(
     nodes = nodes.scalars().all()
     print(f"select objects took: {time.time() - st}")
     st = time.time()
-    stmt = select(Level).where(Level.hierarchy_id == hierarchy_exist.id)
-    h_levels = await session.execute(stmt)
-    h_levels = h_levels.scalars().all()
+    metadata = await hierarchy_metadata_cache.get(hierarchy_exist.id, session)
+    h_levels = metadata.levels if metadata else []
     print(f"select levels took: {time.time() - st}")
     levels_param_type_ids_dict = {
         level.id: level.param_type_id for level in h_levels
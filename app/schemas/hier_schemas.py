@@ -9,6 +9,7 @@ from sqlalchemy import (
     Column,
     Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     UniqueConstraint,
@@ -296,6 +297,19 @@ class Obj(ObjBase, table=True):
         )
     )
 
+    # path is "<root id>/.../<parent id>/", so descendants of node are found
+    # by prefix of their paths with operator ^@ supported by SP-GiST index.
+    # Children of parent are read by pages sorted by key
+    __table_args__ = (
+        Index("ix_obj_path", "path", postgresql_using="spgist"),
+        Index(
+            "ix_obj_hierarchy_id_parent_id_key",
+            "hierarchy_id",
+            "parent_id",
+            "key",
+        ),
+    )
+
     def to_proto(self):
         res = dict()
         uuid_attrs = ["id", "parent_id"]
@@ -341,7 +355,7 @@ class ObjResponseNew(SQLModel):
     additional_params: str | None
     hierarchy_id: int
     level: int
-    parent_id: str | None
+    parent_id: uuid_pkg.UUID | None
     latitude: float | None
     longitude: float | None
     child_count: int = Field(default=0)
@@ -353,6 +367,17 @@ class ObjResponseNew(SQLModel):
     level_id: int | None = None
 
     child: list["ObjResponseNew"] | None = None
+    # node has children which are not returned because of limits of tree
+    truncated: bool = Field(default=False)
+
+
+class ObjPage(SQLModel):
+    """Page of children nodes. next_cursor is passed as after to get the next page,
+    it is None for the last page. total is count of all children if it was requested"""
+
+    items: list[Obj]
+    next_cursor: str | None = None
+    total: int | None = None
 
 
 class HierarchyRebuildOrder(SQLModel, table=True):
@@ -366,6 +391,47 @@ class HierarchyRebuildOrder(SQLModel, table=True):
     on_rebuild: bool = Field(default=False)
 
 
+class HierarchyBuildCheckpoint(SQLModel, table=True):
+    """
+    The database table is used to contain the progress of hierarchy build. Build which was stopped
+    continues after the last built level. heartbeat is updated while the build is alive.
+    """
+
+    __tablename__ = "hierarchy_build_checkpoint"
+
+    hierarchy_id: int = Field(
+        sa_column=Column(
+            Integer,
+            ForeignKey("hierarchy.id", ondelete="CASCADE"),
+            primary_key=True,
+            nullable=False,
+        )
+    )
+    nodes_write_mode: str
+    completed_level_ids: list[int] = Field(
+        sa_column=Column(
+            ARRAY(Integer), server_default="{}", default=list(), nullable=False
+        )
+    )
+    # counts of nodes of completed levels in order of completed_level_ids
+    completed_levels_nodes_counts: list[int] = Field(
+        sa_column=Column(
+            ARRAY(Integer), server_default="{}", default=list(), nullable=False
+        )
+    )
+    current_level_id: int | None = None
+    processed_items: int = Field(default=0)
+    last_mo_id: int | None = Field(
+        default=None, sa_column=Column(BigInteger, nullable=True)
+    )
+    started: datetime.datetime = Field(
+        default_factory=datetime.datetime.now, nullable=False
+    )
+    heartbeat: datetime.datetime = Field(
+        default_factory=datetime.datetime.now, nullable=False, index=True
+    )
+
+
 class NodeData(SQLModel, table=True):
     __tablename__ = "node_data"
 
@@ -1,33 +1,52 @@
-from collections import defaultdict, deque
+from array import array
+from collections import Counter, defaultdict
 import json
 from sys import stderr
 import traceback
-from typing import Any, AsyncGenerator, Callable, Deque
+from typing import Any, AsyncGenerator, Callable
 
 from fastapi import HTTPException
-import grpc
-from sqlalchemy import delete
+from sqlalchemy import delete, text
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlmodel import select
 from starlette import status
 
-from grpc_config.inventory_utils import (
-    get_all_mo_with_special_params_by_tmo_id,
-    get_mo_links_tprms,
-)
+from grpc_config.inventory_utils import get_mo_links_tprms
 from kafka_config.connection_handler.handler import (
     async_kafka_stopping_to_perform_a_function,
 )
 from schemas.enum_models import HierarchyStatus
 from schemas.hier_schemas import Hierarchy, Level, NodeData, Obj
+from services.hierarchy.hierarchy_builder.caches import CachedNode, NodesCache
+from services.hierarchy.hierarchy_builder.checkpoints import (
+    HierarchyBuildCheckpointer,
+)
 from services.hierarchy.hierarchy_builder.configs import (
     DEFAULT_KEY_OF_NULL_NODE,
+    NodesWriteMode,
+)
+from services.hierarchy.hierarchy_builder.dto_models import PipelineStats
+from services.hierarchy.hierarchy_builder.inventory_snapshot import (
+    InventorySnapshotCache,
+)
+from services.hierarchy.hierarchy_builder.pipeline import PrefetchedChunks
+from services.hierarchy.hierarchy_builder.process_pool import (
+    HierarchyBuilderProcessPool,
+    create_hierarchical_level_plan,
+)
+from services.hierarchy.hierarchy_builder.shadow_tables import (
+    HierarchyShadowTables,
 )
 from services.hierarchy.hierarchy_builder.utils import (
     create_path_for_children_node_by_parent_node,
+    get_level_tprm_ids,
     get_node_key_data,
 )
-from settings import INV_HOST, INVENTORY_GRPC_PORT
+from services.hierarchy.hierarchy_builder.writers import (
+    NODES_WRITERS,
+    CopyNodesWriter,
+)
+from settings import HierarchyBuilderConfigs
 
 
 class HierarchyBuilderV2:
@@ -37,12 +56,74 @@ class HierarchyBuilderV2:
         hierarchy_id: int,
         default_key_of_null_node: str = DEFAULT_KEY_OF_NULL_NODE,
         create_empty_nodes: bool = True,
+        nodes_write_mode: NodesWriteMode = NodesWriteMode.ORM,
+        nodes_flush_limit: int | None = None,
+        pipeline_queue_depth: int | None = None,
+        cache_memory_budget: int | None = None,
+        on_level_built: Callable[[int, int], None] | None = None,
+        inventory_snapshot_cache: InventorySnapshotCache | None = None,
+        inventory_snapshot_readers: Counter[int] | None = None,
+        resume: bool = False,
     ):
         self.db_session = db_session
+        builder_configs = HierarchyBuilderConfigs()
+        self.nodes_flush_limit = (
+            nodes_flush_limit
+            if nodes_flush_limit is not None
+            else builder_configs.nodes_flush_limit
+        )
+        self.pipeline_queue_depth = (
+            pipeline_queue_depth
+            if pipeline_queue_depth is not None
+            else builder_configs.pipeline_queue_depth
+        )
+        self.levels_pipeline_stats: dict[int, PipelineStats] = dict()
+        self.cache_memory_budget = (
+            cache_memory_budget
+            if cache_memory_budget is not None
+            else builder_configs.cache_memory_budget
+        )
+        self.cache_spill_dir = builder_configs.cache_spill_dir
+        # peak memory of nodes caches while level is being built, in bytes
+        self.levels_cache_peak_memory: dict[int, int] = dict()
+        # is called with count of built levels and count of all levels
+        self.on_level_built = on_level_built
+        # cache shared by hierarchies rebuilt together, levels of hierarchy
+        # may be registered in it when the build is scheduled, readers of
+        # this registration are released by the build
+        self.inventory_snapshot_cache = inventory_snapshot_cache
+        self.inventory_snapshot_readers = inventory_snapshot_readers
+        self.process_pool_min_items = builder_configs.process_pool_min_items
+        self.process_pool_max_workers = builder_configs.process_pool_max_workers
+        self.nodes_write_mode = NodesWriteMode(nodes_write_mode)
+        self.shadow_tables = None
+        # counts of inserted, updated and deleted nodes of the last build in diff mode
+        self.nodes_changes_stats: dict[str, int] = dict()
+        if self.nodes_write_mode in (
+            NodesWriteMode.SHADOW_COPY,
+            NodesWriteMode.DIFF,
+        ):
+            self.shadow_tables = HierarchyShadowTables(hierarchy_id)
+            self.nodes_writer = CopyNodesWriter(
+                db_session,
+                obj_table_name=self.shadow_tables.obj_table_name,
+                node_data_table_name=self.shadow_tables.node_data_table_name,
+                produce_events=False,
+            )
+        else:
+            self.nodes_writer = NODES_WRITERS[self.nodes_write_mode](db_session)
         self.hierarchy_id = hierarchy_id
+        # build continues after the last completed level of the stopped build
+        self.resume = resume
+        self.checkpointer = HierarchyBuildCheckpointer(
+            session=db_session,
+            hierarchy_id=hierarchy_id,
+            nodes_write_mode=self.nodes_write_mode.value,
+            heartbeat_interval=builder_configs.heartbeat_interval,
+        )
         self._levels = None
-        self.__prev_stage_cache = dict()
-        self.__current_stage_cache = dict()
+        self.__prev_stage_cache: dict[int, NodesCache] = dict()
+        self.__current_stage_cache: dict[int, NodesCache] = dict()
         self.default_key_of_null_node = default_key_of_null_node
         self.create_empty_nodes = create_empty_nodes
         self._node_cache_data = defaultdict(list)
@@ -170,7 +251,7 @@ class HierarchyBuilderV2:
         mo_id = mo_data.get("id")
 
         if level.key_attrs:
-            level_key_attrs = level.key_attrs
+            level_key_attrs = list(level.key_attrs)
         else:
             level_key_attrs = [level.param_type_id]
         if level.attr_as_parent:
@@ -192,7 +273,7 @@ class HierarchyBuilderV2:
         self._node_cache_data[mo_id].append(node_data)
 
     async def __add_node_data_from_cache_into_session_and_flush_and_clear_node_data_cache(
-        self, current_level_obj_cache: dict
+        self, current_level_obj_cache: NodesCache
     ):
         for mo_id, data_for_nodes in self._node_cache_data.items():
             node_from_cache = current_level_obj_cache.get(mo_id)
@@ -202,10 +283,8 @@ class HierarchyBuilderV2:
                     for node_data in data_for_nodes:
                         node_data["node_id"] = str(node_uuid)
 
-                        new = NodeData(**node_data)
-
-                        self.db_session.add(new)
-        await self.db_session.flush()
+                        self.nodes_writer.add_node_data(node_data)
+        await self.nodes_writer.flush_node_data()
         self._node_cache_data = defaultdict(list)
 
     async def _create_real_nodes(
@@ -214,8 +293,8 @@ class HierarchyBuilderV2:
         res_async_generator: AsyncGenerator,
         find_parent_function: Callable,
         level_key_attrs: list[str],
-        parent_level_cache: dict,
-        link_to_cache_of_current_level: dict,
+        parent_level_cache: NodesCache,
+        link_to_cache_of_current_level: NodesCache,
     ):
         item_counter_to_flush = 0
 
@@ -226,7 +305,7 @@ class HierarchyBuilderV2:
         )
 
         # Get mo_links tprms
-        mo_links_tprms = await get_mo_links_tprms(tmo_id=level.object_type_id)
+        mo_links_tprms = await self._get_mo_links_tprms(level.object_type_id)
         mo_links_attrs = list(
             {
                 int(attr) for attr in level_key_attrs if attr.isdigit()
@@ -258,7 +337,7 @@ class HierarchyBuilderV2:
                         parent_node
                     )
 
-                new_node = Obj(
+                new_node = self.nodes_writer.create_node(
                     key=key_data.key,
                     object_id=item.get("id"),
                     object_type_id=level.object_type_id,
@@ -276,7 +355,6 @@ class HierarchyBuilderV2:
                     active=is_active,
                     key_is_empty=key_data.key_is_empty,
                 )
-                self.db_session.add(new_node)
 
                 # add node_data
                 self.__add_node_data_to_cache(mo_data=item, level=level)
@@ -284,20 +362,19 @@ class HierarchyBuilderV2:
                 item_counter_to_flush += 1
                 if parent_node is not None:
                     if is_active:
-                        parent_node.child_count += 1
-                        self.db_session.add(parent_node)
-                link_to_cache_of_current_level[item.get("id")] = new_node
+                        self.nodes_writer.increase_child_count(parent_node)
+                link_to_cache_of_current_level.add(item.get("id"), new_node)
 
-                if item_counter_to_flush >= 25000:
+                if item_counter_to_flush >= self.nodes_flush_limit:
                     item_counter_to_flush = 0
-                    await self.db_session.flush()
+                    await self.nodes_writer.flush_nodes()
 
                     # add node data into session and flush one more time
                     await self.__add_node_data_from_cache_into_session_and_flush_and_clear_node_data_cache(
                         current_level_obj_cache=link_to_cache_of_current_level
                     )
         if item_counter_to_flush:
-            await self.db_session.flush()
+            await self.nodes_writer.flush_nodes()
 
             # add node data into session and flush one more time
             await self.__add_node_data_from_cache_into_session_and_flush_and_clear_node_data_cache(
@@ -310,14 +387,14 @@ class HierarchyBuilderV2:
         res_async_generator: AsyncGenerator,
         find_parent_function: Callable,
         level_key_attrs: list[str],
-        parent_level_cache: dict,
-        link_to_cache_of_current_level: dict,
+        parent_level_cache: NodesCache,
+        link_to_cache_of_current_level: NodesCache,
     ):
         current_virtual_level_cache = dict()
         item_counter_to_flush = 0
 
         # Get mo_links tprms
-        mo_links_tprms = await get_mo_links_tprms(tmo_id=level.object_type_id)
+        mo_links_tprms = await self._get_mo_links_tprms(level.object_type_id)
         mo_links_attrs = list(
             {int(attr) for attr in level_key_attrs}.intersection(mo_links_tprms)
         )
@@ -358,7 +435,7 @@ class HierarchyBuilderV2:
                     )
 
                 if virtual_node_exists is None:
-                    new_node = Obj(
+                    new_node = self.nodes_writer.create_node(
                         key=key_data.key,
                         object_id=None,
                         object_type_id=level.object_type_id,
@@ -374,33 +451,38 @@ class HierarchyBuilderV2:
                         level_id=level.id,
                         path=path,
                         active=is_active,
-                        key_is_emty=key_data.key_is_empty,
+                        key_is_empty=key_data.key_is_empty,
                     )
-                    self.db_session.add(new_node)
 
                     item_counter_to_flush += 1
                     if parent_node is not None:
                         if is_active:
-                            parent_node.child_count += 1
-                            self.db_session.add(parent_node)
-                    current_virtual_level_cache[current_level_key] = new_node
-                    link_to_cache_of_current_level[item.get("id")] = new_node
+                            self.nodes_writer.increase_child_count(parent_node)
+                    # virtual nodes are kept only as ids and paths,
+                    # so written nodes are not held until the level end
+                    current_virtual_level_cache[current_level_key] = CachedNode(
+                        id=new_node.id, path=new_node.path
+                    )
+                    link_to_cache_of_current_level.add(item.get("id"), new_node)
                 else:
-                    self.db_session.add(virtual_node_exists)
-                    link_to_cache_of_current_level[item.get("id")] = (
-                        virtual_node_exists
+                    link_to_cache_of_current_level.add(
+                        item.get("id"), virtual_node_exists
                     )
 
-                if item_counter_to_flush >= 25000:
+                # node data of many MO can be collected for few virtual nodes
+                if (
+                    item_counter_to_flush >= self.nodes_flush_limit
+                    or len(self._node_cache_data) >= self.nodes_flush_limit
+                ):
                     item_counter_to_flush = 0
-                    await self.db_session.flush()
+                    await self.nodes_writer.flush_nodes()
 
                     # add node data into session and flush one more time
                     await self.__add_node_data_from_cache_into_session_and_flush_and_clear_node_data_cache(
                         current_level_obj_cache=link_to_cache_of_current_level
                     )
         if item_counter_to_flush:
-            await self.db_session.flush()
+            await self.nodes_writer.flush_nodes()
 
             # add node data into session and flush one more time
             await self.__add_node_data_from_cache_into_session_and_flush_and_clear_node_data_cache(
@@ -413,207 +495,114 @@ class HierarchyBuilderV2:
         res_async_generator: AsyncGenerator,
         find_parent_function: Callable,
         level_key_attrs: list[str],
-        parent_level_cache: dict,
-        link_to_cache_of_current_level: dict,
+        parent_level_cache: NodesCache,
+        link_to_cache_of_current_level: NodesCache,
     ):
         # Get mo_links tprms
-        mo_links_tprms = await get_mo_links_tprms(tmo_id=level.object_type_id)
+        mo_links_tprms = await self._get_mo_links_tprms(level.object_type_id)
         mo_links_attrs = list(
             {int(attr) for attr in level_key_attrs}.intersection(mo_links_tprms)
         )
 
-        async def _create_flat_hierarchy_from_tprm_id(
-            _chunk: list[dict], tprm_id: int
-        ) -> dict[int | None, list[dict]]:
-            _hierarchy: dict[int | None, list[dict]] = defaultdict(list)
-            str_tprm_id = str(tprm_id)
-            for _item in _chunk:
-                parent_id = _item.get(str_tprm_id, None)
-                if parent_id == 0:
-                    parent_id = None
-                _hierarchy[parent_id].append(_item)
-            return _hierarchy
-
-        def __collect_mo_ids_to_circles(
-            _unpassed_mo_ids: set[str],
-            _flat_hierarchy: dict[str | None, list[dict]],
-        ) -> list[list[str]]:
-            _circles = []
-            # collect circles
-            _passed_circle_mo_ids = set()
-            for _mo_id in _unpassed_mo_ids:
-                _circle = []
-                _circle_queue = deque([_mo_id])
-                while _circle_queue:
-                    _circle_mo_id = _circle_queue.popleft()
-                    if _circle_mo_id in _passed_circle_mo_ids:
-                        continue
-                    _passed_circle_mo_ids.add(_circle_mo_id)
-                    _children_mo_ids = [
-                        i["id"] for i in _flat_hierarchy.get(_circle_mo_id, [])
-                    ]
-                    _circle_queue.extend(_children_mo_ids)
-                if _circle:
-                    _circles.append(_circle)
-            return _circles
-
-        def __find_best_head_of_circles(
-            _circles: list[list[str]], _all_items_by_id: dict[str, dict]
-        ) -> list[dict]:
-            _best_head_of_circles: list[dict] = []
-            for _circle in _circles:
-                best_head_of_circle: dict | None = None
-                sorted(_circle, key=lambda x: int(x))
-                for _item_id in _circle:
-                    _item = _all_items_by_id[_item_id]
-                    best_head_of_circle = _item
-                    break
-                if not best_head_of_circle:
-                    print(
-                        "Best head of circle not found for circle {}".format(
-                            _circle
-                        ),
-                        file=stderr,
-                    )
-                    continue
-                _best_head_of_circles.append(best_head_of_circle)
-            return _best_head_of_circles
-
-        async def __create_recursive(
-            _queue: Deque,
-            _top_level_ids: set[str],
-            _current_virtual_level_cache: dict,
-            _passed_mo_ids: set[str],
-            _flat_hierarchy: dict[int | None, list[dict]],
-        ):
-            f_get_addit_data = (
-                self.__get_func_to_get_key_or_additional_data_from_item(
-                    leve_param_type_id_or_attr_name=str(
-                        level.additional_params_id
-                    )
-                )
-            )
-
-            while _queue:
-                items = _queue.popleft()
-                level_result = []
-                for item in items:  # type: dict
-                    if item["id"] in _passed_mo_ids:
-                        print(
-                            f"Item with id {item['id']} passed before",
-                            file=stderr,
-                        )
-                        continue
-                    is_active = item.get("active", False)
-                    key_data = get_node_key_data(
-                        ordered_key_attrs=level_key_attrs,
-                        mo_data_with_params=item,
-                        mo_links_attrs=mo_links_attrs,
-                    )
-                    additional_p_val = f_get_addit_data(
-                        item_data=item,
-                        attr_or_param_name=str(level.additional_params_id),
-                    )
-                    if item["id"] in _top_level_ids:
-                        parent_node = find_parent_function(
-                            mo=item, parent_level_cache=parent_level_cache
-                        )
-                    else:
-                        parent_node = _current_virtual_level_cache.get(
-                            item.get(str(level.attr_as_parent), None), None
-                        )
-
-                    path = None
-                    if parent_node:
-                        path = create_path_for_children_node_by_parent_node(
-                            parent_node
-                        )
-                        if is_active:
-                            parent_node.child_count += 1
-                            self.db_session.add(parent_node)
-
-                    new_node = Obj(
-                        key=key_data.key,
-                        object_id=item.get("id"),
-                        object_type_id=level.object_type_id,
-                        additional_params=additional_p_val,
-                        hierarchy_id=level.hierarchy_id,
-                        level=level.level,
-                        latitude=None,
-                        longitude=None,
-                        child_count=0,
-                        parent_id=parent_node.id
-                        if parent_node is not None
-                        else None,
-                        level_id=level.id,
-                        path=path,
-                        active=is_active,
-                        key_is_emty=key_data.key_is_empty,
-                    )
-                    link_to_cache_of_current_level[item.get("id")] = new_node
-                    _current_virtual_level_cache[item.get("id")] = new_node
-                    self.__add_node_data_to_cache(mo_data=item, level=level)
-                    _passed_mo_ids.add(item["id"])
-                    level_result.append(new_node)
-
-                    children_items = _flat_hierarchy.get(item["id"], [])
-                    if children_items:
-                        _queue.append(children_items)
-
-                if level_result:
-                    self.db_session.add_all(level_result)
-                    await self.db_session.flush()
-
-                    await self.__add_node_data_from_cache_into_session_and_flush_and_clear_node_data_cache(
-                        current_level_obj_cache=link_to_cache_of_current_level
-                    )
-
-        current_virtual_level_cache = dict()
-
         all_items_by_id = {
             item["id"]: item
             async for chunk in res_async_generator
             for item in chunk
         }
-        flat_hierarchy = await _create_flat_hierarchy_from_tprm_id(
-            list(all_items_by_id.values()), tprm_id=level.attr_as_parent
+        items = list(all_items_by_id.values())
+
+        # grouping by parents and node keys are computed by columns of items
+        str_attr_as_parent = str(level.attr_as_parent)
+        plan_args = (
+            array("q", (item["id"] for item in items)),
+            array(
+                "q", (int(item.get(str_attr_as_parent) or 0) for item in items)
+            ),
+            level_key_attrs,
+            [
+                [item.get(key_attr) for item in items]
+                for key_attr in level_key_attrs
+            ],
+            mo_links_attrs,
         )
+        if (
+            len(items) >= self.process_pool_min_items
+            and HierarchyBuilderProcessPool.can_be_used()
+        ):
+            process_pool = HierarchyBuilderProcessPool(
+                max_workers=self.process_pool_max_workers
+            )
+            plan = await process_pool.run(
+                create_hierarchical_level_plan, *plan_args
+            )
+        else:
+            plan = create_hierarchical_level_plan(*plan_args)
 
-        passed_mo_ids: set[str] = set()
-
-        queue = flat_hierarchy.get(None, [])
-        top_level_ids = {i["id"] for i in queue}
-        if queue:
-            queue = [queue]
-        queue = deque(queue)
-        await __create_recursive(
-            _queue=queue,
-            _top_level_ids=top_level_ids,
-            _passed_mo_ids=passed_mo_ids,
-            _current_virtual_level_cache=current_virtual_level_cache,
-            _flat_hierarchy=flat_hierarchy,
+        f_get_addit_data = (
+            self.__get_func_to_get_key_or_additional_data_from_item(
+                leve_param_type_id_or_attr_name=str(level.additional_params_id)
+            )
         )
-
-        # circular references by parents
-        all_p_ids = set(all_items_by_id.keys())
-        unpassed_mo_ids = all_p_ids.difference(passed_mo_ids)
-        if unpassed_mo_ids:
-            circles = __collect_mo_ids_to_circles(
-                _unpassed_mo_ids=unpassed_mo_ids, _flat_hierarchy=flat_hierarchy
+        nodes_by_item_index = [None] * len(items)
+        item_counter_to_flush = 0
+        for item_index, parent_item_index in zip(
+            plan.order, plan.parent_indexes
+        ):
+            item = items[item_index]
+            is_active = item.get("active", False)
+            additional_p_val = f_get_addit_data(
+                item_data=item,
+                attr_or_param_name=str(level.additional_params_id),
             )
-            head_of_circles = __find_best_head_of_circles(
-                _circles=circles, _all_items_by_id=all_items_by_id
+            if parent_item_index == -1:
+                parent_node = find_parent_function(
+                    mo=item, parent_level_cache=parent_level_cache
+                )
+            else:
+                parent_node = nodes_by_item_index[parent_item_index]
+
+            path = None
+            if parent_node:
+                path = create_path_for_children_node_by_parent_node(parent_node)
+                if is_active:
+                    self.nodes_writer.increase_child_count(parent_node)
+
+            new_node = self.nodes_writer.create_node(
+                key=plan.keys[item_index],
+                object_id=item.get("id"),
+                object_type_id=level.object_type_id,
+                additional_params=additional_p_val,
+                hierarchy_id=level.hierarchy_id,
+                level=level.level,
+                latitude=None,
+                longitude=None,
+                child_count=0,
+                parent_id=parent_node.id if parent_node is not None else None,
+                level_id=level.id,
+                path=path,
+                active=is_active,
+                key_is_empty=bool(plan.keys_are_empty[item_index]),
             )
-            if head_of_circles:
-                top_level_ids.update([i["id"] for i in head_of_circles])
-                queue = deque([head_of_circles])
-                await __create_recursive(
-                    _queue=queue,
-                    _top_level_ids=top_level_ids,
-                    _passed_mo_ids=passed_mo_ids,
-                    _current_virtual_level_cache=current_virtual_level_cache,
-                    _flat_hierarchy=flat_hierarchy,
+            nodes_by_item_index[item_index] = new_node
+            link_to_cache_of_current_level.add(item.get("id"), new_node)
+            self.__add_node_data_to_cache(mo_data=item, level=level)
+
+            item_counter_to_flush += 1
+            if item_counter_to_flush >= self.nodes_flush_limit:
+                item_counter_to_flush = 0
+                await self.nodes_writer.flush_nodes()
+
+                # add node data into session and flush one more time
+                await self.__add_node_data_from_cache_into_session_and_flush_and_clear_node_data_cache(
+                    current_level_obj_cache=link_to_cache_of_current_level
                 )
+        if item_counter_to_flush:
+            await self.nodes_writer.flush_nodes()
+
+            # add node data into session and flush one more time
+            await self.__add_node_data_from_cache_into_session_and_flush_and_clear_node_data_cache(
+                current_level_obj_cache=link_to_cache_of_current_level
+            )
 
     async def _create_virtual_nodes(
         self,
@@ -621,8 +610,8 @@ class HierarchyBuilderV2:
         res_async_generator: AsyncGenerator,
         find_parent_function: Callable,
         level_key_attrs: list[str],
-        parent_level_cache: dict,
-        link_to_cache_of_current_level: dict,
+        parent_level_cache: NodesCache,
+        link_to_cache_of_current_level: NodesCache,
     ):
         if not level.attr_as_parent:
             await self._create_simple_virtual_nodes(
@@ -650,10 +639,17 @@ class HierarchyBuilderV2:
             level.parent_id, dict()
         )
 
-        self.__current_stage_cache[level.id] = dict(
-            object_type_id=level.object_type_id
+        # budget is shared by caches of all levels which are kept
+        used_cache_memory = sum(
+            cache.memory_size
+            for caches in (self.__prev_stage_cache, self.__current_stage_cache)
+            for cache in caches.values()
+        )
+        link_to_cache_of_current_level = NodesCache(
+            memory_budget=max(self.cache_memory_budget - used_cache_memory, 0),
+            spill_dir=self.cache_spill_dir,
         )
-        link_to_cache_of_current_level = self.__current_stage_cache[level.id]
+        self.__current_stage_cache[level.id] = link_to_cache_of_current_level
 
         find_parent_function = (
             await self.__get_func_to_find_parent_node_from_cache(level)
@@ -683,59 +679,245 @@ class HierarchyBuilderV2:
                 res_async_generator=res_async_generator,
             )
 
+        self.levels_cache_peak_memory[level.id] = (
+            used_cache_memory + link_to_cache_of_current_level.peak_memory_size
+        )
+
+        await self.checkpointer.complete_level(
+            level.id, nodes_count=await self._count_level_nodes(level.id)
+        )
         await self.db_session.commit()
 
         # add notes into session and commit also
 
+    async def _get_mo_links_tprms(self, tmo_id: int) -> list[int]:
+        if self.inventory_snapshot_cache is not None:
+            return await self.inventory_snapshot_cache.get_mo_links_tprms(
+                tmo_id
+            )
+        return await get_mo_links_tprms(tmo_id=tmo_id)
+
+    @staticmethod
+    def _close_caches(caches: dict[int, NodesCache]):
+        for cache in caches.values():
+            cache.close()
+
+    def _get_level_chunks(
+        self,
+        inventory_snapshot_cache: InventorySnapshotCache,
+        level: Level,
+        readers: Counter[int],
+    ):
+        """Returns chunks of MO data for level. If pipeline_queue_depth is set,
+        chunks are being read in background from the call."""
+        res_async_generator = inventory_snapshot_cache.get_chunks(
+            tmo_id=level.object_type_id,
+            tprm_ids=get_level_tprm_ids(level),
+            readers=readers,
+        )
+        if not self.pipeline_queue_depth:
+            return res_async_generator
+
+        prefetched_chunks = PrefetchedChunks(
+            source=res_async_generator, queue_depth=self.pipeline_queue_depth
+        )
+        self.levels_pipeline_stats[level.id] = prefetched_chunks.stats
+        return prefetched_chunks.start()
+
+    async def _count_level_nodes(self, level_id: int) -> int:
+        """Returns count of built nodes of level"""
+        if self.shadow_tables:
+            obj_table_name = self.shadow_tables.obj_table_name
+        else:
+            obj_table_name = Obj.__tablename__
+        res = await self.db_session.execute(
+            text(
+                f"SELECT count(*) FROM {obj_table_name} "
+                f"WHERE level_id = :level_id"
+            ),
+            {"level_id": level_id},
+        )
+        return res.scalar()
+
+    async def _completed_levels_are_kept(self) -> bool:
+        """Returns True if nodes of levels completed by the stopped build are kept.
+        Unlogged shadow tables are truncated by crash recovery of database
+        while checkpoint still has their levels."""
+        if not await self.shadow_tables.exists(self.db_session):
+            return False
+        completed_levels_nodes_count = (
+            await self.checkpointer.get_completed_levels_nodes_count()
+        )
+        if not completed_levels_nodes_count:
+            return True
+        for level_id, nodes_count in completed_levels_nodes_count.items():
+            if await self._count_level_nodes(level_id) != nodes_count:
+                print(
+                    f"Hierarchy {self.hierarchy_id} build is not resumed, "
+                    f"nodes of level {level_id} are lost"
+                )
+                return False
+        return True
+
+    async def _load_level_cache(self, level: Level) -> NodesCache:
+        """Returns cache of level built by the stopped build"""
+        if self.shadow_tables:
+            obj_table_name = self.shadow_tables.obj_table_name
+            node_data_table_name = self.shadow_tables.node_data_table_name
+        else:
+            obj_table_name = Obj.__tablename__
+            node_data_table_name = NodeData.__tablename__
+        level_cache = NodesCache(
+            memory_budget=self.cache_memory_budget,
+            spill_dir=self.cache_spill_dir,
+        )
+        stmt = text(
+            f"SELECT node_data.mo_id, obj.id, obj.path "
+            f"FROM {node_data_table_name} AS node_data "
+            f"JOIN {obj_table_name} AS obj ON obj.id = node_data.node_id "
+            f"WHERE node_data.level_id = :level_id"
+        )
+        res = await self.db_session.stream(stmt, {"level_id": level.id})
+        async for mo_id, node_id, path in res:
+            level_cache.add(mo_id, CachedNode(id=node_id, path=path))
+        return level_cache
+
+    async def _track_level_items(
+        self, level: Level, res_async_generator: AsyncGenerator
+    ):
+        async for chunk in res_async_generator:
+            yield chunk
+            self.checkpointer.track_items(level.id, chunk)
+
     async def build_hierarchy(self):
-        """Builds hierarchy. Deletes all old nodes and creates new."""
-        await self._stage1_clear_hierarchy()
+        """Builds hierarchy. Deletes all old nodes and creates new.
+        If shadow tables are used, old nodes are available until new nodes are built.
+        In diff mode nodes are built in shadow tables and only changed nodes are written.
+        If resume is set, levels completed by the stopped build are not built again."""
+        resume = self.resume
+        if resume and self.shadow_tables:
+            resume = await self._completed_levels_are_kept()
+        completed_level_ids = await self.checkpointer.start(resume=resume)
+        try:
+            await self._build_levels(completed_level_ids)
+        except BaseException:
+            await self.checkpointer.stop()
+            raise
+        await self.checkpointer.finish()
+
+    async def _build_levels(self, completed_level_ids: set[int]):
+        if completed_level_ids:
+            print(
+                f"Hierarchy {self.hierarchy_id} build is resumed, "
+                f"completed levels: {sorted(completed_level_ids)}"
+            )
+        elif self.shadow_tables:
+            await self.shadow_tables.create(self.db_session)
+        else:
+            await self._stage1_clear_hierarchy()
         level_stage = None
         levels = await self.levels
-        async with grpc.aio.insecure_channel(
-            target=f"{INV_HOST}:{INVENTORY_GRPC_PORT}",
-            options=self.inventory_grpc_channel_options,
-        ) as channel:
-            try:
-                for level in levels:
-                    if level.level != level_stage:
-                        self.__prev_stage_cache, self.__current_stage_cache = (
-                            self.__current_stage_cache,
-                            dict(),
-                        )
-                        level_stage = level.level
-
-                    tprms_ids = list()
-                    if level.key_attrs:
-                        for attr in level.key_attrs:
-                            if attr.isdigit():
-                                tprms_ids.append(int(attr))
-                    else:
-                        tprms_ids.append(level.param_type_id)
-
-                    if level.additional_params_id:
-                        tprms_ids.append(level.additional_params_id)
-
-                    if level.attr_as_parent:
-                        tprms_ids.append(level.attr_as_parent)
-
-                    if not tprms_ids:
-                        # to not return tprms data
-                        tprms_ids = [0]
-
-                    res_async_generator = (
-                        get_all_mo_with_special_params_by_tmo_id(
-                            channel=channel,
-                            tmo_id=level.object_type_id,
-                            tprm_ids=tprms_ids,
-                        )
+        levels_to_build = [
+            level for level in levels if level.id not in completed_level_ids
+        ]
+        # caches of completed levels are needed by children levels only
+        first_stage_to_build = min(
+            (level.level for level in levels_to_build), default=None
+        )
+        # levels of the same TMO read MO from Inventory once
+        inventory_snapshot_cache = self.inventory_snapshot_cache
+        if inventory_snapshot_cache is None:
+            inventory_snapshot_cache = InventorySnapshotCache(
+                channel_options=self.inventory_grpc_channel_options
+            )
+        readers = self.inventory_snapshot_readers
+        if (
+            readers is None
+            or inventory_snapshot_cache is not self.inventory_snapshot_cache
+        ):
+            readers = inventory_snapshot_cache.register_levels(levels_to_build)
+        levels_chunks = dict()
+        try:
+            for index, level in enumerate(levels):
+                if level.level != level_stage:
+                    self._close_caches(self.__prev_stage_cache)
+                    self.__prev_stage_cache, self.__current_stage_cache = (
+                        self.__current_stage_cache,
+                        dict(),
+                    )
+                    level_stage = level.level
+
+                if level.id in completed_level_ids:
+                    if (
+                        first_stage_to_build is not None
+                        and level.level >= first_stage_to_build - 1
+                    ):
+                        self.__current_stage_cache[
+                            level.id
+                        ] = await self._load_level_cache(level)
+                    continue
+
+                if level.id not in levels_chunks:
+                    levels_chunks[level.id] = self._get_level_chunks(
+                        inventory_snapshot_cache, level, readers
+                    )
+                # data of the next level is being read
+                # while nodes of the current level are written
+                next_level = next(
+                    (
+                        next_level
+                        for next_level in levels[index + 1 :]
+                        if next_level.id not in completed_level_ids
+                    ),
+                    None,
+                )
+                if self.pipeline_queue_depth and next_level is not None:
+                    levels_chunks[next_level.id] = self._get_level_chunks(
+                        inventory_snapshot_cache, next_level, readers
                     )
-                    await self._create_nodes_by_level_data(
-                        level, res_async_generator
+
+                await self._create_nodes_by_level_data(
+                    level,
+                    self._track_level_items(level, levels_chunks[level.id]),
+                )
+                del levels_chunks[level.id]
+                if level.id in self.levels_pipeline_stats:
+                    print(
+                        f"Hierarchy {self.hierarchy_id} level {level.id} "
+                        f"pipeline: {self.levels_pipeline_stats[level.id]}"
                     )
-            except Exception as e:
-                print(traceback.format_exc(), flush=True, file=stderr)
-                raise e
+                print(
+                    f"Hierarchy {self.hierarchy_id} level {level.id} "
+                    f"peak cache memory: "
+                    f"{self.levels_cache_peak_memory[level.id]} bytes"
+                )
+                if self.on_level_built is not None:
+                    self.on_level_built(index + 1, len(levels))
+        except Exception as e:
+            print(traceback.format_exc(), flush=True, file=stderr)
+            raise e
+        finally:
+            for level_chunks in levels_chunks.values():
+                if isinstance(level_chunks, PrefetchedChunks):
+                    await level_chunks.close()
+                else:
+                    await level_chunks.aclose()
+            self._close_caches(self.__prev_stage_cache)
+            self._close_caches(self.__current_stage_cache)
+            # levels which are not read by failed build do not keep snapshots
+            await inventory_snapshot_cache.release_levels(readers)
+            if inventory_snapshot_cache is not self.inventory_snapshot_cache:
+                await inventory_snapshot_cache.close()
+        if self.nodes_write_mode == NodesWriteMode.DIFF:
+            self.nodes_changes_stats = await self.shadow_tables.apply_diff(
+                self.db_session
+            )
+            print(
+                f"Hierarchy {self.hierarchy_id} nodes changes: "
+                f"{self.nodes_changes_stats}"
+            )
+        elif self.shadow_tables:
+            await self.shadow_tables.swap(self.db_session)
         self.__prev_stage_cache, self.__current_stage_cache = dict(), dict()
 
 
@@ -746,7 +928,11 @@ async def refresh_hierarchy_with_error_catch(
     """Refresh hierarchy with catching errors"""
     try:
         keeper = HierarchyBuilderV2(
-            db_session=session, hierarchy_id=hierarchy.id
+            db_session=session,
+            hierarchy_id=hierarchy.id,
+            nodes_write_mode=HierarchyBuilderConfigs().get_nodes_write_mode(
+                hierarchy_id=hierarchy.id
+            ),
         )
         await keeper.build_hierarchy()
     except Exception as ex:
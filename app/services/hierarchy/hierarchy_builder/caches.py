@@ -0,0 +1,153 @@
+"""
+Compact caches of nodes used by HierarchyBuilderV2.
+Cache of level keeps only id and path of node by MO id. Paths are shared by siblings.
+When cache exceeds its memory budget, it is moved into a local sqlite file.
+"""
+
+from array import array
+from dataclasses import dataclass
+import os
+import sqlite3
+import sys
+import tempfile
+import uuid as uuid_pkg
+
+# size of int object used as key and value of dict of indexes
+_INT_SIZE = sys.getsizeof(2**40)
+
+
+@dataclass(slots=True, frozen=True)
+class CachedNode:
+    """Node which has already been created. Enough to create children of node."""
+
+    id: uuid_pkg.UUID
+    path: str | None
+
+
+class NodesCache:
+    """Cache of nodes of level by MO ids"""
+
+    def __init__(self, memory_budget: int, spill_dir: str | None = None):
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self._indexes: dict[int, int] = dict()
+        self._ids = bytearray()
+        self._path_indexes = array("l")
+        self._paths: list[str | None] = [None]
+        self._path_indexes_by_path: dict[str | None, int] = {None: 0}
+        self._paths_size = 0
+        self._file_path: str | None = None
+        self._db: sqlite3.Connection | None = None
+        self.memory_size = 0
+        self.peak_memory_size = 0
+
+    @property
+    def is_spilled(self) -> bool:
+        return self._db is not None
+
+    def __len__(self) -> int:
+        if self._db is not None:
+            return self._db.execute("SELECT count(*) FROM nodes").fetchone()[0]
+        return len(self._indexes)
+
+    def _get_path_index(self, path: str | None) -> int:
+        path_index = self._path_indexes_by_path.get(path)
+        if path_index is None:
+            path_index = len(self._paths)
+            self._paths.append(path)
+            self._path_indexes_by_path[path] = path_index
+            self._paths_size += sys.getsizeof(path)
+        return path_index
+
+    def _get_memory_size(self) -> int:
+        return (
+            sys.getsizeof(self._indexes)
+            + 2 * _INT_SIZE * len(self._indexes)
+            + sys.getsizeof(self._ids)
+            + sys.getsizeof(self._path_indexes)
+            + sys.getsizeof(self._paths)
+            + sys.getsizeof(self._path_indexes_by_path)
+            + self._paths_size
+        )
+
+    def add(self, mo_id: int, node):
+        """Adds id and path of node into cache"""
+        if self._db is not None:
+            self._db.execute(
+                "INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)",
+                (mo_id, node.id.bytes, node.path),
+            )
+            return
+
+        self._indexes[mo_id] = len(self._path_indexes)
+        self._ids += node.id.bytes
+        self._path_indexes.append(self._get_path_index(node.path))
+
+        self.memory_size = self._get_memory_size()
+        if self.memory_size > self.peak_memory_size:
+            self.peak_memory_size = self.memory_size
+        if self.memory_size > self.memory_budget:
+            self._spill()
+
+    def get(self, mo_id: int, default=None) -> CachedNode | None:
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT node_id, path FROM nodes WHERE mo_id = ?", (mo_id,)
+            ).fetchone()
+            if row is None:
+                return default
+            return CachedNode(id=uuid_pkg.UUID(bytes=row[0]), path=row[1])
+
+        index = self._indexes.get(mo_id)
+        if index is None:
+            return default
+        return CachedNode(
+            id=uuid_pkg.UUID(
+                bytes=bytes(self._ids[index * 16 : index * 16 + 16])
+            ),
+            path=self._paths[self._path_indexes[index]],
+        )
+
+    def _spill(self):
+        """Moves cache into sqlite file"""
+        file_descriptor, self._file_path = tempfile.mkstemp(
+            prefix="hierarchy_nodes_cache_",
+            suffix=".sqlite",
+            dir=self.spill_dir,
+        )
+        os.close(file_descriptor)
+        self._db = sqlite3.connect(self._file_path)
+        # file is removed after the build, so it does not have to survive crashes
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute(
+            "CREATE TABLE nodes "
+            "(mo_id INTEGER PRIMARY KEY, node_id BLOB NOT NULL, path TEXT)"
+        )
+        self._db.executemany(
+            "INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)",
+            (
+                (
+                    mo_id,
+                    bytes(self._ids[index * 16 : index * 16 + 16]),
+                    self._paths[self._path_indexes[index]],
+                )
+                for mo_id, index in self._indexes.items()
+            ),
+        )
+        self._indexes = dict()
+        self._ids = bytearray()
+        self._path_indexes = array("l")
+        self._paths = [None]
+        self._path_indexes_by_path = {None: 0}
+        self._paths_size = 0
+        self.memory_size = 0
+
+    def close(self):
+        """Removes sqlite file of spilled cache"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        if self._file_path is not None:
+            os.remove(self._file_path)
+            self._file_path = None
@@ -0,0 +1,182 @@
+"""
+Checkpoints of hierarchy builds. Completed levels are saved in the same transaction
+as their nodes, so a stopped build can continue after the last completed level.
+Heartbeat of the build is written by a background task in a separate session.
+"""
+
+import asyncio
+import datetime
+from sys import stderr
+import traceback
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from schemas.hier_schemas import HierarchyBuildCheckpoint
+
+
+class HierarchyBuildCheckpointer:
+    def __init__(
+        self,
+        session: AsyncSession,
+        hierarchy_id: int,
+        nodes_write_mode: str,
+        heartbeat_interval: float,
+    ):
+        self.session = session
+        self.hierarchy_id = hierarchy_id
+        self.nodes_write_mode = nodes_write_mode
+        self.heartbeat_interval = heartbeat_interval
+        self._heartbeat_session_maker = async_sessionmaker(
+            session.bind, expire_on_commit=False
+        )
+        self._heartbeat_task: asyncio.Task | None = None
+        self.completed_level_ids: list[int] = list()
+        self.completed_levels_nodes_counts: list[int] = list()
+        self.current_level_id: int | None = None
+        self.processed_items = 0
+        self.last_mo_id: int | None = None
+
+    async def start(self, resume: bool) -> set[int]:
+        """Creates checkpoint of the build and starts heartbeat.
+        Returns ids of completed levels if the stopped build is resumed."""
+        async with self._heartbeat_session_maker() as session:
+            checkpoint = await session.get(
+                HierarchyBuildCheckpoint, self.hierarchy_id
+            )
+            if (
+                resume
+                and checkpoint is not None
+                and checkpoint.nodes_write_mode == self.nodes_write_mode
+            ):
+                self.completed_level_ids = list(checkpoint.completed_level_ids)
+                self.completed_levels_nodes_counts = list(
+                    checkpoint.completed_levels_nodes_counts
+                )
+            else:
+                if checkpoint is None:
+                    checkpoint = HierarchyBuildCheckpoint(
+                        hierarchy_id=self.hierarchy_id,
+                        nodes_write_mode=self.nodes_write_mode,
+                    )
+                checkpoint.nodes_write_mode = self.nodes_write_mode
+                checkpoint.completed_level_ids = list()
+                checkpoint.completed_levels_nodes_counts = list()
+                checkpoint.started = datetime.datetime.now()
+            checkpoint.current_level_id = None
+            checkpoint.processed_items = 0
+            checkpoint.last_mo_id = None
+            checkpoint.heartbeat = datetime.datetime.now()
+            session.add(checkpoint)
+            await session.commit()
+
+        self._heartbeat_task = asyncio.create_task(self._beat())
+        return set(self.completed_level_ids)
+
+    async def get_completed_levels_nodes_count(self) -> dict[int, int] | None:
+        """Returns counts of nodes of levels completed by the stopped build
+        by level id or None if there is no checkpoint of the build"""
+        async with self._heartbeat_session_maker() as session:
+            checkpoint = await session.get(
+                HierarchyBuildCheckpoint, self.hierarchy_id
+            )
+            if checkpoint is None:
+                return None
+            return dict(
+                zip(
+                    checkpoint.completed_level_ids,
+                    checkpoint.completed_levels_nodes_counts,
+                )
+            )
+
+    def track_items(self, level_id: int, items: list[dict]):
+        """Remembers progress of level, it is written with the next heartbeat"""
+        if level_id != self.current_level_id:
+            self.current_level_id = level_id
+            self.processed_items = 0
+        self.processed_items += len(items)
+        if items:
+            self.last_mo_id = items[-1].get("id")
+
+    async def complete_level(self, level_id: int, nodes_count: int):
+        """Adds level into completed levels. Change is committed with nodes of level."""
+        self.completed_level_ids.append(level_id)
+        self.completed_levels_nodes_counts.append(nodes_count)
+        self.current_level_id = None
+        self.processed_items = 0
+        self.last_mo_id = None
+        stmt = (
+            update(HierarchyBuildCheckpoint)
+            .where(HierarchyBuildCheckpoint.hierarchy_id == self.hierarchy_id)
+            .values(
+                completed_level_ids=self.completed_level_ids,
+                completed_levels_nodes_counts=self.completed_levels_nodes_counts,
+                current_level_id=None,
+                processed_items=0,
+                last_mo_id=None,
+                heartbeat=datetime.datetime.now(),
+            )
+        )
+        await self.session.execute(stmt)
+
+    async def _write_heartbeat(self):
+        async with self._heartbeat_session_maker() as session:
+            stmt = (
+                update(HierarchyBuildCheckpoint)
+                .where(
+                    HierarchyBuildCheckpoint.hierarchy_id == self.hierarchy_id
+                )
+                .values(
+                    current_level_id=self.current_level_id,
+                    processed_items=self.processed_items,
+                    last_mo_id=self.last_mo_id,
+                    heartbeat=datetime.datetime.now(),
+                )
+            )
+            await session.execute(stmt)
+            await session.commit()
+
+    async def _beat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self._write_heartbeat()
+            except Exception:
+                print(traceback.format_exc(), flush=True, file=stderr)
+
+    async def stop(self):
+        """Stops heartbeat. Checkpoint is kept to resume the build."""
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            try:
+                await self._heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self._heartbeat_task = None
+
+    async def finish(self):
+        """Stops heartbeat and deletes checkpoint of the completed build"""
+        await self.stop()
+        async with self._heartbeat_session_maker() as session:
+            stmt = delete(HierarchyBuildCheckpoint).where(
+                HierarchyBuildCheckpoint.hierarchy_id == self.hierarchy_id
+            )
+            await session.execute(stmt)
+            await session.commit()
+
+
+async def get_stalled_hierarchy_ids(
+    session: AsyncSession,
+    hierarchy_ids: list[int],
+    heartbeat_timeout: float,
+) -> set[int]:
+    """Returns ids of hierarchies whose builds have not sent heartbeat for heartbeat_timeout seconds
+    or have not been started"""
+    stmt = select(HierarchyBuildCheckpoint.hierarchy_id).where(
+        HierarchyBuildCheckpoint.hierarchy_id.in_(hierarchy_ids),
+        HierarchyBuildCheckpoint.heartbeat
+        >= datetime.datetime.now()
+        - datetime.timedelta(seconds=heartbeat_timeout),
+    )
+    alive_hierarchy_ids = await session.execute(stmt)
+    return set(hierarchy_ids).difference(alive_hierarchy_ids.scalars().all())
@@ -1 +1,18 @@
+from enum import Enum
+
 DEFAULT_KEY_OF_NULL_NODE = "Null"
+
+
+class NodesWriteMode(str, Enum):
+    """Ways of writing nodes and node data while hierarchy building"""
+
+    # nodes are added into session and inserted by the unit of work
+    ORM = "orm"
+    # nodes are inserted with COPY bypassing the unit of work
+    COPY = "copy"
+    # nodes are inserted with COPY into shadow tables, which replace
+    # the current nodes of hierarchy in one transaction after the build
+    SHADOW_COPY = "shadow_copy"
+    # nodes are inserted with COPY into shadow tables, only differences between
+    # them and the current nodes are written, nodes which are not changed keep their ids
+    DIFF = "diff"
@@ -5,3 +5,13 @@ from dataclasses import dataclass
 class KeyData:
     key: str
     key_is_empty: bool
+
+
+@dataclass
+class PipelineStats:
+    chunks: int = 0
+    items: int = 0
+    # time the Inventory stream waited for free place in the queue
+    producer_stall_time: float = 0.0
+    # time the builder waited for chunks from the Inventory stream
+    consumer_stall_time: float = 0.0
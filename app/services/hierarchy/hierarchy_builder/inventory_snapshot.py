@@ -0,0 +1,227 @@
+"""
+Snapshots of Inventory MO shared by levels and hierarchies rebuilt together.
+MO of TMO used by several levels are read from Inventory once with all parameters
+needed by these levels and are kept in columnar form until all levels have read them.
+Every build registers its levels before it starts and releases them when it ends,
+so snapshots of levels of failed builds are not kept.
+"""
+
+from array import array
+import asyncio
+from collections import Counter, defaultdict
+from typing import Any, AsyncGenerator, Iterable
+
+import grpc
+
+from grpc_config.inventory_utils import (
+    get_all_mo_with_special_params_by_tmo_id,
+    get_mo_links_tprms,
+)
+from schemas.hier_schemas import Level
+from services.hierarchy.hierarchy_builder.utils import get_level_tprm_ids
+from settings import INV_HOST, INVENTORY_GRPC_PORT
+
+_MISSING = object()
+
+
+class ColumnarChunk:
+    """Chunk of MO data stored by columns instead of dict per MO"""
+
+    __slots__ = ("ids", "columns")
+
+    def __init__(self, items: list[dict]):
+        self.ids = array("q", (item["id"] for item in items))
+        keys = {key for item in items for key in item}
+        keys.discard("id")
+        self.columns: dict[str, list[Any]] = {
+            key: [item.get(key, _MISSING) for item in items] for key in keys
+        }
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def to_items(self) -> list[dict]:
+        """Returns new dicts of MO, so readers can change them"""
+        items = [{"id": mo_id} for mo_id in self.ids]
+        for key, column in self.columns.items():
+            for item, value in zip(items, column):
+                if value is not _MISSING:
+                    item[key] = value
+        return items
+
+
+class TMOSnapshot:
+    """MO of TMO being read from Inventory. Readers get chunks as soon as they are read."""
+
+    def __init__(self, tmo_id: int, tprm_ids: frozenset[int]):
+        self.tmo_id = tmo_id
+        self.tprm_ids = tprm_ids
+        self.chunks: list[ColumnarChunk] = list()
+        self.is_complete = False
+        self.error: BaseException | None = None
+        self._changed = asyncio.Condition()
+        self._task: asyncio.Task | None = None
+
+    def start(self, channel: grpc.aio.Channel):
+        self._task = asyncio.create_task(self._read(channel))
+
+    async def _read(self, channel: grpc.aio.Channel):
+        try:
+            async for chunk in get_all_mo_with_special_params_by_tmo_id(
+                channel=channel,
+                tmo_id=self.tmo_id,
+                tprm_ids=sorted(self.tprm_ids) or [0],
+            ):
+                async with self._changed:
+                    self.chunks.append(ColumnarChunk(chunk))
+                    self._changed.notify_all()
+        except BaseException as e:
+            self.error = e
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            async with self._changed:
+                self.is_complete = True
+                self._changed.notify_all()
+
+    async def iter_chunks(self) -> AsyncGenerator[list[dict], None]:
+        index = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(
+                    lambda: index < len(self.chunks) or self.is_complete
+                )
+            if index < len(self.chunks):
+                yield self.chunks[index].to_items()
+                index += 1
+                continue
+            if self.error is not None:
+                raise self.error
+            return
+
+    async def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+class InventorySnapshotCache:
+    """Snapshots of TMO for levels of hierarchies rebuilt together.
+    Levels have to be registered before they are built and released after the build,
+    readers returned by registration are passed with reads of their levels.
+    TMO read by one level are streamed without snapshot."""
+
+    def __init__(self, channel_options: list[tuple[str, Any]] | None = None):
+        self.channel_options = channel_options
+        self._channel: grpc.aio.Channel | None = None
+        self._readers_count: dict[int, int] = defaultdict(int)
+        self._tprm_ids: dict[int, set[int]] = defaultdict(set)
+        self._snapshots: dict[int, TMOSnapshot] = dict()
+        self._mo_links_tprms: dict[int, asyncio.Task] = dict()
+        self.stats = {"inventory_streams": 0, "served_from_snapshot": 0}
+
+    @property
+    def channel(self) -> grpc.aio.Channel:
+        if self._channel is None:
+            self._channel = grpc.aio.insecure_channel(
+                target=f"{INV_HOST}:{INVENTORY_GRPC_PORT}",
+                options=self.channel_options,
+            )
+        return self._channel
+
+    def register_levels(self, levels: Iterable[Level]) -> Counter[int]:
+        """Returns counts of registered levels by TMO id, which are not read yet"""
+        readers = Counter()
+        for level in levels:
+            readers[level.object_type_id] += 1
+            self._readers_count[level.object_type_id] += 1
+            self._tprm_ids[level.object_type_id].update(
+                get_level_tprm_ids(level)
+            )
+        return readers
+
+    async def release_levels(self, readers: Counter[int]):
+        """Releases registered levels which have not read their TMO,
+        is called when build of levels is finished or failed"""
+        for tmo_id, count in readers.items():
+            await self._release_tmo(tmo_id, count)
+        readers.clear()
+
+    async def _release_tmo(self, tmo_id: int, count: int):
+        self._readers_count[tmo_id] = max(
+            self._readers_count[tmo_id] - count, 0
+        )
+        if self._readers_count[tmo_id]:
+            return
+        # all registered levels have read the snapshot or are released
+        self._readers_count.pop(tmo_id, None)
+        self._tprm_ids.pop(tmo_id, None)
+        snapshot = self._snapshots.pop(tmo_id, None)
+        if snapshot is not None:
+            await snapshot.close()
+
+    async def get_chunks(
+        self,
+        tmo_id: int,
+        tprm_ids: list[int],
+        readers: Counter[int] | None = None,
+    ) -> AsyncGenerator[list[dict], None]:
+        """Returns chunks of MO of TMO with parameters tprm_ids at least.
+        Level is released after the read if readers of its registration are passed."""
+        tprm_ids = {tprm_id for tprm_id in tprm_ids if tprm_id}
+        is_registered = readers is not None and readers[tmo_id] > 0
+        snapshot = self._snapshots.get(tmo_id)
+        if not is_registered or (
+            snapshot is not None and not tprm_ids.issubset(snapshot.tprm_ids)
+        ):
+            # snapshot may be released while not registered level reads it,
+            # parameters of levels registered later are read separately
+            snapshot = None
+        elif snapshot is None and self._readers_count[tmo_id] > 1:
+            snapshot = TMOSnapshot(
+                tmo_id=tmo_id,
+                tprm_ids=frozenset(self._tprm_ids[tmo_id] | tprm_ids),
+            )
+            snapshot.start(self.channel)
+            self._snapshots[tmo_id] = snapshot
+            self.stats["inventory_streams"] += 1
+        elif snapshot is not None:
+            self.stats["served_from_snapshot"] += 1
+
+        try:
+            if snapshot is None:
+                self.stats["inventory_streams"] += 1
+                async for chunk in get_all_mo_with_special_params_by_tmo_id(
+                    channel=self.channel,
+                    tmo_id=tmo_id,
+                    tprm_ids=sorted(tprm_ids) or [0],
+                ):
+                    yield chunk
+            else:
+                async for chunk in snapshot.iter_chunks():
+                    yield chunk
+        finally:
+            if is_registered:
+                readers[tmo_id] -= 1
+                await self._release_tmo(tmo_id, 1)
+
+    async def get_mo_links_tprms(self, tmo_id: int) -> list[int]:
+        """Returns ids of mo_link TPRMs of TMO. Every TMO is requested once."""
+        if tmo_id not in self._mo_links_tprms:
+            self._mo_links_tprms[tmo_id] = asyncio.create_task(
+                get_mo_links_tprms(tmo_id=tmo_id)
+            )
+        return await asyncio.shield(self._mo_links_tprms[tmo_id])
+
+    async def close(self):
+        for snapshot in self._snapshots.values():
+            await snapshot.close()
+        self._snapshots = dict()
+        self._readers_count = defaultdict(int)
+        self._tprm_ids = defaultdict(set)
+        if self._channel is not None:
+            await self._channel.close()
+            self._channel = None
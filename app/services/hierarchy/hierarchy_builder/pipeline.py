@@ -0,0 +1,70 @@
+"""
+Prefetching of Inventory chunks for HierarchyBuilderV2.
+Chunks are read from the gRPC stream by a background task into a bounded queue,
+so the stream of the next chunks overlaps with writing of the previous ones.
+"""
+
+import asyncio
+from contextlib import suppress
+import time
+from typing import AsyncGenerator
+
+from services.hierarchy.hierarchy_builder.dto_models import PipelineStats
+
+
+class _SourceError:
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+class PrefetchedChunks:
+    _END_OF_SOURCE = object()
+
+    def __init__(self, source: AsyncGenerator, queue_depth: int):
+        self.source = source
+        self.stats = PipelineStats()
+        self._queue = asyncio.Queue(maxsize=queue_depth)
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> "PrefetchedChunks":
+        """Starts reading of source in background task"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._read_source())
+        return self
+
+    async def _put(self, item):
+        start_time = time.perf_counter()
+        await self._queue.put(item)
+        self.stats.producer_stall_time += time.perf_counter() - start_time
+
+    async def _read_source(self):
+        try:
+            async for chunk in self.source:
+                await self._put(chunk)
+        except Exception as e:
+            await self._put(_SourceError(e))
+        else:
+            await self._put(self._END_OF_SOURCE)
+
+    async def __aiter__(self):
+        self.start()
+        while True:
+            start_time = time.perf_counter()
+            chunk = await self._queue.get()
+            self.stats.consumer_stall_time += time.perf_counter() - start_time
+
+            if chunk is self._END_OF_SOURCE:
+                break
+            if isinstance(chunk, _SourceError):
+                raise chunk.exception
+
+            self.stats.chunks += 1
+            self.stats.items += len(chunk)
+            yield chunk
+
+    async def close(self):
+        """Stops reading of source if it is not finished"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
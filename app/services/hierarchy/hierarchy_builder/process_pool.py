@@ -0,0 +1,132 @@
+"""
+CPU-bound computations of HierarchyBuilderV2 performed in worker processes.
+Workers receive data of MO as compact arrays and columns instead of MO dicts.
+"""
+
+from array import array
+import asyncio
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import multiprocessing
+from typing import Any
+
+from services.hierarchy.hierarchy_builder.utils import get_node_key_data
+from services.meta_singleton.impl import SingletonMeta
+
+
+@dataclass
+class HierarchicalLevelPlan:
+    # indexes of items in order of nodes creation, parents go before children
+    order: array
+    # index of parent item for every item of order,
+    # -1 if parent node has to be found in parent level
+    parent_indexes: array
+    # node keys and key_is_empty flags by item index
+    keys: list[str]
+    keys_are_empty: array
+
+
+def create_hierarchical_level_plan(
+    mo_ids: array,
+    parent_mo_ids: array,
+    key_attrs: list[str],
+    key_columns: list[list[Any]],
+    mo_links_attrs: list[int],
+) -> HierarchicalLevelPlan:
+    """Groups items of hierarchical virtual level by parents, breaks circular references by parents
+    and computes node keys.
+    Items whose parent is not among items of level are children of nodes from parent level.
+    Every circle of items is created starting from the item with the least id."""
+    index_by_mo_id = {mo_id: index for index, mo_id in enumerate(mo_ids)}
+    children_indexes: dict[int, list[int]] = defaultdict(list)
+    top_indexes = []
+    for index, parent_mo_id in enumerate(parent_mo_ids):
+        parent_index = (
+            index_by_mo_id.get(parent_mo_id) if parent_mo_id else None
+        )
+        if parent_index is None:
+            top_indexes.append(index)
+        else:
+            children_indexes[parent_index].append(index)
+
+    order = array("q")
+    parent_indexes = array("q")
+    passed = bytearray(len(mo_ids))
+
+    def create_from_heads(head_indexes: list[int]):
+        queue = deque((index, -1) for index in head_indexes)
+        while queue:
+            index, parent_index = queue.popleft()
+            if passed[index]:
+                continue
+            passed[index] = 1
+            order.append(index)
+            parent_indexes.append(parent_index)
+            queue.extend(
+                (child_index, index)
+                for child_index in children_indexes.get(index, [])
+            )
+
+    create_from_heads(top_indexes)
+    if len(order) < len(mo_ids):
+        # circular references by parents
+        for index in sorted(range(len(mo_ids)), key=mo_ids.__getitem__):
+            if not passed[index]:
+                create_from_heads([index])
+
+    keys = []
+    keys_are_empty = array("b")
+    for index in range(len(mo_ids)):
+        item_key_data = {
+            key_attr: column[index]
+            for key_attr, column in zip(key_attrs, key_columns)
+            if column[index] is not None
+        }
+        key_data = get_node_key_data(
+            ordered_key_attrs=key_attrs,
+            mo_data_with_params=item_key_data,
+            mo_links_attrs=mo_links_attrs,
+        )
+        keys.append(key_data.key)
+        keys_are_empty.append(key_data.key_is_empty)
+
+    return HierarchicalLevelPlan(
+        order=order,
+        parent_indexes=parent_indexes,
+        keys=keys,
+        keys_are_empty=keys_are_empty,
+    )
+
+
+class HierarchyBuilderProcessPool(metaclass=SingletonMeta):
+    """Pool of worker processes shared by all hierarchy builds of the process"""
+
+    def __init__(self, max_workers: int | None = None):
+        self.max_workers = max_workers
+        self._executor: ProcessPoolExecutor | None = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # workers are spawned, because forking of the process with
+            # running gRPC and database connections is not safe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    @staticmethod
+    def can_be_used() -> bool:
+        """Daemonic processes, as consumer processes, are not allowed to have children"""
+        return not multiprocessing.current_process().daemon
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
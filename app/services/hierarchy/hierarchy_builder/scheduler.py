@@ -0,0 +1,193 @@
+"""
+Scheduler of hierarchy rebuilds. Independent hierarchies are rebuilt concurrently,
+every build uses its own session. Count of concurrent builds is limited by
+the budgets of database connections and Inventory streams.
+"""
+
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime
+from enum import Enum
+from heapq import heappop, heappush
+import itertools
+from sys import stderr
+import traceback
+from typing import Awaitable, Callable
+
+from services.meta_singleton.impl import SingletonMeta
+from settings import HierarchyBuilderConfigs
+
+
+class RebuildTaskStatus(str, Enum):
+    QUEUED = "queued"
+    IN_PROCESS = "in_process"
+    COMPLETE = "complete"
+    ERROR = "error"
+
+
+@dataclass(eq=False)
+class HierarchyRebuildTask:
+    hierarchy_id: int
+    build_function: Callable[["HierarchyRebuildTask"], Awaitable]
+    # tasks with less priority are started first
+    priority: int = 0
+    status: RebuildTaskStatus = RebuildTaskStatus.QUEUED
+    levels_count: int | None = None
+    built_levels_count: int = 0
+    error: str | None = None
+    queued_at: datetime = field(default_factory=datetime.now)
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    finished: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def on_level_built(self, built_levels_count: int, levels_count: int):
+        self.built_levels_count = built_levels_count
+        self.levels_count = levels_count
+
+
+class HierarchyRebuildScheduler(metaclass=SingletonMeta):
+    """Queue of hierarchy rebuilds shared by all requests of the process"""
+
+    def __init__(
+        self,
+        max_concurrent_builds: int | None = None,
+        db_connections_budget: int | None = None,
+        inventory_streams_budget: int | None = None,
+    ):
+        builder_configs = HierarchyBuilderConfigs()
+        self.max_concurrent_builds = (
+            max_concurrent_builds
+            if max_concurrent_builds is not None
+            else builder_configs.rebuild_max_concurrent_builds
+        )
+        self.db_connections_budget = (
+            db_connections_budget
+            if db_connections_budget is not None
+            else builder_configs.rebuild_db_connections_budget
+        )
+        self.inventory_streams_budget = (
+            inventory_streams_budget
+            if inventory_streams_budget is not None
+            else builder_configs.rebuild_inventory_streams_budget
+        )
+        # stream of the next level is opened while the current one is read
+        self.inventory_streams_per_build = (
+            2 if builder_configs.pipeline_queue_depth else 1
+        )
+        self._queue: list[tuple[int, int, HierarchyRebuildTask]] = list()
+        self._sequence = itertools.count()
+        self._tasks: dict[int, HierarchyRebuildTask] = dict()
+        self._workers: set[asyncio.Task] = set()
+
+    @property
+    def max_workers(self) -> int:
+        """Count of concurrent builds allowed by the budgets. Every build uses
+        one database connection and inventory_streams_per_build streams."""
+        return max(
+            min(
+                self.max_concurrent_builds,
+                self.db_connections_budget,
+                self.inventory_streams_budget
+                // self.inventory_streams_per_build,
+            ),
+            1,
+        )
+
+    def add(
+        self,
+        hierarchy_id: int,
+        build_function: Callable[[HierarchyRebuildTask], Awaitable],
+        priority: int = 0,
+    ) -> HierarchyRebuildTask:
+        """Adds hierarchy into queue. Returns task of hierarchy if it is queued or
+        being rebuilt already, so one hierarchy is never rebuilt concurrently."""
+        task = self._tasks.get(hierarchy_id)
+        if task is not None and task.status in (
+            RebuildTaskStatus.QUEUED,
+            RebuildTaskStatus.IN_PROCESS,
+        ):
+            return task
+
+        task = HierarchyRebuildTask(
+            hierarchy_id=hierarchy_id,
+            build_function=build_function,
+            priority=priority,
+        )
+        self._tasks[hierarchy_id] = task
+        heappush(self._queue, (priority, next(self._sequence), task))
+        return task
+
+    def _start_workers(self):
+        count_of_new_workers = min(
+            self.max_workers - len(self._workers), len(self._queue)
+        )
+        for _ in range(count_of_new_workers):
+            worker = asyncio.create_task(self._work())
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+
+    async def _work(self):
+        while self._queue:
+            _, _, task = heappop(self._queue)
+            task.status = RebuildTaskStatus.IN_PROCESS
+            task.started_at = datetime.now()
+            try:
+                await task.build_function(task)
+                task.status = RebuildTaskStatus.COMPLETE
+            except Exception as ex:
+                print(traceback.format_exc(), flush=True, file=stderr)
+                task.status = RebuildTaskStatus.ERROR
+                task.error = str(ex)
+            finally:
+                task.finished_at = datetime.now()
+                task.finished.set()
+
+    async def rebuild(
+        self,
+        hierarchy_ids: list[int],
+        build_function: Callable[[HierarchyRebuildTask], Awaitable],
+        priorities: dict[int, int] | None = None,
+    ) -> list[HierarchyRebuildTask]:
+        """Rebuilds hierarchies by build_function and waits until all of them are rebuilt"""
+        if priorities is None:
+            priorities = dict()
+        tasks = [
+            self.add(
+                hierarchy_id=hierarchy_id,
+                build_function=build_function,
+                priority=priorities.get(hierarchy_id, 0),
+            )
+            for hierarchy_id in hierarchy_ids
+        ]
+        self._start_workers()
+        await asyncio.gather(*(task.finished.wait() for task in tasks))
+        return tasks
+
+    def get_queue_position(self, task: HierarchyRebuildTask) -> int | None:
+        """Returns position of queued task starting from 1"""
+        if task.status != RebuildTaskStatus.QUEUED:
+            return None
+        for position, (_, _, queued_task) in enumerate(
+            sorted(self._queue, key=lambda item: item[:2]), start=1
+        ):
+            if queued_task is task:
+                return position
+        return None
+
+    def get_tasks_state(self) -> list[dict]:
+        """Returns state of the last task of every hierarchy"""
+        return [
+            dict(
+                hierarchy_id=task.hierarchy_id,
+                status=task.status.value,
+                priority=task.priority,
+                queue_position=self.get_queue_position(task),
+                levels_count=task.levels_count,
+                built_levels_count=task.built_levels_count,
+                error=task.error,
+                queued_at=task.queued_at,
+                started_at=task.started_at,
+                finished_at=task.finished_at,
+            )
+            for task in self._tasks.values()
+        ]
@@ -0,0 +1,598 @@
+"""
+Shadow tables of hierarchy nodes.
+New nodes of hierarchy are built in shadow tables while the current nodes
+are still available for reading, then replace them in one transaction.
+
+Nodes are swapped by copy, not by rename of tables: obj and node_data keep nodes
+of all hierarchies and are referenced by foreign keys, so nodes of one hierarchy
+can be renamed or attached only if these tables are partitioned by hierarchy_id,
+which changes their primary and foreign keys. The copy writes rows of hierarchy
+twice (COPY into unlogged shadow table and INSERT into obj), while COPY mode writes
+them once, deleted rows are cleaned by autovacuum. Use DIFF mode to write only
+changed nodes of large hierarchies.
+
+In DIFF mode shadow tables are staging tables: built nodes are matched with the current
+nodes by SQL statements depth by depth, matched nodes take ids of the current ones and
+only differences are applied to obj and node_data, so nodes are not loaded into memory.
+"""
+
+from typing import Callable
+
+from sqlalchemy import ColumnElement, String, column, select, table, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql.expression import TableClause
+
+from schemas.hier_schemas import Level, NodeData, Obj
+from services.hierarchy.hierarchy_builder.writers import (
+    BulkNode,
+    CopyNodesWriter,
+)
+from services.session_utils.listeners.enum_models import SessionDataKeys
+from services.session_utils.listeners.utils import (
+    add_items_data_into_session_info,
+    session_events_are_listened,
+)
+from settings import POSTGRES_ITEMS_LIMIT_IN_QUERY
+
+# columns of nodes compared by DIFF mode, other columns of matched nodes are equal
+NODE_UPDATED_COLUMNS = (
+    "additional_params",
+    "latitude",
+    "longitude",
+    "child_count",
+    "active",
+    "level",
+)
+NODE_DATA_COMPARED_COLUMNS = (
+    "level_id",
+    "mo_name",
+    "mo_latitude",
+    "mo_longitude",
+    "mo_status",
+    "mo_tmo_id",
+    "mo_p_id",
+    "mo_active",
+    "unfolded_key",
+)
+# columns of match of built node with current node, the second match
+# of not matched nodes does not compare activity
+NODE_MATCH_COLUMNS = ("level_id", "parent_id", "key", "object_id", "active")
+
+
+class DiffChangeKind:
+    CREATED = "created"
+    UPDATED = "updated"
+    DELETED = "deleted"
+
+
+def _get_depth_of_path(path: str) -> str:
+    """Returns SQL expression of count of ancestors of node with path"""
+    return (
+        f"length(coalesce({path}, '')) "
+        f"- length(replace(coalesce({path}, ''), '/', ''))"
+    )
+
+
+def _get_table(name: str, model_table, *extra_columns) -> TableClause:
+    """Returns table clause with name and typed columns of model_table"""
+    return table(
+        name,
+        *[column(item.name, item.type) for item in model_table.columns],
+        *extra_columns,
+    )
+
+
+def _node_to_proto(row) -> dict:
+    return BulkNode(**row, is_written=True).to_proto()
+
+
+def _node_data_to_proto(row) -> dict:
+    return NodeData(**row).to_proto()
+
+
+class HierarchyShadowTables:
+    def __init__(self, hierarchy_id: int):
+        self.hierarchy_id = hierarchy_id
+        self.obj_table_name = f"{Obj.__tablename__}_shadow_{hierarchy_id}"
+        self.node_data_table_name = (
+            f"{NodeData.__tablename__}_shadow_{hierarchy_id}"
+        )
+        # changes applied by DIFF mode, messages about them are produced from these tables
+        self.obj_diff_table_name = f"{Obj.__tablename__}_diff_{hierarchy_id}"
+        self.node_data_diff_table_name = (
+            f"{NodeData.__tablename__}_diff_{hierarchy_id}"
+        )
+        self.matches_table_name = f"{Obj.__tablename__}_matches_{hierarchy_id}"
+
+    async def drop(self, session: AsyncSession):
+        """Drops shadow tables if they exist"""
+        await session.execute(
+            text(
+                f"DROP TABLE IF EXISTS {self.node_data_table_name}, "
+                f"{self.obj_table_name}, {self.node_data_diff_table_name}, "
+                f"{self.obj_diff_table_name}"
+            )
+        )
+
+    async def exists(self, session: AsyncSession) -> bool:
+        """Returns True if shadow tables are left by stopped build"""
+        res = await session.execute(
+            text(
+                "SELECT to_regclass(:obj_table_name) IS NOT NULL "
+                "AND to_regclass(:node_data_table_name) IS NOT NULL"
+            ),
+            {
+                "obj_table_name": self.obj_table_name,
+                "node_data_table_name": self.node_data_table_name,
+            },
+        )
+        return res.scalar()
+
+    async def create(self, session: AsyncSession):
+        """Creates empty shadow tables. Shadow tables left by failed build are dropped."""
+        await self.drop(session)
+        # shadow tables are unlogged and have no foreign keys and indexes
+        # except primary key of nodes, which is used to update child_count
+        await session.execute(
+            text(
+                f"CREATE UNLOGGED TABLE {self.obj_table_name} "
+                f"(LIKE {Obj.__tablename__} INCLUDING DEFAULTS)"
+            )
+        )
+        await session.execute(
+            text(f"ALTER TABLE {self.obj_table_name} ADD PRIMARY KEY (id)")
+        )
+        await session.execute(
+            text(
+                f"CREATE UNLOGGED TABLE {self.node_data_table_name} "
+                f"(LIKE {NodeData.__tablename__} INCLUDING DEFAULTS)"
+            )
+        )
+        await session.commit()
+
+    async def swap(self, session: AsyncSession):
+        """Replaces nodes and node data of hierarchy with data of shadow tables
+        in one transaction and drops shadow tables. Messages about created nodes
+        and node data are produced after the swap, when their rows are in obj"""
+        select_levels_ids = (
+            f"SELECT id FROM {Level.__tablename__} "
+            f"WHERE hierarchy_id = :hierarchy_id"
+        )
+        await session.execute(
+            text(
+                f"DELETE FROM {NodeData.__tablename__} "
+                f"WHERE level_id IN ({select_levels_ids})"
+            ),
+            {"hierarchy_id": self.hierarchy_id},
+        )
+        await session.execute(
+            text(
+                f"DELETE FROM {Obj.__tablename__} "
+                f"WHERE hierarchy_id = :hierarchy_id"
+            ),
+            {"hierarchy_id": self.hierarchy_id},
+        )
+
+        obj_columns = ", ".join(CopyNodesWriter.OBJ_COLUMNS)
+        await session.execute(
+            text(
+                f"INSERT INTO {Obj.__tablename__} ({obj_columns}) "
+                f"SELECT {obj_columns} FROM {self.obj_table_name}"
+            )
+        )
+        node_data_columns = ", ".join(CopyNodesWriter.NODE_DATA_COLUMNS)
+        await session.execute(
+            text(
+                f"INSERT INTO {NodeData.__tablename__} ({node_data_columns}) "
+                f"SELECT {node_data_columns} FROM {self.node_data_table_name}"
+            )
+        )
+        await session.commit()
+
+        # readers use new nodes since commit, so shadow tables are not needed
+        await self.drop(session)
+        await session.commit()
+
+        if session_events_are_listened():
+            await self.produce_created_events(session)
+
+    async def produce_created_events(self, session: AsyncSession):
+        """Produces messages about swapped nodes and node data of hierarchy"""
+        obj_table = Obj.__table__
+        await self._produce_events(
+            session,
+            obj_table,
+            obj_table.c.hierarchy_id == self.hierarchy_id,
+            SessionDataKeys.NEW,
+            Obj.__name__,
+            CopyNodesWriter.OBJ_COLUMNS,
+            _node_to_proto,
+        )
+        node_data_table = NodeData.__table__
+        await self._produce_events(
+            session,
+            node_data_table,
+            node_data_table.c.level_id.in_(
+                select(Level.id).where(Level.hierarchy_id == self.hierarchy_id)
+            ),
+            SessionDataKeys.NEW,
+            NodeData.__name__,
+            CopyNodesWriter.NODE_DATA_COLUMNS,
+            _node_data_to_proto,
+        )
+
+    @staticmethod
+    async def _produce_events(
+        session: AsyncSession,
+        events_table: TableClause,
+        condition: ColumnElement[bool],
+        key_for_session_data: SessionDataKeys,
+        class_name: str,
+        columns: tuple[str, ...],
+        to_proto: Callable[[dict], dict],
+    ):
+        """Adds rows of table into session info by chunks ordered by id,
+        messages about every chunk are produced by its commit"""
+        last_id = None
+        while True:
+            stmt = (
+                select(*[events_table.c[item] for item in columns])
+                .where(condition)
+                .order_by(events_table.c.id)
+                .limit(POSTGRES_ITEMS_LIMIT_IN_QUERY)
+            )
+            if last_id is not None:
+                stmt = stmt.where(events_table.c.id > last_id)
+            rows = (await session.execute(stmt)).mappings().all()
+            if not rows:
+                return
+            last_id = rows[-1]["id"]
+            add_items_data_into_session_info(
+                session,
+                key_for_session_data,
+                class_name,
+                [to_proto(row) for row in rows],
+            )
+            await session.commit()
+
+    async def apply_diff(self, session: AsyncSession) -> dict[str, int]:
+        """Writes differences between nodes of shadow tables and the current nodes
+        of hierarchy in one transaction and drops shadow tables.
+        Returns counts of inserted, updated and deleted nodes"""
+        await self._match_nodes(session)
+        await self._remap_matched_nodes(session)
+        await self._collect_changes(session)
+        await self._apply_changes(session)
+        res = await session.execute(
+            text(
+                f"SELECT change_kind, count(*) FROM {self.obj_diff_table_name} "
+                f"GROUP BY change_kind"
+            )
+        )
+        counts = dict(res.all())
+        await session.commit()
+
+        if session_events_are_listened():
+            await self.produce_diff_events(session)
+        await self.drop(session)
+        await session.commit()
+        return {
+            "inserted": counts.get(DiffChangeKind.CREATED, 0),
+            "updated": counts.get(DiffChangeKind.UPDATED, 0),
+            "deleted": counts.get(DiffChangeKind.DELETED, 0),
+        }
+
+    async def _match_nodes(self, session: AsyncSession):
+        """Fills table of matches of built nodes with current nodes. Built node matches
+        current node with the same level, matched parent, key and object id. Nodes are
+        matched from roots to leaves, so parents are matched before their children"""
+        await session.execute(
+            text(
+                f"CREATE TEMP TABLE {self.matches_table_name} "
+                f"(staged_id uuid PRIMARY KEY, current_id uuid UNIQUE NOT NULL) "
+                f"ON COMMIT DROP"
+            )
+        )
+        res = await session.execute(
+            text(
+                f"SELECT max({_get_depth_of_path('path')}) "
+                f"FROM {self.obj_table_name}"
+            )
+        )
+        max_depth = res.scalar()
+        if max_depth is None:
+            return
+        for depth in range(max_depth + 1):
+            # virtual nodes with the same key differ by activity,
+            # so nodes with the same activity are matched first
+            for match_columns in (
+                NODE_MATCH_COLUMNS,
+                NODE_MATCH_COLUMNS[:-1],
+            ):
+                await self._match_nodes_of_depth(session, depth, match_columns)
+
+    async def _match_nodes_of_depth(
+        self,
+        session: AsyncSession,
+        depth: int,
+        match_columns: tuple[str, ...],
+    ):
+        matches = self.matches_table_name
+        partition = ", ".join(match_columns)
+        condition = " AND ".join(
+            f"current_node.{item} IS NOT DISTINCT FROM staged_node.{item}"
+            for item in match_columns
+        )
+        if depth:
+            current_parent_condition = (
+                f"obj.parent_id IN (SELECT current_id FROM {matches})"
+            )
+        else:
+            current_parent_condition = "obj.parent_id IS NULL"
+        await session.execute(
+            text(
+                f"INSERT INTO {matches} (staged_id, current_id) "
+                f"SELECT staged_node.id, current_node.id FROM ("
+                f"SELECT shadow.id, shadow.level_id, shadow.key, shadow.object_id, "
+                f"shadow.active, "
+                f"coalesce(parent.current_id, shadow.parent_id) AS parent_id, "
+                f"row_number() OVER (PARTITION BY {partition} "
+                f"ORDER BY shadow.id) AS number "
+                f"FROM {self.obj_table_name} AS shadow "
+                f"LEFT JOIN {matches} AS parent ON parent.staged_id = shadow.parent_id "
+                f"WHERE {_get_depth_of_path('shadow.path')} = :depth "
+                f"AND NOT EXISTS (SELECT 1 FROM {matches} AS m "
+                f"WHERE m.staged_id = shadow.id)"
+                f") AS staged_node JOIN ("
+                f"SELECT obj.id, obj.level_id, obj.key, obj.object_id, obj.active, "
+                f"obj.parent_id, "
+                f"row_number() OVER (PARTITION BY {partition} "
+                f"ORDER BY obj.id) AS number "
+                f"FROM {Obj.__tablename__} AS obj "
+                f"WHERE obj.hierarchy_id = :hierarchy_id "
+                f"AND {current_parent_condition} "
+                f"AND NOT EXISTS (SELECT 1 FROM {matches} AS m "
+                f"WHERE m.current_id = obj.id)"
+                f") AS current_node ON {condition} "
+                f"AND current_node.number = staged_node.number"
+            ),
+            {"depth": depth, "hierarchy_id": self.hierarchy_id},
+        )
+
+    async def _remap_matched_nodes(self, session: AsyncSession):
+        """Gives ids of current nodes to matched built nodes and rebuilds paths"""
+        matches = self.matches_table_name
+        await session.execute(
+            text(
+                f"UPDATE {self.node_data_table_name} AS shadow "
+                f"SET node_id = m.current_id FROM {matches} AS m "
+                f"WHERE shadow.node_id = m.staged_id"
+            )
+        )
+        for column_name in ("parent_id", "id"):
+            await session.execute(
+                text(
+                    f"UPDATE {self.obj_table_name} AS shadow "
+                    f"SET {column_name} = m.current_id FROM {matches} AS m "
+                    f"WHERE shadow.{column_name} = m.staged_id"
+                )
+            )
+        # ids in paths have the same length, so depth of nodes is not changed
+        res = await session.execute(
+            text(
+                f"SELECT max({_get_depth_of_path('path')}) "
+                f"FROM {self.obj_table_name}"
+            )
+        )
+        max_depth = res.scalar() or 0
+        for depth in range(1, max_depth + 1):
+            await session.execute(
+                text(
+                    f"UPDATE {self.obj_table_name} AS child "
+                    f"SET path = concat(coalesce(parent.path, ''), parent.id, '/') "
+                    f"FROM {self.obj_table_name} AS parent "
+                    f"WHERE child.parent_id = parent.id "
+                    f"AND {_get_depth_of_path('child.path')} = :depth "
+                    f"AND child.path IS DISTINCT FROM "
+                    f"concat(coalesce(parent.path, ''), parent.id, '/')"
+                ),
+                {"depth": depth},
+            )
+
+    async def _collect_changes(self, session: AsyncSession):
+        """Fills diff tables with created, updated and deleted nodes and node data"""
+        matches = self.matches_table_name
+        for diff_table_name, model_table_name in (
+            (self.obj_diff_table_name, Obj.__tablename__),
+            (self.node_data_diff_table_name, NodeData.__tablename__),
+        ):
+            await session.execute(
+                text(
+                    f"CREATE UNLOGGED TABLE {diff_table_name} "
+                    f"(LIKE {model_table_name}, change_kind text NOT NULL)"
+                )
+            )
+
+        obj_columns = ", ".join(CopyNodesWriter.OBJ_COLUMNS)
+        shadow_obj_columns = ", ".join(
+            f"shadow.{item}" for item in CopyNodesWriter.OBJ_COLUMNS
+        )
+        insert_into_obj_diff = f"INSERT INTO {self.obj_diff_table_name} ({obj_columns}, change_kind) "
+        await session.execute(
+            text(
+                f"{insert_into_obj_diff}"
+                f"SELECT {obj_columns}, :change_kind FROM {self.obj_table_name} "
+                f"AS shadow WHERE NOT EXISTS (SELECT 1 FROM {matches} AS m "
+                f"WHERE m.current_id = shadow.id)"
+            ),
+            {"change_kind": DiffChangeKind.CREATED},
+        )
+        await session.execute(
+            text(
+                f"{insert_into_obj_diff}"
+                f"SELECT {shadow_obj_columns}, :change_kind "
+                f"FROM {self.obj_table_name} AS shadow "
+                f"JOIN {Obj.__tablename__} AS obj ON obj.id = shadow.id "
+                f"WHERE ({', '.join(f'obj.{item}' for item in NODE_UPDATED_COLUMNS)}) "
+                f"IS DISTINCT FROM "
+                f"({', '.join(f'shadow.{item}' for item in NODE_UPDATED_COLUMNS)})"
+            ),
+            {"change_kind": DiffChangeKind.UPDATED},
+        )
+        await session.execute(
+            text(
+                f"{insert_into_obj_diff}"
+                f"SELECT {obj_columns}, :change_kind FROM {Obj.__tablename__} AS obj "
+                f"WHERE obj.hierarchy_id = :hierarchy_id "
+                f"AND NOT EXISTS (SELECT 1 FROM {matches} AS m "
+                f"WHERE m.current_id = obj.id)"
+            ),
+            {
+                "change_kind": DiffChangeKind.DELETED,
+                "hierarchy_id": self.hierarchy_id,
+            },
+        )
+
+        node_data_columns = ", ".join(CopyNodesWriter.NODE_DATA_COLUMNS)
+        insert_into_node_data_diff = (
+            f"INSERT INTO {self.node_data_diff_table_name} "
+            f"({node_data_columns}, change_kind) "
+        )
+        current_node_data = (
+            f"SELECT node_data.* FROM {NodeData.__tablename__} AS node_data "
+            f"JOIN {Obj.__tablename__} AS obj ON obj.id = node_data.node_id "
+            f"WHERE obj.hierarchy_id = :hierarchy_id"
+        )
+        await session.execute(
+            text(
+                f"{insert_into_node_data_diff}"
+                f"SELECT {node_data_columns}, :change_kind "
+                f"FROM {self.node_data_table_name} AS shadow "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {NodeData.__tablename__} AS node_data "
+                f"WHERE node_data.node_id = shadow.node_id "
+                f"AND node_data.mo_id = shadow.mo_id)"
+            ),
+            {"change_kind": DiffChangeKind.CREATED},
+        )
+        # updated node data keeps id of the current one
+        await session.execute(
+            text(
+                f"{insert_into_node_data_diff}"
+                f"SELECT current.id, "
+                + ", ".join(
+                    f"shadow.{item}"
+                    for item in CopyNodesWriter.NODE_DATA_COLUMNS[1:]
+                )
+                + f", :change_kind FROM {self.node_data_table_name} AS shadow "
+                f"JOIN ({current_node_data}) AS current "
+                f"ON current.node_id = shadow.node_id AND current.mo_id = shadow.mo_id "
+                f"WHERE ({', '.join(f'current.{item}' for item in NODE_DATA_COMPARED_COLUMNS)}) "
+                f"IS DISTINCT FROM "
+                f"({', '.join(f'shadow.{item}' for item in NODE_DATA_COMPARED_COLUMNS)})"
+            ),
+            {
+                "change_kind": DiffChangeKind.UPDATED,
+                "hierarchy_id": self.hierarchy_id,
+            },
+        )
+        await session.execute(
+            text(
+                f"{insert_into_node_data_diff}"
+                f"SELECT {node_data_columns}, :change_kind "
+                f"FROM ({current_node_data}) AS current "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {self.node_data_table_name} AS shadow "
+                f"WHERE shadow.node_id = current.node_id "
+                f"AND shadow.mo_id = current.mo_id)"
+            ),
+            {
+                "change_kind": DiffChangeKind.DELETED,
+                "hierarchy_id": self.hierarchy_id,
+            },
+        )
+
+    async def _apply_changes(self, session: AsyncSession):
+        """Applies rows of diff tables to obj and node_data"""
+        for diff_table_name, model_table_name in (
+            (self.node_data_diff_table_name, NodeData.__tablename__),
+            (self.obj_diff_table_name, Obj.__tablename__),
+        ):
+            await session.execute(
+                text(
+                    f"DELETE FROM {model_table_name} WHERE id IN "
+                    f"(SELECT id FROM {diff_table_name} "
+                    f"WHERE change_kind = :change_kind)"
+                ),
+                {"change_kind": DiffChangeKind.DELETED},
+            )
+
+        for diff_table_name, model_table_name, columns, updated_columns in (
+            (
+                self.obj_diff_table_name,
+                Obj.__tablename__,
+                CopyNodesWriter.OBJ_COLUMNS,
+                NODE_UPDATED_COLUMNS,
+            ),
+            (
+                self.node_data_diff_table_name,
+                NodeData.__tablename__,
+                CopyNodesWriter.NODE_DATA_COLUMNS,
+                NODE_DATA_COMPARED_COLUMNS,
+            ),
+        ):
+            await session.execute(
+                text(
+                    f"UPDATE {model_table_name} SET "
+                    + ", ".join(
+                        f"{item} = diff.{item}" for item in updated_columns
+                    )
+                    + f" FROM {diff_table_name} AS diff "
+                    f"WHERE {model_table_name}.id = diff.id "
+                    f"AND diff.change_kind = :change_kind"
+                ),
+                {"change_kind": DiffChangeKind.UPDATED},
+            )
+            # foreign keys of parents are checked at the end of statement,
+            # so order of inserted nodes does not matter
+            await session.execute(
+                text(
+                    f"INSERT INTO {model_table_name} ({', '.join(columns)}) "
+                    f"SELECT {', '.join(columns)} FROM {diff_table_name} "
+                    f"WHERE change_kind = :change_kind"
+                ),
+                {"change_kind": DiffChangeKind.CREATED},
+            )
+
+    async def produce_diff_events(self, session: AsyncSession):
+        """Produces messages about changes applied by DIFF mode"""
+        change_kind = column("change_kind", String)
+        obj_diff_table = _get_table(
+            self.obj_diff_table_name, Obj.__table__, change_kind
+        )
+        node_data_diff_table = _get_table(
+            self.node_data_diff_table_name,
+            NodeData.__table__,
+            column("change_kind", String),
+        )
+        for kind, key_for_session_data in (
+            (DiffChangeKind.CREATED, SessionDataKeys.NEW),
+            (DiffChangeKind.UPDATED, SessionDataKeys.DIRTY),
+            (DiffChangeKind.DELETED, SessionDataKeys.DELETED),
+        ):
+            await self._produce_events(
+                session,
+                obj_diff_table,
+                obj_diff_table.c.change_kind == kind,
+                key_for_session_data,
+                Obj.__name__,
+                CopyNodesWriter.OBJ_COLUMNS,
+                _node_to_proto,
+            )
+            await self._produce_events(
+                session,
+                node_data_diff_table,
+                node_data_diff_table.c.change_kind == kind,
+                key_for_session_data,
+                NodeData.__name__,
+                CopyNodesWriter.NODE_DATA_COLUMNS,
+                _node_data_to_proto,
+            )
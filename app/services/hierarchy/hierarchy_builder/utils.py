@@ -1,7 +1,10 @@
 from typing import Any
+import uuid
+
+from sqlalchemy import ColumnElement, String, cast, func
 
 from grpc_config.inventory_utils import get_mo_links_values
-from schemas.hier_schemas import Obj
+from schemas.hier_schemas import Level, Obj
 from services.hierarchy.hierarchy_builder.configs import (
     DEFAULT_KEY_OF_NULL_NODE,
 )
@@ -18,6 +21,48 @@ def create_path_for_children_node_by_parent_node(parent_node: Obj = None):
     return path
 
 
+def get_sql_path_for_children_node(parent_node) -> ColumnElement[str]:
+    """Returns SQL expression of path for children of parent_node,
+    parent_node can be Obj or its alias"""
+    return func.concat(
+        func.coalesce(parent_node.path, ""), cast(parent_node.id, String), "/"
+    )
+
+
+def path_startswith(
+    children_path: str | ColumnElement[str], path=Obj.path
+) -> ColumnElement[bool]:
+    """Returns condition of nodes whose path starts with children_path, so they are descendants
+    of node with this children path. Operator ^@ is supported by SP-GiST index of Obj.path
+    also for bound parameters, unlike LIKE"""
+    return path.op("^@")(children_path)
+
+
+def get_ancestor_ids_by_path(path: str | None) -> list[uuid.UUID]:
+    """Returns ids of ancestors of node with path ordered from root to parent"""
+    if not path:
+        return list()
+    return [uuid.UUID(node_id) for node_id in path.split("/") if node_id]
+
+
+def get_level_tprm_ids(level: Level) -> list[int]:
+    """Returns ids of TPRMs whose values are needed to build nodes of level"""
+    tprm_ids = list()
+    if level.key_attrs:
+        for attr in level.key_attrs:
+            if attr.isdigit():
+                tprm_ids.append(int(attr))
+    else:
+        tprm_ids.append(level.param_type_id)
+
+    if level.additional_params_id:
+        tprm_ids.append(level.additional_params_id)
+
+    if level.attr_as_parent:
+        tprm_ids.append(level.attr_as_parent)
+    return tprm_ids
+
+
 def create_node_key(
     ordered_key_attrs: list[str], mo_data_with_params: dict[str, Any]
 ):
@@ -52,7 +97,7 @@ def get_node_key_data(
         and int(attr) in mo_links_attrs
         and attr in mo_data_with_params
     ]
-    mo_links = get_mo_links_values(mo_links)
+    mo_links = get_mo_links_values(mo_links) if mo_links else dict()
 
     result = []
     at_least_on_value_is_not_none = False
@@ -0,0 +1,337 @@
+"""
+Writers of nodes and node data used by HierarchyBuilderV2.
+OrmNodesWriter inserts nodes by the unit of work, CopyNodesWriter inserts them with COPY.
+Both writers produce the same rows and the same session events.
+Parent nodes can be passed as CachedNode, if they have already been written.
+"""
+
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from dataclasses import dataclass
+import json
+import uuid as uuid_pkg
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas.hier_schemas import NodeData, Obj, default_uuid
+from services.hierarchy.hierarchy_builder.caches import CachedNode
+from services.hierarchy.hierarchy_builder.configs import NodesWriteMode
+from services.session_utils.listeners.enum_models import SessionDataKeys
+from services.session_utils.listeners.utils import (
+    add_items_data_into_session_info,
+    session_events_are_listened,
+)
+from settings import POSTGRES_ITEMS_LIMIT_IN_QUERY
+
+
+class NodesWriterInterface(ABC):
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        # increases of child_count of written nodes by their ids
+        self._child_count_increases: dict[uuid_pkg.UUID, int] = defaultdict(int)
+
+    @abstractmethod
+    def create_node(self, **node_attrs):
+        """Creates new node and returns it"""
+
+    @abstractmethod
+    def increase_child_count(self, parent_node):
+        """Increases child_count of parent_node by 1"""
+
+    @abstractmethod
+    def add_node_data(self, node_data: dict):
+        """Adds node data to write"""
+
+    @abstractmethod
+    async def flush_nodes(self):
+        """Writes all created nodes and changes of parent nodes"""
+
+    @abstractmethod
+    async def flush_node_data(self):
+        """Writes all added node data"""
+
+
+class OrmNodesWriter(NodesWriterInterface):
+    def create_node(self, **node_attrs) -> Obj:
+        new_node = Obj(**node_attrs)
+        self.session.add(new_node)
+        return new_node
+
+    def increase_child_count(self, parent_node: Obj | CachedNode):
+        if isinstance(parent_node, CachedNode):
+            self._child_count_increases[parent_node.id] += 1
+            return
+        parent_node.child_count += 1
+        self.session.add(parent_node)
+
+    def add_node_data(self, node_data: dict):
+        self.session.add(NodeData(**node_data))
+
+    async def flush_nodes(self):
+        # cached parents are loaded to be changed by the unit of work
+        parent_ids = list(self._child_count_increases)
+        for start in range(0, len(parent_ids), POSTGRES_ITEMS_LIMIT_IN_QUERY):
+            stmt = select(Obj).where(
+                Obj.id.in_(
+                    parent_ids[start : start + POSTGRES_ITEMS_LIMIT_IN_QUERY]
+                )
+            )
+            parent_nodes = await self.session.execute(stmt)
+            for parent_node in parent_nodes.scalars().all():
+                parent_node.child_count += self._child_count_increases[
+                    parent_node.id
+                ]
+                self.session.add(parent_node)
+        self._child_count_increases = defaultdict(int)
+        await self.session.flush()
+
+    async def flush_node_data(self):
+        await self.session.flush()
+
+
+@dataclass(slots=True)
+class BulkNode:
+    """Node created by CopyNodesWriter. Has the same attributes as Obj."""
+
+    key: str
+    object_id: int | None
+    object_type_id: int
+    additional_params: str | None
+    hierarchy_id: int
+    level: int
+    latitude: float | None
+    longitude: float | None
+    child_count: int
+    parent_id: uuid_pkg.UUID | None
+    level_id: int
+    path: str | None
+    active: bool
+    key_is_empty: bool
+    id: uuid_pkg.UUID | None = None
+    is_written: bool = False
+
+    to_proto = Obj.to_proto
+
+    def to_record(self) -> tuple:
+        record = [
+            getattr(self, column) for column in CopyNodesWriter.OBJ_COLUMNS
+        ]
+        # the unit of work inserts server default instead of None
+        active_index = CopyNodesWriter.OBJ_COLUMNS.index("active")
+        if record[active_index] is None:
+            record[active_index] = True
+        return tuple(record)
+
+
+class CopyNodesWriter(NodesWriterInterface):
+    OBJ_COLUMNS = (
+        "id",
+        "key",
+        "object_id",
+        "object_type_id",
+        "additional_params",
+        "hierarchy_id",
+        "level",
+        "parent_id",
+        "latitude",
+        "longitude",
+        "child_count",
+        "active",
+        "key_is_empty",
+        "path",
+        "level_id",
+    )
+    NODE_DATA_COLUMNS = (
+        "id",
+        "level_id",
+        "node_id",
+        "mo_id",
+        "mo_name",
+        "mo_latitude",
+        "mo_longitude",
+        "mo_status",
+        "mo_tmo_id",
+        "mo_p_id",
+        "mo_active",
+        "unfolded_key",
+    )
+
+    def __init__(
+        self,
+        session: AsyncSession,
+        obj_table_name: str = Obj.__tablename__,
+        node_data_table_name: str = NodeData.__tablename__,
+        produce_events: bool = True,
+    ):
+        super().__init__(session)
+        self.obj_table_name = obj_table_name
+        self.node_data_table_name = node_data_table_name
+        # rows of shadow tables are not seen by readers until they are swapped,
+        # so messages about them are produced by the swap
+        self.produce_events = produce_events
+        self._new_nodes: list[BulkNode] = list()
+        self._updated_nodes: dict[uuid_pkg.UUID, BulkNode] = dict()
+        self._new_node_data: list[dict] = list()
+
+    def create_node(self, **node_attrs) -> BulkNode:
+        # node id and path of children are needed before the node is written,
+        # so id is generated on the client side as Obj does
+        new_node = BulkNode(**node_attrs, id=default_uuid())
+        self._new_nodes.append(new_node)
+        return new_node
+
+    def increase_child_count(self, parent_node: BulkNode | CachedNode):
+        if isinstance(parent_node, CachedNode):
+            self._child_count_increases[parent_node.id] += 1
+            return
+        parent_node.child_count += 1
+        if parent_node.is_written:
+            self._updated_nodes[parent_node.id] = parent_node
+
+    def add_node_data(self, node_data: dict):
+        self._new_node_data.append(node_data)
+
+    async def _get_driver_connection(self):
+        connection = await self.session.connection()
+        # asyncpg transaction is started by the first executed statement,
+        # COPY must not be performed out of the session transaction
+        await connection.exec_driver_sql("SELECT 1")
+        raw_connection = await connection.get_raw_connection()
+        return raw_connection.driver_connection
+
+    def _session_events_are_listened(self) -> bool:
+        return self.produce_events and session_events_are_listened()
+
+    def _add_items_data_into_session_info(
+        self,
+        key_for_session_data: SessionDataKeys,
+        class_name: str,
+        items_data: list[dict],
+    ):
+        add_items_data_into_session_info(
+            self.session, key_for_session_data, class_name, items_data
+        )
+
+    async def flush_nodes(self):
+        if (
+            not self._new_nodes
+            and not self._updated_nodes
+            and not self._child_count_increases
+        ):
+            return
+        connection = await self._get_driver_connection()
+
+        if self._new_nodes:
+            await connection.copy_records_to_table(
+                self.obj_table_name,
+                records=[node.to_record() for node in self._new_nodes],
+                columns=self.OBJ_COLUMNS,
+            )
+            if self._session_events_are_listened():
+                self._add_items_data_into_session_info(
+                    SessionDataKeys.NEW,
+                    Obj.__name__,
+                    [node.to_proto() for node in self._new_nodes],
+                )
+            for node in self._new_nodes:
+                node.is_written = True
+            self._new_nodes = list()
+
+        if self._updated_nodes:
+            updated_nodes = list(self._updated_nodes.values())
+            await connection.execute(
+                f"UPDATE {self.obj_table_name} SET child_count = data.child_count "
+                f"FROM unnest($1::uuid[], $2::integer[]) AS data(id, child_count) "
+                f"WHERE {self.obj_table_name}.id = data.id",
+                [node.id for node in updated_nodes],
+                [node.child_count for node in updated_nodes],
+            )
+            if self._session_events_are_listened():
+                self._add_items_data_into_session_info(
+                    SessionDataKeys.DIRTY,
+                    Obj.__name__,
+                    [node.to_proto() for node in updated_nodes],
+                )
+            self._updated_nodes = dict()
+
+        if self._child_count_increases:
+            # cached parents are not kept in memory, so their rows for
+            # produced messages are returned by the update
+            updated_rows = await connection.fetch(
+                f"UPDATE {self.obj_table_name} "
+                f"SET child_count = {self.obj_table_name}.child_count + data.increase "
+                f"FROM unnest($1::uuid[], $2::integer[]) AS data(id, increase) "
+                f"WHERE {self.obj_table_name}.id = data.id RETURNING "
+                + ", ".join(
+                    f"{self.obj_table_name}.{column}"
+                    for column in self.OBJ_COLUMNS
+                ),
+                list(self._child_count_increases),
+                list(self._child_count_increases.values()),
+            )
+            if self._session_events_are_listened():
+                self._add_items_data_into_session_info(
+                    SessionDataKeys.DIRTY,
+                    Obj.__name__,
+                    [
+                        BulkNode(**row, is_written=True).to_proto()
+                        for row in updated_rows
+                    ],
+                )
+            self._child_count_increases = defaultdict(int)
+
+    async def flush_node_data(self):
+        if not self._new_node_data:
+            return
+        connection = await self._get_driver_connection()
+
+        # ids are taken from the table sequence to have them in produced messages
+        new_ids = await connection.fetch(
+            f"SELECT nextval(pg_get_serial_sequence('{NodeData.__tablename__}', 'id')) "
+            f"FROM generate_series(1, $1)",
+            len(self._new_node_data),
+        )
+        for node_data, new_id in zip(self._new_node_data, new_ids):
+            node_data["id"] = new_id[0]
+            # the unit of work inserts server default instead of None
+            if node_data.get("mo_active") is None:
+                node_data["mo_active"] = True
+
+        await connection.copy_records_to_table(
+            self.node_data_table_name,
+            records=[
+                (
+                    node_data["id"],
+                    node_data["level_id"],
+                    uuid_pkg.UUID(str(node_data["node_id"])),
+                    node_data["mo_id"],
+                    node_data["mo_name"],
+                    node_data["mo_latitude"],
+                    node_data["mo_longitude"],
+                    node_data["mo_status"],
+                    node_data["mo_tmo_id"],
+                    node_data["mo_p_id"],
+                    node_data["mo_active"],
+                    json.dumps(node_data["unfolded_key"]),
+                )
+                for node_data in self._new_node_data
+            ],
+            columns=self.NODE_DATA_COLUMNS,
+        )
+        if self._session_events_are_listened():
+            self._add_items_data_into_session_info(
+                SessionDataKeys.NEW,
+                NodeData.__name__,
+                [
+                    NodeData(**node_data).to_proto()
+                    for node_data in self._new_node_data
+                ],
+            )
+        self._new_node_data = list()
+
+
+NODES_WRITERS = {
+    NodesWriteMode.ORM: OrmNodesWriter,
+    NodesWriteMode.COPY: CopyNodesWriter,
+}
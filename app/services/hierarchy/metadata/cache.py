@@ -0,0 +1,210 @@
+"""
+Cache of metadata of hierarchies for read endpoints: hierarchy, its levels and graph
+of levels. Metadata of hierarchy is loaded once and is valid while version of cache
+is not changed. Version is increased after commit of every session which has changed
+Hierarchy or Level rows by ORM objects or by bulk statements. Version is shared by the
+app and consumer processes, they receive it from the app before they are started.
+Cached objects are not in session and must not be changed, write endpoints use
+rows of session.
+"""
+
+from dataclasses import dataclass, field
+from itertools import chain
+import multiprocessing
+from multiprocessing.sharedctypes import Synchronized
+from typing import Iterable
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import ORMExecuteState, Session
+
+from schemas.hier_schemas import Hierarchy, Level
+
+METADATA_IS_CHANGED_KEY = "hierarchy_metadata_is_changed"
+METADATA_CLASSES = (Hierarchy, Level)
+METADATA_TABLE_NAMES = {Hierarchy.__tablename__, Level.__tablename__}
+
+
+@dataclass(frozen=True, slots=True)
+class HierarchyMetadata:
+    version: int
+    hierarchy: Hierarchy
+    levels_by_id: dict[int, Level]
+    # ids of child levels by id of parent level, None is parent of top levels
+    child_level_ids: dict[int | None, tuple[int, ...]] = field(
+        default_factory=dict
+    )
+
+    @property
+    def levels(self) -> list[Level]:
+        return list(self.levels_by_id.values())
+
+    @property
+    def object_type_ids(self) -> set[int]:
+        return {level.object_type_id for level in self.levels_by_id.values()}
+
+    @property
+    def virtual_level_ids(self) -> set[int]:
+        return {
+            level.id for level in self.levels_by_id.values() if level.is_virtual
+        }
+
+    @property
+    def real_level_ids(self) -> set[int]:
+        return {
+            level.id
+            for level in self.levels_by_id.values()
+            if not level.is_virtual
+        }
+
+    @property
+    def level_ids_shown_only_with_children(self) -> set[int]:
+        """Ids of levels whose nodes without children are not shown"""
+        return {
+            level.id
+            for level in self.levels_by_id.values()
+            if not level.show_without_children
+        }
+
+    def get_child_levels(self, parent_level_ids: Iterable[int]) -> list[Level]:
+        """Returns first depth child levels, as Level.parent_id.in_() None
+        does not match top levels"""
+        return [
+            self.levels_by_id[level_id]
+            for parent_level_id in parent_level_ids
+            if parent_level_id is not None
+            for level_id in self.child_level_ids.get(parent_level_id, ())
+        ]
+
+    def get_levels_by_object_type_id(self, object_type_id: int) -> list[Level]:
+        return [
+            level
+            for level in self.levels_by_id.values()
+            if level.object_type_id == object_type_id
+        ]
+
+
+class HierarchyMetadataCache:
+    def __init__(self):
+        self.__metadata: dict[int, HierarchyMetadata] = dict()
+        self.__local_version = 0
+        self.__shared_version: Synchronized | None = None
+
+    def get_shared_version(self) -> Synchronized:
+        """Returns version shared with child processes, it is created by the app
+        process and is passed to consumer processes"""
+        if self.__shared_version is None:
+            self.use_shared_version(
+                multiprocessing.Value("q", self.__local_version + 1)
+            )
+        return self.__shared_version
+
+    def use_shared_version(self, shared_version: Synchronized):
+        """Is called by child process with version received from the app"""
+        self.__shared_version = shared_version
+        self.__metadata.clear()
+
+    @property
+    def version(self) -> int:
+        if self.__shared_version is not None:
+            return self.__shared_version.value
+        return self.__local_version
+
+    def increase_version(self):
+        if self.__shared_version is not None:
+            with self.__shared_version.get_lock():
+                self.__shared_version.value += 1
+        else:
+            self.__local_version += 1
+
+    async def get(
+        self, hierarchy_id: int, session: AsyncSession
+    ) -> HierarchyMetadata | None:
+        """Returns metadata of hierarchy or None if hierarchy does not exist"""
+        version = self.version
+        metadata = self.__metadata.get(hierarchy_id)
+        if metadata is not None and metadata.version == version:
+            return metadata
+
+        # version is read before rows, so rows changed while they are read
+        # are loaded again by the next call
+        hierarchy = await session.get(Hierarchy, hierarchy_id)
+        if hierarchy is None:
+            self.__metadata.pop(hierarchy_id, None)
+            return None
+        stmt = select(Level).where(Level.hierarchy_id == hierarchy_id)
+        levels = (await session.execute(stmt)).scalars().all()
+
+        levels_by_id = {
+            level.id: Level(**level.model_dump())
+            for level in sorted(levels, key=lambda item: item.id)
+        }
+        child_level_ids = dict()
+        for level in levels_by_id.values():
+            child_level_ids.setdefault(level.parent_id, list()).append(level.id)
+        metadata = HierarchyMetadata(
+            version=version,
+            hierarchy=Hierarchy(**hierarchy.model_dump()),
+            levels_by_id=levels_by_id,
+            child_level_ids={
+                parent_id: tuple(level_ids)
+                for parent_id, level_ids in child_level_ids.items()
+            },
+        )
+        # rows changed by not committed transaction of session are not cached
+        if not session.info.get(METADATA_IS_CHANGED_KEY):
+            self.__metadata[hierarchy_id] = metadata
+        return metadata
+
+    def clear(self):
+        self.__metadata.clear()
+
+
+hierarchy_metadata_cache = HierarchyMetadataCache()
+
+
+def _mark_changes_of_metadata_after_flush(session: Session, flush_context):
+    if any(
+        isinstance(item, METADATA_CLASSES)
+        for item in chain(session.new, session.dirty, session.deleted)
+    ):
+        session.info[METADATA_IS_CHANGED_KEY] = True
+
+
+def _mark_bulk_changes_of_metadata(orm_execute_state: ORMExecuteState):
+    if not (
+        orm_execute_state.is_insert
+        or orm_execute_state.is_update
+        or orm_execute_state.is_delete
+    ):
+        return
+    # statements of ORM entities and Core statements of tables
+    table = getattr(orm_execute_state.statement, "table", None)
+    if getattr(table, "name", None) in METADATA_TABLE_NAMES:
+        orm_execute_state.session.info[METADATA_IS_CHANGED_KEY] = True
+
+
+def _increase_version_after_commit(session: Session):
+    if session.info.pop(METADATA_IS_CHANGED_KEY, False):
+        hierarchy_metadata_cache.increase_version()
+
+
+def _forget_changes_of_metadata_after_rollback(session: Session):
+    session.info.pop(METADATA_IS_CHANGED_KEY, None)
+
+
+def listen_changes_of_metadata():
+    """Adds listeners of all sessions which increase version of cache
+    after commit of changes of hierarchies and levels"""
+    listeners = (
+        ("after_flush", _mark_changes_of_metadata_after_flush),
+        ("do_orm_execute", _mark_bulk_changes_of_metadata),
+        ("after_commit", _increase_version_after_commit),
+        ("after_rollback", _forget_changes_of_metadata_after_rollback),
+    )
+    for identifier, listener in listeners:
+        if not event.contains(Session, identifier, listener):
+            event.listen(Session, identifier, listener)
+
+
+listen_changes_of_metadata()
@@ -0,0 +1,81 @@
+"""
+Micro-batches of Inventory messages. Consecutive messages of the same class and event
+are coalesced into one message, so they are handled by one handler invocation.
+"""
+
+import dataclasses
+
+from schemas.enum_models import InventoryClassNames
+from services.obj_events.status import ObjEventStatus
+
+# objects of these classes are handled by handlers as lists, so messages can be joined
+COALESCED_CLASS_NAMES = {
+    InventoryClassNames.MO.value,
+    InventoryClassNames.PRM.value,
+}
+
+
+@dataclasses.dataclass(slots=True)
+class InventoryMessagesGroup:
+    class_name: str
+    event: str
+    msg: dict
+    messages_count: int = 1
+    # sources of joined messages, e.g. their positions in topic partitions
+    sources: list = dataclasses.field(default_factory=list)
+
+    @property
+    def objects_count(self) -> int:
+        return len(self.msg.get("objects", []))
+
+
+def _merge_objects(group: InventoryMessagesGroup, msg: dict):
+    """Adds objects of msg into group. Update events contain whole objects,
+    so only the last update of every object is kept."""
+    objects = msg.get("objects", [])
+    if group.event == ObjEventStatus.UPDATED.value:
+        objects_by_id = {item["id"]: item for item in group.msg["objects"]}
+        for item in objects:
+            # the last update is handled at the place of the first one
+            objects_by_id[item["id"]] = item
+        group.msg["objects"] = list(objects_by_id.values())
+    else:
+        group.msg["objects"].extend(objects)
+    group.messages_count += 1
+
+
+def group_inventory_messages(
+    messages: list[tuple[str, str, dict]],
+    max_objects_in_group: int,
+    sources: list | None = None,
+) -> list[InventoryMessagesGroup]:
+    """Returns groups of consecutive messages (class_name, event, msg) with the same class and event.
+    Order of groups is order of messages, so events of one object are handled in the order
+    they were sent. Groups are not joined over max_objects_in_group objects.
+    Items of sources are collected into groups of their messages."""
+    groups: list[InventoryMessagesGroup] = list()
+    if sources is None:
+        sources = [None] * len(messages)
+    for (class_name, event, msg), source in zip(messages, sources):
+        last_group = groups[-1] if groups else None
+        if (
+            last_group is not None
+            and class_name in COALESCED_CLASS_NAMES
+            and last_group.class_name == class_name
+            and last_group.event == event
+            and last_group.objects_count + len(msg.get("objects", []))
+            <= max_objects_in_group
+        ):
+            _merge_objects(last_group, msg)
+            last_group.sources.append(source)
+            continue
+
+        if class_name in COALESCED_CLASS_NAMES:
+            # messages of group are changed by merging, source message is kept
+            msg = dict(msg, objects=list(msg.get("objects", [])))
+        groups.append(
+            InventoryMessagesGroup(
+                class_name=class_name, event=event, msg=msg, sources=[source]
+            )
+        )
+    return groups
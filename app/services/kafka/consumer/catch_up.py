@@ -0,0 +1,107 @@
+"""
+Fast catch-up of hierarchy consumer. After a long stop of consumer, replay of pending
+events one by one is slower than rebuild of hierarchy. Cost of replay is estimated by lag
+and by objects of the last batch, as a sample of the mix of pending messages, with
+measured time of handling of objects of every class. Cost of rebuild is estimated
+by count of nodes of hierarchy.
+"""
+
+import dataclasses
+
+from confluent_kafka import TopicPartition
+
+from schemas.enum_models import InventoryClassNames
+
+# seconds of handling of one object used until time of class is measured,
+# objects of TMO and TPRM change whole levels
+DEFAULT_SECONDS_PER_OBJECT = {
+    InventoryClassNames.MO.value: 0.005,
+    InventoryClassNames.PRM.value: 0.005,
+    InventoryClassNames.TMO.value: 1.0,
+    InventoryClassNames.TPRM.value: 1.0,
+}
+# weight of the last measured time in mean time of handling of object
+MEASURED_TIME_WEIGHT = 0.2
+WATERMARKS_TIMEOUT = 10.0
+
+
+@dataclasses.dataclass(slots=True)
+class CatchUpEstimate:
+    lag: int
+    replay_seconds: float
+    rebuild_seconds: float
+
+    @property
+    def is_rebuild_faster(self) -> bool:
+        return self.rebuild_seconds < self.replay_seconds
+
+
+class ReplayCostEstimator:
+    """Keeps mean time of handling of one object of every class"""
+
+    def __init__(self):
+        self.seconds_per_object = dict(DEFAULT_SECONDS_PER_OBJECT)
+
+    def observe(self, class_name: str, objects_count: int, seconds: float):
+        if objects_count <= 0:
+            return
+        seconds_per_object = seconds / objects_count
+        mean = self.seconds_per_object.get(class_name)
+        if mean is None:
+            self.seconds_per_object[class_name] = seconds_per_object
+        else:
+            self.seconds_per_object[class_name] = (
+                mean + MEASURED_TIME_WEIGHT * (seconds_per_object - mean)
+            )
+
+    def estimate_replay_seconds(
+        self, lag: int, messages: list[tuple[str, str, dict]]
+    ) -> float:
+        """Returns seconds of replay of lag messages with the same mix of objects
+        as messages (class_name, event, msg)"""
+        if not messages:
+            return 0.0
+        seconds = sum(
+            len(msg.get("objects", []))
+            * self.seconds_per_object.get(class_name, 0.0)
+            for class_name, _, msg in messages
+        )
+        return lag * seconds / len(messages)
+
+
+def get_lag_and_high_watermarks(consumer) -> tuple[int, list[TopicPartition]]:
+    """Returns count of messages not read yet from assigned partitions and
+    high watermarks of these partitions"""
+    lag = 0
+    high_watermarks = list()
+    for position in consumer.position(consumer.assignment()):
+        low, high = consumer.get_watermark_offsets(
+            TopicPartition(position.topic, position.partition),
+            timeout=WATERMARKS_TIMEOUT,
+        )
+        # position is not valid before the first message of partition is read
+        offset = position.offset if position.offset >= 0 else low
+        lag += max(high - offset, 0)
+        high_watermarks.append(
+            TopicPartition(position.topic, position.partition, high)
+        )
+    return lag, high_watermarks
+
+
+def get_committed_positions(
+    consumer, partitions: list[TopicPartition]
+) -> list[TopicPartition]:
+    """Returns committed offsets of partitions, partitions without committed offset
+    are read from their low watermarks"""
+    positions = list()
+    for committed in consumer.committed(partitions, timeout=WATERMARKS_TIMEOUT):
+        offset = committed.offset
+        if offset < 0:
+            offset, _ = consumer.get_watermark_offsets(
+                TopicPartition(committed.topic, committed.partition),
+                timeout=WATERMARKS_TIMEOUT,
+            )
+        positions.append(
+            TopicPartition(committed.topic, committed.partition, offset)
+        )
+    return positions
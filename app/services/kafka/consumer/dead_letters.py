@@ -0,0 +1,264 @@
+"""
+Dead letters of Kafka consumer. Message whose handling fails after all retries is published
+to dead letters with hierarchy and error, so consumer continues with next messages.
+Dead letters are applied again by replay after the cause of failure is fixed.
+"""
+
+from abc import ABC, abstractmethod
+import asyncio
+import base64
+import dataclasses
+from datetime import datetime, timezone
+import json
+import os
+from sys import stderr
+import traceback
+from typing import Awaitable, Callable, Iterator
+
+from confluent_kafka import Consumer, Producer, TopicPartition
+
+from services.kafka.consumer.deserialization import (
+    deserialize_inventory_message,
+)
+from settings import KafkaConfigs
+
+# replay stops when no dead letters are received during this count of seconds
+REPLAY_IDLE_TIMEOUT = 5.0
+
+
+@dataclasses.dataclass(slots=True)
+class DeadLetter:
+    key: bytes | None
+    value: bytes | None
+    hierarchy_id: int | None
+    error: str
+    # position of message in topic of Inventory changes
+    topic: str | None = None
+    partition: int | None = None
+    offset: int | None = None
+    failed_at: str = dataclasses.field(
+        default_factory=lambda: datetime.now(timezone.utc).isoformat()
+    )
+
+    @classmethod
+    def from_message(cls, msg, hierarchy_id: int | None, error: str):
+        return cls(
+            key=msg.key(),
+            value=msg.value(),
+            hierarchy_id=hierarchy_id,
+            error=error,
+            topic=msg.topic(),
+            partition=msg.partition(),
+            offset=msg.offset(),
+        )
+
+    def get_metadata(self) -> dict:
+        """Returns fields of dead letter except key and value"""
+        return {
+            field.name: getattr(self, field.name)
+            for field in dataclasses.fields(self)
+            if field.name not in ("key", "value")
+        }
+
+    def to_dict(self) -> dict:
+        def encode(data: bytes | None) -> str | None:
+            return base64.b64encode(data).decode() if data is not None else None
+
+        return dict(
+            self.get_metadata(), key=encode(self.key), value=encode(self.value)
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        def decode(data: str | None) -> bytes | None:
+            return base64.b64decode(data) if data is not None else None
+
+        return cls(
+            **dict(data, key=decode(data["key"]), value=decode(data["value"]))
+        )
+
+
+class DeadLettersSinkI(ABC):
+    @abstractmethod
+    async def publish(self, dead_letter: DeadLetter):
+        """Saves dead letter, returns when it is saved"""
+        pass
+
+    @abstractmethod
+    async def replay(
+        self, apply: Callable[[DeadLetter], Awaitable[None]]
+    ) -> tuple[int, int]:
+        """Applies all dead letters by apply. Dead letters which are applied are removed,
+        failed ones are kept with new error. Returns counts of applied and failed letters"""
+        pass
+
+
+class FileDeadLettersSink(DeadLettersSinkI):
+    """Keeps dead letters in local file as JSON lines, is used by tests and local runs"""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    async def publish(self, dead_letter: DeadLetter):
+        with open(self.file_path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(dead_letter.to_dict()) + "\n")
+
+    def read(self) -> Iterator[DeadLetter]:
+        if not os.path.exists(self.file_path):
+            return
+        with open(self.file_path, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    yield DeadLetter.from_dict(json.loads(line))
+
+    async def replay(
+        self, apply: Callable[[DeadLetter], Awaitable[None]]
+    ) -> tuple[int, int]:
+        applied = 0
+        failed = list()
+        for dead_letter in list(self.read()):
+            try:
+                await apply(dead_letter)
+            except Exception:
+                dead_letter.error = traceback.format_exc()
+                failed.append(dead_letter)
+            else:
+                applied += 1
+
+        temp_file_path = f"{self.file_path}.tmp"
+        with open(temp_file_path, "w", encoding="utf-8") as file:
+            for dead_letter in failed:
+                file.write(json.dumps(dead_letter.to_dict()) + "\n")
+        os.replace(temp_file_path, self.file_path)
+        return applied, len(failed)
+
+
+class KafkaDeadLettersSink(DeadLettersSinkI):
+    """Publishes dead letters into Kafka topic. Key and value are the same as key and value
+    of failed message, other fields are in headers"""
+
+    def __init__(self, kafka_configs: KafkaConfigs):
+        self.kafka_configs = kafka_configs
+        self.topic = kafka_configs.dead_letters_topic
+        self.__producer = None
+
+    @property
+    def producer(self) -> Producer:
+        if self.__producer is None:
+            self.__producer = Producer(
+                self.kafka_configs.get_connection_settings_for_dead_letters_producer()
+            )
+        return self.__producer
+
+    async def publish(self, dead_letter: DeadLetter):
+        headers = {
+            name: json.dumps(value)
+            for name, value in dead_letter.get_metadata().items()
+        }
+        self.producer.produce(
+            topic=self.topic,
+            key=dead_letter.key,
+            value=dead_letter.value,
+            headers=headers,
+        )
+        # offset of failed message is committed only after dead letter is saved,
+        # delivery is waited in thread, so event loop is not blocked
+        not_delivered = await asyncio.to_thread(self.producer.flush, 30)
+        if not_delivered:
+            raise RuntimeError(
+                f"Dead letter is not delivered into topic {self.topic}"
+            )
+
+    @staticmethod
+    def _from_message(msg) -> DeadLetter:
+        metadata = {
+            name: json.loads(value) for name, value in msg.headers() or []
+        }
+        return DeadLetter(key=msg.key(), value=msg.value(), **metadata)
+
+    async def replay(
+        self, apply: Callable[[DeadLetter], Awaitable[None]]
+    ) -> tuple[int, int]:
+        consumer = Consumer(
+            self.kafka_configs.get_connection_settings_for_dead_letters_consumer()
+        )
+        consumer.subscribe([self.topic])
+        replay_started_at = datetime.now(timezone.utc)
+        applied = 0
+        failed = 0
+        try:
+            while True:
+                msg = consumer.poll(REPLAY_IDLE_TIMEOUT)
+                if msg is None:
+                    break
+                if msg.error() is not None:
+                    print(msg.error(), file=stderr)
+                    continue
+
+                dead_letter = self._from_message(msg)
+                if (
+                    datetime.fromisoformat(dead_letter.failed_at)
+                    >= replay_started_at
+                ):
+                    # letters of partition published before replay are replayed,
+                    # letters failed again are left for the next replay
+                    consumer.pause(
+                        [TopicPartition(msg.topic(), msg.partition())]
+                    )
+                    continue
+
+                try:
+                    await apply(dead_letter)
+                except Exception:
+                    # failed letter is published again to be replayed next time
+                    dead_letter.error = traceback.format_exc()
+                    dead_letter.failed_at = datetime.now(
+                        timezone.utc
+                    ).isoformat()
+                    await self.publish(dead_letter)
+                    failed += 1
+                else:
+                    applied += 1
+                consumer.commit(message=msg, asynchronous=False)
+        finally:
+            consumer.close()
+        return applied, failed
+
+
+def get_dead_letters_sink(
+    kafka_configs: KafkaConfigs,
+) -> DeadLettersSinkI | None:
+    """Returns sink of dead letters by settings or None if dead letters are disabled"""
+    match kafka_configs.dead_letters_sink:
+        case "kafka":
+            return KafkaDeadLettersSink(kafka_configs=kafka_configs)
+        case "file":
+            return FileDeadLettersSink(
+                file_path=kafka_configs.dead_letters_file_path
+            )
+    return None
+
+
+async def replay_dead_letters(
+    dead_letters: DeadLettersSinkI, msg_handler, session_maker
+) -> tuple[int, int]:
+    """Handles dead letters again by handler of consumer, each letter in own session
+    for its hierarchy. Returns counts of applied and failed letters"""
+
+    async def apply(dead_letter: DeadLetter):
+        deserialized_msg = deserialize_inventory_message(
+            key=dead_letter.key, value=dead_letter.value
+        )
+        if deserialized_msg is None:
+            return
+        msg_class_name, msg_event, message_as_dict = deserialized_msg
+        async with session_maker() as session:
+            await msg_handler.handle_the_message(
+                msg=message_as_dict,
+                class_name=msg_class_name,
+                event=msg_event,
+                session=session,
+                hierarchy_id=dead_letter.hierarchy_id,
+            )
+
+    return await dead_letters.replay(apply)
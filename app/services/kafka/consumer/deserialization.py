@@ -0,0 +1,33 @@
+"""
+Deserialization of Inventory messages, which is shared by consumer and replay of dead letters.
+"""
+
+from kafka_config import config
+from kafka_config.protobuf.custom_deserializer import protobuf_kafka_msg_to_view
+
+
+def deserialize_inventory_message(
+    key: bytes | None, value: bytes | None
+) -> tuple[str, str, dict] | None:
+    """Returns class name, event and data of Inventory message or None
+    if message can not be handled"""
+    if key is None:
+        return None
+
+    msg_key = key.decode("utf-8")
+    if msg_key.find(":") == -1:
+        return None
+
+    msg_class_name, msg_event = msg_key.split(":")
+    if msg_class_name not in config.KAFKA_PROTOBUF_DESERIALIZERS.keys():
+        return None
+
+    msg_object = config.KAFKA_PROTOBUF_DESERIALIZERS[msg_class_name]()
+    msg_object.ParseFromString(value)
+
+    if msg_object is None:
+        return None
+
+    # objects are read-only views, their fields are converted on access
+    message_as_dict = protobuf_kafka_msg_to_view(msg=msg_object)
+    return msg_class_name, msg_event, message_as_dict
@@ -0,0 +1,145 @@
+"""
+Concurrent handling of Inventory messages. Tasks with common keys are handled in the order
+they were submitted, tasks with different keys are handled in parallel. Offsets of partitions
+are committed only up to the lowest offset whose messages are not handled yet.
+"""
+
+import asyncio
+from collections import defaultdict
+from typing import Awaitable, Callable, Hashable, Iterable
+
+
+class KeyedTaskExecutor:
+    """Runs tasks in parallel up to max_concurrency tasks. Every task has scope and keys,
+    task waits for previous tasks of its scope with at least one common key.
+    Task without keys is exclusive in its scope, it waits for all previous tasks
+    of scope and next tasks of scope wait for it."""
+
+    def __init__(self, max_concurrency: int):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._last_tasks_by_key: dict[
+            Hashable, dict[Hashable, asyncio.Task]
+        ] = defaultdict(dict)
+        self._exclusive_tasks: dict[Hashable, asyncio.Task] = dict()
+        self.tasks: set[asyncio.Task] = set()
+        self.errors: list[BaseException] = list()
+
+    @property
+    def pending_count(self) -> int:
+        return len(self.tasks)
+
+    def submit(
+        self,
+        scope: Hashable,
+        keys: Iterable[Hashable] | None,
+        coro_factory: Callable[[], Awaitable],
+    ) -> asyncio.Task:
+        last_tasks = self._last_tasks_by_key[scope]
+        dependencies = set()
+        if scope in self._exclusive_tasks:
+            dependencies.add(self._exclusive_tasks[scope])
+
+        if keys is None:
+            dependencies.update(last_tasks.values())
+        else:
+            keys = set(keys)
+            dependencies.update(
+                last_tasks[key] for key in keys if key in last_tasks
+            )
+
+        task = asyncio.create_task(self._run(dependencies, coro_factory))
+        self.tasks.add(task)
+        if keys is None:
+            last_tasks.clear()
+            self._exclusive_tasks[scope] = task
+        else:
+            for key in keys:
+                last_tasks[key] = task
+        task.add_done_callback(
+            lambda t: self._on_done(t, scope=scope, keys=keys)
+        )
+        return task
+
+    async def _run(
+        self,
+        dependencies: set[asyncio.Task],
+        coro_factory: Callable[[], Awaitable],
+    ):
+        not_done = {task for task in dependencies if not task.done()}
+        if not_done:
+            await asyncio.wait(not_done)
+        if self.errors or any(
+            not task.cancelled() and task.exception() is not None
+            for task in dependencies
+        ):
+            # after the first error tasks are not handled, so their messages
+            # are handled again after restart of consumer
+            return
+        async with self._semaphore:
+            return await coro_factory()
+
+    def _on_done(self, task: asyncio.Task, scope: Hashable, keys: set | None):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.errors.append(task.exception())
+
+        if keys is None:
+            if self._exclusive_tasks.get(scope) is task:
+                del self._exclusive_tasks[scope]
+            return
+        last_tasks = self._last_tasks_by_key[scope]
+        for key in keys:
+            if last_tasks.get(key) is task:
+                del last_tasks[key]
+        if not last_tasks:
+            del self._last_tasks_by_key[scope]
+
+    async def wait_for_count(self, max_pending_count: int):
+        """Waits until count of pending tasks is not greater than max_pending_count"""
+        while len(self.tasks) > max_pending_count:
+            await asyncio.wait(
+                set(self.tasks), return_when=asyncio.FIRST_COMPLETED
+            )
+
+    async def wait_all(self):
+        await self.wait_for_count(0)
+
+
+class PartitionOffsetsTracker:
+    """Keeps offsets of messages which are not handled yet by partitions"""
+
+    def __init__(self):
+        # count of not finished tasks of messages by offsets
+        self._pending: dict[tuple[str, int], dict[int, int]] = defaultdict(dict)
+        self._next_offsets: dict[tuple[str, int], int] = dict()
+        self._committed: dict[tuple[str, int], int] = dict()
+
+    def add(self, topic: str, partition: int, offset: int, tasks_count: int):
+        """Adds offset of message handled by tasks_count tasks"""
+        topic_partition = (topic, partition)
+        self._next_offsets[topic_partition] = max(
+            self._next_offsets.get(topic_partition, 0), offset + 1
+        )
+        if tasks_count > 0:
+            self._pending[topic_partition][offset] = (
+                self._pending[topic_partition].get(offset, 0) + tasks_count
+            )
+
+    def done(self, topic: str, partition: int, offset: int):
+        """Marks one task of message as finished"""
+        pending = self._pending[(topic, partition)]
+        pending[offset] -= 1
+        if pending[offset] <= 0:
+            del pending[offset]
+
+    def get_offsets_to_commit(self) -> list[tuple[str, int, int]]:
+        """Returns (topic, partition, offset) of partitions whose lowest not handled
+        offset changed since the last call. Offset is the next message to read"""
+        res = list()
+        for topic_partition, next_offset in self._next_offsets.items():
+            pending = self._pending.get(topic_partition)
+            offset = min(pending) if pending else next_offset
+            if self._committed.get(topic_partition) != offset:
+                self._committed[topic_partition] = offset
+                res.append((*topic_partition, offset))
+        return res
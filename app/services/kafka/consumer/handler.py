@@ -1,34 +1,98 @@
 import asyncio
 from asyncio import CancelledError
+import functools
 from multiprocessing import Event
 import signal
 from sys import stderr
+import time
 import traceback
 
-from confluent_kafka import Consumer
+from confluent_kafka import Consumer, TopicPartition
 
 from database import async_session_maker_with_admin_perm
-from kafka_config import config
-from kafka_config.protobuf.custom_deserializer import protobuf_kafka_msg_to_dict
+from kafka_config.batch_change_handler.utils.utils import (
+    get_count_of_hierarchy_nodes,
+    rebuild_hierarchy_and_change_item_of_hierarchy_rebuild_order,
+)
+from schemas.hier_schemas import HierarchyRebuildOrder
+from services.kafka.consumer.batching import group_inventory_messages
+from services.kafka.consumer.catch_up import (
+    CatchUpEstimate,
+    ReplayCostEstimator,
+    get_committed_positions,
+    get_lag_and_high_watermarks,
+)
+from services.kafka.consumer.dead_letters import (
+    DeadLetter,
+    DeadLettersSinkI,
+    get_dead_letters_sink,
+)
+from services.kafka.consumer.deserialization import (
+    deserialize_inventory_message,
+)
+from services.kafka.consumer.executor import (
+    KeyedTaskExecutor,
+    PartitionOffsetsTracker,
+)
 from services.kafka.consumer.interface import KafkaConnectionHandlerI
+from services.kafka.consumer.routing import (
+    TYPE_CLASS_NAMES,
+    DeferredGroups,
+    HierarchiesRouter,
+)
+from services.link_keys.cache import (
+    LinkKeysInvalidations,
+    publish_link_keys_invalidations,
+)
+from services.metrics.consumer import (
+    BATCH_SIZE,
+    DEAD_LETTERS,
+    count_messages,
+    get_consumer_label,
+    measure_handler_time,
+    observe_consumer_statistics,
+)
 from services.updater.event_handlers.mediator.interface import (
     UpdaterEventMediator,
 )
-from settings import KafkaConfigs
+from settings import POSTGRES_ITEMS_LIMIT_IN_QUERY, KafkaConfigs
 
 
 class KafkaConnectionHandlerImpl(KafkaConnectionHandlerI):
+    """Consumer of Inventory changes. Consumer with hierarchy_id handles messages
+    for this hierarchy, consumer without hierarchy_id is consumer of shared mode and
+    handles every message for all hierarchies affected by it."""
+
     def __init__(
         self,
         kafka_configs: KafkaConfigs,
         msg_handler: UpdaterEventMediator,
-        hierarchy_id: int,
+        hierarchy_id: int | None,
         event: Event = None,
+        routing_event: Event = None,
+        dead_letters: DeadLettersSinkI | None = None,
+        link_keys_invalidations: LinkKeysInvalidations | None = None,
     ):
         self.kafka_configs = kafka_configs
         self.msg_handler = msg_handler
         self.hierarchy_id = hierarchy_id
+        self.router = HierarchiesRouter()
+        # groups of messages of hierarchies being rebuilt
+        self.deferred_groups = DeferredGroups(
+            max_groups=kafka_configs.consumer_max_deferred_groups
+        )
+        # (topic, partition) revoked by rebalance since they were handled last time
+        self.__revoked_partitions: set[tuple[str, int]] = set()
+        self.metrics_label = get_consumer_label(hierarchy_id)
+        self.replay_costs = ReplayCostEstimator()
+        self.__catch_up_checked_at = None
+        # messages failed after all retries are published here, None stops consumer
+        self.dead_letters = dead_letters or get_dead_letters_sink(kafka_configs)
         self.__event = event or Event()
+        # is set when levels or hierarchies are changed
+        self.__routing_event = routing_event
+        # ids of changed MOs and PRMs are sent to cache of keys of nodes of the app
+        self.link_keys_invalidations = link_keys_invalidations
 
     @property
     def __connected(self):
@@ -63,10 +127,20 @@ class KafkaConnectionHandlerImpl(KafkaConnectionHandlerI):
             return
         try:
             self.__on_connection_to_kafka_topic()
-            connection_data = self.kafka_configs.get_connection_settings_for_special_hierarchy(
-                hierarchy_id=self.hierarchy_id
-            )
+            if self.hierarchy_id is None:
+                connection_data = self.kafka_configs.get_connection_settings_for_shared_consumer()
+            else:
+                connection_data = self.kafka_configs.get_connection_settings_for_special_hierarchy(
+                    hierarchy_id=self.hierarchy_id
+                )
             print(connection_data)
+            if self.kafka_configs.consumer_statistics_interval_ms:
+                connection_data["statistics.interval.ms"] = (
+                    self.kafka_configs.consumer_statistics_interval_ms
+                )
+                connection_data["stats_cb"] = functools.partial(
+                    observe_consumer_statistics, consumer=self.metrics_label
+                )
             self.__consumer = Consumer(connection_data)
             # asyncio.run(self.__start_to_read_connect_to_kafka_topic(hierarchy_id=self.hierarchy_id))
             loop = asyncio.new_event_loop()
@@ -87,64 +161,771 @@ class KafkaConnectionHandlerImpl(KafkaConnectionHandlerI):
             asyncio.run(asyncio.sleep(5))
             self.connect_to_kafka_topic()
 
-    async def __start_to_read_connect_to_kafka_topic(self, hierarchy_id: int):
-        print("HERER")
-        print(self.kafka_configs.topics)
-        self.__consumer.subscribe(self.kafka_configs.topics)
-        self.__connected = True
-        print(f"Done {hierarchy_id}")
-        try:
-            while self.__connected:
-                msg = self.__consumer.poll(2)
+    @staticmethod
+    def __deserialize_message(msg) -> tuple[str, str, dict] | None:
+        """Returns class name, event and data of Inventory message or None
+        if message can not be handled"""
+        if getattr(msg, "key", None) is None:
+            return None
+        return deserialize_inventory_message(key=msg.key(), value=msg.value())
 
-                if msg is None:
-                    continue
+    async def __load_routing_index(self):
+        """Loads index of levels at start of consumer and after its invalidation"""
+        if self.__routing_event is not None and self.__routing_event.is_set():
+            self.__routing_event.clear()
+            self.router.invalidate()
+        if self.router.is_loaded:
+            if self.router.rebuilding_hierarchy_ids_are_outdated():
+                async with async_session_maker_with_admin_perm() as session:
+                    await self.router.load_rebuilding_hierarchy_ids(session)
+            return
+        async with async_session_maker_with_admin_perm() as session:
+            await self.router.load(session)
+        print(f"Routing index is loaded: {self.router.stats}")
 
-                if getattr(msg, "key", None) is None:
-                    self.__consumer.commit(asynchronous=True, message=msg)
-                    continue
+    async def __handle_for_hierarchies(
+        self,
+        msg: dict,
+        class_name: str,
+        event: str,
+        session,
+        hierarchy_ids: list[int],
+    ):
+        for hierarchy_id in hierarchy_ids:
+            start = time.perf_counter()
+            with measure_handler_time(class_name=class_name, event=event):
+                await self.msg_handler.handle_the_message(
+                    msg=msg,
+                    class_name=class_name,
+                    event=event,
+                    session=session,
+                    hierarchy_id=hierarchy_id,
+                )
+            self.replay_costs.observe(
+                class_name=class_name,
+                objects_count=len(msg.get("objects", [])),
+                seconds=time.perf_counter() - start,
+            )
+        if class_name in TYPE_CLASS_NAMES:
+            # handlers of TMO and TPRM delete levels
+            self.router.invalidate()
 
-                if msg.key() is None:
-                    self.__consumer.commit(asynchronous=True, message=msg)
-                    continue
+    async def __handle_with_retries(
+        self,
+        msg: dict,
+        class_name: str,
+        event: str,
+        session,
+        hierarchy_id: int,
+    ) -> Exception | None:
+        """Handles message for hierarchy, failed handling is retried in new sessions
+        with doubled pauses. Returns the last error or None if message is handled"""
+        error = None
+        for attempt in range(self.kafka_configs.consumer_max_retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(
+                    min(
+                        self.kafka_configs.consumer_retry_backoff
+                        * 2 ** (attempt - 1),
+                        self.kafka_configs.consumer_retry_max_backoff,
+                    )
+                )
+            try:
+                if attempt == 0:
+                    await self.__handle_for_hierarchies(
+                        msg=msg,
+                        class_name=class_name,
+                        event=event,
+                        session=session,
+                        hierarchy_ids=[hierarchy_id],
+                    )
+                else:
+                    async with async_session_maker_with_admin_perm() as session:
+                        await self.__handle_for_hierarchies(
+                            msg=msg,
+                            class_name=class_name,
+                            event=event,
+                            session=session,
+                            hierarchy_ids=[hierarchy_id],
+                        )
+            except Exception as e:
+                print(traceback.format_exc(), file=stderr)
+                print(
+                    f"Hierarchy {hierarchy_id}: handling of {class_name}:{event} "
+                    f"failed, attempt {attempt + 1}",
+                    file=stderr,
+                )
+                if attempt == 0:
+                    # next handlers use session of batch after failed one
+                    await session.rollback()
+                error = e
+            else:
+                return None
+        return error
 
-                msg_key = msg.key().decode("utf-8")
-                if msg_key.find(":") == -1:
-                    self.__consumer.commit(asynchronous=True, message=msg)
+    async def __publish_dead_letter(
+        self, msg, hierarchy_id: int, error: Exception
+    ):
+        dead_letter = DeadLetter.from_message(
+            msg,
+            hierarchy_id=hierarchy_id,
+            error="".join(traceback.format_exception(error)),
+        )
+        await self.dead_letters.publish(dead_letter)
+        DEAD_LETTERS.labels(hierarchy_id=str(hierarchy_id)).inc()
+        print(
+            f"Hierarchy {hierarchy_id}: message {dead_letter.topic} "
+            f"[{dead_letter.partition}] at offset {dead_letter.offset} "
+            f"is published to dead letters",
+            file=stderr,
+        )
+
+    async def __handle_or_publish_dead_letters(
+        self,
+        msg: dict,
+        class_name: str,
+        event: str,
+        session,
+        hierarchy_ids: list[int],
+        sources: list,
+    ):
+        """Handles message or group of messages for hierarchies. If handling fails after
+        all retries, failed messages are published to dead letters, so next messages
+        are not blocked by them. Messages of failed group are handled one by one
+        to publish only poison ones."""
+        for hierarchy_id in hierarchy_ids:
+            error = await self.__handle_with_retries(
+                msg=msg,
+                class_name=class_name,
+                event=event,
+                session=session,
+                hierarchy_id=hierarchy_id,
+            )
+            if error is None:
+                continue
+            if self.dead_letters is None:
+                raise error
+
+            if len(sources) == 1:
+                await self.__publish_dead_letter(
+                    sources[0], hierarchy_id=hierarchy_id, error=error
+                )
+                continue
+
+            for source in sources:
+                deserialized_msg = self.__deserialize_message(source)
+                if deserialized_msg is None:
                     continue
+                msg_class_name, msg_event, message_as_dict = deserialized_msg
+                async with async_session_maker_with_admin_perm() as own_session:
+                    source_error = await self.__handle_with_retries(
+                        msg=message_as_dict,
+                        class_name=msg_class_name,
+                        event=msg_event,
+                        session=own_session,
+                        hierarchy_id=hierarchy_id,
+                    )
+                if source_error is not None:
+                    await self.__publish_dead_letter(
+                        source, hierarchy_id=hierarchy_id, error=source_error
+                    )
 
-                msg_class_name, msg_event = msg_key.split(":")
-                if (
-                    msg_class_name
-                    not in config.KAFKA_PROTOBUF_DESERIALIZERS.keys()
-                ):
-                    self.__consumer.commit(asynchronous=True, message=msg)
+    def __defer_groups_of_rebuilding_hierarchies(
+        self,
+        group,
+        hierarchy_ids: set[int],
+        offsets: PartitionOffsetsTracker | None = None,
+    ) -> set[int]:
+        """Defers group for routed hierarchies being rebuilt,
+        returns ids of hierarchies whose group is handled now"""
+        rebuilding_hierarchy_ids = (
+            hierarchy_ids & self.router.rebuilding_hierarchy_ids
+        )
+        for hierarchy_id in sorted(rebuilding_hierarchy_ids):
+            dropped_groups = self.deferred_groups.add(
+                hierarchy_id, group, offsets=offsets
+            )
+            # hierarchy of dropped groups is rebuilt again after its rebuild
+            for deferred_group in dropped_groups:
+                if deferred_group.offsets is None:
                     continue
+                for msg in deferred_group.group.sources:
+                    deferred_group.offsets.done(
+                        topic=msg.topic(),
+                        partition=msg.partition(),
+                        offset=msg.offset(),
+                    )
+        return hierarchy_ids - rebuilding_hierarchy_ids
+
+    async def __handle_deferred_groups(
+        self, executor: KeyedTaskExecutor | None = None
+    ):
+        """Handles deferred groups of hierarchies which are not rebuilt anymore,
+        in tasks of executor if it is passed. Groups of deleted hierarchies are dropped.
+        Hierarchies whose groups were dropped by limit of deferred groups are ordered
+        to be rebuilt again"""
+        overflowed_hierarchy_ids = (
+            self.deferred_groups.pop_rebuilt_overflowed(self.router)
+            & self.router.hierarchy_ids
+        )
+        if overflowed_hierarchy_ids:
+            print(
+                f"Hierarchies {sorted(overflowed_hierarchy_ids)} are ordered to be "
+                f"rebuilt, their messages deferred while rebuild were dropped"
+            )
+            async with async_session_maker_with_admin_perm() as session:
+                session.add_all(
+                    HierarchyRebuildOrder(hierarchy_id=hierarchy_id)
+                    for hierarchy_id in sorted(overflowed_hierarchy_ids)
+                )
+                await session.commit()
+        for hierarchy_id, deferred_groups in self.deferred_groups.pop_rebuilt(
+            self.router
+        ).items():
+            is_routed = hierarchy_id in self.router.hierarchy_ids
+            print(
+                f"Hierarchy {hierarchy_id}: {len(deferred_groups)} groups "
+                f"deferred while rebuild are {'handled' if is_routed else 'dropped'}"
+            )
+            if executor is not None:
+                for deferred_group in deferred_groups:
+                    if is_routed:
+                        executor.submit(
+                            scope=hierarchy_id,
+                            keys=self.router.get_level_keys(
+                                class_name=deferred_group.group.class_name,
+                                msg=deferred_group.group.msg,
+                                hierarchy_id=hierarchy_id,
+                            ),
+                            coro_factory=functools.partial(
+                                self.__handle_group_in_own_session,
+                                group=deferred_group.group,
+                                hierarchy_id=hierarchy_id,
+                                offsets=deferred_group.offsets,
+                            ),
+                        )
+                    else:
+                        for msg in deferred_group.group.sources:
+                            deferred_group.offsets.done(
+                                topic=msg.topic(),
+                                partition=msg.partition(),
+                                offset=msg.offset(),
+                            )
+                continue
+            if not is_routed:
+                continue
+            async with async_session_maker_with_admin_perm() as session:
+                for deferred_group in deferred_groups:
+                    await self.__handle_or_publish_dead_letters(
+                        msg=deferred_group.group.msg,
+                        class_name=deferred_group.group.class_name,
+                        event=deferred_group.group.event,
+                        session=session,
+                        hierarchy_ids=[hierarchy_id],
+                        sources=deferred_group.group.sources,
+                    )
+
+    def __on_revoke(self, consumer, partitions: list[TopicPartition]):
+        """Is called by poll or consume of consumer when partitions are revoked or lost
+        by rebalance. Partitions are forgotten after poll in the loop of consumer"""
+        self.__revoked_partitions.update(
+            (item.topic, item.partition) for item in partitions
+        )
+
+    def __forget_revoked_partitions(self) -> bool:
+        """Forgets deferred messages of revoked partitions. Returns True
+        if partitions were revoked since the last call"""
+        if not self.__revoked_partitions:
+            return False
+        revoked_partitions = self.__revoked_partitions
+        self.__revoked_partitions = set()
+        print(f"Partitions are revoked: {sorted(revoked_partitions)}")
+        self.deferred_groups.forget_partitions(revoked_partitions)
+        return True
+
+    def __commit_positions(self, messages: list):
+        """Commits positions of consumer. Partitions with deferred messages
+        are committed up to the first deferred message"""
+        if not len(self.deferred_groups):
+            self.__consumer.commit(asynchronous=True)
+            return
+        lowest_offsets = self.deferred_groups.get_lowest_offsets()
+        next_offsets = dict()
+        for msg in messages:
+            topic_partition = (msg.topic(), msg.partition())
+            next_offsets[topic_partition] = max(
+                next_offsets.get(topic_partition, 0), msg.offset() + 1
+            )
+        self.__consumer.commit(
+            offsets=[
+                TopicPartition(
+                    topic,
+                    partition,
+                    lowest_offsets.get((topic, partition), next_offset),
+                )
+                for (topic, partition), next_offset in next_offsets.items()
+            ],
+            asynchronous=True,
+        )
+
+    async def __get_high_watermarks_to_catch_up(
+        self,
+        hierarchy_id: int | None,
+        batch_size: int,
+        messages: list[tuple[str, str, dict]],
+    ) -> list[TopicPartition] | None:
+        """Returns high watermarks of assigned partitions if lag of consumer of hierarchy
+        is huge and rebuild of hierarchy is estimated faster than replay of pending
+        messages. Lag is checked after full batches only, deserialized messages
+        of the last batch are used as sample of pending ones"""
+        configs = self.kafka_configs
+        if (
+            hierarchy_id is None
+            or not configs.consumer_catch_up_min_lag
+            or batch_size < configs.consumer_batch_max_size
+            or not messages
+        ):
+            return None
+        now = time.monotonic()
+        if (
+            self.__catch_up_checked_at is not None
+            and now - self.__catch_up_checked_at
+            < configs.consumer_catch_up_check_interval
+        ):
+            return None
+        self.__catch_up_checked_at = now
+
+        lag, high_watermarks = await asyncio.to_thread(
+            get_lag_and_high_watermarks, self.__consumer
+        )
+        if lag < configs.consumer_catch_up_min_lag:
+            return None
+
+        async with async_session_maker_with_admin_perm() as session:
+            count_of_nodes = await get_count_of_hierarchy_nodes(
+                session=session, hierarchy_ids=[hierarchy_id]
+            )
+        estimate = CatchUpEstimate(
+            lag=lag,
+            replay_seconds=self.replay_costs.estimate_replay_seconds(
+                lag=lag, messages=messages
+            ),
+            rebuild_seconds=count_of_nodes.get(hierarchy_id, 0)
+            * configs.consumer_catch_up_rebuild_seconds_per_node,
+        )
+        print(f"Hierarchy {hierarchy_id} catch-up estimate: {estimate}")
+        if not estimate.is_rebuild_faster:
+            return None
+        return high_watermarks
+
+    async def __catch_up_by_rebuild(
+        self, hierarchy_id: int, high_watermarks: list[TopicPartition]
+    ):
+        """Rebuilds hierarchy instead of replay of messages before high watermarks captured
+        at rebuild start, messages received during rebuild are handled after it.
+        High watermarks are committed only after rebuild succeeds. After failed
+        or stopped rebuild consumer reads messages again from committed offsets,
+        stopped rebuild is also continued from rebuild order"""
+        print(f"Hierarchy {hierarchy_id} catches up by rebuild")
+        self.__consumer.pause(self.__consumer.assignment())
+        is_rebuilt = False
+        try:
+            async with async_session_maker_with_admin_perm() as session:
+                item_to_rebuild = HierarchyRebuildOrder(
+                    hierarchy_id=hierarchy_id
+                )
+                session.add(item_to_rebuild)
+                await session.commit()
+
+                rebuild = asyncio.create_task(
+                    rebuild_hierarchy_and_change_item_of_hierarchy_rebuild_order(
+                        session=session, item_to_rebuild=item_to_rebuild
+                    )
+                )
+                while not rebuild.done():
+                    # consumer stays in group while hierarchy is rebuilt
+                    msg = await asyncio.to_thread(self.__consumer.poll, 1.0)
+                    if msg is not None:
+                        # partitions were assigned again from committed offsets,
+                        # message is read again after rebuild
+                        self.__consumer.pause(self.__consumer.assignment())
+                is_rebuilt = await rebuild
+            if is_rebuilt:
+                self.__consumer.commit(
+                    offsets=high_watermarks, asynchronous=False
+                )
+        finally:
+            if is_rebuilt:
+                positions = high_watermarks
+            else:
+                positions = get_committed_positions(
+                    self.__consumer, high_watermarks
+                )
+            assignment = self.__consumer.assignment()
+            assigned = {(item.topic, item.partition) for item in assignment}
+            for partition in positions:
+                if (partition.topic, partition.partition) in assigned:
+                    self.__consumer.seek(partition)
+            self.__consumer.resume(assignment)
+        if is_rebuilt:
+            print(f"Hierarchy {hierarchy_id} is rebuilt, consumer is resumed")
+        else:
+            print(
+                f"Hierarchy {hierarchy_id} is not rebuilt, consumer is resumed "
+                f"from committed offsets",
+                file=stderr,
+            )
+
+    async def __start_to_read_connect_to_kafka_topic(
+        self, hierarchy_id: int | None
+    ):
+        print("HERER")
+        print(self.kafka_configs.topics)
+        self.__consumer.subscribe(
+            self.kafka_configs.topics,
+            on_revoke=self.__on_revoke,
+            on_lost=self.__on_revoke,
+        )
+        self.__connected = True
+        print(f"Done {hierarchy_id}")
+        try:
+            await self.__load_routing_index()
+            if self.kafka_configs.consumer_max_concurrency > 1:
+                await self.__read_batches_concurrently(
+                    hierarchy_id=hierarchy_id
+                )
+            elif self.kafka_configs.consumer_batch_max_size > 1:
+                await self.__read_batches(hierarchy_id=hierarchy_id)
+            else:
+                await self.__read_messages(hierarchy_id=hierarchy_id)
+        except Exception as e:
+            print(traceback.format_exc(), file=stderr)
+            print("HERER WAS ")
+            self.disconnect_from_kafka_topic()
+            raise e
+
+    async def __read_messages(self, hierarchy_id: int | None):
+        while self.__connected:
+            msg = self.__consumer.poll(2)
+            self.__forget_revoked_partitions()
+            await self.__load_routing_index()
+            await self.__handle_deferred_groups()
 
-                msg_object = config.KAFKA_PROTOBUF_DESERIALIZERS[
-                    msg_class_name
-                ]()
-                msg_object.ParseFromString(msg.value())
+            if msg is None:
+                continue
 
-                if msg_object is not None:
-                    message_as_dict = protobuf_kafka_msg_to_dict(
-                        msg=msg_object, including_default_value_fields=True
+            deserialized_msg = self.__deserialize_message(msg)
+            if deserialized_msg is not None:
+                publish_link_keys_invalidations(
+                    self.link_keys_invalidations, [deserialized_msg]
+                )
+                msg_class_name, msg_event, message_as_dict = deserialized_msg
+                hierarchy_ids = self.router.route(
+                    class_name=msg_class_name,
+                    msg=message_as_dict,
+                    hierarchy_id=hierarchy_id,
+                )
+                routed_hierarchy_ids = hierarchy_ids
+                if hierarchy_ids & self.router.rebuilding_hierarchy_ids:
+                    (group,) = group_inventory_messages(
+                        [deserialized_msg],
+                        max_objects_in_group=POSTGRES_ITEMS_LIMIT_IN_QUERY,
+                        sources=[msg],
                     )
+                    hierarchy_ids = (
+                        self.__defer_groups_of_rebuilding_hierarchies(
+                            group, hierarchy_ids
+                        )
+                    )
+                if hierarchy_ids:
                     async with async_session_maker_with_admin_perm() as session:
-                        await self.msg_handler.handle_the_message(
+                        await self.__handle_or_publish_dead_letters(
                             msg=message_as_dict,
                             class_name=msg_class_name,
                             event=msg_event,
                             session=session,
-                            hierarchy_id=hierarchy_id,
+                            hierarchy_ids=sorted(hierarchy_ids),
+                            sources=[msg],
                         )
+                if routed_hierarchy_ids:
+                    count_messages(self.metrics_label, "processed")
+                else:
+                    count_messages(self.metrics_label, "skipped")
+            else:
+                count_messages(self.metrics_label, "skipped")
 
-                self.__consumer.commit(asynchronous=True, message=msg)
-        except Exception as e:
-            print(traceback.format_exc(), file=stderr)
-            print("HERER WAS ")
-            self.disconnect_from_kafka_topic()
-            raise e
+            self.__commit_positions([msg])
+
+    async def __read_batches(self, hierarchy_id: int | None):
+        """Reads messages by batches. Consecutive messages of the same class and event
+        are handled by one handler invocation in one session, offsets are committed
+        once per batch after all messages of batch are handled. In shared mode
+        every group is handled for all hierarchies affected by it."""
+        while self.__connected:
+            messages = self.__consumer.consume(
+                num_messages=self.kafka_configs.consumer_batch_max_size,
+                timeout=self.kafka_configs.consumer_batch_max_latency,
+            )
+            self.__forget_revoked_partitions()
+            await self.__load_routing_index()
+            await self.__handle_deferred_groups()
+            if not messages:
+                continue
+            BATCH_SIZE.labels(consumer=self.metrics_label).observe(
+                len(messages)
+            )
+
+            deserialized_messages = list()
+            sources = list()
+            for msg in messages:
+                if msg.error() is not None:
+                    print(msg.error(), file=stderr)
+                    continue
+                deserialized_msg = self.__deserialize_message(msg)
+                if deserialized_msg is not None:
+                    deserialized_messages.append(deserialized_msg)
+                    sources.append(msg)
+            publish_link_keys_invalidations(
+                self.link_keys_invalidations, deserialized_messages
+            )
+
+            high_watermarks = await self.__get_high_watermarks_to_catch_up(
+                hierarchy_id=hierarchy_id,
+                batch_size=len(messages),
+                messages=deserialized_messages,
+            )
+            if high_watermarks is not None:
+                # messages of batch are before high watermarks, they are applied by rebuild
+                await self.__catch_up_by_rebuild(
+                    hierarchy_id=hierarchy_id, high_watermarks=high_watermarks
+                )
+                continue
+
+            groups = group_inventory_messages(
+                deserialized_messages,
+                max_objects_in_group=POSTGRES_ITEMS_LIMIT_IN_QUERY,
+                sources=sources,
+            )
+            await self.__load_routing_index()
+            routed_groups = list()
+            processed = 0
+            for group in groups:
+                hierarchy_ids = self.router.route(
+                    class_name=group.class_name,
+                    msg=group.msg,
+                    messages_count=group.messages_count,
+                    hierarchy_id=hierarchy_id,
+                )
+                if hierarchy_ids:
+                    processed += len(group.sources)
+                hierarchy_ids = self.__defer_groups_of_rebuilding_hierarchies(
+                    group, hierarchy_ids
+                )
+                if hierarchy_ids:
+                    routed_groups.append((group, sorted(hierarchy_ids)))
+            count_messages(self.metrics_label, "processed", processed)
+            count_messages(
+                self.metrics_label, "skipped", len(messages) - processed
+            )
+
+            if routed_groups:
+                invocations = 0
+                async with async_session_maker_with_admin_perm() as session:
+                    for group, hierarchy_ids in routed_groups:
+                        await self.__handle_or_publish_dead_letters(
+                            msg=group.msg,
+                            class_name=group.class_name,
+                            event=group.event,
+                            session=session,
+                            hierarchy_ids=hierarchy_ids,
+                            sources=group.sources,
+                        )
+                        invocations += len(hierarchy_ids)
+                consumer_name = (
+                    "Shared consumer"
+                    if hierarchy_id is None
+                    else f"Hierarchy {hierarchy_id}"
+                )
+                print(
+                    f"{consumer_name} batch: {len(messages)} messages, "
+                    f"{invocations} handler invocations, {self.router.stats}"
+                )
+
+            self.__commit_positions(messages)
+
+    async def __handle_group_in_own_session(
+        self,
+        group,
+        hierarchy_id: int,
+        offsets: PartitionOffsetsTracker,
+    ):
+        async with async_session_maker_with_admin_perm() as session:
+            await self.__handle_or_publish_dead_letters(
+                msg=group.msg,
+                class_name=group.class_name,
+                event=group.event,
+                session=session,
+                hierarchy_ids=[hierarchy_id],
+                sources=group.sources,
+            )
+        for msg in group.sources:
+            offsets.done(
+                topic=msg.topic(),
+                partition=msg.partition(),
+                offset=msg.offset(),
+            )
+
+    def __commit_handled_offsets(self, offsets: PartitionOffsetsTracker):
+        offsets_to_commit = offsets.get_offsets_to_commit()
+        if offsets_to_commit:
+            self.__consumer.commit(
+                offsets=[
+                    TopicPartition(topic, partition, offset)
+                    for topic, partition, offset in offsets_to_commit
+                ],
+                asynchronous=True,
+            )
+
+    async def __read_batches_concurrently(self, hierarchy_id: int | None):
+        """Reads messages by batches and handles groups of messages for every hierarchy
+        in parallel tasks with own sessions. Groups which change nodes of the same levels
+        or of their parent and child levels are handled in order of messages, as they
+        share parent nodes, groups of TMO and TPRM wait for all previous groups of hierarchy
+        and block next ones. Batches are read while previous groups are handled, offsets are
+        committed up to the lowest offset whose messages are not handled yet.
+        After rebalance offsets are tracked again from the new assignment."""
+        max_concurrency = self.kafka_configs.consumer_max_concurrency
+        executor = KeyedTaskExecutor(max_concurrency=max_concurrency)
+        offsets = PartitionOffsetsTracker()
+        try:
+            while self.__connected:
+                messages = await asyncio.to_thread(
+                    self.__consumer.consume,
+                    num_messages=self.kafka_configs.consumer_batch_max_size,
+                    timeout=self.kafka_configs.consumer_batch_max_latency,
+                )
+                if executor.errors:
+                    raise executor.errors[0]
+                if self.__forget_revoked_partitions():
+                    # offsets of handled messages can not be committed to revoked
+                    # partitions, their messages are handled again by the next owner
+                    await executor.wait_all()
+                    if executor.errors:
+                        raise executor.errors[0]
+                    offsets = PartitionOffsetsTracker()
+                    self.deferred_groups.track_offsets(offsets)
+                if messages:
+                    BATCH_SIZE.labels(consumer=self.metrics_label).observe(
+                        len(messages)
+                    )
+
+                deserialized_messages = list()
+                sources = list()
+                for msg in messages:
+                    if msg.error() is not None:
+                        print(msg.error(), file=stderr)
+                        continue
+                    deserialized_msg = self.__deserialize_message(msg)
+                    if deserialized_msg is not None:
+                        deserialized_messages.append(deserialized_msg)
+                        sources.append(msg)
+                    else:
+                        offsets.add(
+                            topic=msg.topic(),
+                            partition=msg.partition(),
+                            offset=msg.offset(),
+                            tasks_count=0,
+                        )
+                publish_link_keys_invalidations(
+                    self.link_keys_invalidations, deserialized_messages
+                )
+
+                high_watermarks = await self.__get_high_watermarks_to_catch_up(
+                    hierarchy_id=hierarchy_id,
+                    batch_size=len(messages),
+                    messages=deserialized_messages,
+                )
+                if high_watermarks is not None:
+                    # handled messages are applied before rebuild, other messages
+                    # before high watermarks are applied by rebuild
+                    await executor.wait_all()
+                    if executor.errors:
+                        raise executor.errors[0]
+                    await self.__catch_up_by_rebuild(
+                        hierarchy_id=hierarchy_id,
+                        high_watermarks=high_watermarks,
+                    )
+                    offsets = PartitionOffsetsTracker()
+                    self.deferred_groups.track_offsets(offsets)
+                    continue
+
+                groups = group_inventory_messages(
+                    deserialized_messages,
+                    max_objects_in_group=POSTGRES_ITEMS_LIMIT_IN_QUERY,
+                    sources=sources,
+                )
+                await self.__load_routing_index()
+                # deferred groups are handled before next groups of their hierarchies
+                await self.__handle_deferred_groups(executor)
+                processed = 0
+                for group in groups:
+                    hierarchy_ids = self.router.route(
+                        class_name=group.class_name,
+                        msg=group.msg,
+                        messages_count=group.messages_count,
+                        hierarchy_id=hierarchy_id,
+                    )
+                    if hierarchy_ids:
+                        processed += len(group.sources)
+                    for msg in group.sources:
+                        offsets.add(
+                            topic=msg.topic(),
+                            partition=msg.partition(),
+                            offset=msg.offset(),
+                            tasks_count=len(hierarchy_ids),
+                        )
+                    hierarchy_ids = (
+                        self.__defer_groups_of_rebuilding_hierarchies(
+                            group, hierarchy_ids, offsets=offsets
+                        )
+                    )
+                    for h_id in sorted(hierarchy_ids):
+                        executor.submit(
+                            scope=h_id,
+                            keys=self.router.get_level_keys(
+                                class_name=group.class_name,
+                                msg=group.msg,
+                                hierarchy_id=h_id,
+                            ),
+                            coro_factory=functools.partial(
+                                self.__handle_group_in_own_session,
+                                group=group,
+                                hierarchy_id=h_id,
+                                offsets=offsets,
+                            ),
+                        )
+
+                count_messages(self.metrics_label, "processed", processed)
+                count_messages(
+                    self.metrics_label, "skipped", len(messages) - processed
+                )
+
+                # next batch is read while slow groups are handled
+                await executor.wait_for_count(max_concurrency)
+                if executor.errors:
+                    raise executor.errors[0]
+                self.__commit_handled_offsets(offsets)
+                if messages:
+                    print(
+                        f"Batch: {len(messages)} messages, "
+                        f"{executor.pending_count} groups in process, {self.router.stats}"
+                    )
+        finally:
+            await executor.wait_all()
+            try:
+                self.__commit_handled_offsets(offsets)
+            except Exception:
+                print(traceback.format_exc(), file=stderr)
 
     def disconnect_from_kafka_topic(self):
         print("disconnect_from_kafka_topic")
@@ -0,0 +1,323 @@
+"""
+Routing of Inventory messages to hierarchies. Consumers keep index of levels by TMO and TPRM
+and handle messages only for hierarchies whose levels use TMO or TPRM of the message,
+messages which affect no hierarchy are dropped before any session is opened.
+Messages of hierarchies being rebuilt are deferred until the rebuild is finished,
+offsets of deferred messages are not committed, so they are read again after restart.
+Hierarchy is rebuilt while its status is IN_PROCESS and its build sends heartbeats,
+hierarchies being rebuilt are checked again while their messages are deferred.
+"""
+
+from collections import defaultdict
+import dataclasses
+import time
+from typing import Any
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas.enum_models import HierarchyStatus, InventoryClassNames
+from schemas.hier_schemas import Hierarchy, Level
+from services.hierarchy.hierarchy_builder.checkpoints import (
+    get_stalled_hierarchy_ids,
+)
+from services.hierarchy.hierarchy_builder.utils import get_level_tprm_ids
+from services.kafka.consumer.batching import InventoryMessagesGroup
+from settings import HierarchyBuilderConfigs
+
+# messages of these classes change types used by levels
+TYPE_CLASS_NAMES = {
+    InventoryClassNames.TMO.value,
+    InventoryClassNames.TPRM.value,
+}
+
+
+def get_all_level_tprm_ids(level: Level) -> set[int]:
+    """Returns ids of all TPRMs whose values are used by nodes of level"""
+    tprm_ids = set(get_level_tprm_ids(level))
+    tprm_ids.update(
+        tprm_id
+        for tprm_id in (level.latitude_id, level.longitude_id)
+        if tprm_id
+    )
+    tprm_ids.discard(None)
+    return tprm_ids
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class RoutedLevel:
+    id: int
+    hierarchy_id: int
+    object_type_id: int
+    # key attrs and attr_as_parent resolved into TPRM ids
+    tprm_ids: frozenset[int]
+    parent_id: int | None = None
+
+
+class HierarchiesRouter:
+    """Index of levels of hierarchies by TMO and TPRM. Index is loaded once
+    and is used until it is invalidated by changes of levels or hierarchies."""
+
+    def __init__(self):
+        builder_configs = HierarchyBuilderConfigs()
+        self.heartbeat_timeout = builder_configs.heartbeat_timeout
+        self.rebuilding_check_interval = builder_configs.heartbeat_interval
+        self.is_loaded = False
+        self.hierarchy_ids: set[int] = set()
+        # hierarchies being rebuilt, their messages are deferred
+        self.rebuilding_hierarchy_ids: set[int] = set()
+        self.rebuilding_checked_at = time.monotonic()
+        self.levels_by_tmo_id: dict[int, list[RoutedLevel]] = defaultdict(list)
+        self.levels_by_tprm_id: dict[int, list[RoutedLevel]] = defaultdict(list)
+        self.child_level_ids: dict[int, set[int]] = defaultdict(set)
+        # counts of routed and dropped messages
+        self.hits = 0
+        self.skips = 0
+
+    def invalidate(self):
+        self.is_loaded = False
+
+    async def load(self, session: AsyncSession):
+        """Loads levels of hierarchies and ids of hierarchies being rebuilt"""
+        levels = await session.execute(select(Level))
+        await self.load_rebuilding_hierarchy_ids(session)
+
+        self.hierarchy_ids = set()
+        self.levels_by_tmo_id = defaultdict(list)
+        self.levels_by_tprm_id = defaultdict(list)
+        self.child_level_ids = defaultdict(set)
+        for level in levels.scalars().all():
+            routed_level = RoutedLevel(
+                id=level.id,
+                hierarchy_id=level.hierarchy_id,
+                object_type_id=level.object_type_id,
+                tprm_ids=frozenset(get_all_level_tprm_ids(level)),
+                parent_id=level.parent_id,
+            )
+            if level.parent_id is not None:
+                self.child_level_ids[level.parent_id].add(level.id)
+            self.hierarchy_ids.add(level.hierarchy_id)
+            self.levels_by_tmo_id[level.object_type_id].append(routed_level)
+            for tprm_id in routed_level.tprm_ids:
+                self.levels_by_tprm_id[tprm_id].append(routed_level)
+        self.is_loaded = True
+
+    async def load_rebuilding_hierarchy_ids(self, session: AsyncSession):
+        """Loads ids of hierarchies being rebuilt. Status stays IN_PROCESS after
+        stopped build or build which was not started, so only hierarchies whose
+        builds send heartbeats are rebuilt"""
+        in_process_hierarchy_ids = await session.execute(
+            select(Hierarchy.id).where(
+                Hierarchy.status == HierarchyStatus.IN_PROCESS.value
+            )
+        )
+        in_process_hierarchy_ids = list(
+            in_process_hierarchy_ids.scalars().all()
+        )
+        stalled_hierarchy_ids = set()
+        if in_process_hierarchy_ids:
+            stalled_hierarchy_ids = await get_stalled_hierarchy_ids(
+                session=session,
+                hierarchy_ids=in_process_hierarchy_ids,
+                heartbeat_timeout=self.heartbeat_timeout,
+            )
+        self.rebuilding_hierarchy_ids = (
+            set(in_process_hierarchy_ids) - stalled_hierarchy_ids
+        )
+        self.rebuilding_checked_at = time.monotonic()
+
+    def rebuilding_hierarchy_ids_are_outdated(self) -> bool:
+        """Returns True if hierarchies being rebuilt have to be checked again,
+        as their builds may stop without change of levels or hierarchies"""
+        return (
+            bool(self.rebuilding_hierarchy_ids)
+            and time.monotonic() - self.rebuilding_checked_at
+            >= self.rebuilding_check_interval
+        )
+
+    def get_hierarchy_ids(self, class_name: str, msg: dict) -> set[int]:
+        """Returns ids of hierarchies affected by message"""
+        objects = msg.get("objects", [])
+        match class_name:
+            case InventoryClassNames.MO.value:
+                tmo_ids = {item.get("tmo_id") for item in objects}
+                return self._get_by_ids(self.levels_by_tmo_id, tmo_ids)
+            case InventoryClassNames.TMO.value:
+                tmo_ids = {item.get("id") for item in objects}
+                return self._get_by_ids(self.levels_by_tmo_id, tmo_ids)
+            case InventoryClassNames.PRM.value:
+                tprm_ids = {item.get("tprm_id") for item in objects}
+                return self._get_by_ids(self.levels_by_tprm_id, tprm_ids)
+            case InventoryClassNames.TPRM.value:
+                tprm_ids = {item.get("id") for item in objects}
+                return self._get_by_ids(self.levels_by_tprm_id, tprm_ids)
+        # messages of other classes are handled by all hierarchies
+        return set(self.hierarchy_ids)
+
+    def route(
+        self,
+        class_name: str,
+        msg: dict,
+        messages_count: int = 1,
+        hierarchy_id: int | None = None,
+    ) -> set[int]:
+        """Returns ids of hierarchies affected by message and counts it as hit or skip.
+        If hierarchy_id is set, only this hierarchy is considered"""
+        hierarchy_ids = self.get_hierarchy_ids(class_name=class_name, msg=msg)
+        if hierarchy_id is not None:
+            hierarchy_ids &= {hierarchy_id}
+        if hierarchy_ids:
+            self.hits += messages_count
+        else:
+            self.skips += messages_count
+        return hierarchy_ids
+
+    def get_level_keys(
+        self, class_name: str, msg: dict, hierarchy_id: int
+    ) -> set[int] | None:
+        """Returns ids of levels of hierarchy whose nodes may be changed by message:
+        levels of TMO or TPRM of message with their parent and child levels,
+        as nodes of these levels share parent nodes and their child_count.
+        Returns None if message changes types, which may affect all levels"""
+        objects = msg.get("objects", [])
+        match class_name:
+            case InventoryClassNames.MO.value:
+                levels_by_id = self.levels_by_tmo_id
+                ids = {item.get("tmo_id") for item in objects}
+            case InventoryClassNames.PRM.value:
+                levels_by_id = self.levels_by_tprm_id
+                ids = {item.get("tprm_id") for item in objects}
+            case _:
+                return None
+        res = set()
+        for item_id in ids:
+            for level in levels_by_id.get(item_id, ()):
+                if level.hierarchy_id != hierarchy_id:
+                    continue
+                res.add(level.id)
+                if level.parent_id is not None:
+                    res.add(level.parent_id)
+                res.update(self.child_level_ids.get(level.id, ()))
+        return res
+
+    @property
+    def stats(self) -> str:
+        return f"routed {self.hits}, skipped {self.skips}"
+
+    @staticmethod
+    def _get_by_ids(
+        levels_by_id: dict[int, list[RoutedLevel]], ids: set[int]
+    ) -> set[int]:
+        res = set()
+        for item_id in ids:
+            res.update(
+                level.hierarchy_id for level in levels_by_id.get(item_id, ())
+            )
+        return res
+
+
+@dataclasses.dataclass(slots=True)
+class DeferredGroup:
+    group: InventoryMessagesGroup
+    # tracker of offsets of messages of group, if consumer handles groups concurrently
+    offsets: Any = None
+
+
+class DeferredGroups:
+    """Groups of messages routed to hierarchies being rebuilt. Rebuild reads Inventory
+    while messages are received, so messages are handled after the rebuild in the order
+    they were received. Partitions are committed up to the first deferred message.
+    Count of groups is limited by max_groups, groups of hierarchy with the most groups
+    are dropped when limit is exceeded, such hierarchy is rebuilt again after its rebuild."""
+
+    def __init__(self, max_groups: int | None = None):
+        self.max_groups = max_groups
+        self.groups_by_hierarchy_id: dict[int, list[DeferredGroup]] = (
+            defaultdict(list)
+        )
+        # hierarchies whose groups were dropped, their next groups are dropped too
+        self.overflowed_hierarchy_ids: set[int] = set()
+
+    def __len__(self) -> int:
+        return sum(
+            len(groups) for groups in self.groups_by_hierarchy_id.values()
+        )
+
+    def add(
+        self, hierarchy_id: int, group: InventoryMessagesGroup, offsets=None
+    ) -> list[DeferredGroup]:
+        """Defers group of hierarchy. Returns dropped groups, if limit of groups
+        is exceeded or groups of hierarchy were dropped before"""
+        deferred_group = DeferredGroup(group=group, offsets=offsets)
+        if hierarchy_id in self.overflowed_hierarchy_ids:
+            return [deferred_group]
+        self.groups_by_hierarchy_id[hierarchy_id].append(deferred_group)
+        if self.max_groups is None or len(self) <= self.max_groups:
+            return []
+        largest_hierarchy_id = max(
+            self.groups_by_hierarchy_id,
+            key=lambda item: len(self.groups_by_hierarchy_id[item]),
+        )
+        self.overflowed_hierarchy_ids.add(largest_hierarchy_id)
+        return self.groups_by_hierarchy_id.pop(largest_hierarchy_id)
+
+    def pop_rebuilt(
+        self, router: HierarchiesRouter
+    ) -> dict[int, list[DeferredGroup]]:
+        """Returns and forgets groups of hierarchies which are not rebuilt anymore"""
+        res = dict()
+        for hierarchy_id in list(self.groups_by_hierarchy_id):
+            if hierarchy_id not in router.rebuilding_hierarchy_ids:
+                res[hierarchy_id] = self.groups_by_hierarchy_id.pop(
+                    hierarchy_id
+                )
+        return res
+
+    def pop_rebuilt_overflowed(self, router: HierarchiesRouter) -> set[int]:
+        """Returns and forgets ids of hierarchies whose groups were dropped
+        and which are not rebuilt anymore"""
+        res = self.overflowed_hierarchy_ids - router.rebuilding_hierarchy_ids
+        self.overflowed_hierarchy_ids -= res
+        return res
+
+    def forget_partitions(self, partitions: set[tuple[str, int]]):
+        """Forgets groups whose messages are only in revoked partitions, they are
+        read again from committed offsets by the next owner of partitions"""
+        for hierarchy_id in list(self.groups_by_hierarchy_id):
+            groups = [
+                deferred_group
+                for deferred_group in self.groups_by_hierarchy_id[hierarchy_id]
+                if any(
+                    (msg.topic(), msg.partition()) not in partitions
+                    for msg in deferred_group.group.sources
+                )
+            ]
+            if groups:
+                self.groups_by_hierarchy_id[hierarchy_id] = groups
+            else:
+                del self.groups_by_hierarchy_id[hierarchy_id]
+
+    def track_offsets(self, offsets):
+        """Adds messages of groups into new tracker of offsets"""
+        for groups in self.groups_by_hierarchy_id.values():
+            for deferred_group in groups:
+                deferred_group.offsets = offsets
+                for msg in deferred_group.group.sources:
+                    offsets.add(
+                        topic=msg.topic(),
+                        partition=msg.partition(),
+                        offset=msg.offset(),
+                        tasks_count=1,
+                    )
+
+    def get_lowest_offsets(self) -> dict[tuple[str, int], int]:
+        """Returns offsets of the first deferred messages by topic and partition"""
+        res = dict()
+        for groups in self.groups_by_hierarchy_id.values():
+            for deferred_group in groups:
+                for msg in deferred_group.group.sources:
+                    topic_partition = (msg.topic(), msg.partition())
+                    res[topic_partition] = min(
+                        res.get(topic_partition, msg.offset()), msg.offset()
+                    )
+        return res
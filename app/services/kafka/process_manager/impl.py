@@ -1,5 +1,6 @@
 import dataclasses
 from multiprocessing import Event, Process
+from multiprocessing.sharedctypes import Synchronized
 from typing import Callable
 
 from sqlalchemy import select
@@ -8,9 +9,13 @@ from sqlalchemy.orm import Session
 
 from database import database
 from schemas.hier_schemas import Hierarchy
+from services.hierarchy.metadata.cache import hierarchy_metadata_cache
 from services.kafka.consumer.handler import KafkaConnectionHandlerImpl
 from services.kafka.consumer.interface import KafkaConnectionHandlerI
+from services.link_keys.cache import LinkKeysInvalidations, link_keys_cache
 from services.meta_singleton.impl import SingletonMeta
+from services.metrics.consumer import listen_db_time
+from services.metrics.exposition import forget_metrics_of_process
 from services.session_utils.listeners.processes.inner_listener import (
     process_session_receive_after_commit,
     process_session_receive_after_flush,
@@ -25,12 +30,23 @@ from settings import KafkaConfigs
 class ProcessInfo:
     process: Process
     event: Event
-
-
-def target(hierarchy_id: int, event: Event):
+    # is set to reload index of levels used for routing of messages
+    routing_event: Event
+
+
+def target(
+    hierarchy_id: int | None,
+    event: Event,
+    routing_event: Event,
+    link_keys_invalidations: LinkKeysInvalidations | None = None,
+    hierarchy_metadata_version: Synchronized | None = None,
+):
+    if hierarchy_metadata_version is not None:
+        hierarchy_metadata_cache.use_shared_version(hierarchy_metadata_version)
     # add session listeners
     listen(Session, "after_flush", process_session_receive_after_flush)
     listen(Session, "after_commit", process_session_receive_after_commit)
+    listen_db_time()
 
     kafka_config = KafkaConfigs()
     msg_handler = UpdaterEventMediatorImpl()
@@ -39,35 +55,90 @@ def target(hierarchy_id: int, event: Event):
         msg_handler=msg_handler,
         hierarchy_id=hierarchy_id,
         event=event,
+        routing_event=routing_event,
+        link_keys_invalidations=link_keys_invalidations,
     )
     handler.connect_to_kafka_topic()
 
 
+def shared_target(
+    worker_id: int,
+    event: Event,
+    routing_event: Event,
+    link_keys_invalidations: LinkKeysInvalidations | None = None,
+    hierarchy_metadata_version: Synchronized | None = None,
+):
+    """Consumer process of shared mode, consumers of all workers are in one group,
+    so partitions of topics are distributed between them"""
+    print(f"Shared Kafka Consumer worker {worker_id} started")
+    target(
+        hierarchy_id=None,
+        event=event,
+        routing_event=routing_event,
+        link_keys_invalidations=link_keys_invalidations,
+        hierarchy_metadata_version=hierarchy_metadata_version,
+    )
+
+
 class KafkaConsumerProcessManager(metaclass=SingletonMeta):
     def __init__(
         self,
         target_callable: Callable = None,
         default_kafka_consumer_handler: KafkaConnectionHandlerI = None,
+        shared_mode: bool = False,
     ):
         self.__temporary_process_db: dict[int, ProcessInfo] = dict()
+        self.__shared_process_db: dict[int, ProcessInfo] = dict()
         self.default_kafka_consumer_handler = default_kafka_consumer_handler
         self.target_callable = target_callable
+        # in shared mode hierarchies have no own processes,
+        # messages are routed to them by shared workers
+        self.shared_mode = shared_mode
+
+    def start_shared_processes(self, workers: int):
+        for worker_id in range(len(self.__shared_process_db), workers):
+            e = Event()
+            routing_e = Event()
+            p = Process(
+                target=shared_target,
+                kwargs={
+                    "worker_id": worker_id,
+                    "event": e,
+                    "routing_event": routing_e,
+                    "link_keys_invalidations": link_keys_cache.get_invalidations(),
+                    "hierarchy_metadata_version": hierarchy_metadata_cache.get_shared_version(),
+                },
+                daemon=True,
+            )
+            self.__start_new_process(p)
+            self.__shared_process_db[worker_id] = ProcessInfo(
+                process=p, event=e, routing_event=routing_e
+            )
 
     def start_new_process_for_hierarchy_id(self, hierarchy_id: int):
+        if self.shared_mode:
+            return
         if self.get_process_info_by_hierarchy_id(hierarchy_id):
             print(
                 f"Kafka Consumer Process for hierarchy id {hierarchy_id} already exist"
             )
         else:
             e = Event()
+            routing_e = Event()
             p = Process(
                 target=self.target_callable,
-                kwargs={"hierarchy_id": hierarchy_id, "event": e},
+                kwargs={
+                    "hierarchy_id": hierarchy_id,
+                    "event": e,
+                    "routing_event": routing_e,
+                    "link_keys_invalidations": link_keys_cache.get_invalidations(),
+                    "hierarchy_metadata_version": hierarchy_metadata_cache.get_shared_version(),
+                },
                 daemon=True,
             )
             self.__start_new_process(p)
             self.__temporary_process_db[hierarchy_id] = ProcessInfo(
-                process=p, event=e
+                process=p, event=e, routing_event=routing_e
             )
 
     @staticmethod
@@ -80,6 +151,8 @@ class KafkaConsumerProcessManager(metaclass=SingletonMeta):
         return self.__temporary_process_db.get(hierarchy_id)
 
     def stop_process_for_hierarchy_id(self, hierarchy_id: int):
+        if self.shared_mode:
+            return
         process_info = self.get_process_info_by_hierarchy_id(
             hierarchy_id=hierarchy_id
         )
@@ -100,6 +173,7 @@ class KafkaConsumerProcessManager(metaclass=SingletonMeta):
             )
             self.__stop_process(process_info)
             process_inst.join()
+            forget_metrics_of_process(process_inst.pid)
             self.__temporary_process_db.pop(hierarchy_id, None)
             print(
                 f"{process_inst.name=}, {process_inst.is_alive()=},{process_inst.pid=}, {process_inst.ident=},"
@@ -111,16 +185,38 @@ class KafkaConsumerProcessManager(metaclass=SingletonMeta):
         print("event set", flush=True)
         process_info.event.set()
 
+    def invalidate_routing_of_all_processes(self):
+        """Consumers reload index of levels before the next messages"""
+        for p in [
+            *self.__temporary_process_db.values(),
+            *self.__shared_process_db.values(),
+        ]:
+            p.routing_event.set()
+
     def stop_all_processes(self):
-        for p in self.__temporary_process_db.values():
+        processes = [
+            *self.__temporary_process_db.values(),
+            *self.__shared_process_db.values(),
+        ]
+        for p in processes:
             self.__stop_process(p)
-        for p in self.__temporary_process_db.values():
+        for p in processes:
             p.process.join()
+            forget_metrics_of_process(p.process.pid)
         self.__temporary_process_db = dict()
+        self.__shared_process_db = dict()
 
 
 async def init_all_kafka_consumer_processes_with_admin_session():
-    pm = KafkaConsumerProcessManager(target_callable=target)
+    kafka_config = KafkaConfigs()
+    pm = KafkaConsumerProcessManager(
+        target_callable=target,
+        shared_mode=kafka_config.is_shared_consumer_mode,
+    )
+    if pm.shared_mode:
+        pm.start_shared_processes(workers=kafka_config.shared_consumer_workers)
+        return
+
     stmt = select(Hierarchy)
     async with database.async_session_factory() as session:
         all_h = (await session.execute(stmt)).scalars().all()
@@ -31,3 +31,9 @@ def process_manager_mediator_for_hierarchies(
                 p_m.start_new_process_for_hierarchy_id(
                     hierarchy_id=h_data["id"]
                 )
+
+
+def process_manager_mediator_for_levels():
+    """Consumers route messages by index of levels, so it is reloaded
+    after changes of levels and hierarchies"""
+    KafkaConsumerProcessManager().invalidate_routing_of_all_processes()
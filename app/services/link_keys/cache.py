@@ -0,0 +1,280 @@
+"""
+Cache of keys of nodes of levels with mo_link or prm_link parameter. Such nodes keep id
+of linked MO or PRM as key, responses show name of MO or value of PRM received from
+Inventory. Cache keeps them by ids for LINK_KEYS_CACHE_TTL seconds and drops the least
+recently used items when it is full.
+Consumer processes send ids of updated and deleted MOs and PRMs into bounded queue created
+by the app process before consumers are started, the app drops these ids from cache.
+If queue is full, consumers set overflow event instead and the app clears whole cache.
+"""
+
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+import multiprocessing
+from multiprocessing.queues import Queue
+from multiprocessing.synchronize import Event
+import queue
+import time
+from typing import Any, Callable, Hashable, Iterable
+
+import grpc
+
+from grpc_config.inventory_utils import (
+    get_mo_data_by_mo_ids,
+    get_mo_prm_data_by_prm_ids,
+)
+from schemas.enum_models import InventoryClassNames
+from services.metrics.link_keys import count_link_keys_cache_requests
+from settings import (
+    INV_HOST,
+    INVENTORY_GRPC_PORT,
+    LINK_KEYS_CACHE_MAX_SIZE,
+    LINK_KEYS_CACHE_TTL,
+)
+
+# events after which cached names of MOs and values of PRMs are not valid
+INVALIDATING_EVENTS = ("updated", "deleted")
+# count of not applied invalidations, consumers do not wait for free place in queue
+MAX_QUEUED_INVALIDATIONS = 10_000
+# seconds between applying of invalidations when cache is not requested
+INVALIDATIONS_INTERVAL = 1.0
+
+
+class TTLLRUCache:
+    """Dict with time to live of items and limit of size. When cache is full,
+    the least recently used item is dropped"""
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._items: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._items.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at <= self.clock():
+            del self._items[key]
+            return default
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._items[key] = (self.clock() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, keys: Iterable[Hashable]):
+        for key in keys:
+            self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+
+def get_invalidated_link_keys(
+    messages: Iterable[tuple[str, str, dict]],
+) -> tuple[list[int], list[int]]:
+    """Returns ids of MOs and PRMs updated or deleted by deserialized messages
+    (class_name, event, msg) of Inventory"""
+    mo_ids = list()
+    prm_ids = list()
+    ids_by_class_name = {
+        InventoryClassNames.MO.value: mo_ids,
+        InventoryClassNames.PRM.value: prm_ids,
+    }
+    for class_name, event, msg in messages:
+        ids = ids_by_class_name.get(class_name)
+        if ids is None or event not in INVALIDATING_EVENTS:
+            continue
+        ids.extend(
+            item["id"] for item in msg.get("objects", []) if "id" in item
+        )
+    return mo_ids, prm_ids
+
+
+@dataclass(frozen=True, slots=True)
+class LinkKeysInvalidations:
+    """Ids to invalidate sent by consumer processes to the app process"""
+
+    queue: Queue
+    # is set by consumers whose ids did not fit into full queue
+    overflowed: Event
+
+
+class LinkKeysCache:
+    """Names, ids and TMO ids of linked MOs and values of linked PRMs by their ids"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.mo_data = TTLLRUCache(max_size=max_size, ttl=ttl)
+        self.prm_values = TTLLRUCache(max_size=max_size, ttl=ttl)
+        self.__invalidations: LinkKeysInvalidations | None = None
+        # is increased by every invalidation, data received from Inventory
+        # while ids were invalidated is not cached
+        self.__invalidations_count = 0
+
+    def get_invalidations(self) -> LinkKeysInvalidations:
+        """Returns queue of ids to invalidate, it is created by the app process
+        and is passed to consumer processes"""
+        if self.__invalidations is None:
+            self.__invalidations = LinkKeysInvalidations(
+                queue=multiprocessing.Queue(maxsize=MAX_QUEUED_INVALIDATIONS),
+                overflowed=multiprocessing.Event(),
+            )
+        return self.__invalidations
+
+    def invalidate(self, mo_ids: Iterable[int], prm_ids: Iterable[int]):
+        self.mo_data.invalidate(mo_ids)
+        self.prm_values.invalidate(prm_ids)
+        self.__invalidations_count += 1
+
+    def apply_invalidations(self) -> int:
+        """Drops all ids received from consumer processes, returns count of
+        applied invalidations"""
+        if self.__invalidations is None:
+            return 0
+        # event is cleared before queue is read, so overflow which happens
+        # while queue is read is handled by the next call
+        overflowed = self.__invalidations.overflowed.is_set()
+        if overflowed:
+            self.__invalidations.overflowed.clear()
+        mo_ids = set()
+        prm_ids = set()
+        applied = 0
+        # queue keeps at most MAX_QUEUED_INVALIDATIONS items, so all items
+        # queued before the call are read
+        while applied < MAX_QUEUED_INVALIDATIONS:
+            try:
+                received_mo_ids, received_prm_ids = (
+                    self.__invalidations.queue.get_nowait()
+                )
+            except queue.Empty:
+                break
+            mo_ids.update(received_mo_ids)
+            prm_ids.update(received_prm_ids)
+            applied += 1
+
+        if overflowed:
+            # ids of not queued invalidations are unknown
+            self.clear()
+            self.__invalidations_count += 1
+        elif applied:
+            self.invalidate(mo_ids=mo_ids, prm_ids=prm_ids)
+        return applied
+
+    async def apply_invalidations_periodically(
+        self, interval: float = INVALIDATIONS_INTERVAL
+    ):
+        """Applies invalidations also when cache is not requested,
+        so queue does not grow"""
+        while True:
+            self.apply_invalidations()
+            await asyncio.sleep(interval)
+
+    def clear(self):
+        self.mo_data.clear()
+        self.prm_values.clear()
+
+    async def get_mo_data_and_prm_values(
+        self, mo_ids: Iterable[int], prm_ids: Iterable[int]
+    ) -> tuple[dict[int, dict], dict[int, str]]:
+        """Returns data of MOs {"name", "id", "tmo_id"} and values of PRMs by their ids.
+        Ids missing in cache are requested from Inventory by one channel.
+        Ids not found in Inventory are missing in results"""
+        self.apply_invalidations()
+        mo_data, missing_mo_ids = self.__get_cached(self.mo_data, mo_ids)
+        prm_values, missing_prm_ids = self.__get_cached(
+            self.prm_values, prm_ids
+        )
+        count_link_keys_cache_requests(
+            "mo", hits=len(mo_data), misses=len(missing_mo_ids)
+        )
+        count_link_keys_cache_requests(
+            "prm", hits=len(prm_values), misses=len(missing_prm_ids)
+        )
+        if not missing_mo_ids and not missing_prm_ids:
+            return mo_data, prm_values
+
+        invalidations_count = self.__invalidations_count
+        received_mo_data = dict()
+        received_prm_values = dict()
+        async with grpc.aio.insecure_channel(
+            f"{INV_HOST}:{INVENTORY_GRPC_PORT}"
+        ) as channel:
+            if missing_mo_ids:
+                async for msg in get_mo_data_by_mo_ids(
+                    channel, mo_ids=missing_mo_ids
+                ):
+                    for item in msg.list_of_mo:
+                        received_mo_data[item.id] = {
+                            "name": item.name,
+                            "id": item.id,
+                            "tmo_id": item.tmo_id,
+                        }
+            if missing_prm_ids:
+                async for msg in get_mo_prm_data_by_prm_ids(
+                    channel, prm_ids=missing_prm_ids
+                ):
+                    for item in msg.list_of_prm:
+                        received_prm_values[item.id] = item.value
+
+        self.apply_invalidations()
+        if invalidations_count == self.__invalidations_count:
+            for mo_id, data in received_mo_data.items():
+                self.mo_data.set(mo_id, data)
+            for prm_id, value in received_prm_values.items():
+                self.prm_values.set(prm_id, value)
+        mo_data.update(received_mo_data)
+        prm_values.update(received_prm_values)
+        return mo_data, prm_values
+
+    @staticmethod
+    def __get_cached(
+        cache: TTLLRUCache, ids: Iterable[int]
+    ) -> tuple[dict[int, Any], list[int]]:
+        """Returns cached values by ids and ids missing in cache"""
+        cached = dict()
+        missing = list()
+        for item_id in set(ids):
+            value = cache.get(item_id)
+            if value is None:
+                missing.append(item_id)
+            else:
+                cached[item_id] = value
+        return cached, missing
+
+
+link_keys_cache = LinkKeysCache(
+    max_size=LINK_KEYS_CACHE_MAX_SIZE, ttl=LINK_KEYS_CACHE_TTL
+)
+
+
+def publish_link_keys_invalidations(
+    invalidations: LinkKeysInvalidations | None,
+    messages: Iterable[tuple[str, str, dict]],
+):
+    """Sends ids of MOs and PRMs changed by messages to the app process,
+    every id is sent once"""
+    if invalidations is None:
+        return
+    mo_ids, prm_ids = get_invalidated_link_keys(messages)
+    if not mo_ids and not prm_ids:
+        return
+    try:
+        invalidations.queue.put_nowait(
+            (list(dict.fromkeys(mo_ids)), list(dict.fromkeys(prm_ids)))
+        )
+    except queue.Full:
+        invalidations.overflowed.set()
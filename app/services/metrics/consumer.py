@@ -0,0 +1,183 @@
+"""
+Metrics of Kafka consumer processes. prometheus_client writes values of every
+process into files of PROMETHEUS_MULTIPROC_DIR, the app aggregates them on request.
+Time of message handler is split into time of queries to db and time of gRPC
+requests to Inventory, which are accumulated while the handler is running.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import inspect
+import json
+import time
+
+# prometheus_client writes values into files only if PROMETHEUS_MULTIPROC_DIR
+# is set before its import, the variable is set by settings
+import settings  # noqa: F401
+
+# isort: split
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+HANDLER_TIME_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    float("inf"),
+)
+
+MESSAGES = Counter(
+    "hierarchy_consumer_messages",
+    "Messages of Inventory read by consumer, 'skipped' messages are not "
+    "deserialized or do not affect hierarchies",
+    ["consumer", "status"],
+)
+DEAD_LETTERS = Counter(
+    "hierarchy_consumer_dead_letters",
+    "Messages published to dead letters after all retries",
+    ["hierarchy_id"],
+)
+BATCH_SIZE = Histogram(
+    "hierarchy_consumer_batch_size",
+    "Count of messages in batch read by consumer",
+    ["consumer"],
+    buckets=(1, 5, 10, 50, 100, 250, 500, 1000, 5000, float("inf")),
+)
+LAG = Gauge(
+    "hierarchy_consumer_lag",
+    "Count of messages of partition not read by consumer yet",
+    ["consumer", "topic", "partition"],
+    multiprocess_mode="livemax",
+)
+HANDLER_SECONDS = Histogram(
+    "hierarchy_consumer_handler_seconds",
+    "Time of handling of message or group of messages for hierarchy",
+    ["class_name", "event"],
+    buckets=HANDLER_TIME_BUCKETS,
+)
+HANDLER_DB_SECONDS = Histogram(
+    "hierarchy_consumer_handler_db_seconds",
+    "Time of queries to db during handling of message for hierarchy",
+    ["class_name", "event"],
+    buckets=HANDLER_TIME_BUCKETS,
+)
+HANDLER_INVENTORY_GRPC_SECONDS = Histogram(
+    "hierarchy_consumer_handler_inventory_grpc_seconds",
+    "Time of gRPC requests to Inventory during handling of message for hierarchy",
+    ["class_name", "event"],
+    buckets=HANDLER_TIME_BUCKETS,
+)
+
+# seconds of db queries and Inventory requests of running handler
+_handler_timings: ContextVar[dict[str, float] | None] = ContextVar(
+    "handler_timings", default=None
+)
+
+
+def get_consumer_label(hierarchy_id: int | None) -> str:
+    return "shared" if hierarchy_id is None else str(hierarchy_id)
+
+
+def count_messages(consumer: str, status: str, count: int = 1):
+    if count:
+        MESSAGES.labels(consumer=consumer, status=status).inc(count)
+
+
+def observe_consumer_statistics(stats_json: str, consumer: str):
+    """Callback of statistics of confluent_kafka consumer, sets lag of assigned
+    partitions"""
+    stats = json.loads(stats_json)
+    for topic, topic_stats in stats.get("topics", {}).items():
+        for partition, partition_stats in topic_stats.get(
+            "partitions", {}
+        ).items():
+            # lag is -1 if partition is not assigned or its offsets are unknown
+            lag = partition_stats.get("consumer_lag", -1)
+            if partition == "-1" or lag < 0:
+                continue
+            LAG.labels(consumer=consumer, topic=topic, partition=partition).set(
+                lag
+            )
+
+
+def _add_handler_time(kind: str, seconds: float):
+    timings = _handler_timings.get()
+    if timings is not None:
+        timings[kind] += seconds
+
+
+@contextmanager
+def measure_handler_time(class_name: str, event: str):
+    """Observes time of handler and time of its db queries and Inventory requests"""
+    timings = {"db": 0.0, "inventory_grpc": 0.0}
+    token = _handler_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _handler_timings.reset(token)
+        labels = {"class_name": class_name, "event": event}
+        HANDLER_SECONDS.labels(**labels).observe(time.perf_counter() - start)
+        HANDLER_DB_SECONDS.labels(**labels).observe(timings["db"])
+        HANDLER_INVENTORY_GRPC_SECONDS.labels(**labels).observe(
+            timings["inventory_grpc"]
+        )
+
+
+def measure_inventory_grpc_time(func):
+    """Adds time of gRPC request to Inventory to time of running handler"""
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _add_handler_time("inventory_grpc", time.perf_counter() - start)
+
+        return wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _add_handler_time("inventory_grpc", time.perf_counter() - start)
+
+    return wrapper
+
+
+def _before_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+):
+    start = conn.info["query_start_time"].pop()
+    _add_handler_time("db", time.perf_counter() - start)
+
+
+def listen_db_time():
+    """Adds time of db queries to time of running handler"""
+    if not event.contains(
+        Engine, "before_cursor_execute", _before_cursor_execute
+    ):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
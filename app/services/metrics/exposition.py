@@ -0,0 +1,32 @@
+"""
+Exposition of metrics collected by processes of the app.
+"""
+
+import os
+
+# PROMETHEUS_MULTIPROC_DIR is set by settings before import of prometheus_client
+from settings import PROMETHEUS_MULTIPROC_DIR
+
+# isort: split
+from prometheus_client import CollectorRegistry, make_asgi_app, multiprocess
+
+
+def clear_metrics_of_previous_run():
+    """Removes files of metrics of processes of previous run of the app.
+    Directory of metrics is not shared with other instances of the app."""
+    for file_name in os.listdir(PROMETHEUS_MULTIPROC_DIR):
+        if file_name.endswith(".db"):
+            os.remove(os.path.join(PROMETHEUS_MULTIPROC_DIR, file_name))
+
+
+def forget_metrics_of_process(pid: int | None):
+    """Removes gauges of stopped process, its counters are kept"""
+    if pid is not None:
+        multiprocess.mark_process_dead(pid, PROMETHEUS_MULTIPROC_DIR)
+
+
+def create_metrics_app():
+    """Returns ASGI app serving metrics aggregated from all processes"""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=PROMETHEUS_MULTIPROC_DIR)
+    return make_asgi_app(registry=registry)
@@ -0,0 +1,25 @@
+"""
+Metrics of cache of names of linked MOs and values of linked PRMs used as keys of nodes.
+Hit rate of cache is hits / (hits + misses) of hierarchy_link_keys_cache_requests.
+"""
+
+# prometheus_client writes values into files only if PROMETHEUS_MULTIPROC_DIR
+# is set before its import, the variable is set by settings
+import settings  # noqa: F401
+
+# isort: split
+from prometheus_client import Counter
+
+LINK_KEYS_CACHE_REQUESTS = Counter(
+    "hierarchy_link_keys_cache_requests",
+    "Ids of linked MOs and PRMs requested from cache of keys of nodes, "
+    "'miss' ids are requested from Inventory",
+    ["kind", "result"],
+)
+
+
+def count_link_keys_cache_requests(kind: str, hits: int, misses: int):
+    if hits:
+        LINK_KEYS_CACHE_REQUESTS.labels(kind=kind, result="hit").inc(hits)
+    if misses:
+        LINK_KEYS_CACHE_REQUESTS.labels(kind=kind, result="miss").inc(misses)
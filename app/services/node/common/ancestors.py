@@ -0,0 +1,113 @@
+"""
+Resolution of ancestors of nodes. Path of node contains ids of all its ancestors
+from root to parent, so ancestors of any count of nodes are found by their ids
+in one query per chunk instead of one query per ancestor.
+"""
+
+from typing import Iterable
+import uuid
+
+from sqlalchemy import RowMapping, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from schemas.hier_schemas import Level, Obj
+from services.hierarchy.hierarchy_builder.utils import get_ancestor_ids_by_path
+from settings import POSTGRES_ITEMS_LIMIT_IN_QUERY
+
+
+async def _get_nodes_by_ids(
+    node_ids: Iterable[uuid.UUID], session: AsyncSession
+) -> dict[uuid.UUID, Obj]:
+    """Returns nodes by their ids"""
+    node_ids = list(set(node_ids))
+    nodes = dict()
+    for start in range(0, len(node_ids), POSTGRES_ITEMS_LIMIT_IN_QUERY):
+        stmt = select(Obj).where(
+            Obj.id.in_(node_ids[start : start + POSTGRES_ITEMS_LIMIT_IN_QUERY])
+        )
+        result = await session.execute(stmt)
+        nodes.update((node.id, node) for node in result.scalars().all())
+    return nodes
+
+
+async def get_ancestors_of_nodes(
+    nodes: Iterable[Obj], session: AsyncSession
+) -> dict[uuid.UUID, list[Obj]]:
+    """Returns ancestors of every node ordered from root to parent.
+    Common ancestors of nodes are loaded once"""
+    ancestor_ids_by_node_id = {
+        node.id: get_ancestor_ids_by_path(node.path) for node in nodes
+    }
+    ancestors = await _get_nodes_by_ids(
+        (
+            ancestor_id
+            for ancestor_ids in ancestor_ids_by_node_id.values()
+            for ancestor_id in ancestor_ids
+        ),
+        session,
+    )
+    return {
+        node_id: [
+            ancestors[ancestor_id]
+            for ancestor_id in ancestor_ids
+            if ancestor_id in ancestors
+        ]
+        for node_id, ancestor_ids in ancestor_ids_by_node_id.items()
+    }
+
+
+async def get_breadcrumbs_of_nodes(
+    nodes: Iterable[Obj], session: AsyncSession
+) -> dict[uuid.UUID, list[Obj]]:
+    """Returns breadcrumbs of every node: its ancestors from root and the node itself"""
+    nodes = list(nodes)
+    ancestors_by_node_id = await get_ancestors_of_nodes(nodes, session)
+    return {node.id: ancestors_by_node_id[node.id] + [node] for node in nodes}
+
+
+def cut_to_nearest_real_ancestor(ancestors: list) -> list:
+    """Returns ancestors from parent up to the nearest ancestor with object_id.
+    ancestors are ordered from root to parent, items are nodes or rows with node"""
+    result = list()
+    for ancestor in reversed(ancestors):
+        result.append(ancestor)
+        node = ancestor if isinstance(ancestor, Obj) else ancestor["node"]
+        if node.object_id is not None:
+            break
+    return result
+
+
+async def get_short_chain_of_ancestors(
+    node: Obj, session: AsyncSession
+) -> list[Obj]:
+    """Returns ancestors of node from parent up to the nearest real ancestor"""
+    ancestors_by_node_id = await get_ancestors_of_nodes([node], session)
+    return cut_to_nearest_real_ancestor(ancestors_by_node_id[node.id])
+
+
+async def get_short_chain_of_ancestors_with_levels(
+    node: Obj, session: AsyncSession
+) -> list[RowMapping]:
+    """Returns rows with node and level of ancestors of node from parent up to
+    the nearest real ancestor"""
+    ancestor_ids = get_ancestor_ids_by_path(node.path)
+    if not ancestor_ids:
+        return []
+
+    ancestor = aliased(Obj, name="node")
+    level = aliased(Level, name="level")
+    stmt = (
+        select(ancestor, level)
+        .join(level, ancestor.level_id == level.id)
+        .where(ancestor.id.in_(ancestor_ids))
+    )
+    rows = await session.execute(stmt)
+    rows_by_node_id = {row["node"].id: row for row in rows.mappings().all()}
+    return cut_to_nearest_real_ancestor(
+        [
+            rows_by_node_id[ancestor_id]
+            for ancestor_id in ancestor_ids
+            if ancestor_id in rows_by_node_id
+        ]
+    )
@@ -8,7 +8,7 @@ from services.hierarchy.hierarchy_builder.utils import (
     create_path_for_children_node_by_parent_node,
 )
 from services.node.common.update.child_count_updater import (
-    NodeChildCounterUpdater,
+    mark_nodes_to_update_child_count,
 )
 from settings import POSTGRES_ITEMS_LIMIT_IN_QUERY
 
@@ -73,12 +73,11 @@ class NodeDeleteHandler:
             await self.session.delete(node)
 
     async def __recalculate_node_child_count(self):
-        if self.__node_ids_to_update_child_count:
-            node_child_count_updater = NodeChildCounterUpdater(
-                session=self.session,
-                node_ids=list(self.__node_ids_to_update_child_count),
-            )
-            await node_child_count_updater.update_without_commit()
+        # child_count of parents is recalculated before commit once per transaction
+        mark_nodes_to_update_child_count(
+            session=self.session,
+            node_ids=self.__node_ids_to_update_child_count,
+        )
 
     async def delete_without_commit(self):
         self.__create_default_params()
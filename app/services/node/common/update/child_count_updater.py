@@ -1,13 +1,127 @@
-import math
-from typing import Generator, List
+"""
+Update of child_count of nodes.
+Handlers do not recalculate child_count of parents at once, they mark parents
+in the session instead. child_count of all marked nodes is recalculated by one aggregated
+statement per chunk right before commit of the session or by explicit call
+of update_child_count_of_marked_nodes, so the same parent is updated once per transaction.
+"""
 
-from sqlalchemy import func, select, true
+from typing import Iterable, List
+import uuid
+
+from sqlalchemy import event, func, select, true, update
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import Session, aliased
 
 from schemas.hier_schemas import Obj
+from services.session_utils.listeners.enum_models import SessionDataKeys
+from services.session_utils.listeners.utils import (
+    add_items_data_into_session_info,
+    session_events_are_listened,
+)
 from settings import POSTGRES_ITEMS_LIMIT_IN_QUERY
 
+NODES_TO_UPDATE_CHILD_COUNT_KEY = "nodes_to_update_child_count"
+
+
+def mark_nodes_to_update_child_count(
+    session: AsyncSession | Session, node_ids: Iterable[uuid.UUID | str]
+):
+    """Marks nodes whose children were changed. child_count of marked nodes
+    is recalculated before commit of session"""
+    if isinstance(session, AsyncSession):
+        session = session.sync_session
+
+    marked_node_ids = session.info.setdefault(
+        NODES_TO_UPDATE_CHILD_COUNT_KEY, set()
+    )
+    marked_node_ids.update(
+        uuid.UUID(str(node_id)) for node_id in node_ids if node_id is not None
+    )
+
+    if not event.contains(
+        session, "before_commit", _update_child_count_before_commit
+    ):
+        event.listen(
+            session, "before_commit", _update_child_count_before_commit
+        )
+        event.listen(
+            session, "after_rollback", _forget_marked_nodes_after_rollback
+        )
+
+
+def _update_child_count_of_marked_nodes(session: Session) -> list[Obj]:
+    """Recalculates child_count of marked nodes by count of their active children.
+    Only nodes with changed child_count are updated"""
+    marked_node_ids = session.info.pop(NODES_TO_UPDATE_CHILD_COUNT_KEY, None)
+    if not marked_node_ids:
+        return []
+
+    marked_node_ids = list(marked_node_ids)
+    children = aliased(Obj)
+    updated_nodes = list()
+
+    for start in range(0, len(marked_node_ids), POSTGRES_ITEMS_LIMIT_IN_QUERY):
+        step_node_ids = marked_node_ids[
+            start : start + POSTGRES_ITEMS_LIMIT_IN_QUERY
+        ]
+        new_counts = (
+            select(
+                Obj.id.label("node_id"),
+                func.count(children.id).label("new_count"),
+            )
+            .outerjoin(
+                children,
+                (children.parent_id == Obj.id) & (children.active == true()),
+            )
+            .where(Obj.id.in_(step_node_ids))
+            .group_by(Obj.id)
+            .subquery()
+        )
+        stmt = (
+            update(Obj)
+            .where(
+                Obj.id == new_counts.c.node_id,
+                Obj.child_count.is_distinct_from(new_counts.c.new_count),
+            )
+            .values(child_count=new_counts.c.new_count)
+            .returning(Obj)
+        )
+        nodes = session.execute(
+            stmt,
+            execution_options={
+                "synchronize_session": False,
+                "populate_existing": True,
+            },
+        )
+        updated_nodes.extend(nodes.scalars().all())
+
+    if updated_nodes and session_events_are_listened():
+        # statement is not seen by session listeners
+        add_items_data_into_session_info(
+            session=session,
+            key_for_session_data=SessionDataKeys.DIRTY,
+            class_name=Obj.__name__,
+            items_data=[node.to_proto() for node in updated_nodes],
+        )
+    return updated_nodes
+
+
+def _update_child_count_before_commit(session: Session):
+    _update_child_count_of_marked_nodes(session)
+
+
+def _forget_marked_nodes_after_rollback(session: Session):
+    session.info.pop(NODES_TO_UPDATE_CHILD_COUNT_KEY, None)
+
+
+async def update_child_count_of_marked_nodes(
+    session: AsyncSession,
+) -> list[Obj]:
+    """Recalculates child_count of marked nodes without commit.
+    Used when changed child_count must be read before commit"""
+    return await session.run_sync(_update_child_count_of_marked_nodes)
+
 
 class NodeChildCounterUpdater:
     """Updates child count for nodes of special level"""
@@ -21,51 +135,15 @@ class NodeChildCounterUpdater:
             execution_options={"isolation_level": "SERIALIZABLE"}
         )
 
-    def __get_generator_of_nodes_to_update_divided_on_parts(self) -> Generator:
-        """Divides nodes_to_delete on parts and returns as generator"""
-        size_per_step = POSTGRES_ITEMS_LIMIT_IN_QUERY
-        steps = math.ceil(len(self.node_ids) / POSTGRES_ITEMS_LIMIT_IN_QUERY)
-        return (
-            self.node_ids[
-                (start := step * size_per_step) : start + size_per_step
-            ]
-            for step in range(steps)
-        )
-
     async def update_without_commit(self):
         """Updates child count for obj of special level and marks them as updated in the session without commit
         Used to read events from the session and send all related data to kafka"""
         await self.__set_transaction_isolation_level()
 
-        for (
-            step_node_ids
-        ) in self.__get_generator_of_nodes_to_update_divided_on_parts():
-            subquery = (
-                select(Obj.parent_id, func.count(Obj.id).label("new_count"))
-                .where(Obj.parent_id.in_(step_node_ids), Obj.active == true())
-                .group_by(Obj.parent_id)
-                .subquery()
-            )
-            aliased_table = aliased(subquery)
-
-            stmt = (
-                select(Obj)
-                .where(Obj.id.in_(step_node_ids))
-                .outerjoin(aliased_table, Obj.id == aliased_table.c.parent_id)
-                .add_columns(aliased_table.c.new_count)
-            )
-
-            res = await self.session.execute(stmt)
-            res = res.all()
-
-            for item in res:
-                if item.new_count is None:
-                    item.Obj.child_count = 0
-                else:
-                    item.Obj.child_count = item.new_count
-                self.session.add(item.Obj)
-
-            await self.session.flush()
+        mark_nodes_to_update_child_count(
+            session=self.session, node_ids=self.node_ids
+        )
+        await update_child_count_of_marked_nodes(session=self.session)
 
     async def update_and_commit(self):
         """Updates child count for obj of special level and marks them as updated in the session with saving data in DB
@@ -0,0 +1,48 @@
+"""
+Utils for changes made by bulk statements, which are not seen by session listeners.
+Data of changed instances is added into session info as listeners do after flush,
+so messages about them are produced after commit.
+"""
+
+import sys
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from services.session_utils.listeners.enum_models import SessionDataKeys
+
+# modules and names of 'after_flush' listeners of the main process and of consumer processes
+AFTER_FLUSH_LISTENERS = (
+    ("kafka_producer.session_listener.listener", "receive_after_flush"),
+    (
+        "services.session_utils.listeners.processes.inner_listener",
+        "process_session_receive_after_flush",
+    ),
+)
+
+
+def session_events_are_listened() -> bool:
+    """Returns True if changes of instances are produced by session listeners
+    of the main process or of consumer processes"""
+    # listener modules import database and security modules, so they are not imported here:
+    # listener can be registered only after its module was imported by the caller of listen
+    for module_name, listener_name in AFTER_FLUSH_LISTENERS:
+        module = sys.modules.get(module_name)
+        if module is not None and event.contains(
+            Session, "after_flush", getattr(module, listener_name)
+        ):
+            return True
+    return False
+
+
+def add_items_data_into_session_info(
+    session: AsyncSession | Session,
+    key_for_session_data: SessionDataKeys,
+    class_name: str,
+    items_data: list[dict],
+):
+    """Adds items data into session info in the same way as session listeners do
+    for instances changed by the unit of work"""
+    session_data = session.info.setdefault(key_for_session_data.value, dict())
+    session_data.setdefault(class_name, list()).extend(items_data)
@@ -2,9 +2,19 @@ from collections import defaultdict
 import math
 from uuid import UUID
 
-from sqlalchemy import func, select
+from sqlalchemy import (
+    Boolean,
+    String,
+    cast,
+    column,
+    delete,
+    func,
+    select,
+    update,
+    values,
+)
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import aliased
+from sqlalchemy_utils import UUIDType
 
 from schemas.hier_schemas import Level, NodeData, Obj
 from services.hierarchy.hierarchy_builder.configs import (
@@ -14,9 +24,17 @@ from services.hierarchy.hierarchy_builder.dto_models import KeyData
 from services.hierarchy.hierarchy_builder.utils import (
     create_path_for_children_node_by_parent_node,
     get_node_key_data,
+    path_startswith,
+)
+from services.node.common.update.child_count_updater import (
+    mark_nodes_to_update_child_count,
+)
+from services.session_utils.listeners.enum_models import SessionDataKeys
+from services.session_utils.listeners.utils import (
+    add_items_data_into_session_info,
+    session_events_are_listened,
 )
 from settings import (
-    LIMIT_OF_POSTGRES_RESULTS_PER_STEP,
     POSTGRES_ITEMS_LIMIT_IN_QUERY,
 )
 
@@ -414,7 +432,9 @@ class SpecialHierarchyMOCreateHandler:
                     child_count=0,
                     level_id=level.id,
                     parent_id=parent_node_id,
-                    path=None,
+                    path=create_path_for_children_node_by_parent_node(
+                        parent_node
+                    ),
                     active=is_active,
                     key_is_empty=key_data.key_is_empty,
                 )
@@ -631,6 +651,115 @@ async def __group_by_new_parents(
     return node_id_new_p_node_id
 
 
+async def __execute_nodes_statement(
+    session: AsyncSession,
+    stmt,
+    key_for_session_data: SessionDataKeys,
+) -> list[Obj]:
+    """Executes UPDATE or DELETE of nodes returning changed nodes. Nodes of session are
+    synchronized with returned rows. Statements are not seen by session listeners,
+    so data of changed nodes is added into session info as listeners do"""
+    if key_for_session_data == SessionDataKeys.DELETED:
+        execution_options = {"synchronize_session": "fetch"}
+    else:
+        execution_options = {
+            "synchronize_session": False,
+            "populate_existing": True,
+        }
+    nodes = await session.execute(
+        stmt.returning(Obj), execution_options=execution_options
+    )
+    nodes = nodes.scalars().all()
+
+    if nodes and session_events_are_listened():
+        add_items_data_into_session_info(
+            session=session,
+            key_for_session_data=key_for_session_data,
+            class_name=Obj.__name__,
+            items_data=[node.to_proto() for node in nodes],
+        )
+    return nodes
+
+
+async def __replace_path_prefixes(
+    session: AsyncSession,
+    replace_path_cache: dict[str, str],
+):
+    """Replaces old path prefixes of descendant nodes with new ones.
+    Every node is changed once by the longest old prefix its path starts with"""
+    replace_path_items = list(replace_path_cache.items())
+    # every item of VALUES uses two parameters
+    step = POSTGRES_ITEMS_LIMIT_IN_QUERY // 2
+
+    for start in range(0, len(replace_path_items), step):
+        prefixes = values(
+            column("old_prefix", String),
+            column("new_prefix", String),
+            name="prefixes",
+        ).data(replace_path_items[start : start + step])
+        matched_prefixes = (
+            select(
+                Obj.id.label("node_id"),
+                prefixes.c.old_prefix,
+                prefixes.c.new_prefix,
+            )
+            .join(prefixes, path_startswith(prefixes.c.old_prefix))
+            .distinct(Obj.id)
+            .order_by(Obj.id, func.length(prefixes.c.old_prefix).desc())
+            .subquery()
+        )
+        stmt = (
+            update(Obj)
+            .where(Obj.id == matched_prefixes.c.node_id)
+            .values(
+                path=matched_prefixes.c.new_prefix
+                + func.substr(
+                    Obj.path, func.length(matched_prefixes.c.old_prefix) + 1
+                )
+            )
+        )
+        await __execute_nodes_statement(
+            session=session,
+            stmt=stmt,
+            key_for_session_data=SessionDataKeys.DIRTY,
+        )
+
+
+async def __get_nodes_by_key_parent_and_active(
+    session: AsyncSession,
+    level: Level,
+    keys_parents_and_active: set[tuple[str, UUID | None, bool]],
+) -> dict[tuple[str, UUID | None, bool], list[Obj]]:
+    """Returns nodes of level grouped by (key, parent_id, active) for all requested groups"""
+    res = defaultdict(list)
+    keys_parents_and_active = list(keys_parents_and_active)
+    # every item of VALUES uses three parameters
+    step = POSTGRES_ITEMS_LIMIT_IN_QUERY // 3
+
+    for start in range(0, len(keys_parents_and_active), step):
+        requested = values(
+            column("key", String),
+            column("parent_id", UUIDType()),
+            column("active", Boolean),
+            name="requested",
+        ).data(keys_parents_and_active[start : start + step])
+        stmt = select(Obj).join(
+            requested,
+            (Obj.level_id == level.id)
+            & (Obj.key == requested.c.key)
+            & (
+                Obj.parent_id.is_not_distinct_from(
+                    cast(requested.c.parent_id, UUIDType())
+                )
+            )
+            & (Obj.active == requested.c.active),
+        )
+        nodes = await session.execute(stmt)
+        for node in nodes.scalars().all():
+            res[(node.key, node.parent_id, node.active)].append(node)
+    return res
+
+
 async def __rebuild_real(
     session: AsyncSession,
     node_data_with_new_parents: list[NodeData],
@@ -725,19 +854,9 @@ async def __rebuild_real(
             session.add(child_node)
 
         await session.flush()
-        for old_path_prefix, new_path_prefix in replace_path_cache.items():
-            query = select(Obj).where(Obj.path.like(f"{old_path_prefix}%"))
-            result_generator = await session.stream_scalars(query)
-            async for partition in result_generator.yield_per(
-                LIMIT_OF_POSTGRES_RESULTS_PER_STEP
-            ).partitions(LIMIT_OF_POSTGRES_RESULTS_PER_STEP):
-                for child_node in partition:
-                    child_node.path = child_node.path.replace(
-                        old_path_prefix, new_path_prefix
-                    )
-                    session.add(child_node)
-
-            await session.flush()
+        await __replace_path_prefixes(
+            session=session, replace_path_cache=replace_path_cache
+        )
 
     await session.flush()
     return node_ids_to_recalc_child_count
@@ -845,19 +964,9 @@ async def __rebuild_hierarchical_data(
                 session.add(child_node)
 
             await session.flush()
-            for old_path_prefix, new_path_prefix in replace_path_cache.items():
-                query = select(Obj).where(Obj.path.like(f"{old_path_prefix}%"))
-                result_generator = await session.stream_scalars(query)
-                async for partition in result_generator.yield_per(
-                    LIMIT_OF_POSTGRES_RESULTS_PER_STEP
-                ).partitions(LIMIT_OF_POSTGRES_RESULTS_PER_STEP):
-                    for child_node in partition:
-                        child_node.path = child_node.path.replace(
-                            old_path_prefix, new_path_prefix
-                        )
-                        session.add(child_node)
-
-                await session.flush()
+            await __replace_path_prefixes(
+                session=session, replace_path_cache=replace_path_cache
+            )
 
     await session.flush()
     return node_ids_to_recalc_child_count
@@ -989,6 +1098,32 @@ async def __rebuild_virtual(
             replace_path_cache = dict()
             old_node_id_new_node_id_for_children = dict()
 
+            # check if exist nodes with same key and same parent on this level
+            # for all nodes by one query, nodes which are moved now are not used
+            # as existing ones, they are found by moved_nodes_by_key_parent_and_active
+            node_key_data_by_node_id = dict()
+            for node in nodes:
+                based_n_data = n_data_list_grouped_by_node_id.get(node.id)[0]
+                node_key_data_by_node_id[node.id] = get_node_key_data(
+                    ordered_key_attrs=list(based_n_data.unfolded_key),
+                    mo_data_with_params=based_n_data.unfolded_key,
+                )
+            existing_nodes = await __get_nodes_by_key_parent_and_active(
+                session=session,
+                level=level,
+                keys_parents_and_active={
+                    (
+                        node_key_data_by_node_id[node.id].key,
+                        node_id_new_p_node_id.get(node.id),
+                        n_data_list_grouped_by_node_id.get(node.id)[
+                            0
+                        ].mo_active,
+                    )
+                    for node in nodes
+                },
+            )
+            moved_nodes_by_key_parent_and_active = dict()
+
             # change node paren, path and path for children new parents
             for node in nodes:
                 based_n_data = n_data_list_grouped_by_node_id.get(node.id)[0]
@@ -999,23 +1134,33 @@ async def __rebuild_virtual(
                 if new_parent_node_id:
                     new_parent = parents.get(new_parent_node_id)
 
-                # check if exists node with same key and same parent on this level
-                node_key_data = get_node_key_data(
-                    ordered_key_attrs=list(based_n_data.unfolded_key),
-                    mo_data_with_params=based_n_data.unfolded_key,
-                )
+                node_key_data = node_key_data_by_node_id[node.id]
                 node_key = node_key_data.key
-                stmt = select(Obj).where(
-                    Obj.level_id == level.id,
-                    Obj.parent_id == new_parent_node_id,
-                    Obj.key == node_key,
-                    Obj.active == based_n_data.mo_active,
-                    Obj.id != node.id,
+                key_parent_and_active = (
+                    node_key,
+                    new_parent_node_id,
+                    based_n_data.mo_active,
                 )
-                default_node = await session.execute(stmt)
-                default_node = default_node.scalars().first()
+                default_node = moved_nodes_by_key_parent_and_active.get(
+                    key_parent_and_active
+                )
+                if default_node is None:
+                    default_node = next(
+                        (
+                            existing_node
+                            for existing_node in existing_nodes.get(
+                                key_parent_and_active, []
+                            )
+                            if existing_node.id
+                            not in virtual_node_ids_to_change_parents
+                        ),
+                        None,
+                    )
 
                 if not default_node:
+                    moved_nodes_by_key_parent_and_active[
+                        key_parent_and_active
+                    ] = node
                     node.parent_id = (
                         new_parent.id if new_parent is not None else None
                     )
@@ -1049,6 +1194,8 @@ async def __rebuild_virtual(
                     old_node_id_new_node_id_for_children[node.id] = (
                         default_node.id
                     )
+                    # children of node are moved to default node
+                    node_ids_to_recalc_child_count.add(default_node.id)
                     old_path = create_path_for_children_node_by_parent_node(
                         node
                     )
@@ -1062,61 +1209,63 @@ async def __rebuild_virtual(
                     for n_data in n_data_list_grouped_by_node_id.get(node.id):
                         n_data.node_id = default_node.id
 
+            # node_data must be moved before nodes are deleted
+            await session.flush()
+
             if old_node_id_new_node_id_for_children:
-                old_node_ids = list(old_node_id_new_node_id_for_children)
-                inner_steps = math.ceil(len(old_node_ids) / 30_000)
+                old_node_id_new_node_id_items = list(
+                    old_node_id_new_node_id_for_children.items()
+                )
+                # every item of VALUES uses two parameters
+                inner_step = POSTGRES_ITEMS_LIMIT_IN_QUERY // 2
 
                 # update node id for children
-                for inner_step in range(inner_steps):
-                    inner_start = inner_step * 30_000
-                    inner_end = inner_start + 30_000
-                    step_old_node_ids = old_node_ids[inner_start:inner_end]
-
-                    stmt = select(Obj).where(
-                        Obj.parent_id.in_(step_old_node_ids)
+                for inner_start in range(
+                    0, len(old_node_id_new_node_id_items), inner_step
+                ):
+                    new_parents = values(
+                        column("old_parent_id", UUIDType()),
+                        column("new_parent_id", UUIDType()),
+                        name="new_parents",
+                    ).data(
+                        old_node_id_new_node_id_items[
+                            inner_start : inner_start + inner_step
+                        ]
                     )
-                    objs_with_old_parents = await session.execute(stmt)
-                    objs_with_old_parents = (
-                        objs_with_old_parents.scalars().all()
+                    stmt = (
+                        update(Obj)
+                        .where(Obj.parent_id == new_parents.c.old_parent_id)
+                        .values(parent_id=new_parents.c.new_parent_id)
+                    )
+                    await __execute_nodes_statement(
+                        session=session,
+                        stmt=stmt,
+                        key_for_session_data=SessionDataKeys.DIRTY,
                     )
-
-                    for obj_with_old_parent in objs_with_old_parents:
-                        new_p = old_node_id_new_node_id_for_children.get(
-                            obj_with_old_parent.parent_id
-                        )
-                        obj_with_old_parent.parent_id = new_p
-                        session.add(obj_with_old_parent)
-                    await session.commit()
 
                 # delete node id for children
-                for inner_step in range(inner_steps):
-                    inner_start = inner_step * 30_000
-                    inner_end = inner_start + 30_000
-                    step_old_node_ids = old_node_ids[inner_start:inner_end]
-
-                    stmt = select(Obj).where(Obj.id.in_(step_old_node_ids))
-                    old_parents = await session.execute(stmt)
-                    old_parents = old_parents.scalars().all()
-                    for old_parent in old_parents:
-                        await session.delete(old_parent)
-
-                    await session.commit()
-
-            # update paths
-            for old_path_prefix, new_path_prefix in replace_path_cache.items():
-                query = select(Obj).where(Obj.path.like(f"{old_path_prefix}%"))
-                result_generator = await session.stream_scalars(query)
-                async for partition in result_generator.yield_per(
-                    LIMIT_OF_POSTGRES_RESULTS_PER_STEP
-                ).partitions(LIMIT_OF_POSTGRES_RESULTS_PER_STEP):
-                    for child_node in partition:
-                        child_node.path = child_node.path.replace(
-                            old_path_prefix, new_path_prefix
+                old_node_ids = list(old_node_id_new_node_id_for_children)
+                for inner_start in range(
+                    0, len(old_node_ids), POSTGRES_ITEMS_LIMIT_IN_QUERY
+                ):
+                    stmt = delete(Obj).where(
+                        Obj.id.in_(
+                            old_node_ids[
+                                inner_start : inner_start
+                                + POSTGRES_ITEMS_LIMIT_IN_QUERY
+                            ]
                         )
-                        session.add(child_node)
+                    )
+                    await __execute_nodes_statement(
+                        session=session,
+                        stmt=stmt,
+                        key_for_session_data=SessionDataKeys.DELETED,
+                    )
 
-                await session.flush()
-            await session.flush()
+            # update paths
+            await __replace_path_prefixes(
+                session=session, replace_path_cache=replace_path_cache
+            )
 
     # case 2 change parent for only for node_data of virtual nodes
 
@@ -1193,25 +1342,42 @@ async def __rebuild_virtual(
             n_data_grouped_by_key_node_p_id_and_active[
                 (key_data.key, key_data.key_is_empty, p_id, is_active)
             ].append(n_data)
-        # todo: optimize
+        # check if nodes with such keys exist for these parent nodes by one query
+        existing_nodes = await __get_nodes_by_key_parent_and_active(
+            session=session,
+            level=level,
+            keys_parents_and_active={
+                (key, new_parent_node_id, is_active)
+                for (
+                    key,
+                    _,
+                    new_parent_node_id,
+                    is_active,
+                ) in n_data_grouped_by_key_node_p_id_and_active
+            },
+        )
+        created_nodes_with_n_data = list()
         for (
             key_parent_id_active_tuple,
             list_of_n_data,
         ) in n_data_grouped_by_key_node_p_id_and_active.items():
-            # check if node with such key exists for this parent node
             key, key_is_empty, new_parent_node_id, is_active = (
                 key_parent_id_active_tuple
             )
-            stmt = select(Obj).where(
-                Obj.key == key,
-                Obj.parent_id == new_parent_node_id,
-                Obj.level_id == level.id,
-                Obj.active == is_active,
-            )
-            existing_v_node = await session.execute(stmt)
-            existing_v_node = existing_v_node.scalars().first()
-
-            if existing_v_node:
+            same_nodes = existing_nodes[(key, new_parent_node_id, is_active)]
+
+            if same_nodes:
+                # node data stays on its node if it is one of the same nodes,
+                # so result does not depend on order of rows
+                current_node_ids = {n_data.node_id for n_data in list_of_n_data}
+                existing_v_node = next(
+                    (
+                        node
+                        for node in same_nodes
+                        if node.id in current_node_ids
+                    ),
+                    same_nodes[0],
+                )
                 for n_data in list_of_n_data:
                     n_data.node_id = existing_v_node.id
                     session.add(n_data)
@@ -1244,14 +1410,19 @@ async def __rebuild_virtual(
                 )
 
                 session.add(new_node)
-                await session.flush()
+                # next groups with the same key differ only by key_is_empty
+                same_nodes.append(new_node)
+                created_nodes_with_n_data.append((new_node, list_of_n_data))
 
-                for node_data in list_of_n_data:
-                    node_data.node_id = new_node.id
-                    session.add(node_data)
-                    get_children_for_mo_ids.add(node_data.mo_id)
+        # new nodes are inserted by one flush before node_data refer to them
+        await session.flush()
+        for new_node, list_of_n_data in created_nodes_with_n_data:
+            for node_data in list_of_n_data:
+                node_data.node_id = new_node.id
+                session.add(node_data)
+                get_children_for_mo_ids.add(node_data.mo_id)
 
-            await session.flush()
+        await session.flush()
 
     # change parent for node data
     # if was created some nodes or node_data after active was changed, changes node_id,
@@ -1307,48 +1478,6 @@ async def __rebuild_virtual(
     )
 
 
-async def __recalc_child_count(
-    node_ids_to_recalc_child_count: set,
-    session: AsyncSession,
-):
-    steps = math.ceil(
-        len(node_ids_to_recalc_child_count) / POSTGRES_ITEMS_LIMIT_IN_QUERY
-    )
-    list_of_node_id = list(node_ids_to_recalc_child_count)
-
-    for step in range(steps):
-        start = POSTGRES_ITEMS_LIMIT_IN_QUERY * step
-        end = start + POSTGRES_ITEMS_LIMIT_IN_QUERY
-
-        step_list = list_of_node_id[start:end]
-
-        subquery = (
-            select(Obj.parent_id, func.count(Obj.id).label("new_count"))
-            .where(Obj.parent_id.in_(step_list), Obj.active == True)  # noqa: E712
-            .group_by(Obj.parent_id)
-            .subquery()
-        )
-        aliased_table = aliased(subquery)
-
-        stmt = (
-            select(Obj)
-            .where(Obj.id.in_(step_list))
-            .outerjoin(aliased_table, Obj.id == aliased_table.c.parent_id)
-            .add_columns(aliased_table.c.new_count)
-        )
-
-        res = await session.execute(stmt)
-        res = res.all()
-        for item in res:
-            if item.new_count is None:
-                item.Obj.child_count = 0
-            else:
-                item.Obj.child_count = item.new_count
-            session.add(item.Obj)
-
-        await session.flush()
-
-
 async def __rebuilding_nodes_based_on_their_data_and_level(
     node_data_with_new_parents: list[NodeData],
     session: AsyncSession,
@@ -1383,6 +1512,9 @@ async def __rebuilding_nodes_based_on_their_data_and_level(
                 node_data_with_new_parents=node_data_with_new_parents,
                 level=level,
             )
+            mark_nodes_to_update_child_count(
+                session=session, node_ids=node_ids_to_recalc_child_count
+            )
         # For correct work with test test_with_mo_update_changed_active_case_3
         if level.is_virtual:
             (
@@ -1396,11 +1528,10 @@ async def __rebuilding_nodes_based_on_their_data_and_level(
                 parent_level=parent_level,
             )
 
-    if node_ids_to_recalc_child_count:
-        await __recalc_child_count(
-            node_ids_to_recalc_child_count=node_ids_to_recalc_child_count,
-            session=session,
-        )
+    # child_count is recalculated once for all levels of rebuilding
+    mark_nodes_to_update_child_count(
+        session=session, node_ids=node_ids_to_recalc_child_count
+    )
     return return_node_data_for_one_more_iteration
 
 
@@ -1,6 +1,9 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from schemas.enum_models import InventoryClassNames
+from services.node.common.update.child_count_updater import (
+    update_child_count_of_marked_nodes,
+)
 from services.obj_events.status import ObjEventStatus
 from services.updater.event_handlers.common.handler_interface import (
     HierarchyChangeInterface,
@@ -80,3 +83,5 @@ class UpdaterEventMediatorImpl(UpdaterEventMediator):
         if not handler:
             return
         await handler.make_changes()
+        # handlers which do not commit leave marked parents in the session
+        await update_child_count_of_marked_nodes(session=session)
@@ -6,12 +6,15 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from schemas.hier_schemas import Level, NodeData, Obj
 from services.hierarchy.hierarchy_builder.utils import (
     create_path_for_children_node_by_parent_node,
+    path_startswith,
+)
+from services.node.common.update.child_count_updater import (
+    mark_nodes_to_update_child_count,
 )
 from services.updater.event_handlers.common.handler_interface import (
     HierarchyChangeInterface,
 )
 from services.updater.event_handlers.common.msg_utils import (
-    __recalc_child_count,
     rebuilding_nodes_based_on_their_data,
 )
 from settings import LIMIT_OF_POSTGRES_RESULTS_PER_STEP
@@ -119,22 +122,22 @@ async def with_tprm_delete_event_in_parent_attr(
             # replace child path
             path = create_path_for_children_node_by_parent_node(parent_node=obj)
             stmt = select(Obj).where(
-                Obj.hierarchy_id == hierarchy_id, Obj.path.like(f"{path}%")
+                Obj.hierarchy_id == hierarchy_id, path_startswith(path)
             )
             result_generator = await session.stream_scalars(stmt)
             async for partition in result_generator.yield_per(
                 LIMIT_OF_POSTGRES_RESULTS_PER_STEP
             ).partitions(LIMIT_OF_POSTGRES_RESULTS_PER_STEP):
                 for child_node in partition:
-                    child_node.path = child_node.path.replace(path, obj.path)
+                    child_node.path = (
+                        child_node.path.replace(path, obj.path or "", 1) or None
+                    )
             await session.delete(obj)
 
-    # recalculate child_count
-    if p_ids_for_recalc_child_count:
-        await __recalc_child_count(
-            node_ids_to_recalc_child_count=p_ids_for_recalc_child_count,
-            session=session,
-        )
+    # child_count is recalculated once for all marked nodes
+    mark_nodes_to_update_child_count(
+        session=session, node_ids=p_ids_for_recalc_child_count
+    )
 
     # change child level parents
     stmt = select(Level).where(Level.parent_id.in_(level_ids))
@@ -1,5 +1,6 @@
 import functools
 import os
+import tempfile
 import time
 from typing import Literal
 
@@ -94,6 +95,24 @@ DOCS_SWAGGER_CSS_URL = os.environ.get("DOCS_SWAGGER_CSS_URL", None)
 DOCS_REDOC_JS_URL = os.environ.get("DOCS_REDOC_JS_URL", None)
 SERVER_GRPC_PORT = os.environ.get("SERVER_GRPC_PORT", "50051")
 
+# metrics of consumer processes are written into files of this directory and
+# aggregated by the app, files of the directory are removed on start of the app,
+# so by default every instance of the app has its own directory. Consumer
+# processes inherit directory of the app. It is set before prometheus_client
+# is imported by metrics modules
+if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(
+        tempfile.gettempdir(), f"hierarchy_metrics_{os.getpid()}"
+    )
+PROMETHEUS_MULTIPROC_DIR = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+# cache of names of linked MOs and values of linked PRMs used as keys of nodes
+LINK_KEYS_CACHE_MAX_SIZE = int(
+    os.environ.get("LINK_KEYS_CACHE_MAX_SIZE", "100000")
+)
+LINK_KEYS_CACHE_TTL = float(os.environ.get("LINK_KEYS_CACHE_TTL", "300"))
+
 # INVENTORY CHANGES TOPIC CONFIGS
 
 
@@ -142,6 +161,72 @@ class KafkaConfigs(BaseSettings):
         "inventory.changes", alias="kafka_subscribe_topics"
     )
     secured: bool = Field(False, alias="kafka_secured")
+    # max count of messages handled as one batch, 1 handles every message separately
+    consumer_batch_max_size: int = Field(
+        500, ge=1, alias="kafka_consumer_batch_max_size"
+    )
+    # max seconds of waiting for messages of batch
+    consumer_batch_max_latency: float = Field(
+        1.0, gt=0, alias="kafka_consumer_batch_max_latency"
+    )
+    # max count of groups of messages handled in parallel, messages of the same MO
+    # are handled in order, 1 handles groups of batch one by one in one session
+    consumer_max_concurrency: int = Field(
+        1, ge=1, alias="kafka_consumer_max_concurrency"
+    )
+    # 'per_hierarchy' runs consumer process for every hierarchy,
+    # 'shared' runs pool of consumer processes handling messages for all hierarchies
+    consumer_mode: Literal["per_hierarchy", "shared"] = Field(
+        "per_hierarchy", alias="kafka_consumer_mode"
+    )
+    shared_consumer_workers: int = Field(
+        2, ge=1, alias="kafka_shared_consumer_workers"
+    )
+    # count of retries of failed handling of message, pause before retry is doubled
+    # from consumer_retry_backoff up to consumer_retry_max_backoff seconds
+    consumer_max_retries: int = Field(
+        3, ge=0, alias="kafka_consumer_max_retries"
+    )
+    consumer_retry_backoff: float = Field(
+        1.0, ge=0, alias="kafka_consumer_retry_backoff"
+    )
+    consumer_retry_max_backoff: float = Field(
+        30.0, ge=0, alias="kafka_consumer_retry_max_backoff"
+    )
+    # messages failed after all retries are published to 'kafka' topic or 'file'
+    # and consumer continues, 'disabled' stops consumer until message is handled
+    dead_letters_sink: Literal["kafka", "file", "disabled"] = Field(
+        "kafka", alias="kafka_dead_letters_sink"
+    )
+    dead_letters_topic: str = Field(
+        "hierarchy.inventory.changes.dlq",
+        alias="kafka_dead_letters_topic",
+        min_length=1,
+    )
+    dead_letters_file_path: str = Field(
+        "dead_letters.jsonl", alias="kafka_dead_letters_file_path"
+    )
+    # interval of statistics of consumer used for metrics of lag, 0 turns them off
+    consumer_statistics_interval_ms: int = Field(
+        15_000, ge=0, alias="kafka_consumer_statistics_interval_ms"
+    )
+    # consumer of hierarchy with lag over consumer_catch_up_min_lag rebuilds hierarchy
+    # if rebuild is estimated faster than replay of pending messages, 0 turns it off.
+    # Lag is checked not more often than every consumer_catch_up_check_interval seconds
+    consumer_catch_up_min_lag: int = Field(
+        100_000, ge=0, alias="kafka_consumer_catch_up_min_lag"
+    )
+    consumer_catch_up_check_interval: float = Field(
+        60.0, ge=0, alias="kafka_consumer_catch_up_check_interval"
+    )
+    consumer_catch_up_rebuild_seconds_per_node: float = Field(
+        0.001, ge=0, alias="kafka_consumer_catch_up_rebuild_seconds_per_node"
+    )
+    # limit of messages groups of hierarchies being rebuilt deferred by consumer,
+    # hierarchy with the most groups is rebuilt again instead of handling of its groups
+    consumer_max_deferred_groups: int = Field(
+        100_000, ge=1, alias="kafka_consumer_max_deferred_groups"
+    )
 
     @property
     def topics(self):
@@ -204,8 +289,41 @@ class KafkaConfigs(BaseSettings):
             )
         return res
 
+    @property
+    def is_shared_consumer_mode(self) -> bool:
+        return self.consumer_mode == "shared"
+
+    def get_connection_settings_for_shared_consumer(self) -> dict:
+        """Returns settings of consumers of shared mode, all of them are in one group"""
+        return self.get_connection_settings_for_special_hierarchy(
+            hierarchy_id="shared"
+        )
+
+    def get_connection_settings_for_dead_letters_producer(self) -> dict:
+        res = {"bootstrap.servers": self.bootstrap_servers}
+        if self.secured:
+            res.update(
+                {
+                    "security.protocol": "sasl_plaintext",
+                    "sasl.mechanisms": "OAUTHBEARER",
+                    "oauth_cb": functools.partial(
+                        self._get_token_for_kafka_producer,
+                        keycloak_config=KafkaKeycloakConfigs(),
+                    ),
+                }
+            )
+        return res
+
+    def get_connection_settings_for_dead_letters_consumer(self) -> dict:
+        """Returns settings of consumer replaying dead letters from the beginning of topic"""
+        res = self.get_connection_settings_for_special_hierarchy(
+            hierarchy_id="dead_letters"
+        )
+        res["auto.offset.reset"] = "earliest"
+        return res
+
     def get_connection_settings_for_special_hierarchy(
-        self, hierarchy_id: int
+        self, hierarchy_id: int | str
     ) -> dict:
         res = {
             "bootstrap.servers": self.bootstrap_servers,
@@ -226,3 +344,75 @@ class KafkaConfigs(BaseSettings):
             )
 
         return res
+
+
+class HierarchyBuilderConfigs(BaseSettings):
+    # 'orm', 'copy', 'shadow_copy' or 'diff'
+    nodes_write_mode: Literal["orm", "copy", "shadow_copy", "diff"] = Field(
+        "orm", alias="hierarchy_builder_nodes_write_mode"
+    )
+    # write modes of special hierarchies as 'hierarchy_id:mode,...'
+    hierarchies_nodes_write_modes_as_str: str = Field(
+        "", alias="hierarchy_builder_hierarchies_nodes_write_modes"
+    )
+    # count of created nodes after which nodes are written into db
+    nodes_flush_limit: int = Field(
+        25_000, ge=1, alias="hierarchy_builder_nodes_flush_limit"
+    )
+    # count of Inventory chunks read ahead for every level, 0 turns off prefetching
+    pipeline_queue_depth: int = Field(
+        4, ge=0, alias="hierarchy_builder_pipeline_queue_depth"
+    )
+    # hierarchical virtual levels with this count of MO are grouped
+    # by parents in worker processes
+    process_pool_min_items: int = Field(
+        100_000, ge=0, alias="hierarchy_builder_process_pool_min_items"
+    )
+    process_pool_max_workers: int | None = Field(
+        None, ge=1, alias="hierarchy_builder_process_pool_max_workers"
+    )
+    # memory of nodes caches in bytes, after which caches of levels
+    # are moved into sqlite files
+    cache_memory_budget: int = Field(
+        512 * 1024 * 1024, ge=0, alias="hierarchy_builder_cache_memory_budget"
+    )
+    # directory of sqlite files of caches, temp directory by default
+    cache_spill_dir: str | None = Field(
+        None, alias="hierarchy_builder_cache_spill_dir"
+    )
+    # hierarchies rebuilt concurrently by HierarchyRebuildScheduler,
+    # every build uses one db connection and one or two Inventory streams
+    rebuild_max_concurrent_builds: int = Field(
+        4, ge=1, alias="hierarchy_builder_rebuild_max_concurrent_builds"
+    )
+    rebuild_db_connections_budget: int = Field(
+        4, ge=1, alias="hierarchy_builder_rebuild_db_connections_budget"
+    )
+    rebuild_inventory_streams_budget: int = Field(
+        8, ge=1, alias="hierarchy_builder_rebuild_inventory_streams_budget"
+    )
+    # seconds between heartbeats of build, build without heartbeat
+    # for heartbeat_timeout seconds is considered as stopped
+    heartbeat_interval: float = Field(
+        30, gt=0, alias="hierarchy_builder_heartbeat_interval"
+    )
+    heartbeat_timeout: float = Field(
+        300, gt=0, alias="hierarchy_builder_heartbeat_timeout"
+    )
+
+    @property
+    def hierarchies_nodes_write_modes(self) -> dict[int, str]:
+        res = dict()
+        for hierarchy_mode in self.hierarchies_nodes_write_modes_as_str.split(
+            ","
+        ):
+            if not hierarchy_mode.strip():
+                continue
+            hierarchy_id, mode = hierarchy_mode.split(":")
+            res[int(hierarchy_id)] = mode.strip()
+        return res
+
+    def get_nodes_write_mode(self, hierarchy_id: int) -> str:
+        return self.hierarchies_nodes_write_modes.get(
+            hierarchy_id, self.nodes_write_mode
+        )
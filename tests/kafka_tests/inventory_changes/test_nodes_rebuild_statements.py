@@ -0,0 +1,301 @@
+"""TESTS for rebuilding of nodes whose node data got new parents"""
+
+import uuid as uuid_pkg
+
+from kafka_tests.inventory_changes.utils_for_mo_events import (
+    add_hierarchy_to_session,
+    add_level_to_session,
+    add_node_to_session,
+)
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas.hier_schemas import Level, NodeData, Obj
+from services.session_utils.listeners.enum_models import SessionDataKeys
+from services.updater.event_handlers.common import msg_utils
+
+PARENT_TMO_ID = 10
+VIRTUAL_TMO_ID = 1
+
+
+def _parent_mo(mo_id: int) -> dict:
+    return {"id": mo_id, "name": f"MO {mo_id}", "tmo_id": PARENT_TMO_ID}
+
+
+def _virtual_mo(mo_id: int, p_id: int, key: str) -> dict:
+    return {
+        "id": mo_id,
+        "name": f"MO {mo_id}",
+        "tmo_id": VIRTUAL_TMO_ID,
+        "p_id": p_id,
+        "1": key,
+    }
+
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def levels(session: AsyncSession) -> tuple[Level, Level]:
+    """Real parent level and its virtual child level"""
+    hierarchy = await add_hierarchy_to_session(session, "Rebuild hierarchy")
+    parent_level = await add_level_to_session(
+        session=session,
+        is_virtual=False,
+        hierarchy_id=hierarchy.id,
+        level_name="Parent level",
+        obj_type_id=PARENT_TMO_ID,
+        level=1,
+        level_key_attrs=["name"],
+    )
+    virtual_level = await add_level_to_session(
+        session=session,
+        is_virtual=True,
+        hierarchy_id=hierarchy.id,
+        level_name="Virtual level",
+        obj_type_id=VIRTUAL_TMO_ID,
+        level=2,
+        parent_id=parent_level.id,
+        level_key_attrs=["1"],
+    )
+    return parent_level, virtual_level
+
+
+async def _get_node_data(
+    session: AsyncSession, level_id: int, mo_id: int
+) -> NodeData:
+    stmt = select(NodeData).where(
+        NodeData.level_id == level_id, NodeData.mo_id == mo_id
+    )
+    return (await session.execute(stmt)).scalar_one()
+
+
+@pytest.mark.parametrize("first_node", ["current", "duplicate"])
+@pytest.mark.asyncio(loop_scope="session")
+async def test_node_data_stays_on_its_node_regardless_of_row_order(
+    session: AsyncSession, levels: tuple[Level, Level], first_node, mocker
+):
+    """TEST Node data of virtual node is not moved to the duplicate node with the
+    same key, parent and active, whichever of them is selected first"""
+    parent_level, virtual_level = levels
+    parent_node = await add_node_to_session(
+        session, parent_level, [_parent_mo(100)]
+    )
+    current_node = await add_node_to_session(
+        session,
+        virtual_level,
+        [_virtual_mo(1, 100, "A"), _virtual_mo(3, 100, "A")],
+        parent_node=parent_node,
+    )
+    duplicate_node = await add_node_to_session(
+        session,
+        virtual_level,
+        [_virtual_mo(2, 100, "A")],
+        parent_node=parent_node,
+    )
+    current_node_id = current_node.id
+    first_node_id = (
+        current_node_id if first_node == "current" else duplicate_node.id
+    )
+
+    get_nodes = getattr(msg_utils, "__get_nodes_by_key_parent_and_active")
+
+    async def get_nodes_in_order(*args, **kwargs):
+        res = await get_nodes(*args, **kwargs)
+        for nodes in res.values():
+            nodes.sort(key=lambda node: node.id != first_node_id)
+        return res
+
+    mocker.patch.object(
+        msg_utils,
+        "__get_nodes_by_key_parent_and_active",
+        side_effect=get_nodes_in_order,
+    )
+
+    # only one of node data of node is changed, so node data is rebuilt alone
+    virtual_level_id = virtual_level.id
+    node_data = await _get_node_data(session, virtual_level_id, 1)
+    await getattr(msg_utils, "__rebuild_virtual")(
+        session=session,
+        node_data_with_new_parents=[node_data],
+        node_id_new_p_node_id={current_node.id: parent_node.id},
+        level=virtual_level,
+        parent_level=parent_level,
+    )
+
+    session.expire_all()
+    node_data = await _get_node_data(session, virtual_level_id, 1)
+    assert node_data.node_id == current_node_id
+
+
+def _get_session_node_ids(
+    session: AsyncSession, key: SessionDataKeys
+) -> set[str]:
+    items = session.info.get(key.value, dict()).get(Obj.__name__, [])
+    return {item["id"] for item in items}
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_nested_paths_are_replaced_by_longest_prefix(
+    session: AsyncSession, levels: tuple[Level, Level], mocker
+):
+    """TEST Path of every descendant is replaced once by the longest old prefix
+    it starts with, paths without old prefixes are not changed"""
+    mocker.patch(
+        "services.updater.event_handlers.common.msg_utils.session_events_are_listened",
+        return_value=True,
+    )
+    parent_level, _ = levels
+    root = f"{uuid_pkg.uuid4()}/"
+    old_paths = {
+        "moved": f"{root}a/",
+        "nested_moved": f"{root}a/b/",
+        "descendant_of_nested": f"{root}a/b/c/",
+        "descendant": f"{root}a/d/",
+        "not_moved": f"{root}e/a/",
+    }
+    nodes = {
+        name: Obj(
+            key=name,
+            object_type_id=parent_level.object_type_id,
+            hierarchy_id=parent_level.hierarchy_id,
+            level=parent_level.level,
+            level_id=parent_level.id,
+            path=path,
+        )
+        for name, path in old_paths.items()
+    }
+    session.add_all(nodes.values())
+    await session.flush()
+    node_ids = {name: node.id for name, node in nodes.items()}
+
+    await getattr(msg_utils, "__replace_path_prefixes")(
+        session=session,
+        replace_path_cache={f"{root}a/": f"{root}x/", f"{root}a/b/": "y/"},
+    )
+
+    stmt = select(Obj.key, Obj.path).where(Obj.id.in_(node_ids.values()))
+    paths = dict((await session.execute(stmt)).all())
+    assert paths == {
+        "moved": f"{root}x/",
+        "nested_moved": "y/",
+        "descendant_of_nested": "y/c/",
+        "descendant": f"{root}x/d/",
+        "not_moved": f"{root}e/a/",
+    }
+    assert _get_session_node_ids(session, SessionDataKeys.DIRTY) == {
+        str(node_ids[name]) for name in paths if name != "not_moved"
+    }
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_nodes_are_found_by_null_parent(
+    session: AsyncSession, levels: tuple[Level, Level]
+):
+    """TEST Top nodes are found by None parent, which is matched as NULL,
+    nodes with other parent or active are not found"""
+    parent_level, virtual_level = levels
+    top_node = await add_node_to_session(
+        session, parent_level, [_parent_mo(100)]
+    )
+    await add_node_to_session(
+        session, parent_level, [_parent_mo(200)], active=False
+    )
+    await add_node_to_session(
+        session,
+        virtual_level,
+        [_virtual_mo(1, 100, "MO 100")],
+        parent_node=top_node,
+    )
+
+    nodes = await getattr(msg_utils, "__get_nodes_by_key_parent_and_active")(
+        session=session,
+        level=parent_level,
+        keys_parents_and_active={
+            ("MO 100", None, True),
+            ("MO 100", top_node.id, True),
+            ("MO 200", None, True),
+        },
+    )
+
+    assert {
+        key: [node.id for node in value] for key, value in nodes.items()
+    } == {("MO 100", None, True): [top_node.id]}
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_moved_node_is_merged_into_node_with_same_key(
+    session: AsyncSession, levels: tuple[Level, Level], mocker
+):
+    """TEST Virtual node moved to parent which already has node with the same key
+    is merged into it: node data and children are moved, paths of children are
+    rebased and moved node is deleted. Changed and deleted nodes are added into
+    session info for produced messages"""
+    mocker.patch(
+        "services.updater.event_handlers.common.msg_utils.session_events_are_listened",
+        return_value=True,
+    )
+    parent_level, virtual_level = levels
+    child_level = await add_level_to_session(
+        session=session,
+        is_virtual=False,
+        hierarchy_id=virtual_level.hierarchy_id,
+        level_name="Child level",
+        obj_type_id=VIRTUAL_TMO_ID,
+        level=3,
+        parent_id=virtual_level.id,
+        level_key_attrs=["name"],
+    )
+    old_parent_node = await add_node_to_session(
+        session, parent_level, [_parent_mo(100)]
+    )
+    new_parent_node = await add_node_to_session(
+        session, parent_level, [_parent_mo(200)]
+    )
+    moved_node = await add_node_to_session(
+        session,
+        virtual_level,
+        [_virtual_mo(1, 100, "A")],
+        parent_node=old_parent_node,
+    )
+    same_node = await add_node_to_session(
+        session,
+        virtual_level,
+        [_virtual_mo(2, 200, "A")],
+        parent_node=new_parent_node,
+    )
+    child_node = await add_node_to_session(
+        session,
+        child_level,
+        [{"id": 1, "name": "MO 1", "tmo_id": VIRTUAL_TMO_ID}],
+        parent_node=moved_node,
+    )
+    moved_node_id = moved_node.id
+    same_node_id = same_node.id
+    child_node_id = child_node.id
+    expected_child_path = f"{new_parent_node.id}/{same_node_id}/"
+    virtual_level_id = virtual_level.id
+
+    node_data = await _get_node_data(session, virtual_level_id, 1)
+    node_data.mo_p_id = 200
+    await getattr(msg_utils, "__rebuild_virtual")(
+        session=session,
+        node_data_with_new_parents=[node_data],
+        node_id_new_p_node_id={moved_node_id: new_parent_node.id},
+        level=virtual_level,
+        parent_level=parent_level,
+    )
+
+    session.expire_all()
+    assert await session.get(Obj, moved_node_id) is None
+    node_data = await _get_node_data(session, virtual_level_id, 1)
+    assert node_data.node_id == same_node_id
+    child_node = await session.get(Obj, child_node_id)
+    assert child_node.parent_id == same_node_id
+    assert child_node.path == expected_child_path
+
+    assert str(child_node_id) in _get_session_node_ids(
+        session, SessionDataKeys.DIRTY
+    )
+    assert _get_session_node_ids(session, SessionDataKeys.DELETED) == {
+        str(moved_node_id)
+    }
@@ -0,0 +1,179 @@
+"""TESTS for micro-batches of Kafka consumer"""
+
+from contextlib import asynccontextmanager
+from multiprocessing import Event
+from unittest.mock import AsyncMock
+
+import pytest
+
+from kafka_config.protobuf import inventory_instances_pb2
+from services.kafka.consumer.batching import group_inventory_messages
+from services.kafka.consumer.routing import RoutedLevel
+from settings import KafkaConfigs
+
+
+def _mo(mo_id: int, name: str) -> dict:
+    return {"id": mo_id, "name": name, "tmo_id": 1}
+
+
+def test_consecutive_messages_of_same_class_and_event_are_grouped():
+    """TEST Consecutive messages with the same class and event are joined in order,
+    messages of other classes and events split groups"""
+    messages = [
+        ("MO", "created", {"objects": [_mo(1, "a")]}),
+        ("MO", "created", {"objects": [_mo(2, "b")]}),
+        ("PRM", "updated", {"objects": [{"id": 10, "value": "1"}]}),
+        ("MO", "created", {"objects": [_mo(3, "c")]}),
+        ("TPRM", "deleted", {"objects": [{"id": 5}]}),
+        ("TPRM", "deleted", {"objects": [{"id": 6}]}),
+    ]
+
+    groups = group_inventory_messages(messages, max_objects_in_group=100)
+
+    assert [
+        (group.class_name, group.event, group.messages_count)
+        for group in groups
+    ] == [
+        ("MO", "created", 2),
+        ("PRM", "updated", 1),
+        ("MO", "created", 1),
+        ("TPRM", "deleted", 1),
+        ("TPRM", "deleted", 1),
+    ]
+    assert groups[0].msg == {"objects": [_mo(1, "a"), _mo(2, "b")]}
+    # source messages are not changed
+    assert messages[0][2] == {"objects": [_mo(1, "a")]}
+
+
+def test_updates_of_same_object_are_merged():
+    """TEST Only the last update of object is kept in group"""
+    messages = [
+        ("MO", "updated", {"objects": [_mo(1, "a"), _mo(2, "b")]}),
+        ("MO", "updated", {"objects": [_mo(1, "c")]}),
+        ("MO", "updated", {"objects": [_mo(3, "d"), _mo(2, "e")]}),
+    ]
+
+    groups = group_inventory_messages(messages, max_objects_in_group=100)
+
+    assert len(groups) == 1
+    assert groups[0].msg["objects"] == [_mo(1, "c"), _mo(2, "e"), _mo(3, "d")]
+
+
+def test_groups_are_limited_by_count_of_objects():
+    """TEST Messages are not joined over max_objects_in_group objects"""
+    messages = [
+        ("MO", "created", {"objects": [_mo(1, "a"), _mo(2, "b")]}),
+        ("MO", "created", {"objects": [_mo(3, "c")]}),
+        ("MO", "created", {"objects": [_mo(4, "d")]}),
+    ]
+
+    groups = group_inventory_messages(messages, max_objects_in_group=3)
+
+    assert [group.objects_count for group in groups] == [3, 1]
+
+
+class FakeMessage:
+    def __init__(self, key: str | None, value: bytes = b""):
+        self._key = key
+        self._value = value
+
+    def key(self):
+        return self._key.encode("utf-8") if self._key is not None else None
+
+    def value(self):
+        return self._value
+
+    def error(self):
+        return None
+
+
+def _mo_message(event: str, *mos: dict) -> FakeMessage:
+    msg = inventory_instances_pb2.ListMO()
+    for mo in mos:
+        msg.objects.add(**mo)
+    return FakeMessage(f"MO:{event}", msg.SerializeToString())
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_consumer_handles_batch_by_groups_and_commits_once(mocker):
+    """TEST Consumer handles messages of batch by one handler invocation per group
+    in one session and commits offsets once per batch"""
+    # consumer module imports database, which creates security by SECURITY_TYPE,
+    # so it is imported with security turned off as by client of routers tests
+    mocker.patch("services.security.security_config.SECURITY_TYPE", "DISABLE")
+    from services.kafka.consumer.handler import KafkaConnectionHandlerImpl
+    from services.meta_singleton.impl import SingletonABCMeta
+
+    event = Event()
+    batch = [
+        _mo_message("updated", _mo(1, "a")),
+        _mo_message("updated", _mo(1, "b"), _mo(2, "c")),
+        FakeMessage(None),
+        _mo_message("deleted", _mo(3, "d")),
+    ]
+
+    class FakeConsumer:
+        def __init__(self):
+            self.consume_calls = []
+            self.commits = 0
+
+        def consume(self, num_messages, timeout):
+            self.consume_calls.append((num_messages, timeout))
+            # connection is closed after the first batch
+            event.set()
+            return batch
+
+        def commit(self, asynchronous=True, message=None):
+            self.commits += 1
+
+    sessions = []
+
+    @asynccontextmanager
+    async def session_maker():
+        sessions.append(object())
+        yield sessions[-1]
+
+    mocker.patch(
+        "services.kafka.consumer.handler.async_session_maker_with_admin_perm",
+        side_effect=session_maker,
+    )
+    msg_handler = mocker.Mock(handle_the_message=AsyncMock())
+    kafka_configs = KafkaConfigs(
+        kafka_consumer_batch_max_size=100,
+        kafka_consumer_batch_max_latency=0.5,
+    )
+    SingletonABCMeta._instances.pop(KafkaConnectionHandlerImpl, None)
+    handler = KafkaConnectionHandlerImpl(
+        kafka_configs=kafka_configs,
+        msg_handler=msg_handler,
+        hierarchy_id=1,
+        event=event,
+    )
+    SingletonABCMeta._instances.pop(KafkaConnectionHandlerImpl, None)
+    # hierarchy has level of MO of batch
+    handler.router.levels_by_tmo_id[1] = [
+        RoutedLevel(
+            id=1, hierarchy_id=1, object_type_id=1, tprm_ids=frozenset()
+        )
+    ]
+    handler.router.is_loaded = True
+    consumer = FakeConsumer()
+    handler._KafkaConnectionHandlerImpl__consumer = consumer
+
+    await handler._KafkaConnectionHandlerImpl__read_batches(hierarchy_id=1)
+
+    assert consumer.consume_calls == [(100, 0.5)]
+    assert consumer.commits == 1
+    assert len(sessions) == 1
+    calls = msg_handler.handle_the_message.await_args_list
+    assert [
+        (call.kwargs["class_name"], call.kwargs["event"]) for call in calls
+    ] == [
+        ("MO", "updated"),
+        ("MO", "deleted"),
+    ]
+    updated_objects = calls[0].kwargs["msg"]["objects"]
+    assert [(mo["id"], mo["name"]) for mo in updated_objects] == [
+        (1, "b"),
+        (2, "c"),
+    ]
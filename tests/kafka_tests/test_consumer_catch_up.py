@@ -0,0 +1,278 @@
+"""TESTS for fast catch-up of Kafka consumer by rebuild of hierarchy"""
+
+from contextlib import asynccontextmanager
+from multiprocessing import Event
+
+from confluent_kafka import OFFSET_INVALID, TopicPartition
+import pytest
+
+from kafka_config.protobuf import inventory_instances_pb2
+from services.kafka.consumer.catch_up import (
+    ReplayCostEstimator,
+    get_lag_and_high_watermarks,
+)
+from services.kafka.consumer.routing import RoutedLevel
+from settings import KafkaConfigs
+
+TOPIC = "inventory.changes"
+
+
+def test_replay_cost_is_estimated_by_mix_of_objects():
+    """TEST Cost of replay is lag multiplied by mean cost of sampled messages,
+    measured time of handling of objects replaces the default one"""
+    estimator = ReplayCostEstimator()
+    estimator.seconds_per_object = {"MO": 0.01, "TMO": 1.0}
+    messages = [
+        ("MO", "updated", {"objects": [{"id": 1}, {"id": 2}]}),
+        ("TMO", "updated", {"objects": [{"id": 3}]}),
+    ]
+
+    assert estimator.estimate_replay_seconds(
+        lag=100, messages=messages
+    ) == pytest.approx(100 * (0.02 + 1.0) / 2)
+    assert estimator.estimate_replay_seconds(lag=100, messages=[]) == 0
+
+    estimator.observe("MO", objects_count=10, seconds=0.6)
+    estimator.observe("PRM", objects_count=2, seconds=0.1)
+    estimator.observe("PRM", objects_count=0, seconds=1.0)
+
+    assert estimator.seconds_per_object["MO"] == pytest.approx(
+        0.01 + 0.2 * (0.06 - 0.01)
+    )
+    assert estimator.seconds_per_object["PRM"] == pytest.approx(0.05)
+
+
+class FakeMessage:
+    def __init__(self, key: str, value: bytes, partition: int, offset: int):
+        self._key = key
+        self._value = value
+        self._partition = partition
+        self._offset = offset
+
+    def key(self):
+        return self._key.encode("utf-8")
+
+    def value(self):
+        return self._value
+
+    def error(self):
+        return None
+
+    def topic(self):
+        return TOPIC
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+
+def _mo_message(mo_id: int, partition: int, offset: int) -> FakeMessage:
+    msg = inventory_instances_pb2.ListMO()
+    msg.objects.add(id=mo_id, tmo_id=1)
+    return FakeMessage("MO:updated", msg.SerializeToString(), partition, offset)
+
+
+class FakeConsumer:
+    """Consumer of two partitions, messages of partition 0 are read up to offset 10,
+    partition 1 is not read yet"""
+
+    def __init__(self, event: Event, batch: list[FakeMessage]):
+        self.event = event
+        self.batch = batch
+        self.calls = []
+
+    def consume(self, num_messages, timeout):
+        self.event.set()
+        return self.batch
+
+    def assignment(self):
+        return [TopicPartition(TOPIC, 0), TopicPartition(TOPIC, 1)]
+
+    def position(self, partitions):
+        return [
+            TopicPartition(TOPIC, 0, 10),
+            TopicPartition(TOPIC, 1, OFFSET_INVALID),
+        ]
+
+    def committed(self, partitions, timeout=None):
+        return [
+            TopicPartition(TOPIC, 0, 8),
+            TopicPartition(TOPIC, 1, OFFSET_INVALID),
+        ]
+
+    def get_watermark_offsets(self, partition, timeout=None, cached=False):
+        return {0: (0, 1000), 1: (500, 1500)}[partition.partition]
+
+    def pause(self, partitions):
+        self.calls.append(("pause", len(partitions)))
+
+    def resume(self, partitions):
+        self.calls.append(("resume", len(partitions)))
+
+    def poll(self, timeout):
+        return None
+
+    def seek(self, partition):
+        self.calls.append(
+            ("seek", partition.topic, partition.partition, partition.offset)
+        )
+
+    def commit(self, offsets=None, message=None, asynchronous=True):
+        self.calls.append(
+            (
+                "commit",
+                [(item.topic, item.partition, item.offset) for item in offsets]
+                if offsets is not None
+                else None,
+            )
+        )
+
+
+def test_lag_and_high_watermarks_of_assigned_partitions():
+    """TEST Lag of partition not read yet is counted from its low watermark"""
+    consumer = FakeConsumer(event=Event(), batch=[])
+
+    lag, high_watermarks = get_lag_and_high_watermarks(consumer)
+
+    assert lag == 990 + 1000
+    assert [
+        (item.topic, item.partition, item.offset) for item in high_watermarks
+    ] == [(TOPIC, 0, 1000), (TOPIC, 1, 1500)]
+
+
+class FakeSession:
+    def __init__(self):
+        self.added = []
+
+    def add(self, item):
+        self.added.append(item)
+
+    async def commit(self):
+        pass
+
+
+def _create_handler(mocker, count_of_nodes: int):
+    # consumer module imports database, which creates security by SECURITY_TYPE,
+    # so it is imported with security turned off as by client of routers tests
+    mocker.patch("services.security.security_config.SECURITY_TYPE", "DISABLE")
+    from services.kafka.consumer.handler import KafkaConnectionHandlerImpl
+    from services.meta_singleton.impl import SingletonABCMeta
+
+    @asynccontextmanager
+    async def session_maker():
+        yield FakeSession()
+
+    mocker.patch(
+        "services.kafka.consumer.handler.async_session_maker_with_admin_perm",
+        side_effect=session_maker,
+    )
+    mocker.patch(
+        "services.kafka.consumer.handler.get_count_of_hierarchy_nodes",
+        mocker.AsyncMock(return_value={1: count_of_nodes}),
+    )
+    rebuild = mocker.patch(
+        "services.kafka.consumer.handler."
+        "rebuild_hierarchy_and_change_item_of_hierarchy_rebuild_order",
+        mocker.AsyncMock(),
+    )
+    msg_handler = mocker.Mock(handle_the_message=mocker.AsyncMock())
+    event = Event()
+    SingletonABCMeta._instances.pop(KafkaConnectionHandlerImpl, None)
+    handler = KafkaConnectionHandlerImpl(
+        kafka_configs=KafkaConfigs(
+            kafka_consumer_batch_max_size=2,
+            kafka_consumer_catch_up_min_lag=1000,
+            kafka_consumer_catch_up_rebuild_seconds_per_node=0.001,
+        ),
+        msg_handler=msg_handler,
+        hierarchy_id=1,
+        event=event,
+    )
+    SingletonABCMeta._instances.pop(KafkaConnectionHandlerImpl, None)
+    handler.router.levels_by_tmo_id[1] = [
+        RoutedLevel(
+            id=1, hierarchy_id=1, object_type_id=1, tprm_ids=frozenset()
+        )
+    ]
+    handler.router.is_loaded = True
+    consumer = FakeConsumer(
+        event=event, batch=[_mo_message(1, 0, 8), _mo_message(2, 0, 9)]
+    )
+    handler._KafkaConnectionHandlerImpl__consumer = consumer
+
+    async def rebuild_hierarchy(session, item_to_rebuild):
+        consumer.calls.append(("rebuild", item_to_rebuild.hierarchy_id))
+        return True
+
+    rebuild.side_effect = rebuild_hierarchy
+    return handler, consumer, msg_handler, rebuild
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_consumer_with_huge_lag_catches_up_by_rebuild(mocker):
+    """TEST Consumer with lag whose replay is slower than rebuild enqueues rebuild
+    of hierarchy, commits and seeks to high watermarks captured before rebuild
+    after rebuild and resumes reading"""
+    handler, consumer, msg_handler, rebuild = _create_handler(
+        mocker, count_of_nodes=100
+    )
+
+    await handler._KafkaConnectionHandlerImpl__read_batches(hierarchy_id=1)
+
+    msg_handler.handle_the_message.assert_not_awaited()
+    rebuild.assert_awaited_once()
+    item_to_rebuild = rebuild.await_args.kwargs["item_to_rebuild"]
+    assert item_to_rebuild.hierarchy_id == 1
+    # batch read before rebuild is not committed again
+    assert consumer.calls == [
+        ("pause", 2),
+        ("rebuild", 1),
+        ("commit", [(TOPIC, 0, 1000), (TOPIC, 1, 1500)]),
+        ("seek", TOPIC, 0, 1000),
+        ("seek", TOPIC, 1, 1500),
+        ("resume", 2),
+    ]
+
+
+@pytest.mark.parametrize("failure", ["not_rebuilt", "exception"])
+@pytest.mark.asyncio(loop_scope="session")
+async def test_consumer_does_not_commit_high_watermarks_of_failed_rebuild(
+    mocker, failure
+):
+    """TEST High watermarks are not committed if rebuild fails, consumer is resumed
+    from committed offsets, so pending messages are replayed. Partition without
+    committed offset is read from its low watermark"""
+    handler, consumer, _, rebuild = _create_handler(mocker, count_of_nodes=100)
+    if failure == "not_rebuilt":
+        rebuild.side_effect = None
+        rebuild.return_value = False
+        await handler._KafkaConnectionHandlerImpl__read_batches(hierarchy_id=1)
+    else:
+        rebuild.side_effect = RuntimeError("Rebuild failed")
+        with pytest.raises(RuntimeError):
+            await handler._KafkaConnectionHandlerImpl__read_batches(
+                hierarchy_id=1
+            )
+
+    assert consumer.calls == [
+        ("pause", 2),
+        ("seek", TOPIC, 0, 8),
+        ("seek", TOPIC, 1, 500),
+        ("resume", 2),
+    ]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_consumer_replays_messages_if_rebuild_is_slower(mocker):
+    """TEST Consumer of large hierarchy handles pending messages"""
+    handler, consumer, msg_handler, rebuild = _create_handler(
+        mocker, count_of_nodes=1_000_000
+    )
+
+    await handler._KafkaConnectionHandlerImpl__read_batches(hierarchy_id=1)
+
+    rebuild.assert_not_awaited()
+    msg_handler.handle_the_message.assert_awaited_once()
+    assert consumer.calls == [("commit", None)]
@@ -0,0 +1,218 @@
+"""TESTS for dead letters of Kafka consumer"""
+
+from contextlib import asynccontextmanager
+from multiprocessing import Event
+import threading
+
+import pytest
+
+from kafka_config.protobuf import inventory_instances_pb2
+from services.kafka.consumer.dead_letters import (
+    DeadLetter,
+    FileDeadLettersSink,
+    KafkaDeadLettersSink,
+    replay_dead_letters,
+)
+from services.kafka.consumer.routing import RoutedLevel
+from settings import KafkaConfigs
+
+POISON_MO_ID = 2
+
+
+class FakeMessage:
+    def __init__(self, key: str, value: bytes, offset: int):
+        self._key = key
+        self._value = value
+        self._offset = offset
+
+    def key(self):
+        return self._key.encode("utf-8")
+
+    def value(self):
+        return self._value
+
+    def error(self):
+        return None
+
+    def topic(self):
+        return "inventory.changes"
+
+    def partition(self):
+        return 0
+
+    def offset(self):
+        return self._offset
+
+
+def _mo_message(event: str, mo_id: int, offset: int) -> FakeMessage:
+    msg = inventory_instances_pb2.ListMO()
+    msg.objects.add(id=mo_id, tmo_id=1)
+    return FakeMessage(f"MO:{event}", msg.SerializeToString(), offset)
+
+
+class FakeSession:
+    def __init__(self):
+        self.rollbacks = 0
+
+    async def rollback(self):
+        self.rollbacks += 1
+
+
+@asynccontextmanager
+async def session_maker():
+    yield FakeSession()
+
+
+def _handle_all_except_poison(handled: list):
+    async def handle_the_message(msg, class_name, event, session, hierarchy_id):
+        mo_ids = [mo["id"] for mo in msg["objects"]]
+        if POISON_MO_ID in mo_ids:
+            raise ValueError("Poison message")
+        handled.append((event, mo_ids, hierarchy_id))
+
+    return handle_the_message
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_poison_message_is_published_to_dead_letters(mocker, tmp_path):
+    """TEST Group with poison message is retried and handled message by message,
+    poison message is published to dead letters, other messages are handled
+    and offsets of batch are committed"""
+    # consumer module imports database, which creates security by SECURITY_TYPE,
+    # so it is imported with security turned off as by client of routers tests
+    mocker.patch("services.security.security_config.SECURITY_TYPE", "DISABLE")
+    from services.kafka.consumer.handler import KafkaConnectionHandlerImpl
+    from services.meta_singleton.impl import SingletonABCMeta
+
+    event = Event()
+    batch = [
+        _mo_message("updated", 1, offset=0),
+        _mo_message("updated", POISON_MO_ID, offset=1),
+        _mo_message("deleted", 3, offset=2),
+    ]
+
+    class FakeConsumer:
+        def __init__(self):
+            self.commits = 0
+
+        def consume(self, num_messages, timeout):
+            event.set()
+            return batch
+
+        def commit(self, asynchronous=True, message=None):
+            self.commits += 1
+
+    mocker.patch(
+        "services.kafka.consumer.handler.async_session_maker_with_admin_perm",
+        side_effect=session_maker,
+    )
+    handled = []
+    handle_the_message = mocker.AsyncMock(
+        side_effect=_handle_all_except_poison(handled)
+    )
+    msg_handler = mocker.Mock(handle_the_message=handle_the_message)
+    kafka_configs = KafkaConfigs(
+        kafka_consumer_max_retries=2,
+        kafka_consumer_retry_backoff=0,
+        kafka_dead_letters_sink="file",
+        kafka_dead_letters_file_path=str(tmp_path / "dead_letters.jsonl"),
+    )
+    SingletonABCMeta._instances.pop(KafkaConnectionHandlerImpl, None)
+    handler = KafkaConnectionHandlerImpl(
+        kafka_configs=kafka_configs,
+        msg_handler=msg_handler,
+        hierarchy_id=1,
+        event=event,
+    )
+    SingletonABCMeta._instances.pop(KafkaConnectionHandlerImpl, None)
+    handler.router.levels_by_tmo_id[1] = [
+        RoutedLevel(
+            id=1, hierarchy_id=1, object_type_id=1, tprm_ids=frozenset()
+        )
+    ]
+    handler.router.is_loaded = True
+    consumer = FakeConsumer()
+    handler._KafkaConnectionHandlerImpl__consumer = consumer
+
+    await handler._KafkaConnectionHandlerImpl__read_batches(hierarchy_id=1)
+
+    assert handled == [
+        ("updated", [1], 1),
+        ("deleted", [3], 1),
+    ]
+    # group of updates is handled with retries, then its messages one by one
+    # and poison message is handled with retries again
+    assert handle_the_message.await_count == 3 + 1 + 3 + 1
+    assert consumer.commits == 1
+
+    dead_letters = list(handler.dead_letters.read())
+    assert len(dead_letters) == 1
+    assert dead_letters[0].value == batch[1].value()
+    assert dead_letters[0].hierarchy_id == 1
+    assert dead_letters[0].offset == 1
+    assert "Poison message" in dead_letters[0].error
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_replay_applies_dead_letters_and_keeps_failed_ones(
+    mocker, tmp_path
+):
+    """TEST Applied dead letters are removed by replay, failed ones are kept
+    with new error"""
+    dead_letters = FileDeadLettersSink(str(tmp_path / "dead_letters.jsonl"))
+    for mo_id in (1, POISON_MO_ID):
+        await dead_letters.publish(
+            DeadLetter.from_message(
+                _mo_message("updated", mo_id, offset=mo_id),
+                hierarchy_id=5,
+                error="Error",
+            )
+        )
+    handled = []
+    msg_handler = mocker.Mock(
+        handle_the_message=_handle_all_except_poison(handled)
+    )
+
+    applied, failed = await replay_dead_letters(
+        dead_letters=dead_letters,
+        msg_handler=msg_handler,
+        session_maker=session_maker,
+    )
+
+    assert (applied, failed) == (1, 1)
+    assert handled == [("updated", [1], 5)]
+    remaining = list(dead_letters.read())
+    assert [letter.offset for letter in remaining] == [POISON_MO_ID]
+    assert "Poison message" in remaining[0].error
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_kafka_dead_letter_is_delivered_without_blocking_event_loop(
+    mocker,
+):
+    """TEST Delivery of dead letter into Kafka is waited in thread,
+    failed delivery is raised"""
+    flush_thread_ids = []
+
+    def flush(timeout):
+        flush_thread_ids.append(threading.get_ident())
+        return 0
+
+    producer = mocker.Mock(flush=mocker.Mock(side_effect=flush))
+    mocker.patch(
+        "services.kafka.consumer.dead_letters.Producer", return_value=producer
+    )
+    dead_letters = KafkaDeadLettersSink(KafkaConfigs())
+    dead_letter = DeadLetter.from_message(
+        _mo_message("updated", 1, offset=1), hierarchy_id=5, error="Error"
+    )
+
+    await dead_letters.publish(dead_letter)
+
+    assert producer.produce.call_args.kwargs["value"] == dead_letter.value
+    assert flush_thread_ids[0] != threading.get_ident()
+
+    producer.flush.side_effect = None
+    producer.flush.return_value = 1
+    with pytest.raises(RuntimeError):
+        await dead_letters.publish(dead_letter)
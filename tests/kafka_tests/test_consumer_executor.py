@@ -0,0 +1,325 @@
+"""TESTS for concurrent handling of messages by Kafka consumer"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from multiprocessing import Event
+
+from confluent_kafka import TopicPartition
+import pytest
+
+from kafka_config.protobuf import inventory_instances_pb2
+from services.kafka.consumer.executor import (
+    KeyedTaskExecutor,
+    PartitionOffsetsTracker,
+)
+from services.kafka.consumer.routing import RoutedLevel
+from settings import KafkaConfigs
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_tasks_with_common_keys_are_handled_in_order():
+    """TEST Tasks of the same key wait for previous ones,
+    tasks of other keys and scopes are not blocked by them"""
+    executor = KeyedTaskExecutor(max_concurrency=4)
+    first_is_released = asyncio.Event()
+    handled = []
+
+    async def handle(name, wait=False):
+        if wait:
+            await first_is_released.wait()
+        handled.append(name)
+
+    executor.submit(1, {1}, lambda: handle("1: mo 1", wait=True))
+    executor.submit(1, {1, 2}, lambda: handle("1: mo 1 and 2"))
+    executor.submit(1, {3}, lambda: handle("1: mo 3"))
+    executor.submit(2, {1}, lambda: handle("2: mo 1"))
+    await asyncio.sleep(0.01)
+
+    assert handled == ["1: mo 3", "2: mo 1"]
+
+    first_is_released.set()
+    await executor.wait_all()
+
+    assert handled == ["1: mo 3", "2: mo 1", "1: mo 1", "1: mo 1 and 2"]
+    assert executor.pending_count == 0
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_task_without_keys_is_exclusive_in_scope():
+    """TEST Task without keys waits for all previous tasks of scope
+    and blocks all next tasks of scope"""
+    executor = KeyedTaskExecutor(max_concurrency=4)
+    handled = []
+
+    async def handle(name, delay=0.0):
+        await asyncio.sleep(delay)
+        handled.append(name)
+
+    executor.submit(1, {1}, lambda: handle("mo 1", delay=0.02))
+    executor.submit(1, None, lambda: handle("tprm"))
+    executor.submit(1, {2}, lambda: handle("mo 2"))
+    await executor.wait_all()
+
+    assert handled == ["mo 1", "tprm", "mo 2"]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_tasks_are_not_handled_after_error():
+    """TEST Error of task is collected and next tasks are skipped"""
+    executor = KeyedTaskExecutor(max_concurrency=1)
+    handled = []
+
+    async def fail():
+        raise ValueError("Error")
+
+    async def handle():
+        handled.append(True)
+
+    executor.submit(1, {1}, fail)
+    executor.submit(1, {1}, handle)
+    await executor.wait_all()
+
+    assert handled == []
+    assert [type(error) for error in executor.errors] == [ValueError]
+
+
+def test_offsets_are_committed_up_to_lowest_not_handled_offset():
+    """TEST Offset of partition is the lowest offset of not handled message"""
+    offsets = PartitionOffsetsTracker()
+    offsets.add("topic", 0, 10, tasks_count=1)
+    offsets.add("topic", 0, 11, tasks_count=2)
+    offsets.add("topic", 0, 12, tasks_count=0)
+    offsets.add("topic", 1, 5, tasks_count=1)
+
+    offsets.done("topic", 0, 11)
+    offsets.done("topic", 1, 5)
+    assert offsets.get_offsets_to_commit() == [
+        ("topic", 0, 10),
+        ("topic", 1, 6),
+    ]
+
+    offsets.done("topic", 0, 10)
+    assert offsets.get_offsets_to_commit() == [("topic", 0, 11)]
+
+    offsets.done("topic", 0, 11)
+    assert offsets.get_offsets_to_commit() == [("topic", 0, 13)]
+    assert offsets.get_offsets_to_commit() == []
+
+
+class FakeMessage:
+    def __init__(self, key: str, value: bytes, partition: int, offset: int):
+        self._key = key
+        self._value = value
+        self._partition = partition
+        self._offset = offset
+
+    def key(self):
+        return self._key.encode("utf-8")
+
+    def value(self):
+        return self._value
+
+    def error(self):
+        return None
+
+    def topic(self):
+        return "inventory.changes"
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+
+def _message(
+    class_name: str, event: str, partition: int, offset: int, **item
+) -> FakeMessage:
+    msg = getattr(inventory_instances_pb2, f"List{class_name}")()
+    msg.objects.add(**item)
+    return FakeMessage(
+        f"{class_name}:{event}", msg.SerializeToString(), partition, offset
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_consumer_handles_groups_of_different_levels_concurrently(mocker):
+    """TEST Groups of slow level do not block groups of other levels, groups of the same
+    level and of its child levels are handled in order and offsets are committed
+    after all groups are handled"""
+    # consumer module imports database, which creates security by SECURITY_TYPE,
+    # so it is imported with security turned off as by client of routers tests
+    mocker.patch("services.security.security_config.SECURITY_TYPE", "DISABLE")
+    from services.kafka.consumer.handler import KafkaConnectionHandlerImpl
+    from services.meta_singleton.impl import SingletonABCMeta
+
+    event = Event()
+    batch = [
+        _message("MO", "updated", 0, 0, id=1, tmo_id=1),
+        _message("PRM", "updated", 1, 0, id=10, tprm_id=20, mo_id=2),
+        _message("MO", "deleted", 0, 1, id=1, tmo_id=1),
+        # MO of child level may be created under node of slow MO
+        _message("MO", "created", 0, 2, id=3, tmo_id=3, p_id=1),
+    ]
+
+    class FakeConsumer:
+        def __init__(self):
+            self.commits = []
+
+        def consume(self, num_messages, timeout):
+            event.set()
+            return batch
+
+        def commit(self, offsets=None, asynchronous=True):
+            self.commits.extend(
+                (item.topic, item.partition, item.offset) for item in offsets
+            )
+
+    @asynccontextmanager
+    async def session_maker():
+        yield None
+
+    mocker.patch(
+        "services.kafka.consumer.handler.async_session_maker_with_admin_perm",
+        side_effect=session_maker,
+    )
+    handled = []
+
+    async def handle_the_message(msg, class_name, event, session, hierarchy_id):
+        if (class_name, event) == ("MO", "updated"):
+            await asyncio.sleep(0.05)
+        handled.append((class_name, event))
+
+    msg_handler = mocker.Mock(handle_the_message=handle_the_message)
+    SingletonABCMeta._instances.pop(KafkaConnectionHandlerImpl, None)
+    handler = KafkaConnectionHandlerImpl(
+        kafka_configs=KafkaConfigs(kafka_consumer_max_concurrency=4),
+        msg_handler=msg_handler,
+        hierarchy_id=1,
+        event=event,
+    )
+    SingletonABCMeta._instances.pop(KafkaConnectionHandlerImpl, None)
+    level = RoutedLevel(
+        id=1, hierarchy_id=1, object_type_id=1, tprm_ids=frozenset({10})
+    )
+    other_level = RoutedLevel(
+        id=2, hierarchy_id=1, object_type_id=2, tprm_ids=frozenset({20})
+    )
+    child_level = RoutedLevel(
+        id=3,
+        hierarchy_id=1,
+        object_type_id=3,
+        tprm_ids=frozenset(),
+        parent_id=1,
+    )
+    for routed_level in (level, other_level, child_level):
+        handler.router.levels_by_tmo_id[routed_level.object_type_id] = [
+            routed_level
+        ]
+        for tprm_id in routed_level.tprm_ids:
+            handler.router.levels_by_tprm_id[tprm_id] = [routed_level]
+    handler.router.child_level_ids[1] = {3}
+    handler.router.is_loaded = True
+    consumer = FakeConsumer()
+    handler._KafkaConnectionHandlerImpl__consumer = consumer
+
+    await handler._KafkaConnectionHandlerImpl__read_batches_concurrently(
+        hierarchy_id=1
+    )
+
+    assert handled == [
+        ("PRM", "updated"),
+        ("MO", "updated"),
+        ("MO", "deleted"),
+        ("MO", "created"),
+    ]
+    # offsets are committed after batch is read and after all groups are handled
+    assert consumer.commits == [
+        ("inventory.changes", 0, 0),
+        ("inventory.changes", 1, 0),
+        ("inventory.changes", 0, 3),
+        ("inventory.changes", 1, 1),
+    ]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_consumer_tracks_offsets_again_after_rebalance(mocker):
+    """TEST Offsets and deferred messages of revoked partitions are forgotten
+    after rebalance, so they do not hold commits of partitions assigned again"""
+    mocker.patch("services.security.security_config.SECURITY_TYPE", "DISABLE")
+    from services.kafka.consumer.handler import KafkaConnectionHandlerImpl
+    from services.meta_singleton.impl import SingletonABCMeta
+
+    event = Event()
+    batches = [
+        # MO of hierarchy being rebuilt is deferred
+        [_message("MO", "updated", 1, 3, id=1, tmo_id=1)],
+        [_message("MO", "updated", 1, 7, id=2, tmo_id=2)],
+    ]
+
+    class FakeConsumer:
+        def __init__(self):
+            self.commits = []
+
+        def consume(self, num_messages, timeout):
+            batch = batches.pop(0)
+            if not batches:
+                # partition is revoked and assigned again while consume
+                handler._KafkaConnectionHandlerImpl__on_revoke(
+                    self, [TopicPartition("inventory.changes", 1)]
+                )
+                event.set()
+            return batch
+
+        def commit(self, offsets=None, asynchronous=True):
+            self.commits.extend(
+                (item.topic, item.partition, item.offset) for item in offsets
+            )
+
+    @asynccontextmanager
+    async def session_maker():
+        yield None
+
+    mocker.patch(
+        "services.kafka.consumer.handler.async_session_maker_with_admin_perm",
+        side_effect=session_maker,
+    )
+    handled = []
+
+    async def handle_the_message(msg, class_name, event, session, hierarchy_id):
+        handled.append(hierarchy_id)
+
+    SingletonABCMeta._instances.pop(KafkaConnectionHandlerImpl, None)
+    handler = KafkaConnectionHandlerImpl(
+        kafka_configs=KafkaConfigs(kafka_consumer_max_concurrency=4),
+        msg_handler=mocker.Mock(handle_the_message=handle_the_message),
+        hierarchy_id=None,
+        event=event,
+    )
+    SingletonABCMeta._instances.pop(KafkaConnectionHandlerImpl, None)
+    for hierarchy_id in (1, 2):
+        handler.router.levels_by_tmo_id[hierarchy_id] = [
+            RoutedLevel(
+                id=hierarchy_id,
+                hierarchy_id=hierarchy_id,
+                object_type_id=hierarchy_id,
+                tprm_ids=frozenset(),
+            )
+        ]
+        handler.router.hierarchy_ids.add(hierarchy_id)
+    handler.router.rebuilding_hierarchy_ids = {1}
+    handler.router.is_loaded = True
+    consumer = FakeConsumer()
+    handler._KafkaConnectionHandlerImpl__consumer = consumer
+
+    await handler._KafkaConnectionHandlerImpl__read_batches_concurrently(
+        hierarchy_id=None
+    )
+
+    assert handled == [2]
+    assert len(handler.deferred_groups) == 0
+    assert consumer.commits == [
+        ("inventory.changes", 1, 3),
+        ("inventory.changes", 1, 7),
+        ("inventory.changes", 1, 8),
+    ]
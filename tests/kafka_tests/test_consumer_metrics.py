@@ -0,0 +1,142 @@
+"""TESTS for metrics of Kafka consumer"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+from httpx import ASGITransport, AsyncClient
+from prometheus_client import REGISTRY
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from services.metrics.consumer import (
+    count_messages,
+    listen_db_time,
+    measure_handler_time,
+    measure_inventory_grpc_time,
+    observe_consumer_statistics,
+)
+from services.metrics.exposition import create_metrics_app
+
+
+def _get_value(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_lag_is_set_by_statistics_of_consumer():
+    """TEST Lag of assigned partitions is set, partitions with unknown lag
+    are skipped"""
+    stats = {
+        "topics": {
+            "inventory.changes": {
+                "partitions": {
+                    "0": {"consumer_lag": 7},
+                    "1": {"consumer_lag": -1},
+                    "-1": {"consumer_lag": 100},
+                }
+            }
+        }
+    }
+
+    observe_consumer_statistics(json.dumps(stats), consumer="lag_test")
+
+    def get_lag(partition: str):
+        return REGISTRY.get_sample_value(
+            "hierarchy_consumer_lag",
+            {
+                "consumer": "lag_test",
+                "topic": "inventory.changes",
+                "partition": partition,
+            },
+        )
+
+    assert get_lag("0") == 7
+    assert get_lag("1") is None
+    assert get_lag("-1") is None
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_handler_time_is_split_into_db_and_inventory_time(
+    session: AsyncSession,
+):
+    """TEST Time of db queries and Inventory requests made during handler
+    is observed separately from total time of handler"""
+    labels = {"class_name": "TEST", "event": "split"}
+    names = (
+        "hierarchy_consumer_handler_seconds_sum",
+        "hierarchy_consumer_handler_db_seconds_sum",
+        "hierarchy_consumer_handler_inventory_grpc_seconds_sum",
+    )
+    before = [_get_value(name, **labels) for name in names]
+
+    @measure_inventory_grpc_time
+    async def request_inventory():
+        await asyncio.sleep(0.02)
+
+    listen_db_time()
+    # time outside of handler is not observed
+    await request_inventory()
+    with measure_handler_time(**labels):
+        await request_inventory()
+        await session.execute(text("SELECT pg_sleep(0.02)"))
+    count = _get_value("hierarchy_consumer_handler_seconds_count", **labels)
+
+    total, db, grpc = [
+        _get_value(name, **labels) - value for name, value in zip(names, before)
+    ]
+    assert count >= 1
+    assert 0.02 <= grpc < 0.04
+    assert 0.02 <= db < total
+    assert grpc + db <= total
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_metrics_are_served_from_files_of_processes():
+    """TEST Metrics app serves values written by processes into files"""
+    count_messages("exposition_test", "processed", 3)
+
+    transport = ASGITransport(app=create_metrics_app())
+    async with AsyncClient(
+        transport=transport, base_url="http://test"
+    ) as client:
+        response = await client.get("/")
+
+    assert response.status_code == 200
+    assert (
+        'hierarchy_consumer_messages_total{consumer="exposition_test",'
+        'status="processed"}' in response.text
+    )
+
+
+def test_metrics_are_written_into_directory_of_instance_regardless_of_import_order():
+    """TEST Metrics module imported before settings writes values into files,
+    default directory of metrics belongs to the instance of the app"""
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if key != "PROMETHEUS_MULTIPROC_DIR"
+    }
+    # modules are found as in tests, settings of tests are found first
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    script = (
+        "import os\n"
+        "import services.metrics.consumer\n"
+        "from prometheus_client import values\n"
+        "print(values.ValueClass.__name__)\n"
+        "print(os.path.basename(os.environ['PROMETHEUS_MULTIPROC_DIR']))\n"
+        "print(os.getpid())\n"
+    )
+    res = subprocess.run(
+        [sys.executable, "-c", script],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    value_class, directory, pid = res.stdout.split()
+    assert value_class == "MmapedValue"
+    assert directory == f"hierarchy_metrics_{pid}"
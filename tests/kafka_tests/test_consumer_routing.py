@@ -0,0 +1,392 @@
+"""TESTS for routing of messages by shared Kafka consumer"""
+
+from contextlib import asynccontextmanager
+import datetime
+from multiprocessing import Event
+from unittest.mock import AsyncMock
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from kafka_config.protobuf import inventory_instances_pb2
+from schemas.enum_models import HierarchyStatus
+from schemas.hier_schemas import (
+    Hierarchy,
+    HierarchyBuildCheckpoint,
+    HierarchyRebuildOrder,
+    Level,
+)
+from schemas.main_base_connector import Base
+from services.kafka.consumer.routing import HierarchiesRouter
+from settings import KafkaConfigs
+
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def hierarchies(session: AsyncSession) -> dict[str, Hierarchy]:
+    """Hierarchies:
+    first: level of TMO 1 by TPRM 10 -> level of TMO 2 by key attrs TPRM 20 and name
+    second: level of TMO 2 by TPRM 30 with coordinates TPRM 31 and 32
+    in_process: level of TMO 3 by TPRM 40, its build sends heartbeats"""
+    hierarchies = {
+        "first": Hierarchy(name="first", author="Admin"),
+        "second": Hierarchy(name="second", author="Admin"),
+        "in_process": Hierarchy(
+            name="in_process",
+            author="Admin",
+            status=HierarchyStatus.IN_PROCESS.value,
+        ),
+    }
+    session.add_all(hierarchies.values())
+    await session.flush()
+
+    def add_level(hierarchy, level, object_type_id, key_attrs, **kwargs):
+        session.add(
+            Level(
+                level=level,
+                name=f"{hierarchy.name} {level}",
+                object_type_id=object_type_id,
+                is_virtual=False,
+                hierarchy_id=hierarchy.id,
+                param_type_id=int(key_attrs[0]),
+                key_attrs=key_attrs,
+                author="Admin",
+                **kwargs,
+            )
+        )
+
+    add_level(hierarchies["first"], 1, 1, ["10"])
+    add_level(hierarchies["first"], 2, 2, ["20", "name"])
+    add_level(
+        hierarchies["second"], 1, 2, ["30"], latitude_id=31, longitude_id=32
+    )
+    add_level(hierarchies["in_process"], 1, 3, ["40"])
+    session.add(
+        HierarchyBuildCheckpoint(
+            hierarchy_id=hierarchies["in_process"].id, nodes_write_mode="copy"
+        )
+    )
+    await session.commit()
+    yield hierarchies
+
+    for table in reversed(Base.metadata.sorted_tables):
+        await session.execute(table.delete())
+    await session.commit()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_messages_are_routed_to_hierarchies_by_levels(
+    session: AsyncSession, hierarchies: dict[str, Hierarchy]
+):
+    """TEST Messages are routed only to hierarchies whose levels use TMO or TPRM
+    of message, hierarchies being rebuilt are routed and are marked as rebuilding"""
+    first_id = hierarchies["first"].id
+    second_id = hierarchies["second"].id
+    in_process_id = hierarchies["in_process"].id
+    router = HierarchiesRouter()
+    await router.load(session)
+
+    def route(class_name, *objects):
+        return router.get_hierarchy_ids(
+            class_name=class_name, msg={"objects": list(objects)}
+        )
+
+    assert route("MO", {"id": 1, "tmo_id": 1}) == {first_id}
+    assert route("MO", {"id": 1, "tmo_id": 1}, {"id": 2, "tmo_id": 2}) == {
+        first_id,
+        second_id,
+    }
+    assert route("MO", {"id": 3, "tmo_id": 3}) == {in_process_id}
+    assert route("MO", {"id": 3, "tmo_id": 4}) == set()
+    assert route("PRM", {"id": 1, "tprm_id": 20}) == {first_id}
+    assert route("PRM", {"id": 1, "tprm_id": 32}) == {second_id}
+    assert route("PRM", {"id": 1, "tprm_id": 99}) == set()
+    assert route("TMO", {"id": 2}) == {first_id, second_id}
+    assert route("TPRM", {"id": 31}) == {second_id}
+    assert route("TPRM", {"id": 40}) == {in_process_id}
+    assert router.rebuilding_hierarchy_ids == {in_process_id}
+
+
+class FakeMessage:
+    def __init__(self, key: str, value: bytes, offset: int = 0):
+        self._key = key
+        self._value = value
+        self._offset = offset
+
+    def key(self):
+        return self._key.encode("utf-8")
+
+    def value(self):
+        return self._value
+
+    def error(self):
+        return None
+
+    def topic(self):
+        return "inventory"
+
+    def partition(self):
+        return 0
+
+    def offset(self):
+        return self._offset
+
+
+def _mo_message(event: str, *mos: dict, offset: int = 0) -> FakeMessage:
+    msg = inventory_instances_pb2.ListMO()
+    for mo in mos:
+        msg.objects.add(**mo)
+    return FakeMessage(f"MO:{event}", msg.SerializeToString(), offset=offset)
+
+
+class FakeConsumer:
+    def __init__(self, event: Event, batch: list[FakeMessage]):
+        self.event = event
+        self.batch = batch
+        self.commits = 0
+        # offsets of explicit commits, None is commit of positions
+        self.committed_offsets = []
+
+    def consume(self, num_messages, timeout):
+        # connection is closed after the first batch
+        self.event.set()
+        return self.batch
+
+    def commit(self, asynchronous=True, message=None, offsets=None):
+        self.commits += 1
+        self.committed_offsets.append(
+            None
+            if offsets is None
+            else [(item.topic, item.partition, item.offset) for item in offsets]
+        )
+
+
+@pytest.fixture
+def create_handler(session: AsyncSession, mocker):
+    """Returns function which creates consumer reading one batch
+    and list of sessions opened by consumer"""
+    # consumer module imports database, which creates security by SECURITY_TYPE,
+    # so it is imported with security turned off as by client of routers tests
+    mocker.patch("services.security.security_config.SECURITY_TYPE", "DISABLE")
+    from services.kafka.consumer.handler import KafkaConnectionHandlerImpl
+    from services.meta_singleton.impl import SingletonABCMeta
+
+    opened_sessions = []
+
+    @asynccontextmanager
+    async def session_maker():
+        opened_sessions.append(session)
+        yield session
+
+    mocker.patch(
+        "services.kafka.consumer.handler.async_session_maker_with_admin_perm",
+        side_effect=session_maker,
+    )
+
+    def create(hierarchy_id: int | None, routing_event: Event = None):
+        SingletonABCMeta._instances.pop(KafkaConnectionHandlerImpl, None)
+        handler = KafkaConnectionHandlerImpl(
+            kafka_configs=KafkaConfigs(),
+            msg_handler=mocker.Mock(handle_the_message=AsyncMock()),
+            hierarchy_id=hierarchy_id,
+            event=Event(),
+            routing_event=routing_event,
+        )
+        SingletonABCMeta._instances.pop(KafkaConnectionHandlerImpl, None)
+        return handler
+
+    return create, opened_sessions
+
+
+async def _read_batch(handler, batch: list[FakeMessage]) -> FakeConsumer:
+    consumer = FakeConsumer(handler._KafkaConnectionHandlerImpl__event, batch)
+    handler._KafkaConnectionHandlerImpl__event.clear()
+    handler._KafkaConnectionHandlerImpl__consumer = consumer
+    await handler._KafkaConnectionHandlerImpl__read_batches(
+        hierarchy_id=handler.hierarchy_id
+    )
+    return consumer
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_shared_consumer_fans_out_messages_to_routed_hierarchies(
+    hierarchies: dict[str, Hierarchy], create_handler
+):
+    """TEST Shared consumer deserializes message once and handles it
+    for every hierarchy affected by it"""
+    create, _ = create_handler
+    handler = create(hierarchy_id=None)
+    batch = [
+        _mo_message("updated", {"id": 1, "tmo_id": 2}),
+        _mo_message("deleted", {"id": 2, "tmo_id": 1}),
+        _mo_message("deleted", {"id": 3, "tmo_id": 3}),
+    ]
+
+    consumer = await _read_batch(handler, batch)
+
+    calls = handler.msg_handler.handle_the_message.await_args_list
+    assert [
+        (call.kwargs["event"], call.kwargs["hierarchy_id"]) for call in calls
+    ] == sorted(
+        [
+            ("updated", hierarchies["first"].id),
+            ("updated", hierarchies["second"].id),
+        ]
+    ) + [("deleted", hierarchies["first"].id)]
+    assert consumer.commits == 1
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_irrelevant_messages_are_dropped_without_session(
+    session: AsyncSession, hierarchies: dict[str, Hierarchy], create_handler
+):
+    """TEST Messages of TMO without levels are skipped without opening of session,
+    index of levels is reloaded after it is invalidated"""
+    create, opened_sessions = create_handler
+    routing_event = Event()
+    handler = create(
+        hierarchy_id=hierarchies["first"].id, routing_event=routing_event
+    )
+    batch = [_mo_message("created", {"id": 1, "tmo_id": 5})]
+    await handler._KafkaConnectionHandlerImpl__load_routing_index()
+    opened_sessions.clear()
+
+    consumer = await _read_batch(handler, batch)
+
+    assert opened_sessions == []
+    assert handler.msg_handler.handle_the_message.await_count == 0
+    assert (handler.router.hits, handler.router.skips) == (0, 1)
+    assert consumer.commits == 1
+
+    session.add(
+        Level(
+            level=3,
+            name="first 3",
+            object_type_id=5,
+            is_virtual=False,
+            hierarchy_id=hierarchies["first"].id,
+            param_type_id=50,
+            key_attrs=["50"],
+            author="Admin",
+        )
+    )
+    await session.commit()
+    routing_event.set()
+
+    await _read_batch(handler, batch)
+
+    assert not routing_event.is_set()
+    assert handler.msg_handler.handle_the_message.await_count == 1
+    assert (handler.router.hits, handler.router.skips) == (1, 1)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_messages_received_while_rebuild_are_handled_after_it(
+    session: AsyncSession, hierarchies: dict[str, Hierarchy], create_handler
+):
+    """TEST Message of hierarchy being rebuilt is not handled and is not committed
+    while rebuild, it is handled when routing is reloaded after the rebuild"""
+    create, _ = create_handler
+    routing_event = Event()
+    handler = create(hierarchy_id=None, routing_event=routing_event)
+    in_process = hierarchies["in_process"]
+    batch = [
+        _mo_message("updated", {"id": 1, "tmo_id": 2}, offset=10),
+        _mo_message("created", {"id": 3, "tmo_id": 3}, offset=11),
+        _mo_message("deleted", {"id": 2, "tmo_id": 1}, offset=12),
+    ]
+
+    consumer = await _read_batch(handler, batch)
+
+    calls = handler.msg_handler.handle_the_message.await_args_list
+    assert in_process.id not in {call.kwargs["hierarchy_id"] for call in calls}
+    assert len(calls) == 3
+    # partition is committed up to the deferred message
+    assert consumer.committed_offsets == [[("inventory", 0, 11)]]
+    assert len(handler.deferred_groups) == 1
+
+    in_process.status = HierarchyStatus.COMPLETE.value
+    await session.commit()
+    routing_event.set()
+    handler.msg_handler.handle_the_message.reset_mock()
+
+    consumer = await _read_batch(handler, [])
+
+    calls = handler.msg_handler.handle_the_message.await_args_list
+    assert [
+        (call.kwargs["hierarchy_id"], call.kwargs["msg"]["objects"][0]["id"])
+        for call in calls
+    ] == [(in_process.id, 3)]
+    assert len(handler.deferred_groups) == 0
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_messages_of_stopped_rebuild_are_not_deferred_anymore(
+    session: AsyncSession, hierarchies: dict[str, Hierarchy], create_handler
+):
+    """TEST Hierarchy whose build stopped sending heartbeats is not rebuilt anymore,
+    though its status stays IN_PROCESS, its deferred messages are handled
+    when hierarchies being rebuilt are checked again"""
+    create, _ = create_handler
+    handler = create(hierarchy_id=None)
+    in_process_id = hierarchies["in_process"].id
+
+    await _read_batch(handler, [_mo_message("created", {"id": 3, "tmo_id": 3})])
+    assert len(handler.deferred_groups) == 1
+
+    heartbeat_timeout = handler.router.heartbeat_timeout
+    await session.execute(
+        update(HierarchyBuildCheckpoint)
+        .where(HierarchyBuildCheckpoint.hierarchy_id == in_process_id)
+        .values(
+            heartbeat=datetime.datetime.now()
+            - datetime.timedelta(seconds=heartbeat_timeout + 1)
+        )
+    )
+    await session.commit()
+    handler.router.rebuilding_check_interval = 0
+
+    await _read_batch(handler, [])
+
+    calls = handler.msg_handler.handle_the_message.await_args_list
+    assert [call.kwargs["hierarchy_id"] for call in calls] == [in_process_id]
+    assert handler.router.rebuilding_hierarchy_ids == set()
+    assert len(handler.deferred_groups) == 0
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_hierarchy_is_rebuilt_again_if_deferred_messages_exceed_limit(
+    session: AsyncSession, hierarchies: dict[str, Hierarchy], create_handler
+):
+    """TEST Groups of hierarchy are dropped and committed when limit of deferred groups
+    is exceeded, hierarchy is ordered to be rebuilt again after its rebuild"""
+    create, _ = create_handler
+    routing_event = Event()
+    handler = create(hierarchy_id=None, routing_event=routing_event)
+    handler.deferred_groups.max_groups = 1
+    in_process = hierarchies["in_process"]
+    batch = [
+        _mo_message("created", {"id": 3, "tmo_id": 3}, offset=10),
+        _mo_message("updated", {"id": 3, "tmo_id": 3}, offset=11),
+        _mo_message("deleted", {"id": 33, "tmo_id": 3}, offset=12),
+    ]
+
+    consumer = await _read_batch(handler, batch)
+
+    assert handler.msg_handler.handle_the_message.await_count == 0
+    assert len(handler.deferred_groups) == 0
+    assert consumer.committed_offsets == [None]
+
+    in_process.status = HierarchyStatus.COMPLETE.value
+    await session.commit()
+    routing_event.set()
+
+    await _read_batch(handler, [])
+
+    assert handler.msg_handler.handle_the_message.await_count == 0
+    rebuild_order = await session.execute(select(HierarchyRebuildOrder))
+    assert [item.hierarchy_id for item in rebuild_order.scalars().all()] == [
+        in_process.id
+    ]
+    assert handler.deferred_groups.overflowed_hierarchy_ids == set()
@@ -332,7 +332,7 @@ async def test_changes_related_to_hierarch_less_than_handler_min_default_value_s
     Waits until rebuilt process will be finished. In case when the hierarchy is stuck at the recovery stage,
     trys to rebuilt it one more time."""
     spy = mocker.patch(
-        "common_utils.hierarchy_builder.HierarchyBuilder.build_hierarchy"
+        "services.hierarchy.hierarchy_builder.builder.HierarchyBuilderV2.build_hierarchy"
     )
 
     stmt = select(Hierarchy).where(Hierarchy.name == HIERARCHY_NAME_1)
@@ -503,7 +503,7 @@ async def test_changes_related_to_hierarchy_more_than_min_default_value_case_3(
     trys to rebuilt it one more time. And add this hierarchy one more time to rebuild order
     (because count of changes more than MINIMUM_CHANGES_COUNT_TO_REBUILD)"""
     spy = mocker.patch(
-        "common_utils.hierarchy_builder.HierarchyBuilder.build_hierarchy"
+        "services.hierarchy.hierarchy_builder.builder.HierarchyBuilderV2.build_hierarchy"
     )
 
     stmt = select(Hierarchy).where(Hierarchy.name == HIERARCHY_NAME_1)
@@ -0,0 +1,71 @@
+"""TESTS for views of protobuf messages"""
+
+import pytest
+
+from kafka_config.protobuf import inventory_instances_pb2
+from kafka_config.protobuf.custom_deserializer import (
+    protobuf_kafka_msg_to_dict,
+    protobuf_kafka_msg_to_view,
+)
+
+
+def _list_mo(count: int) -> inventory_instances_pb2.ListMO:
+    msg = inventory_instances_pb2.ListMO()
+    for mo_id in range(1, count + 1):
+        item = msg.objects.add(
+            id=mo_id,
+            name=f"MO {mo_id}",
+            tmo_id=1,
+            p_id=mo_id - 1,
+            active=True,
+            latitude=1.5,
+        )
+        item.pov.update({"key": "value"})
+        item.creation_date.FromSeconds(1_700_000_000)
+    return msg
+
+
+def test_view_is_equal_to_dict_with_default_value_fields():
+    """TEST View returns the same values as dict with default value fields"""
+    msg = _list_mo(2)
+
+    view = protobuf_kafka_msg_to_view(msg)
+    as_dict = protobuf_kafka_msg_to_dict(
+        msg, including_default_value_fields=True
+    )
+
+    assert view == as_dict
+    item = view["objects"][0]
+    assert item["pov"] == {"key": "value"}
+    assert item["creation_date"] == "2023-11-14T22:13:20"
+    assert item["label"] == ""
+    assert item.get("tprm_id") is None
+    assert "tmo_id" in item and "tprm_id" not in item
+    assert set(item) == set(as_dict["objects"][0])
+    with pytest.raises(KeyError):
+        item["tprm_id"]
+
+
+def test_view_converts_only_read_fields_once_and_keeps_message(mocker):
+    """TEST Fields of view are converted on the first read only, other fields
+    are not converted, view is read-only and does not change protobuf message"""
+    msg = _list_mo(2)
+    data = msg.SerializeToString()
+    serializer = mocker.patch(
+        "kafka_config.protobuf.custom_deserializer._msg_f_serializer",
+        side_effect=lambda value: value,
+    )
+
+    view = protobuf_kafka_msg_to_view(msg)
+    assert serializer.call_count == 0
+
+    item = view["objects"][0]
+    assert (item["id"], item["tmo_id"]) == (1, 1)
+    assert item["id"] == 1
+    assert serializer.call_count == 2
+    assert view["objects"][1]["id"] == 2
+    assert serializer.call_count == 3
+
+    with pytest.raises(TypeError):
+        item["id"] = 3
+    assert msg.SerializeToString() == data
@@ -0,0 +1,133 @@
+"""PUBLIC TESTS for pages of children nodes of Hierarchy object router"""
+
+from httpx import AsyncClient
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas.hier_schemas import Hierarchy, Level, Obj
+from schemas.main_base_connector import Base
+from services.hierarchy.hierarchy_builder.configs import (
+    DEFAULT_KEY_OF_NULL_NODE,
+)
+
+URL = "/api/hierarchy/v1/hierarchy"
+
+CHILD_COUNTS = {"a": 3, "b": 0, "c": 1, "d": 2, "e": 0}
+
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def hierarchy(session: AsyncSession) -> Hierarchy:
+    """Root nodes a..e, node with default key and node of level
+    which is not shown without children"""
+    hierarchy = Hierarchy(
+        name="Test hierarchy", author="Admin", create_empty_nodes=False
+    )
+    session.add(hierarchy)
+    await session.flush()
+    hidden_level = Level(
+        hierarchy_id=hierarchy.id,
+        level=1,
+        name="Hidden without children",
+        object_type_id=1,
+        param_type_id=1,
+        is_virtual=False,
+        author="Admin",
+        show_without_children=False,
+    )
+    session.add(hidden_level)
+    await session.flush()
+
+    def add_node(key, child_count, level_id=None):
+        session.add(
+            Obj(
+                key=key,
+                object_type_id=1,
+                hierarchy_id=hierarchy.id,
+                level=1,
+                level_id=level_id,
+                child_count=child_count,
+            )
+        )
+
+    for key, child_count in CHILD_COUNTS.items():
+        add_node(key, child_count)
+    add_node(DEFAULT_KEY_OF_NULL_NODE, 0)
+    add_node("hidden", 0, level_id=hidden_level.id)
+    await session.commit()
+    yield hierarchy
+
+    await session.rollback()
+    for table in reversed(Base.metadata.sorted_tables):
+        await session.execute(table.delete())
+    await session.commit()
+
+
+async def _read_pages(client: AsyncClient, url: str, **params) -> list[dict]:
+    pages = []
+    after = None
+    while True:
+        query = dict(params, **({"after": after} if after else {}))
+        res = await client.get(url, params=query)
+        assert res.status_code == 200
+        pages.append(res.json())
+        after = pages[-1]["next_cursor"]
+        if after is None:
+            return pages
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_children_are_read_by_pages_sorted_by_key(
+    private_client: AsyncClient, hierarchy: Hierarchy
+):
+    """TEST Pages of children follow each other by cursor, hidden nodes are
+    skipped and total is returned if it is requested"""
+    url = f"{URL}/{hierarchy.id}/parent/root/page"
+
+    pages = await _read_pages(private_client, url, limit=2, with_total=True)
+    pages_desc = await _read_pages(
+        private_client, url, limit=3, descending=True
+    )
+
+    assert [[node["key"] for node in page["items"]] for page in pages] == [
+        ["a", "b"],
+        ["c", "d"],
+        ["e"],
+    ]
+    assert {page["total"] for page in pages} == {5}
+    assert [node["key"] for page in pages_desc for node in page["items"]] == [
+        "e",
+        "d",
+        "c",
+        "b",
+        "a",
+    ]
+    assert pages_desc[0]["total"] is None
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_children_are_read_by_pages_sorted_by_child_count(
+    private_client: AsyncClient, hierarchy: Hierarchy
+):
+    """TEST Children are sorted by stored child_count and id"""
+    url = f"{URL}/{hierarchy.id}/parent/root/page"
+
+    pages = await _read_pages(
+        private_client, url, limit=2, sort_by="child_count", descending=True
+    )
+
+    keys = [node["key"] for page in pages for node in page["items"]]
+    assert keys[:3] == ["a", "d", "c"]
+    assert sorted(keys[3:]) == ["b", "e"]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_children_page_with_invalid_cursor_fails(
+    private_client: AsyncClient, hierarchy: Hierarchy
+):
+    """TEST Invalid cursor returns 422 error"""
+    url = f"{URL}/{hierarchy.id}/parent/root/page"
+
+    res = await private_client.get(url, params={"after": "invalid"})
+
+    assert res.status_code == 422
@@ -0,0 +1,106 @@
+import pytest
+import pytest_asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas.hier_schemas import Hierarchy, Obj
+from schemas.main_base_connector import Base
+from services.hierarchy.hierarchy_builder.utils import (
+    create_path_for_children_node_by_parent_node,
+)
+from services.node.common.update.child_count_updater import (
+    NODES_TO_UPDATE_CHILD_COUNT_KEY,
+    mark_nodes_to_update_child_count,
+    update_child_count_of_marked_nodes,
+)
+
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def nodes(session: AsyncSession) -> dict[str, Obj]:
+    """Tree of nodes with wrong child_count:
+    A -> B, C(inactive)
+    D -> E"""
+    hierarchy = Hierarchy(name="Test hierarchy", author="Admin")
+    session.add(hierarchy)
+    await session.flush()
+
+    nodes = dict()
+
+    def add_node(name, parent=None, active=True):
+        node = Obj(
+            key=name,
+            object_id=None,
+            object_type_id=1,
+            hierarchy_id=hierarchy.id,
+            level=1 if parent is None else parent.level + 1,
+            parent_id=parent.id if parent is not None else None,
+            path=create_path_for_children_node_by_parent_node(parent),
+            child_count=5,
+            active=active,
+        )
+        session.add(node)
+        nodes[name] = node
+
+    add_node("A")
+    add_node("B", nodes["A"])
+    add_node("C", nodes["A"], active=False)
+    add_node("D")
+    add_node("E", nodes["D"])
+    await session.commit()
+    yield nodes
+
+    for table in reversed(Base.metadata.sorted_tables):
+        await session.execute(table.delete())
+    await session.commit()
+
+
+async def _get_child_count(session: AsyncSession, node_id) -> int:
+    stmt = select(Obj.child_count).where(Obj.id == node_id)
+    return (await session.execute(stmt)).scalar_one()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_child_count_of_marked_nodes_is_updated_on_commit(
+    session: AsyncSession, nodes: dict[str, Obj]
+):
+    """TEST Nodes marked several times are updated once by count of active children
+    right before commit"""
+    mark_nodes_to_update_child_count(session, [nodes["A"].id, nodes["B"].id])
+    mark_nodes_to_update_child_count(session, [str(nodes["A"].id), None])
+
+    assert session.info[NODES_TO_UPDATE_CHILD_COUNT_KEY] == {
+        nodes["A"].id,
+        nodes["B"].id,
+    }
+    assert await _get_child_count(session, nodes["A"].id) == 5
+
+    await session.commit()
+
+    assert NODES_TO_UPDATE_CHILD_COUNT_KEY not in session.info
+    assert await _get_child_count(session, nodes["A"].id) == 1
+    assert await _get_child_count(session, nodes["B"].id) == 0
+    assert await _get_child_count(session, nodes["D"].id) == 5
+    # nodes of session are refreshed by returned rows
+    assert nodes["A"].child_count == 1
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_marked_nodes_are_updated_explicitly_and_forgotten_on_rollback(
+    session: AsyncSession, nodes: dict[str, Obj]
+):
+    """TEST Marked nodes are updated without commit by explicit call
+    and are not updated after rollback"""
+    a_id, d_id = nodes["A"].id, nodes["D"].id
+    mark_nodes_to_update_child_count(session, [d_id])
+    updated_nodes = await update_child_count_of_marked_nodes(session)
+
+    assert [node.id for node in updated_nodes] == [d_id]
+    assert await _get_child_count(session, d_id) == 1
+    assert await update_child_count_of_marked_nodes(session) == []
+
+    mark_nodes_to_update_child_count(session, [a_id])
+    await session.rollback()
+    await session.commit()
+
+    assert await _get_child_count(session, a_id) == 5
+    assert await _get_child_count(session, d_id) == 5
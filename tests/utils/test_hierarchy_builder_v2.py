@@ -0,0 +1,1064 @@
+from array import array
+import datetime
+import sys
+from unittest.mock import AsyncMock
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import event, func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas.enum_models import HierarchyStatus
+from schemas.hier_schemas import (
+    Hierarchy,
+    HierarchyBuildCheckpoint,
+    Level,
+    NodeData,
+    Obj,
+    default_uuid,
+)
+from schemas.main_base_connector import Base
+from services.hierarchy.hierarchy_builder import inventory_snapshot
+from services.hierarchy.hierarchy_builder.builder import HierarchyBuilderV2
+from services.hierarchy.hierarchy_builder.caches import CachedNode, NodesCache
+from services.hierarchy.hierarchy_builder.checkpoints import (
+    get_stalled_hierarchy_ids,
+)
+from services.hierarchy.hierarchy_builder.configs import (
+    DEFAULT_KEY_OF_NULL_NODE,
+    NodesWriteMode,
+)
+from services.hierarchy.hierarchy_builder.pipeline import PrefetchedChunks
+from services.hierarchy.hierarchy_builder.process_pool import (
+    HierarchyBuilderProcessPool,
+    create_hierarchical_level_plan,
+)
+from services.hierarchy.hierarchy_builder.scheduler import (
+    HierarchyRebuildScheduler,
+)
+from services.hierarchy.hierarchy_builder.shadow_tables import (
+    HierarchyShadowTables,
+)
+from services.session_utils.listeners.enum_models import SessionDataKeys
+
+
+def _mo(mo_id: int, tmo_id: int, p_id: int = 0, active=True, **params):
+    res = {
+        "id": mo_id,
+        "name": f"MO {mo_id}",
+        "tmo_id": tmo_id,
+        "p_id": p_id,
+        "active": active,
+        "latitude": float(mo_id),
+        "longitude": None,
+        "status": "status",
+    }
+    res.update(params)
+    return res
+
+
+INVENTORY_DB = {
+    # real level
+    1: [_mo(1, 1), _mo(2, 1), _mo(3, 1, active=False)],
+    # simple virtual level
+    2: [
+        _mo(11, 2, p_id=1, **{"10": "A"}),
+        _mo(12, 2, p_id=1, **{"10": "A"}),
+        _mo(13, 2, p_id=2, **{"10": "B"}),
+        _mo(14, 2, p_id=2, active=False, **{"10": "B"}),
+        _mo(15, 2, p_id=3),
+    ],
+    # hierarchical virtual level
+    3: [
+        _mo(21, 3, p_id=1, **{"11": "Root", "12": 0}),
+        _mo(22, 3, p_id=1, **{"11": "Child", "12": 21}),
+        _mo(23, 3, p_id=1, **{"11": "Child", "12": 22}),
+        _mo(24, 3, p_id=2, active=False, **{"11": "Other", "12": 21}),
+    ],
+}
+
+
+@pytest_asyncio.fixture(loop_scope="session", autouse=True)
+async def session_fixture(session: AsyncSession, mocker, mock_grpc_response):
+    hierarchy = Hierarchy(name="Test hierarchy", author="Admin")
+    session.add(hierarchy)
+    await session.flush()
+    level_1 = Level(
+        hierarchy_id=hierarchy.id,
+        name="Real level",
+        level=1,
+        object_type_id=1,
+        is_virtual=False,
+        key_attrs=["name"],
+        author="Admin",
+    )
+    session.add(level_1)
+    await session.flush()
+    level_2 = Level(
+        hierarchy_id=hierarchy.id,
+        name="Virtual level",
+        level=2,
+        object_type_id=2,
+        is_virtual=True,
+        key_attrs=["10"],
+        author="Admin",
+        parent_id=level_1.id,
+    )
+    level_3 = Level(
+        hierarchy_id=hierarchy.id,
+        name="Hierarchical virtual level",
+        level=2,
+        object_type_id=3,
+        is_virtual=True,
+        key_attrs=["11"],
+        attr_as_parent=12,
+        author="Admin",
+        parent_id=level_1.id,
+    )
+    session.add_all([level_2, level_3])
+    await session.commit()
+
+    async def mocked_async_generator(channel, tmo_id, tprm_ids):
+        yield INVENTORY_DB[tmo_id]
+
+    mocker.patch(
+        "services.hierarchy.hierarchy_builder.inventory_snapshot.get_all_mo_with_special_params_by_tmo_id",
+        side_effect=mocked_async_generator,
+    )
+    for module in ("builder", "inventory_snapshot"):
+        mocker.patch(
+            f"services.hierarchy.hierarchy_builder.{module}.get_mo_links_tprms",
+            new=AsyncMock(return_value=[]),
+        )
+    yield hierarchy
+
+
+@pytest_asyncio.fixture(loop_scope="session", autouse=True)
+async def clean_test_data(session: AsyncSession):
+    yield
+    await session.rollback()
+    for table in reversed(Base.metadata.sorted_tables):
+        await session.execute(table.delete())
+    await session.commit()
+
+
+async def _build_and_get_hierarchy_state(
+    session: AsyncSession,
+    hierarchy_id: int,
+    nodes_write_mode: NodesWriteMode,
+    **builder_kwargs,
+):
+    """Builds hierarchy and returns its nodes and node data without generated ids"""
+    builder = HierarchyBuilderV2(
+        db_session=session,
+        hierarchy_id=hierarchy_id,
+        nodes_write_mode=nodes_write_mode,
+        **builder_kwargs,
+    )
+    await builder.build_hierarchy()
+    session.expunge_all()
+
+    nodes = await session.execute(
+        select(Obj).where(Obj.hierarchy_id == hierarchy_id)
+    )
+    nodes = {node.id: node for node in nodes.scalars().all()}
+
+    def node_identity(node_id):
+        node = nodes.get(node_id)
+        if node is None:
+            return None
+        return node.level_id, node.key, node.object_id, node.active
+
+    nodes_state = sorted(
+        (
+            node_identity(node.id),
+            node_identity(node.parent_id),
+            tuple(
+                node_identity(node_id)
+                for node_id in node.path.split("/")
+                if node_id
+            )
+            if node.path
+            else None,
+            node.child_count,
+            node.key_is_empty,
+            node.additional_params,
+            node.latitude,
+            node.longitude,
+            node.object_type_id,
+            node.level,
+        )
+        for node in nodes.values()
+    )
+    node_data = await session.execute(
+        select(NodeData).where(NodeData.node_id.in_(list(nodes)))
+    )
+    node_data_state = sorted(
+        (
+            node_identity(item.node_id),
+            item.level_id,
+            item.mo_id,
+            item.mo_name,
+            item.mo_latitude,
+            item.mo_p_id,
+            item.mo_active,
+            tuple(sorted(item.unfolded_key.items())),
+        )
+        for item in node_data.scalars().all()
+    )
+    return nodes_state, node_data_state
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_copy_nodes_writer_builds_same_hierarchy_as_orm_writer(
+    session: AsyncSession, session_fixture: Hierarchy
+):
+    """TEST Hierarchy built with COPY has the same nodes and node data as hierarchy built by the unit of work"""
+    hierarchy_id = session_fixture.id
+    orm_nodes, orm_node_data = await _build_and_get_hierarchy_state(
+        session, hierarchy_id, NodesWriteMode.ORM
+    )
+    copy_nodes, copy_node_data = await _build_and_get_hierarchy_state(
+        session, hierarchy_id, NodesWriteMode.COPY
+    )
+
+    assert len(orm_nodes) == 11
+    assert len(orm_node_data) == 12
+    assert copy_nodes == orm_nodes
+    assert copy_node_data == orm_node_data
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_copy_nodes_writer_counts_only_active_children(
+    session: AsyncSession, session_fixture: Hierarchy
+):
+    """TEST child_count of nodes built with COPY includes only active children"""
+    hierarchy_id = session_fixture.id
+    builder = HierarchyBuilderV2(
+        db_session=session,
+        hierarchy_id=hierarchy_id,
+        nodes_write_mode=NodesWriteMode.COPY,
+    )
+    await builder.build_hierarchy()
+    session.expunge_all()
+
+    stmt = select(Obj.object_id, Obj.child_count).where(
+        Obj.hierarchy_id == hierarchy_id, Obj.object_id.in_([1, 2, 21, 22])
+    )
+    res = await session.execute(stmt)
+    assert dict(res.all()) == {1: 2, 2: 1, 21: 1, 22: 1}
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_shadow_copy_nodes_writer_builds_same_hierarchy_as_orm_writer(
+    session: AsyncSession, session_fixture: Hierarchy
+):
+    """TEST Hierarchy built in shadow tables has the same nodes and node data as hierarchy built by the unit of work.
+    Shadow tables are dropped after the build."""
+    hierarchy_id = session_fixture.id
+    orm_nodes, orm_node_data = await _build_and_get_hierarchy_state(
+        session, hierarchy_id, NodesWriteMode.ORM
+    )
+    shadow_nodes, shadow_node_data = await _build_and_get_hierarchy_state(
+        session, hierarchy_id, NodesWriteMode.SHADOW_COPY
+    )
+
+    assert shadow_nodes == orm_nodes
+    assert shadow_node_data == orm_node_data
+
+    res = await session.execute(
+        text("SELECT to_regclass(:table_name)"),
+        {"table_name": f"obj_shadow_{hierarchy_id}"},
+    )
+    assert res.scalar() is None
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_shadow_copy_nodes_writer_keeps_old_nodes_while_building(
+    session: AsyncSession,
+    session_fixture: Hierarchy,
+    async_session_maker,
+    mocker,
+):
+    """TEST Old nodes of hierarchy are available for other sessions until the hierarchy built in shadow tables"""
+    hierarchy_id = session_fixture.id
+    await HierarchyBuilderV2(
+        db_session=session, hierarchy_id=hierarchy_id
+    ).build_hierarchy()
+    res = await session.execute(
+        select(func.count(Obj.id)).where(Obj.hierarchy_id == hierarchy_id)
+    )
+    old_nodes_count = res.scalar()
+
+    nodes_count_while_building = []
+
+    async def mocked_async_generator(channel, tmo_id, tprm_ids):
+        async with async_session_maker() as reader_session:
+            res = await reader_session.execute(
+                select(func.count(Obj.id)).where(
+                    Obj.hierarchy_id == hierarchy_id
+                )
+            )
+            nodes_count_while_building.append(res.scalar())
+        yield INVENTORY_DB[tmo_id]
+
+    mocker.patch(
+        "services.hierarchy.hierarchy_builder.inventory_snapshot.get_all_mo_with_special_params_by_tmo_id",
+        side_effect=mocked_async_generator,
+    )
+    await HierarchyBuilderV2(
+        db_session=session,
+        hierarchy_id=hierarchy_id,
+        nodes_write_mode=NodesWriteMode.SHADOW_COPY,
+    ).build_hierarchy()
+
+    assert nodes_count_while_building == [old_nodes_count] * 3
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_shadow_copy_nodes_writer_produces_created_events_after_swap(
+    session: AsyncSession, session_fixture: Hierarchy, mocker
+):
+    """TEST Messages about nodes built in shadow tables are produced by commits
+    after the swap and contain all swapped nodes and node data"""
+    hierarchy_id = session_fixture.id
+    for module in ("writers", "shadow_tables"):
+        mocker.patch(
+            f"services.hierarchy.hierarchy_builder.{module}.session_events_are_listened",
+            return_value=True,
+        )
+    swap = HierarchyShadowTables.swap
+    swap_is_started = False
+
+    async def spied_swap(self, session):
+        nonlocal swap_is_started
+        swap_is_started = True
+        await swap(self, session)
+
+    mocker.patch.object(HierarchyShadowTables, "swap", spied_swap)
+    created = {"Obj": [], "NodeData": []}
+    created_before_swap = []
+
+    def receive_after_commit(sync_session):
+        data = sync_session.info.pop(SessionDataKeys.NEW.value, dict())
+        sync_session.info.pop(SessionDataKeys.DIRTY.value, None)
+        if data and not swap_is_started:
+            created_before_swap.append(data)
+        for class_name, items in data.items():
+            created[class_name].extend(items)
+
+    event.listen(session.sync_session, "after_commit", receive_after_commit)
+    try:
+        await HierarchyBuilderV2(
+            db_session=session,
+            hierarchy_id=hierarchy_id,
+            nodes_write_mode=NodesWriteMode.SHADOW_COPY,
+        ).build_hierarchy()
+    finally:
+        event.remove(session.sync_session, "after_commit", receive_after_commit)
+
+    res = await session.execute(
+        select(Obj.id).where(Obj.hierarchy_id == hierarchy_id)
+    )
+    node_ids = {str(node_id) for node_id in res.scalars().all()}
+    assert created_before_swap == []
+    assert {item["id"] for item in created["Obj"]} == node_ids
+    assert {item["node_id"] for item in created["NodeData"]} <= node_ids
+    assert len(created["NodeData"]) == 12
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_prefetched_chunks_keeps_order_and_counts_stats():
+    """TEST PrefetchedChunks returns all chunks of source in the same order and counts them"""
+
+    async def source():
+        for i in range(10):
+            yield [i] * i
+
+    prefetched_chunks = PrefetchedChunks(source(), queue_depth=2).start()
+    res = [chunk async for chunk in prefetched_chunks]
+
+    assert res == [[i] * i for i in range(10)]
+    assert prefetched_chunks.stats.chunks == 10
+    assert prefetched_chunks.stats.items == 45
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_prefetched_chunks_raises_error_of_source():
+    """TEST PrefetchedChunks raises error of source after chunks received before the error"""
+
+    async def source():
+        yield [1]
+        raise ValueError("Stream error")
+
+    res = []
+    with pytest.raises(ValueError, match="Stream error"):
+        async for chunk in PrefetchedChunks(source(), queue_depth=2):
+            res.append(chunk)
+    assert res == [[1]]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_builder_with_prefetching_builds_same_hierarchy_as_without(
+    session: AsyncSession, session_fixture: Hierarchy
+):
+    """TEST Hierarchy built with prefetching of Inventory chunks is the same as hierarchy built without it"""
+    hierarchy_id = session_fixture.id
+
+    async def build_and_get_nodes(pipeline_queue_depth: int):
+        builder = HierarchyBuilderV2(
+            db_session=session,
+            hierarchy_id=hierarchy_id,
+            nodes_write_mode=NodesWriteMode.COPY,
+            pipeline_queue_depth=pipeline_queue_depth,
+        )
+        await builder.build_hierarchy()
+        session.expunge_all()
+        res = await session.execute(
+            select(Obj.level_id, Obj.key, Obj.object_id, Obj.child_count)
+            .where(Obj.hierarchy_id == hierarchy_id)
+            .order_by(Obj.level_id, Obj.key, Obj.object_id)
+        )
+        return res.all(), builder.levels_pipeline_stats
+
+    nodes_without_prefetching, stats = await build_and_get_nodes(0)
+    assert stats == {}
+    nodes_with_prefetching, stats = await build_and_get_nodes(1)
+    assert nodes_with_prefetching == nodes_without_prefetching
+    assert sorted(level_stats.items for level_stats in stats.values()) == [
+        3,
+        4,
+        5,
+    ]
+
+
+def test_hierarchical_level_plan_creates_parents_before_children():
+    """TEST Items of hierarchical level are ordered so that parent goes before its children.
+    Items whose parent is not in level get parent from parent level."""
+    plan = create_hierarchical_level_plan(
+        array("q", [4, 3, 2, 1, 5]),
+        array("q", [3, 2, 1, 0, 100]),
+        ["11"],
+        [["d", "c", "b", "a", None]],
+        [],
+    )
+
+    assert list(plan.order) == [3, 4, 2, 1, 0]
+    assert list(plan.parent_indexes) == [-1, -1, 3, 2, 1]
+    assert plan.keys == ["d", "c", "b", "a", DEFAULT_KEY_OF_NULL_NODE]
+    assert list(plan.keys_are_empty) == [0, 0, 0, 0, 1]
+
+
+def test_hierarchical_level_plan_breaks_circles_by_least_id():
+    """TEST Circle of items of hierarchical level is created starting from item with the least id"""
+    plan = create_hierarchical_level_plan(
+        array("q", [7, 5, 6]),
+        array("q", [6, 7, 5]),
+        ["11"],
+        [["a", "b", "c"]],
+        [],
+    )
+
+    assert list(plan.order) == [1, 2, 0]
+    assert list(plan.parent_indexes) == [-1, 1, 2]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_builder_groups_hierarchical_level_in_process_pool(
+    session: AsyncSession, session_fixture: Hierarchy
+):
+    """TEST Hierarchy built with grouping of hierarchical level in worker process is the same
+    as hierarchy built with grouping in the event loop process"""
+    hierarchy_id = session_fixture.id
+
+    async def build_and_get_nodes(process_pool_min_items: int):
+        builder = HierarchyBuilderV2(
+            db_session=session,
+            hierarchy_id=hierarchy_id,
+            nodes_write_mode=NodesWriteMode.COPY,
+        )
+        builder.process_pool_min_items = process_pool_min_items
+        await builder.build_hierarchy()
+        session.expunge_all()
+        res = await session.execute(
+            select(Obj.level_id, Obj.key, Obj.object_id, Obj.child_count)
+            .where(Obj.hierarchy_id == hierarchy_id)
+            .order_by(Obj.level_id, Obj.key, Obj.object_id)
+        )
+        return res.all()
+
+    nodes_without_pool = await build_and_get_nodes(10**9)
+    try:
+        nodes_with_pool = await build_and_get_nodes(0)
+    finally:
+        HierarchyBuilderProcessPool().shutdown()
+    assert nodes_with_pool == nodes_without_pool
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_builder_in_daemon_process_does_not_use_process_pool(
+    session: AsyncSession, session_fixture: Hierarchy, mocker
+):
+    """TEST Builder of consumer process, which is daemonic and is not allowed
+    to have children, groups hierarchical level in the event loop process"""
+    mocker.patch(
+        "services.hierarchy.hierarchy_builder.process_pool.multiprocessing.current_process",
+        return_value=mocker.Mock(daemon=True),
+    )
+    run = mocker.spy(HierarchyBuilderProcessPool, "run")
+    builder = HierarchyBuilderV2(
+        db_session=session,
+        hierarchy_id=session_fixture.id,
+        nodes_write_mode=NodesWriteMode.COPY,
+    )
+    builder.process_pool_min_items = 0
+
+    await builder.build_hierarchy()
+
+    run.assert_not_called()
+    assert await _get_all_nodes_ids(session, session_fixture.id)
+
+
+async def _get_nodes_ids_by_object_id(session: AsyncSession, hierarchy_id):
+    res = await session.execute(
+        select(Obj.object_id, Obj.key, Obj.id).where(
+            Obj.hierarchy_id == hierarchy_id
+        )
+    )
+    return {(object_id, key): node_id for object_id, key, node_id in res.all()}
+
+
+async def _get_all_nodes_ids(session: AsyncSession, hierarchy_id) -> set[str]:
+    res = await session.execute(
+        select(Obj.id).where(Obj.hierarchy_id == hierarchy_id)
+    )
+    return {str(node_id) for node_id in res.scalars().all()}
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_diff_nodes_writer_keeps_not_changed_hierarchy(
+    session: AsyncSession, session_fixture: Hierarchy
+):
+    """TEST Rebuild in diff mode of not changed hierarchy writes nothing and keeps ids of nodes"""
+    hierarchy_id = session_fixture.id
+    orm_nodes, orm_node_data = await _build_and_get_hierarchy_state(
+        session, hierarchy_id, NodesWriteMode.ORM
+    )
+    nodes_ids_before = await _get_nodes_ids_by_object_id(session, hierarchy_id)
+
+    builder = HierarchyBuilderV2(
+        db_session=session,
+        hierarchy_id=hierarchy_id,
+        nodes_write_mode=NodesWriteMode.DIFF,
+    )
+    await builder.build_hierarchy()
+    session.expunge_all()
+
+    assert builder.nodes_changes_stats == {
+        "inserted": 0,
+        "updated": 0,
+        "deleted": 0,
+    }
+    assert (
+        await _get_nodes_ids_by_object_id(session, hierarchy_id)
+        == nodes_ids_before
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_diff_nodes_writer_writes_only_changes(
+    session: AsyncSession, session_fixture: Hierarchy, mocker
+):
+    """TEST Rebuild in diff mode after Inventory changes gives the same hierarchy as full rebuild.
+    Nodes whose place in hierarchy is not changed keep their ids."""
+    hierarchy_id = session_fixture.id
+    await _build_and_get_hierarchy_state(
+        session, hierarchy_id, NodesWriteMode.ORM
+    )
+    nodes_ids_before = await _get_nodes_ids_by_object_id(session, hierarchy_id)
+    all_ids_before = await _get_all_nodes_ids(session, hierarchy_id)
+
+    changed_inventory_db = {
+        # MO 2 deleted
+        1: [_mo(1, 1), _mo(3, 1, active=False)],
+        2: [
+            _mo(11, 2, p_id=1, **{"10": "A"}),
+            # key of virtual node changed
+            _mo(12, 2, p_id=1, **{"10": "C"}),
+            _mo(15, 2, p_id=3),
+        ],
+        3: [
+            _mo(21, 3, p_id=1, **{"11": "Root", "12": 0}),
+            # became not active
+            _mo(22, 3, p_id=1, active=False, **{"11": "Child", "12": 21}),
+            _mo(23, 3, p_id=1, **{"11": "Child", "12": 22}),
+        ],
+    }
+
+    async def mocked_async_generator(channel, tmo_id, tprm_ids):
+        yield changed_inventory_db[tmo_id]
+
+    mocker.patch(
+        "services.hierarchy.hierarchy_builder.inventory_snapshot.get_all_mo_with_special_params_by_tmo_id",
+        side_effect=mocked_async_generator,
+    )
+
+    mocker.patch(
+        "services.hierarchy.hierarchy_builder.shadow_tables.session_events_are_listened",
+        return_value=True,
+    )
+    events = {key: {"Obj": [], "NodeData": []} for key in SessionDataKeys}
+
+    def receive_after_commit(sync_session):
+        for key in SessionDataKeys:
+            data = sync_session.info.pop(key.value, dict())
+            for class_name, items in data.items():
+                events[key][class_name].extend(items)
+
+    event.listen(session.sync_session, "after_commit", receive_after_commit)
+    try:
+        diff_nodes, diff_node_data = await _build_and_get_hierarchy_state(
+            session, hierarchy_id, NodesWriteMode.DIFF
+        )
+    finally:
+        event.remove(session.sync_session, "after_commit", receive_after_commit)
+    nodes_ids_after = await _get_nodes_ids_by_object_id(session, hierarchy_id)
+    all_ids_after = await _get_all_nodes_ids(session, hierarchy_id)
+    orm_nodes, orm_node_data = await _build_and_get_hierarchy_state(
+        session, hierarchy_id, NodesWriteMode.ORM
+    )
+
+    assert diff_nodes == orm_nodes
+    assert diff_node_data == orm_node_data
+    for not_changed_node in [
+        (1, "MO 1"),
+        (3, "MO 3"),
+        (None, "A"),
+        (None, DEFAULT_KEY_OF_NULL_NODE),
+        (21, "Root"),
+        (22, "Child"),
+        (23, "Child"),
+    ]:
+        assert (
+            nodes_ids_after[not_changed_node]
+            == nodes_ids_before[not_changed_node]
+        )
+    assert (2, "MO 2") not in nodes_ids_after
+    assert (None, "C") in nodes_ids_after
+    # messages are produced only about changed nodes
+    created_ids = {item["id"] for item in events[SessionDataKeys.NEW]["Obj"]}
+    deleted_ids = {
+        item["id"] for item in events[SessionDataKeys.DELETED]["Obj"]
+    }
+    assert created_ids == all_ids_after - all_ids_before
+    assert deleted_ids == all_ids_before - all_ids_after
+    assert events[SessionDataKeys.DIRTY]["Obj"]
+
+
+def test_nodes_cache_is_spilled_into_file_over_memory_budget(tmp_path):
+    """TEST Nodes cache is moved into sqlite file when it exceeds memory budget
+    and returns the same nodes after that. File is removed by close."""
+    nodes = {
+        mo_id: CachedNode(id=default_uuid(), path=f"{mo_id % 3}/")
+        for mo_id in range(1, 101)
+    }
+    cache = NodesCache(memory_budget=4096, spill_dir=str(tmp_path))
+    for mo_id, node in nodes.items():
+        cache.add(mo_id, node)
+
+    assert cache.is_spilled
+    assert 0 < cache.peak_memory_size <= 4096 * 2
+    assert len(cache) == 100
+    assert all(cache.get(mo_id) == node for mo_id, node in nodes.items())
+    assert cache.get(101) is None
+    assert len(list(tmp_path.iterdir())) == 1
+
+    cache.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_nodes_cache_shares_paths_of_siblings():
+    """TEST Nodes cache keeps one path for all nodes with the same parent"""
+    parent_path = f"{default_uuid()}/"
+    siblings_cache = NodesCache(memory_budget=1024 * 1024)
+    cache = NodesCache(memory_budget=1024 * 1024)
+    for mo_id in range(1, 1001):
+        siblings_cache.add(
+            mo_id, CachedNode(id=default_uuid(), path=parent_path)
+        )
+        cache.add(
+            mo_id, CachedNode(id=default_uuid(), path=f"{default_uuid()}/")
+        )
+
+    assert not siblings_cache.is_spilled
+    assert siblings_cache.get(500).path is parent_path
+    assert (
+        siblings_cache.memory_size + 999 * sys.getsizeof(parent_path)
+        < cache.memory_size
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+@pytest.mark.parametrize(
+    "nodes_write_mode", [NodesWriteMode.ORM, NodesWriteMode.COPY]
+)
+async def test_builder_with_spilled_caches_builds_same_hierarchy(
+    session: AsyncSession,
+    session_fixture: Hierarchy,
+    nodes_write_mode: NodesWriteMode,
+    tmp_path,
+    mocker,
+    monkeypatch,
+):
+    """TEST Hierarchy built with caches moved into files is the same as hierarchy built in memory.
+    Files of caches are removed after the build."""
+    hierarchy_id = session_fixture.id
+    nodes, node_data = await _build_and_get_hierarchy_state(
+        session, hierarchy_id, nodes_write_mode
+    )
+
+    monkeypatch.setenv("hierarchy_builder_cache_spill_dir", str(tmp_path))
+    spill_spy = mocker.spy(NodesCache, "_spill")
+    spilled_nodes, spilled_node_data = await _build_and_get_hierarchy_state(
+        session, hierarchy_id, nodes_write_mode, cache_memory_budget=0
+    )
+
+    assert spilled_nodes == nodes
+    assert spilled_node_data == node_data
+    assert spill_spy.call_count == 3
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_builder_reports_peak_cache_memory_of_levels(
+    session: AsyncSession, session_fixture: Hierarchy
+):
+    """TEST Peak memory of nodes caches is reported for every level"""
+    hierarchy_id = session_fixture.id
+    builder = HierarchyBuilderV2(
+        db_session=session,
+        hierarchy_id=hierarchy_id,
+        nodes_write_mode=NodesWriteMode.COPY,
+    )
+    await builder.build_hierarchy()
+
+    levels = await session.execute(
+        select(Level.id)
+        .where(Level.hierarchy_id == hierarchy_id)
+        .order_by(Level.level)
+    )
+    levels_ids = levels.scalars().all()
+    assert list(builder.levels_cache_peak_memory) == levels_ids
+    assert all(
+        peak_memory > 0
+        for peak_memory in builder.levels_cache_peak_memory.values()
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_refresh_all_hierarchies_rebuilds_hierarchies_by_scheduler(
+    session: AsyncSession, session_fixture: Hierarchy
+):
+    """TEST All hierarchies are rebuilt by scheduler, every one in its own session,
+    and get status Complete"""
+    # router imports security modules, which are patched by fixtures of routers tests
+    from routers.hierarchy_object_router import refresh_all_hierarchies
+
+    second_hierarchy = Hierarchy(name="Second test hierarchy", author="Admin")
+    session.add(second_hierarchy)
+    await session.flush()
+    session.add(
+        Level(
+            hierarchy_id=second_hierarchy.id,
+            name="Real level",
+            level=1,
+            object_type_id=1,
+            is_virtual=False,
+            key_attrs=["name"],
+            author="Admin",
+        )
+    )
+    await session.commit()
+
+    res = await refresh_all_hierarchies(session=session)
+
+    assert res == {"details": "Completed"}
+    # MO of TMO used by both hierarchies are read from Inventory once
+    requested_tmo_ids = [
+        call.kwargs["tmo_id"]
+        for call in inventory_snapshot.get_all_mo_with_special_params_by_tmo_id.call_args_list
+    ]
+    assert sorted(requested_tmo_ids) == [1, 2, 3]
+    session.expunge_all()
+    hierarchies = await session.execute(select(Hierarchy))
+    assert {hierarchy.status for hierarchy in hierarchies.scalars().all()} == {
+        HierarchyStatus.COMPLETE.value
+    }
+    count_of_nodes = await session.execute(
+        select(Obj.hierarchy_id, func.count(Obj.id)).group_by(Obj.hierarchy_id)
+    )
+    assert dict(count_of_nodes.all()) == {
+        session_fixture.id: 11,
+        second_hierarchy.id: 3,
+    }
+    queue = {
+        state["hierarchy_id"]: state
+        for state in HierarchyRebuildScheduler().get_tasks_state()
+    }
+    assert queue[session_fixture.id]["built_levels_count"] == 3
+    assert queue[second_hierarchy.id]["levels_count"] == 1
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_refresh_all_hierarchies_sets_statuses_of_tasks_scheduled_before(
+    session: AsyncSession, session_fixture: Hierarchy
+):
+    """TEST Hierarchies queued for rebuild before the refresh by other build
+    function, which does not change statuses, get status by results of their tasks"""
+    from fastapi import HTTPException
+
+    from routers.hierarchy_object_router import refresh_all_hierarchies
+
+    failed_hierarchy = Hierarchy(name="Failed test hierarchy", author="Admin")
+    session.add(failed_hierarchy)
+    await session.commit()
+    complete_hierarchy_id = session_fixture.id
+    failed_hierarchy_id = failed_hierarchy.id
+
+    async def build_from_order(task):
+        if task.hierarchy_id == failed_hierarchy_id:
+            raise ValueError("Hierarchy was not rebuilt from order")
+
+    scheduler = HierarchyRebuildScheduler()
+    for hierarchy_id in (complete_hierarchy_id, failed_hierarchy_id):
+        scheduler.add(
+            hierarchy_id=hierarchy_id, build_function=build_from_order
+        )
+
+    with pytest.raises(HTTPException) as exc_info:
+        await refresh_all_hierarchies(session=session)
+
+    assert str(failed_hierarchy_id) in exc_info.value.detail
+    session.expunge_all()
+    statuses = await session.execute(select(Hierarchy.id, Hierarchy.status))
+    assert dict(statuses.all()) == {
+        complete_hierarchy_id: HierarchyStatus.COMPLETE.value,
+        failed_hierarchy_id: HierarchyStatus.ERROR.value,
+    }
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_failed_build_releases_levels_of_shared_snapshots(
+    session: AsyncSession, session_fixture: Hierarchy, mocker
+):
+    """TEST Levels registered in shared inventory snapshots for scheduled build
+    are released when the build fails, so their snapshots are not kept"""
+    hierarchy_id = session_fixture.id
+    levels = await session.execute(
+        select(Level).where(Level.hierarchy_id == hierarchy_id)
+    )
+    cache = inventory_snapshot.InventorySnapshotCache()
+    readers = cache.register_levels(levels.scalars().all())
+    assert sum(readers.values()) == 3
+
+    mocker.patch.object(
+        HierarchyBuilderV2,
+        "_create_nodes_by_level_data",
+        side_effect=ConnectionError("Inventory is not available"),
+    )
+    builder = HierarchyBuilderV2(
+        db_session=session,
+        hierarchy_id=hierarchy_id,
+        inventory_snapshot_cache=cache,
+        inventory_snapshot_readers=readers,
+    )
+    with pytest.raises(ConnectionError):
+        await builder.build_hierarchy()
+    await session.rollback()
+
+    assert readers == {}
+    assert not any(cache._readers_count.values())
+    assert cache._snapshots == {}
+    await cache.close()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+@pytest.mark.parametrize(
+    "nodes_write_mode",
+    [
+        NodesWriteMode.ORM,
+        NodesWriteMode.COPY,
+        NodesWriteMode.SHADOW_COPY,
+        NodesWriteMode.DIFF,
+    ],
+)
+async def test_resumed_build_builds_same_hierarchy(
+    session: AsyncSession,
+    session_fixture: Hierarchy,
+    nodes_write_mode: NodesWriteMode,
+    mocker,
+):
+    """TEST Build stopped on the last level is resumed from its checkpoint:
+    completed levels are not built again and hierarchy is the same as built at once.
+    Checkpoint is deleted after the build."""
+    hierarchy_id = session_fixture.id
+    nodes, node_data = await _build_and_get_hierarchy_state(
+        session, hierarchy_id, nodes_write_mode
+    )
+    levels = await session.execute(
+        select(Level)
+        .where(Level.hierarchy_id == hierarchy_id)
+        .order_by(Level.level, Level.id)
+    )
+    levels = levels.scalars().all()
+    stopped_level = levels[-1]
+
+    create_nodes = HierarchyBuilderV2._create_nodes_by_level_data
+    is_stopped = True
+
+    async def create_nodes_until_stop(builder, level, res_async_generator):
+        if is_stopped and level.id == stopped_level.id:
+            raise ConnectionError("Inventory is not available")
+        await create_nodes(builder, level, res_async_generator)
+
+    patched = mocker.patch.object(
+        HierarchyBuilderV2,
+        "_create_nodes_by_level_data",
+        autospec=True,
+        side_effect=create_nodes_until_stop,
+    )
+    builder = HierarchyBuilderV2(
+        db_session=session,
+        hierarchy_id=hierarchy_id,
+        nodes_write_mode=nodes_write_mode,
+    )
+    with pytest.raises(ConnectionError):
+        await builder.build_hierarchy()
+    await session.rollback()
+    checkpoint = await session.get(HierarchyBuildCheckpoint, hierarchy_id)
+    assert checkpoint.completed_level_ids == [level.id for level in levels[:-1]]
+    assert checkpoint.completed_levels_nodes_counts == [
+        len([node for node in nodes if node[0][0] == level.id])
+        for level in levels[:-1]
+    ]
+
+    is_stopped = False
+    patched.reset_mock()
+    resumed_nodes, resumed_node_data = await _build_and_get_hierarchy_state(
+        session, hierarchy_id, nodes_write_mode, resume=True
+    )
+
+    assert [call.args[1].id for call in patched.call_args_list] == [
+        stopped_level.id
+    ]
+    assert resumed_nodes == nodes
+    assert resumed_node_data == node_data
+    assert await session.get(HierarchyBuildCheckpoint, hierarchy_id) is None
+
+
+@pytest.mark.asyncio(loop_scope="session")
+@pytest.mark.parametrize(
+    "nodes_write_mode", [NodesWriteMode.SHADOW_COPY, NodesWriteMode.DIFF]
+)
+async def test_build_is_not_resumed_if_shadow_tables_are_truncated(
+    session: AsyncSession,
+    session_fixture: Hierarchy,
+    nodes_write_mode: NodesWriteMode,
+    mocker,
+):
+    """TEST Build is restarted from scratch instead of resume if nodes of completed levels
+    are lost from unlogged shadow tables, which are truncated by crash recovery of database"""
+    hierarchy_id = session_fixture.id
+    nodes, node_data = await _build_and_get_hierarchy_state(
+        session, hierarchy_id, nodes_write_mode
+    )
+    levels = await session.execute(
+        select(Level)
+        .where(Level.hierarchy_id == hierarchy_id)
+        .order_by(Level.level, Level.id)
+    )
+    levels_ids = [level.id for level in levels.scalars().all()]
+
+    create_nodes = HierarchyBuilderV2._create_nodes_by_level_data
+    is_stopped = True
+
+    async def create_nodes_until_stop(builder, level, res_async_generator):
+        if is_stopped and level.id == levels_ids[-1]:
+            raise ConnectionError("Inventory is not available")
+        await create_nodes(builder, level, res_async_generator)
+
+    patched = mocker.patch.object(
+        HierarchyBuilderV2,
+        "_create_nodes_by_level_data",
+        autospec=True,
+        side_effect=create_nodes_until_stop,
+    )
+    builder = HierarchyBuilderV2(
+        db_session=session,
+        hierarchy_id=hierarchy_id,
+        nodes_write_mode=nodes_write_mode,
+    )
+    with pytest.raises(ConnectionError):
+        await builder.build_hierarchy()
+    await session.rollback()
+    shadow_tables = HierarchyShadowTables(hierarchy_id)
+    await session.execute(
+        text(
+            f"TRUNCATE {shadow_tables.obj_table_name}, "
+            f"{shadow_tables.node_data_table_name}"
+        )
+    )
+    await session.commit()
+
+    is_stopped = False
+    patched.reset_mock()
+    resumed_nodes, resumed_node_data = await _build_and_get_hierarchy_state(
+        session, hierarchy_id, nodes_write_mode, resume=True
+    )
+
+    assert [call.args[1].id for call in patched.call_args_list] == levels_ids
+    assert resumed_nodes == nodes
+    assert resumed_node_data == node_data
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_stalled_hierarchy_ids_returns_builds_without_heartbeat(
+    session: AsyncSession, session_fixture: Hierarchy
+):
+    """TEST Builds are stalled if they have not sent heartbeat for timeout
+    or have not been started"""
+    alive_hierarchy = Hierarchy(name="Alive hierarchy", author="Admin")
+    not_started_hierarchy = Hierarchy(name="Not started", author="Admin")
+    session.add_all([alive_hierarchy, not_started_hierarchy])
+    await session.flush()
+    now = datetime.datetime.now()
+    session.add_all(
+        [
+            HierarchyBuildCheckpoint(
+                hierarchy_id=session_fixture.id,
+                nodes_write_mode=NodesWriteMode.ORM.value,
+                heartbeat=now - datetime.timedelta(seconds=600),
+            ),
+            HierarchyBuildCheckpoint(
+                hierarchy_id=alive_hierarchy.id,
+                nodes_write_mode=NodesWriteMode.ORM.value,
+                heartbeat=now,
+            ),
+        ]
+    )
+    await session.commit()
+
+    stalled_hierarchy_ids = await get_stalled_hierarchy_ids(
+        session=session,
+        hierarchy_ids=[
+            session_fixture.id,
+            alive_hierarchy.id,
+            not_started_hierarchy.id,
+        ],
+        heartbeat_timeout=300,
+    )
+
+    assert stalled_hierarchy_ids == {
+        session_fixture.id,
+        not_started_hierarchy.id,
+    }
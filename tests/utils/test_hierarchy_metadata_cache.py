@@ -0,0 +1,112 @@
+"""TESTS for cache of metadata of hierarchies"""
+
+import pytest
+import pytest_asyncio
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas.hier_schemas import Hierarchy, Level
+from schemas.main_base_connector import Base
+from services.hierarchy.metadata.cache import HierarchyMetadataCache
+
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def hierarchy(session: AsyncSession) -> Hierarchy:
+    """Real top level with virtual child level"""
+    hierarchy = Hierarchy(name="Test hierarchy", author="Admin")
+    session.add(hierarchy)
+    await session.flush()
+    top_level = Level(
+        hierarchy_id=hierarchy.id,
+        level=1,
+        name="Top",
+        object_type_id=1,
+        param_type_id=1,
+        is_virtual=False,
+        author="Admin",
+    )
+    session.add(top_level)
+    await session.flush()
+    session.add(
+        Level(
+            hierarchy_id=hierarchy.id,
+            parent_id=top_level.id,
+            level=2,
+            name="Child",
+            object_type_id=2,
+            param_type_id=2,
+            is_virtual=True,
+            author="Admin",
+            show_without_children=False,
+        )
+    )
+    await session.commit()
+    yield hierarchy
+
+    await session.rollback()
+    for table in reversed(Base.metadata.sorted_tables):
+        await session.execute(table.delete())
+    await session.commit()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_metadata_is_loaded_once_per_version(
+    session: AsyncSession, hierarchy: Hierarchy, mocker
+):
+    """TEST Metadata is not selected again until levels are committed"""
+    cache = HierarchyMetadataCache()
+    metadata = await cache.get(hierarchy.id, session)
+
+    top_level_id = metadata.child_level_ids[None][0]
+    child_level = metadata.get_child_levels([top_level_id])[0]
+    assert metadata.object_type_ids == {1, 2}
+    assert metadata.virtual_level_ids == {child_level.id}
+    assert metadata.real_level_ids == {top_level_id}
+    assert metadata.level_ids_shown_only_with_children == {child_level.id}
+    assert metadata.get_child_levels([None]) == []
+    assert await cache.get(hierarchy.id + 1, session) is None
+
+    execute = mocker.spy(session, "execute")
+    assert await cache.get(hierarchy.id, session) is metadata
+    assert execute.call_count == 0
+
+    cache.increase_version()
+    assert await cache.get(hierarchy.id, session) is not metadata
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_committed_changes_of_levels_invalidate_metadata(
+    session: AsyncSession, hierarchy: Hierarchy
+):
+    """TEST Version is increased by commit of changed levels and by commit of
+    bulk update of levels, it is not increased by rolled back changes"""
+    hierarchy_id = hierarchy.id
+    cache = HierarchyMetadataCache()
+    # listeners of sessions increase version of module cache
+    module_cache = "services.hierarchy.metadata.cache.hierarchy_metadata_cache"
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(module_cache, cache)
+        metadata = await cache.get(hierarchy_id, session)
+        level_id = next(iter(metadata.levels_by_id))
+        level = await session.get(Level, level_id)
+
+        level.name = "Rolled back"
+        await session.flush()
+        await session.rollback()
+        assert await cache.get(hierarchy_id, session) is metadata
+
+        level = await session.get(Level, level_id)
+        level.name = "Renamed"
+        await session.commit()
+        metadata = await cache.get(hierarchy_id, session)
+        assert metadata.levels_by_id[level_id].name == "Renamed"
+
+        await session.execute(
+            update(Level)
+            .where(Level.hierarchy_id == hierarchy_id)
+            .values(show_without_children=True)
+        )
+        await session.commit()
+        metadata = await cache.get(hierarchy_id, session)
+
+    assert metadata.level_ids_shown_only_with_children == set()
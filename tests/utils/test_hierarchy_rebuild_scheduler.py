@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+from services.hierarchy.hierarchy_builder.scheduler import (
+    HierarchyRebuildScheduler,
+    HierarchyRebuildTask,
+    RebuildTaskStatus,
+)
+from services.meta_singleton.impl import SingletonMeta
+
+
+@pytest.fixture(autouse=True)
+def new_scheduler():
+    SingletonMeta._instances.pop(HierarchyRebuildScheduler, None)
+    yield
+    SingletonMeta._instances.pop(HierarchyRebuildScheduler, None)
+
+
+def test_scheduler_max_workers_are_limited_by_budgets():
+    """TEST Count of concurrent builds is limited by db connections and Inventory streams budgets"""
+    scheduler = HierarchyRebuildScheduler(
+        max_concurrent_builds=10,
+        db_connections_budget=6,
+        inventory_streams_budget=8,
+    )
+    scheduler.inventory_streams_per_build = 2
+    assert scheduler.max_workers == 4
+
+    scheduler.db_connections_budget = 3
+    assert scheduler.max_workers == 3
+
+    scheduler.inventory_streams_budget = 1
+    assert scheduler.max_workers == 1
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_scheduler_runs_builds_concurrently_within_budget():
+    """TEST Scheduler runs not more builds at once than budgets allow"""
+    scheduler = HierarchyRebuildScheduler(
+        max_concurrent_builds=2,
+        db_connections_budget=10,
+        inventory_streams_budget=10,
+    )
+    running = set()
+    max_running = 0
+
+    async def build(task: HierarchyRebuildTask):
+        nonlocal max_running
+        running.add(task.hierarchy_id)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.01)
+        running.discard(task.hierarchy_id)
+
+    tasks = await scheduler.rebuild(
+        hierarchy_ids=[1, 2, 3, 4, 5], build_function=build
+    )
+
+    assert max_running == 2
+    assert all(task.status == RebuildTaskStatus.COMPLETE for task in tasks)
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_scheduler_starts_builds_by_priority_and_reports_queue():
+    """TEST Builds with less priority are started first. Queued builds have queue positions
+    and errors of builds do not stop other builds."""
+    scheduler = HierarchyRebuildScheduler(
+        max_concurrent_builds=1,
+        db_connections_budget=1,
+        inventory_streams_budget=2,
+    )
+    started = []
+    queue_states = []
+
+    async def build(task: HierarchyRebuildTask):
+        started.append(task.hierarchy_id)
+        queue_states.append(
+            {
+                state["hierarchy_id"]: state["queue_position"]
+                for state in scheduler.get_tasks_state()
+            }
+        )
+        task.on_level_built(1, 2)
+        if task.hierarchy_id == 2:
+            raise ValueError("build error")
+
+    tasks = await scheduler.rebuild(
+        hierarchy_ids=[1, 2, 3],
+        build_function=build,
+        priorities={1: 300, 2: 10, 3: 20},
+    )
+
+    assert started == [2, 3, 1]
+    assert queue_states[0] == {1: 2, 2: None, 3: 1}
+    assert queue_states[1] == {1: 1, 2: None, 3: None}
+    tasks_by_hierarchy_id = {task.hierarchy_id: task for task in tasks}
+    assert tasks_by_hierarchy_id[2].status == RebuildTaskStatus.ERROR
+    assert tasks_by_hierarchy_id[2].error == "build error"
+    assert tasks_by_hierarchy_id[1].status == RebuildTaskStatus.COMPLETE
+    assert tasks_by_hierarchy_id[1].built_levels_count == 1
+    assert tasks_by_hierarchy_id[1].levels_count == 2
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_scheduler_does_not_queue_hierarchy_twice():
+    """TEST Hierarchy which is queued or being rebuilt is not queued again"""
+    scheduler = HierarchyRebuildScheduler(
+        max_concurrent_builds=1,
+        db_connections_budget=1,
+        inventory_streams_budget=2,
+    )
+    builds_count = 0
+
+    async def build(task: HierarchyRebuildTask):
+        nonlocal builds_count
+        builds_count += 1
+        await asyncio.sleep(0.01)
+
+    first_rebuild = asyncio.create_task(
+        scheduler.rebuild(hierarchy_ids=[1], build_function=build)
+    )
+    await asyncio.sleep(0)
+    second_tasks = await scheduler.rebuild(
+        hierarchy_ids=[1], build_function=build
+    )
+    first_tasks = await first_rebuild
+
+    assert builds_count == 1
+    assert first_tasks[0] is second_tasks[0]
@@ -0,0 +1,136 @@
+import pytest
+
+from schemas.hier_schemas import Level
+from services.hierarchy.hierarchy_builder.inventory_snapshot import (
+    ColumnarChunk,
+    InventorySnapshotCache,
+)
+
+INVENTORY_DB = {
+    1: [
+        [
+            {"id": 1, "name": "MO 1", "p_id": None, "10": "a", "11": "x"},
+            {"id": 2, "name": "MO 2", "p_id": 1, "10": "b"},
+        ],
+        [{"id": 3, "name": "MO 3", "p_id": 1, "10": None, "11": "y"}],
+    ],
+    2: [[{"id": 4, "name": "MO 4"}]],
+}
+
+
+@pytest.fixture
+def inventory_requests(mocker):
+    requests = []
+
+    async def mocked_async_generator(channel, tmo_id, tprm_ids):
+        requests.append((tmo_id, tprm_ids))
+        for chunk in INVENTORY_DB[tmo_id]:
+            yield [dict(item) for item in chunk]
+
+    mocker.patch(
+        "services.hierarchy.hierarchy_builder.inventory_snapshot.get_all_mo_with_special_params_by_tmo_id",
+        side_effect=mocked_async_generator,
+    )
+    return requests
+
+
+def _level(object_type_id: int, key_attrs: list[str]) -> Level:
+    return Level(
+        hierarchy_id=1,
+        name="Level",
+        level=1,
+        object_type_id=object_type_id,
+        is_virtual=False,
+        key_attrs=key_attrs,
+        author="Admin",
+    )
+
+
+async def _read_all(chunks) -> list[dict]:
+    return [item async for chunk in chunks for item in chunk]
+
+
+def test_columnar_chunk_returns_same_items():
+    """TEST Columnar chunk returns items equal to source items,
+    absent keys are not added to items"""
+    items = INVENTORY_DB[1][0]
+    chunk = ColumnarChunk(items)
+
+    assert len(chunk) == 2
+    assert chunk.to_items() == items
+    assert "11" not in chunk.to_items()[1]
+    assert chunk.to_items()[0] is not chunk.to_items()[0]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_snapshot_cache_reads_tmo_of_several_levels_once(
+    inventory_requests,
+):
+    """TEST MO of TMO used by several levels are read once with parameters of all levels"""
+    cache = InventorySnapshotCache()
+    readers = cache.register_levels(
+        [_level(1, ["10"]), _level(1, ["11", "name"])]
+    )
+
+    first_chunks = cache.get_chunks(tmo_id=1, tprm_ids=[10], readers=readers)
+    second_chunks = cache.get_chunks(tmo_id=1, tprm_ids=[11], readers=readers)
+    first_items = await _read_all(first_chunks)
+    second_items = await _read_all(second_chunks)
+    await cache.close()
+
+    assert inventory_requests == [(1, [10, 11])]
+    expected_items = [item for chunk in INVENTORY_DB[1] for item in chunk]
+    assert first_items == expected_items
+    assert second_items == expected_items
+    assert first_items[0] is not second_items[0]
+    assert cache.stats == {"inventory_streams": 1, "served_from_snapshot": 1}
+    # snapshot is released after all registered levels have read it
+    assert cache._snapshots == {}
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_snapshot_cache_streams_tmo_of_one_level(inventory_requests):
+    """TEST MO of TMO used by one level or by not registered levels are streamed without snapshot"""
+    cache = InventorySnapshotCache()
+    readers = cache.register_levels([_level(1, ["10"])])
+
+    items = await _read_all(
+        cache.get_chunks(tmo_id=1, tprm_ids=[10], readers=readers)
+    )
+    not_registered_items = await _read_all(
+        cache.get_chunks(tmo_id=2, tprm_ids=[])
+    )
+    await cache.close()
+
+    assert inventory_requests == [(1, [10]), (2, [0])]
+    assert len(items) == 3
+    assert not_registered_items == [{"id": 4, "name": "MO 4"}]
+    assert cache.stats == {"inventory_streams": 2, "served_from_snapshot": 0}
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_snapshot_cache_releases_levels_of_failed_build(
+    inventory_requests,
+):
+    """TEST Snapshot is closed when levels which have not read it are released
+    by failed build, levels of other builds keep their registration"""
+    cache = InventorySnapshotCache()
+    failed_build_readers = cache.register_levels(
+        [_level(1, ["10"]), _level(1, ["11"]), _level(2, [])]
+    )
+    other_build_readers = cache.register_levels([_level(2, [])])
+
+    chunks = cache.get_chunks(
+        tmo_id=1, tprm_ids=[10], readers=failed_build_readers
+    )
+    assert len(await anext(chunks)) == 2
+    snapshot = cache._snapshots[1]
+    await chunks.aclose()
+    await cache.release_levels(failed_build_readers)
+
+    assert failed_build_readers == {}
+    assert cache._snapshots == {}
+    assert snapshot.is_complete
+    assert dict(cache._readers_count) == {2: 1}
+    assert other_build_readers == {2: 1}
+    await cache.close()
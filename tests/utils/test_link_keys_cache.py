@@ -0,0 +1,182 @@
+"""TESTS for cache of names of linked MOs and values of linked PRMs"""
+
+import time
+
+from prometheus_client import REGISTRY
+import pytest
+
+from services.link_keys import cache as cache_module
+from services.link_keys.cache import (
+    LinkKeysCache,
+    TTLLRUCache,
+    get_invalidated_link_keys,
+    publish_link_keys_invalidations,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_items_expire_and_least_recently_used_are_dropped():
+    """TEST Item is missing after ttl, the least recently used item is dropped
+    when cache is full"""
+    clock = FakeClock()
+    cache = TTLLRUCache(max_size=2, ttl=10, clock=clock)
+    cache.set(1, "a")
+    cache.set(2, "b")
+    assert cache.get(1) == "a"
+
+    cache.set(3, "c")
+
+    assert cache.get(2) is None
+    assert (cache.get(1), cache.get(3)) == ("a", "c")
+
+    clock.now = 10
+    assert cache.get(1) is None
+    assert len(cache) == 1
+
+
+def test_ids_of_updated_and_deleted_mos_and_prms_are_invalidated():
+    """TEST Created objects and objects of other classes do not invalidate cache"""
+    messages = [
+        ("MO", "updated", {"objects": [{"id": 1}, {"id": 2}]}),
+        ("MO", "created", {"objects": [{"id": 3}]}),
+        ("PRM", "deleted", {"objects": [{"id": 10, "tprm_id": 5}]}),
+        ("TMO", "updated", {"objects": [{"id": 20}]}),
+    ]
+
+    assert get_invalidated_link_keys(messages) == ([1, 2], [10])
+
+
+class FakeMOResponse:
+    def __init__(self, mo_ids):
+        self.list_of_mo = [
+            type("MO", (), {"id": mo_id, "name": f"MO {mo_id}", "tmo_id": 7})
+            for mo_id in mo_ids
+        ]
+
+
+class FakePRMResponse:
+    def __init__(self, prm_ids):
+        self.list_of_prm = [
+            type("PRM", (), {"id": prm_id, "value": f"value {prm_id}"})
+            for prm_id in prm_ids
+        ]
+
+
+def _get_value(kind: str, result: str) -> float:
+    return (
+        REGISTRY.get_sample_value(
+            "hierarchy_link_keys_cache_requests_total",
+            {"kind": kind, "result": result},
+        )
+        or 0.0
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_link_keys_are_requested_from_inventory_once(mocker):
+    """TEST Cached ids are not requested from Inventory again, ids invalidated by
+    consumer are requested again, not found ids are missing in results"""
+    requested = []
+
+    async def get_mo_data_by_mo_ids(channel, mo_ids):
+        requested.append(("mo", sorted(mo_ids)))
+        yield FakeMOResponse([mo_id for mo_id in mo_ids if mo_id != 404])
+
+    async def get_mo_prm_data_by_prm_ids(channel, prm_ids):
+        requested.append(("prm", sorted(prm_ids)))
+        yield FakePRMResponse(prm_ids)
+
+    mocker.patch(
+        "services.link_keys.cache.get_mo_data_by_mo_ids",
+        side_effect=get_mo_data_by_mo_ids,
+    )
+    mocker.patch(
+        "services.link_keys.cache.get_mo_prm_data_by_prm_ids",
+        side_effect=get_mo_prm_data_by_prm_ids,
+    )
+    cache = LinkKeysCache(max_size=100, ttl=60)
+    hits_before = _get_value("mo", "hit")
+
+    mo_data, prm_values = await cache.get_mo_data_and_prm_values(
+        mo_ids=[1, 2, 404], prm_ids=[10]
+    )
+    assert mo_data == {
+        1: {"name": "MO 1", "id": 1, "tmo_id": 7},
+        2: {"name": "MO 2", "id": 2, "tmo_id": 7},
+    }
+    assert prm_values == {10: "value 10"}
+
+    await cache.get_mo_data_and_prm_values(mo_ids=[1, 2], prm_ids=[10])
+    assert _get_value("mo", "hit") - hits_before == 2
+
+    publish_link_keys_invalidations(
+        cache.get_invalidations(),
+        [("MO", "updated", {"objects": [{"id": 2}]})],
+    )
+    # queue delivers items by background thread
+    deadline = time.monotonic() + 5
+    while not cache.apply_invalidations() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    mo_data, _ = await cache.get_mo_data_and_prm_values(
+        mo_ids=[1, 2], prm_ids=[]
+    )
+
+    assert mo_data[2]["name"] == "MO 2"
+    assert requested == [("mo", [1, 2, 404]), ("prm", [10]), ("mo", [2])]
+
+
+def _apply_invalidations(cache: LinkKeysCache, count: int) -> int:
+    # queue delivers items by background thread
+    applied = 0
+    deadline = time.monotonic() + 5
+    while applied < count and time.monotonic() < deadline:
+        applied += cache.apply_invalidations()
+        time.sleep(0.01)
+    return applied
+
+
+def test_ids_are_sent_once_and_overflow_of_queue_clears_cache(mocker):
+    """TEST Repeated ids are sent once, all queued invalidations are applied by one
+    call. If queue is full, whole cache is cleared by the next call"""
+    mocker.patch.object(cache_module, "MAX_QUEUED_INVALIDATIONS", 2)
+    cache = LinkKeysCache(max_size=100, ttl=60)
+    invalidations = cache.get_invalidations()
+    for mo_id in (1, 2, 3):
+        cache.mo_data.set(mo_id, {"id": mo_id})
+
+    messages = [
+        ("MO", "updated", {"objects": [{"id": 1}, {"id": 1}]}),
+        ("MO", "deleted", {"objects": [{"id": 1}]}),
+    ]
+    publish_link_keys_invalidations(invalidations, messages)
+    assert invalidations.queue.get(timeout=5) == ([1], [])
+
+    publish_link_keys_invalidations(invalidations, messages)
+    publish_link_keys_invalidations(
+        invalidations, [("MO", "updated", {"objects": [{"id": 2}]})]
+    )
+    assert _apply_invalidations(cache, count=2) == 2
+    assert (cache.mo_data.get(1), cache.mo_data.get(2)) == (None, None)
+    assert cache.mo_data.get(3) == {"id": 3}
+    assert not invalidations.overflowed.is_set()
+
+    for mo_id in (1, 2, 3):
+        cache.mo_data.set(mo_id, {"id": mo_id})
+    for mo_id in (1, 2, 3):
+        publish_link_keys_invalidations(
+            invalidations, [("MO", "updated", {"objects": [{"id": mo_id}]})]
+        )
+    assert invalidations.overflowed.is_set()
+
+    cache.apply_invalidations()
+
+    assert not invalidations.overflowed.is_set()
+    assert len(cache.mo_data) == 0
@@ -0,0 +1,279 @@
+import pytest
+import pytest_asyncio
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from common_utils.node_manipulator import NodeManipulator
+from routers.hierarchy_object.utills.utils import (
+    get_child_mo_ids_for_nodes_ids,
+    get_child_mo_ids_for_nodes_ids_consider_default_key,
+)
+from routers.utility_checks import (
+    create_tree_from_parent,
+    create_tree_from_parent_node,
+)
+from schemas.hier_schemas import Hierarchy, Obj
+from schemas.main_base_connector import Base
+from services.hierarchy.hierarchy_builder.configs import (
+    DEFAULT_KEY_OF_NULL_NODE,
+)
+from services.hierarchy.hierarchy_builder.utils import (
+    create_path_for_children_node_by_parent_node,
+    get_ancestor_ids_by_path,
+)
+from services.node.common.ancestors import (
+    get_breadcrumbs_of_nodes,
+    get_short_chain_of_ancestors,
+)
+
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def nodes(session: AsyncSession) -> dict[str, Obj]:
+    """Tree of nodes:
+    A(1) -> B(virtual) -> C(3), D(4)
+    A(1) -> E(virtual with default key) -> F(6)
+    A(1) -> G(7 with default key)
+    H(8) -> I(9)"""
+    hierarchy = Hierarchy(name="Test hierarchy", author="Admin")
+    session.add(hierarchy)
+    await session.flush()
+
+    nodes = dict()
+
+    def add_node(name, object_id, parent=None, key=None):
+        node = Obj(
+            key=key or name,
+            object_id=object_id,
+            object_type_id=1,
+            hierarchy_id=hierarchy.id,
+            level=1 if parent is None else parent.level + 1,
+            parent_id=parent.id if parent is not None else None,
+            path=create_path_for_children_node_by_parent_node(parent),
+            child_count=0,
+        )
+        session.add(node)
+        nodes[name] = node
+        return node
+
+    add_node("A", 1)
+    add_node("B", None, nodes["A"])
+    add_node("C", 3, nodes["B"])
+    add_node("D", 4, nodes["B"])
+    add_node("E", None, nodes["A"], key=DEFAULT_KEY_OF_NULL_NODE)
+    add_node("F", 6, nodes["E"])
+    add_node("G", 7, nodes["A"], key=DEFAULT_KEY_OF_NULL_NODE)
+    add_node("H", 8)
+    add_node("I", 9, nodes["H"])
+    await session.commit()
+    yield nodes
+
+    for table in reversed(Base.metadata.sorted_tables):
+        await session.execute(table.delete())
+    await session.commit()
+
+
+def test_get_ancestor_ids_by_path(nodes: dict[str, Obj]):
+    """TEST Ids of ancestors are returned from root to parent"""
+    assert get_ancestor_ids_by_path(nodes["A"].path) == []
+    assert get_ancestor_ids_by_path(nodes["C"].path) == [
+        nodes["A"].id,
+        nodes["B"].id,
+    ]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_child_mo_ids_for_nodes_ids_by_paths(
+    session: AsyncSession, nodes: dict[str, Obj]
+):
+    """TEST MO ids of all descendants are returned for every node"""
+    res = await get_child_mo_ids_for_nodes_ids(
+        node_ids=[nodes["A"].id, nodes["H"].id, nodes["F"].id],
+        session=session,
+    )
+
+    assert {node_id: sorted(mo_ids) for node_id, mo_ids in res.items()} == {
+        nodes["A"].id: [3, 4, 6, 7],
+        nodes["H"].id: [9],
+        nodes["F"].id: [],
+    }
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_get_child_mo_ids_not_considering_nodes_with_default_key(
+    session: AsyncSession, nodes: dict[str, Obj]
+):
+    """TEST Nodes with default key and their descendants are skipped
+    if consider_nodes_with_default_key is False"""
+    res = await get_child_mo_ids_for_nodes_ids_consider_default_key(
+        node_ids=[nodes["A"].id, nodes["E"].id],
+        session=session,
+        consider_nodes_with_default_key=False,
+    )
+
+    assert {node_id: sorted(mo_ids) for node_id, mo_ids in res.items()} == {
+        nodes["A"].id: [3, 4],
+        nodes["E"].id: [6],
+    }
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_full_chain_of_parent_nodes_by_path(
+    session: AsyncSession, nodes: dict[str, Obj]
+):
+    """TEST Breadcrumbs are ordered from root to node"""
+    chain = await NodeManipulator(
+        nodes["C"], session
+    ).get_full_chain_of_parent_nodes()
+    root_chain = await NodeManipulator(
+        nodes["H"], session
+    ).get_full_chain_of_parent_nodes()
+
+    assert [node.id for node in chain] == [
+        nodes["A"].id,
+        nodes["B"].id,
+        nodes["C"].id,
+    ]
+    assert [node.id for node in root_chain] == [nodes["H"].id]
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_breadcrumbs_of_many_nodes_by_one_query(
+    session: AsyncSession, nodes: dict[str, Obj]
+):
+    """TEST Breadcrumbs of every node are returned from root to node"""
+    breadcrumbs = await get_breadcrumbs_of_nodes(
+        [nodes["C"], nodes["F"], nodes["H"]], session
+    )
+
+    assert {
+        node_id: [node.key for node in chain]
+        for node_id, chain in breadcrumbs.items()
+    } == {
+        nodes["C"].id: ["A", "B", "C"],
+        nodes["F"].id: ["A", DEFAULT_KEY_OF_NULL_NODE, "F"],
+        nodes["H"].id: ["H"],
+    }
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_short_chain_of_ancestors_by_path(
+    session: AsyncSession, nodes: dict[str, Obj]
+):
+    """TEST Ancestors are returned from parent up to the nearest real one"""
+    assert [
+        node.key
+        for node in await get_short_chain_of_ancestors(nodes["C"], session)
+    ] == ["B", "A"]
+    assert [
+        node.key
+        for node in await get_short_chain_of_ancestors(nodes["B"], session)
+    ] == ["A"]
+    assert await get_short_chain_of_ancestors(nodes["A"], session) == []
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_create_tree_from_parent_by_path(
+    session: AsyncSession, nodes: dict[str, Obj]
+):
+    """TEST Tree of all descendants of node is created"""
+
+    def tree_keys(tree):
+        if tree is None:
+            return None
+        return sorted(
+            (node.object_id or 0, tree_keys(node.child)) for node in tree
+        )
+
+    tree = await create_tree_from_parent(nodes["A"].id, session)
+
+    assert tree_keys(tree) == [
+        (0, [(3, None), (4, None)]),
+        (0, [(6, None)]),
+        (7, None),
+    ]
+    assert await create_tree_from_parent(nodes["I"].id, session) == []
+
+
+def _tree_keys(tree):
+    if tree is None:
+        return None
+    return sorted(
+        (node.key, node.child_count, node.truncated, _tree_keys(node.child))
+        for node in tree
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_create_tree_from_parent_node_by_one_query(
+    session: AsyncSession, nodes: dict[str, Obj]
+):
+    """TEST Tree of descendants of node is loaded, nodes with default key
+    are skipped and not counted in child_count if they are not considered"""
+    counts = {"B": 2, "E": 1, "H": 1}
+    for name, child_count in counts.items():
+        nodes[name].child_count = child_count
+    nodes["A"].child_count = 3
+    await session.flush()
+
+    tree, is_truncated = await create_tree_from_parent_node(nodes["A"], session)
+    tree_without_default, _ = await create_tree_from_parent_node(
+        nodes["A"], session, consider_nodes_with_default_key=False
+    )
+
+    assert _tree_keys(tree) == [
+        ("B", 2, False, [("C", 0, False, None), ("D", 0, False, None)]),
+        (DEFAULT_KEY_OF_NULL_NODE, 0, False, None),
+        (DEFAULT_KEY_OF_NULL_NODE, 1, False, [("F", 0, False, None)]),
+    ]
+    assert _tree_keys(tree_without_default) == [
+        ("B", 2, False, [("C", 0, False, None), ("D", 0, False, None)]),
+    ]
+    assert is_truncated is False
+    assert nodes["A"].child_count == 1
+    assert await create_tree_from_parent_node(nodes["C"], session) == (
+        [],
+        False,
+    )
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_create_tree_from_parent_node_is_truncated(
+    session: AsyncSession, nodes: dict[str, Obj]
+):
+    """TEST Tree is cut by max depth and max count of nodes, if children of node
+    are more than max count of nodes, first of them are returned and are truncated"""
+    for name, child_count in {"A": 3, "B": 2, "E": 1}.items():
+        nodes[name].child_count = child_count
+    await session.flush()
+
+    by_depth, by_depth_is_truncated = await create_tree_from_parent_node(
+        nodes["A"], session, max_depth=1
+    )
+    by_nodes, by_nodes_is_truncated = await create_tree_from_parent_node(
+        nodes["A"], session, max_nodes=5
+    )
+    (
+        all_children,
+        all_children_are_truncated,
+    ) = await create_tree_from_parent_node(nodes["A"], session, max_nodes=3)
+    (
+        first_children,
+        first_children_are_truncated,
+    ) = await create_tree_from_parent_node(nodes["A"], session, max_nodes=2)
+
+    expected = [
+        ("B", 2, True, None),
+        (DEFAULT_KEY_OF_NULL_NODE, 0, False, None),
+        (DEFAULT_KEY_OF_NULL_NODE, 1, True, None),
+    ]
+    assert _tree_keys(by_depth) == expected
+    assert _tree_keys(by_nodes) == expected
+    assert _tree_keys(all_children) == expected
+    assert not any(
+        (
+            by_depth_is_truncated,
+            by_nodes_is_truncated,
+            all_children_are_truncated,
+        )
+    )
+    assert first_children_are_truncated is True
+    assert len(first_children) == 2